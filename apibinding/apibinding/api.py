@@ -9,6 +9,8 @@ import time
 from zstacklib.utils import jsonobject
 from zstacklib.utils import log
 from zstacklib.utils import http
+from zstacklib.utils import thread
+import completion
 import inventory
 
 logger = log.get_logger(__name__)
@@ -18,6 +20,48 @@ class ApiError(Exception):
     ''' Api failure '''
 
 
+class ApiFuture(object):
+    '''
+    the pending result of an async API call, result() returns (name, event)
+    '''
+
+    def __init__(self, api, apicmd, future, exception_on_error, timeout, mask_result):
+        self.api = api
+        self.apicmd = apicmd
+        self.future = future
+        self.exception_on_error = exception_on_error
+        self.timeout = timeout
+        self.mask_result = mask_result
+        self.start = time.time()
+
+    def done(self):
+        return self.future.done()
+
+    def wait(self, timeout=None):
+        return self.future.wait(timeout)
+
+    def result(self, timeout=None):
+        '''
+        `timeout` in seconds, the timeout of the API message by default
+        '''
+        if timeout is None:
+            timeout = max(0, self.start + float(self.timeout) / 1000 - time.time())
+        if not self.future.wait(timeout):
+            raise ApiError('API call[%s] timeout after %dms' % (self.apicmd.FULL_NAME, (time.time() - self.start) * 1000))
+
+        rsp = self.future.result()
+        logger.debug("async call[url: %s, response: %s] after %dms" % (
+            self.api.api_url, self.mask_result(rsp.result), (time.time() - self.start) * 1000))
+        return self.api._unpack_event(rsp, self.exception_on_error)
+
+
+def wait_all(futures, timeout=None):
+    '''
+    wait for many async API calls, return (done, not_done) lists of ApiFuture
+    '''
+    return completion.wait_all(futures, timeout)
+
+
 class Api(object):
     '''
     classdocs
@@ -39,8 +83,23 @@ class Api(object):
         if not port:
             port = 8080
 
+        self.host = host
+        self.port = port
         self.api_url = http.build_url(('http', host, port, api_path))
         self.api_result_url = http.build_url(('http', host, port, result_path))
+        self.result_listener = None
+
+    def enable_result_listener(self, listener=None):
+        '''
+        wait for the results of async calls through a local listener, which
+        polls them all from one thread and takes the results the management
+        node posts to it
+        '''
+        if listener is None:
+            listener = completion.ResultListener(callback_host=completion.get_local_ip_to(self.host, self.port))
+            listener.start()
+        self.result_listener = listener
+        return listener
 
     def _get_response(self, ret_uuid):
         url = '%s%s' % (self.api_result_url, ret_uuid)
@@ -99,7 +158,14 @@ class Api(object):
             logger.warn(
                 'Logout session[uuid:%s] failed because %s' % (session_uuid, self._error_code_to_string(reply.error)))
 
-    def async_call_wait_for_complete(self, apicmd, apievent=None, exception_on_error=True, interval=500, fail_soon=False):
+    def _unpack_event(self, rsp, exception_on_error):
+        reply = jsonobject.loads(rsp.result)
+        (name, event) = (reply.__dict__.items()[0])
+        if exception_on_error and not event.success:
+            raise ApiError('API call[%s] failed because %s' % (name, self._error_code_to_string(event.error)))
+        return name, event
+
+    def _post_async_call(self, apicmd, apievent, fail_soon, headers):
         def mask_result(result):
             event_name, event_str = result[1:-1].split(':', 1)
             log_event = log.mask_sensitive_field(apievent, event_str)
@@ -110,35 +176,43 @@ class Api(object):
         if not timeout:
             timeout = 1800000
         cmd = {apicmd.FULL_NAME: apicmd}
-        log_cmd = '{"%s": "%s"}' % (apicmd.FULL_NAME, log.mask_sensitive_field(apicmd, jsonobject.dumps(apicmd)))
-        logger.debug("async call[url: %s, request: %s]" % (self.api_url, log_cmd))
-        jstr = http.json_dump_post(self.api_url, cmd, fail_soon=fail_soon)
-        rsp = jsonobject.loads(jstr)
+        log_cmd = log.Lazy(lambda: log.mask_json(jsonobject.dumps(apicmd), log.get_sensitive_paths(apicmd)))
+        logger.debug('async call[url: %s, request: {"%s": "%s"}]', self.api_url, apicmd.FULL_NAME, log_cmd)
+        jstr = http.json_dump_post(self.api_url, cmd, headers, fail_soon=fail_soon)
+        return jsonobject.loads(jstr), timeout, mask_result
+
+    def async_call(self, apicmd, apievent=None, exception_on_error=True, fail_soon=False):
+        '''
+        send an async API call and return an ApiFuture without waiting, the
+        result is polled or received by the result listener
+        '''
+        if self.result_listener is None:
+            self.enable_result_listener()
+
+        headers = {http.CALLBACK_URI: self.result_listener.url()}
+        rsp, timeout, mask_result = self._post_async_call(apicmd, apievent, fail_soon, headers)
+        if rsp.state == 'Done':
+            future = thread.Future()
+            future.set_result(rsp)
+        else:
+            future = self.result_listener.expect(rsp.uuid, self._get_response)
+        return ApiFuture(self, apicmd, future, exception_on_error, timeout, mask_result)
+
+    def async_call_wait_for_complete(self, apicmd, apievent=None, exception_on_error=True, interval=500, fail_soon=False):
+        if self.result_listener is not None:
+            return self.async_call(apicmd, apievent, exception_on_error, fail_soon).result()
+
+        rsp, timeout, mask_result = self._post_async_call(apicmd, apievent, fail_soon, {})
         if rsp.state == 'Done':
             logger.debug("async call[url: %s, response: %s]" % (self.api_url, mask_result(rsp.result)))
-            reply = jsonobject.loads(rsp.result)
-            (name, event) = (reply.__dict__.items()[0])
-            if exception_on_error and not event.success:
-                raise ApiError('API call[%s] failed because %s' % (name, self._error_code_to_string(event.error)))
-            return name, event
-
-        curr = 0
-        finterval = float(float(interval) / float(1000))
-        ret_uuid = rsp.uuid
-        while rsp.state != 'Done' and curr < timeout:
-            time.sleep(finterval)
-            rsp = self._get_response(ret_uuid)
-            curr += interval
+            return self._unpack_event(rsp, exception_on_error)
 
+        rsp, curr = completion.poll_until_done(self._get_response, rsp, interval, timeout)
         if curr >= timeout:
             raise ApiError('API call[%s] timeout after %dms' % (apicmd.FULL_NAME, curr))
 
         logger.debug("async call[url: %s, response: %s] after %dms" % (self.api_url, mask_result(rsp.result), curr))
-        reply = jsonobject.loads(rsp.result)
-        (name, event) = (reply.__dict__.items()[0])
-        if exception_on_error and not event.success:
-            raise ApiError('API call[%s] failed because %s' % (name, self._error_code_to_string(event.error)))
-        return name, event
+        return self._unpack_event(rsp, exception_on_error)
 
     def sync_call(self, apicmd, exception_on_error=True, fail_soon=False):
         self._check_not_none_field(apicmd)
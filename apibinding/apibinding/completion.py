@@ -0,0 +1,209 @@
+'''
+
+completion of async API calls.
+
+The polling way asks the management node for the job result every interval.
+ResultListener polls the jobs of many calls from one thread at the same
+interval, and is also a local http endpoint whose url goes with the API
+call in the callbackurl header. A management node posting the result there
+completes the call before its next poll; one that does not is polled as
+before, so polling stays the way results come by default.
+'''
+import BaseHTTPServer
+import SocketServer
+import heapq
+import socket
+import threading
+import time
+
+from zstacklib.utils import http
+from zstacklib.utils import jsonobject
+from zstacklib.utils import log
+from zstacklib.utils import thread
+
+logger = log.get_logger(__name__)
+
+# as poll_until_done() is called with by Api
+DEFAULT_POLL_INTERVAL = 0.5
+RESULT_PATH = '/result/'
+
+
+class PollStat(object):
+    def __init__(self):
+        self.requests = 0
+
+
+def poll_until_done(get_response, rsp, interval, timeout, stat=None):
+    '''
+    the polling loop, return (rsp, waited_ms). rsp.state is not 'Done' if
+    the job does not finish in `timeout` ms
+    '''
+    curr = 0
+    finterval = float(float(interval) / float(1000))
+    ret_uuid = rsp.uuid
+    while rsp.state != 'Done' and curr < timeout:
+        time.sleep(finterval)
+        rsp = get_response(ret_uuid)
+        if stat:
+            stat.requests += 1
+        curr += interval
+    return rsp, curr
+
+
+def get_local_ip_to(host, port):
+    '''
+    the local address the management node can reach this host by
+    '''
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # no packet is sent for an udp connect, it only looks up the route
+        s.connect((host, int(port)))
+        return s.getsockname()[0]
+    finally:
+        s.close()
+
+
+class _Job(object):
+    def __init__(self, job_uuid, get_response, deadline):
+        self.job_uuid = job_uuid
+        self.get_response = get_response
+        self.deadline = deadline
+        self.future = thread.Future()
+
+
+class _ResultHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length)
+        job_uuid = self.headers.getheader(http.TASK_UUID) or self.path[len(RESULT_PATH):].strip('/')
+        # only the result of a job waited for is taken
+        self.send_response(200 if self.server.listener.on_result(job_uuid, body) else 404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ResultListener(object):
+    '''
+    poll the results of async API calls, or receive them when the management
+    node posts them.
+
+    `callback_host` is the address the management node reaches this host by,
+    see get_local_ip_to(), the listener is bound to it. Only results of the
+    jobs waited for are taken, a result posted before the call returned its
+    job uuid is left to the poll. Counters `callbacks` and `polls` tell how
+    results were received.
+    '''
+
+    def __init__(self, callback_host='127.0.0.1', port=0, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.callback_host = callback_host
+        self.poll_interval = poll_interval
+        self.server = _ThreadingHttpServer((callback_host, port), _ResultHandler)
+        self.server.listener = self
+        self.port = self.server.server_address[1]
+        self.jobs = {}
+        self.callbacks = 0
+        self.polls = 0
+        self._poll_queue = []
+        self._cond = threading.Condition(threading.Lock())
+        self._stopped = False
+        self._threads = []
+
+    def url(self):
+        return 'http://%s:%d%s' % (self.callback_host, self.port, RESULT_PATH)
+
+    def start(self):
+        for target, name in ((self.server.serve_forever, 'api-result-listener'),
+                             (self._poll, 'api-result-poller')):
+            t = threading.Thread(target=target, name=name)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def expect(self, job_uuid, get_response):
+        '''
+        return a Future of the ApiResponse of the job. `get_response` fetches
+        the response by job uuid when polling
+        '''
+        job = _Job(job_uuid, get_response, time.time() + self.poll_interval)
+        with self._cond:
+            self.jobs[job_uuid] = job
+            heapq.heappush(self._poll_queue, (job.deadline, job_uuid))
+            self._cond.notify_all()
+        return job.future
+
+    def _complete(self, job, body):
+        try:
+            rsp = jsonobject.loads(body)
+            if rsp.state is None and rsp.result is None:
+                # a bare result rather than an ApiResponse
+                rsp = jsonobject.loads(jsonobject.dumps({'uuid': job.job_uuid, 'state': 'Done', 'result': body}))
+            job.future.set_result(rsp)
+        except Exception as e:
+            job.future.set_exception(e)
+
+    def on_result(self, job_uuid, body):
+        '''
+        complete the job with the posted result, False if it is not waited for
+        '''
+        with self._cond:
+            job = self.jobs.pop(job_uuid, None)
+            if job is None:
+                return False
+            self.callbacks += 1
+        self._complete(job, body)
+        return True
+
+    def _poll(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    now = time.time()
+                    while self._poll_queue and self._poll_queue[0][1] not in self.jobs:
+                        heapq.heappop(self._poll_queue)
+                    if self._poll_queue and self._poll_queue[0][0] <= now:
+                        _, job_uuid = heapq.heappop(self._poll_queue)
+                        job = self.jobs[job_uuid]
+                        break
+                    self._cond.wait(self._poll_queue[0][0] - now if self._poll_queue else None)
+                else:
+                    return
+
+            try:
+                rsp = job.get_response(job.job_uuid)
+            except Exception as e:
+                logger.warn('failed to get result of api job[uuid:%s]: %s' % (job.job_uuid, e))
+                rsp = None
+
+            with self._cond:
+                self.polls += 1
+                if job.job_uuid not in self.jobs:
+                    # the result is posted meanwhile
+                    continue
+                if rsp is None or rsp.state != 'Done':
+                    job.deadline = time.time() + self.poll_interval
+                    heapq.heappush(self._poll_queue, (job.deadline, job.job_uuid))
+                    continue
+                del self.jobs[job.job_uuid]
+            job.future.set_result(rsp)
+
+
+def wait_all(futures, timeout=None):
+    '''
+    wait for a set of async API calls, return (done, not_done)
+    '''
+    return thread.wait_futures(futures, timeout)
@@ -0,0 +1,186 @@
+'''
+
+async API completion by result listener against the polling loop, on a
+local fake API server posting results or not
+'''
+import BaseHTTPServer
+import httplib
+import SocketServer
+import threading
+import time
+import unittest
+import uuid
+
+from apibinding import completion
+from zstacklib.utils import http
+from zstacklib.utils import jsonobject
+
+JOB_TIME = 0.05
+
+
+class FakeApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def _reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        job_uuid = uuid.uuid4().hex
+        self.server.jobs[job_uuid] = {'uuid': job_uuid, 'state': 'Processing'}
+        callback = self.headers.getheader(http.CALLBACK_URI) if self.server.post_results else None
+        timer = threading.Timer(JOB_TIME, self.server.finish_job, (job_uuid, callback))
+        self.server.timers.append(timer)
+        timer.start()
+        self._reply(jsonobject.dumps(self.server.jobs[job_uuid]))
+
+    def do_GET(self):
+        self.server.gets += 1
+        self._reply(jsonobject.dumps(self.server.jobs[self.path.split('/')[-1]]))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeApiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, post_results=True):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeApiHandler)
+        self.post_results = post_results
+        self.jobs = {}
+        self.timers = []
+        self.gets = 0
+        self.api_url = 'http://127.0.0.1:%d/zstack/api' % self.server_address[1]
+        self.result_url = 'http://127.0.0.1:%d/zstack/api/result/' % self.server_address[1]
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def finish_job(self, job_uuid, callback):
+        result = jsonobject.dumps({'org.zstack.header.vm.APIStartVmInstanceEvent': {'success': True}})
+        self.jobs[job_uuid] = {'uuid': job_uuid, 'state': 'Done', 'result': result}
+        if callback:
+            try:
+                http.json_post(callback + job_uuid, jsonobject.dumps(self.jobs[job_uuid]), {http.TASK_UUID: job_uuid})
+            except Exception:
+                # refused as the job was already polled
+                pass
+
+    def stop(self):
+        # let results be posted before the listener of the test is stopped
+        for timer in self.timers:
+            timer.join()
+        self.shutdown()
+        self.server_close()
+
+
+class TestCompletion(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for s in self.servers:
+            s.stop()
+
+    def _server(self, post_results=True):
+        s = FakeApiServer(post_results)
+        self.servers.append(s)
+        return s
+
+    def _listener(self, **kwargs):
+        listener = completion.ResultListener(**kwargs).start()
+        self.servers.append(listener)
+        return listener
+
+    def _call(self, server, headers=None):
+        return jsonobject.loads(http.json_post(server.api_url, '{}', headers or {}))
+
+    def _get_response(self, server):
+        return lambda job_uuid: jsonobject.loads(http.json_dump_get(server.result_url + job_uuid))
+
+    def test_listener_against_polling(self):
+        calls = 4
+        server = self._server(post_results=False)
+        stat = completion.PollStat()
+        start = time.time()
+        for _ in range(calls):
+            rsp, _ = completion.poll_until_done(self._get_response(server), self._call(server), 500, 10000, stat)
+            self.assertEqual('Done', rsp.state)
+        polling_time = time.time() - start
+        self.assertEqual(calls, server.gets)
+
+        server = self._server()
+        listener = self._listener(callback_host=completion.get_local_ip_to('127.0.0.1', server.server_address[1]))
+        start = time.time()
+        for _ in range(calls):
+            rsp = self._call(server, {http.CALLBACK_URI: listener.url()})
+            self.assertEqual('Done', listener.expect(rsp.uuid, self._get_response(server)).result(10).state)
+        listener_time = time.time() - start
+
+        self.assertEqual(0, server.gets)
+        self.assertEqual(calls, listener.callbacks)
+        self.assertLess(listener_time, polling_time / 2)
+        print '\n%d calls: polling %.0f ms with %d result requests, listener %.0f ms with %d' % (
+            calls, polling_time * 1000, stat.requests, listener_time * 1000, server.gets)
+
+    def test_many_calls_in_flight(self):
+        server = self._server()
+        listener = self._listener()
+        futures = []
+        for _ in range(200):
+            rsp = self._call(server, {http.CALLBACK_URI: listener.url()})
+            futures.append(listener.expect(rsp.uuid, self._get_response(server)))
+
+        done, not_done = completion.wait_all(futures, 30)
+        self.assertEqual(200, len(done))
+        self.assertEqual([], not_done)
+        self.assertTrue(all(f.result().state == 'Done' for f in done))
+        # a result posted later than the poll interval is polled
+        self.assertEqual(200, listener.callbacks + listener.polls)
+        self.assertLess(listener.polls, 20)
+        self.assertEqual(listener.polls, server.gets)
+
+    def _post(self, listener, job_uuid, body):
+        conn = httplib.HTTPConnection(listener.callback_host, listener.port)
+        try:
+            conn.request('POST', completion.RESULT_PATH + job_uuid, body)
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+    def test_only_results_waited_for_are_taken(self):
+        listener = self._listener()
+        self.assertEqual('127.0.0.1', listener.server.server_address[0])
+        body = jsonobject.dumps({'uuid': 'job', 'state': 'Done', 'result': '{}'})
+
+        # a fake result of a job nobody waits for is refused and not kept
+        self.assertEqual(404, self._post(listener, 'job', body))
+        self.assertEqual(0, listener.callbacks)
+
+        server = self._server(post_results=False)
+        job_uuid = self._call(server).uuid
+        future = listener.expect(job_uuid, self._get_response(server))
+        self.assertEqual(200, self._post(listener, job_uuid, body))
+        self.assertEqual('Done', future.result(1).state)
+        self.assertEqual(404, self._post(listener, job_uuid, body))
+
+    def test_polled_at_the_old_interval(self):
+        # a management node not posting results is polled every 0.5s as before
+        self.assertEqual(0.5, completion.DEFAULT_POLL_INTERVAL)
+        server = self._server(post_results=False)
+        listener = self._listener()
+        start = time.time()
+        futures = [listener.expect(self._call(server).uuid, self._get_response(server)) for _ in range(5)]
+
+        done, not_done = completion.wait_all(futures, 10)
+        elapsed = time.time() - start
+        self.assertEqual(5, len(done))
+        self.assertEqual(0, listener.callbacks)
+        self.assertEqual(5, listener.polls)
+        self.assertLess(elapsed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
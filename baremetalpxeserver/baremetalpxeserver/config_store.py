@@ -0,0 +1,126 @@
+'''
+
+files the pxeserver writes for baremetal instances: pxelinux configs,
+preconfiguration files and their pre/post scripts
+'''
+import hashlib
+import os
+import os.path
+import tempfile
+import threading
+
+from jinja2 import Template
+
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+MAX_CACHED_TEMPLATES = 256
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(source):
+    '''
+    the compiled jinja2 template of `source`. Niccfg snippets are the same
+    for every instance and users share a few preconfiguration templates, so
+    they are compiled once
+    '''
+    key = hashlib.md5(source.encode('utf-8') if isinstance(source, unicode) else source).hexdigest()
+    with _templates_lock:
+        tmpl = _templates.get(key)
+    if tmpl is not None:
+        return tmpl
+
+    tmpl = Template(source)
+    with _templates_lock:
+        if len(_templates) >= MAX_CACHED_TEMPLATES:
+            _templates.clear()
+        _templates[key] = tmpl
+    return tmpl
+
+
+def _digest(content):
+    return hashlib.md5(content.encode('utf-8') if isinstance(content, unicode) else content).hexdigest()
+
+
+class PxeConfigStore(object):
+    '''
+    the files of each instance, by the pxe nic mac they are named after.
+    A file is replaced by rename so tftp and ftp never serve half of it, and
+    is not written again when its content is unchanged.
+
+    `owners` maps a directory to how its file names give the mac, the index
+    is rebuilt from them when the agent starts
+    '''
+
+    def __init__(self, owners):
+        # type: (dict[str, callable]) -> None
+        self.owners = owners
+        self.index = {}         # type: dict[str, dict[str, str]]
+        self.written = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        for d, owner_of in self.owners.items():
+            if not os.path.isdir(d):
+                continue
+            for name in os.listdir(d):
+                mac = owner_of(name)
+                if mac:
+                    # digests are taken when the file is next written
+                    self.index.setdefault(mac, {})[os.path.join(d, name)] = None
+
+    def _same_content(self, path, digest, known):
+        if not os.path.exists(path):
+            return False
+        if known is not None:
+            return known == digest
+        with open(path) as fd:
+            return _digest(fd.read()) == digest
+
+    def write(self, mac, path, content):
+        digest = _digest(content)
+        with self.lock:
+            files = self.index.setdefault(mac, {})
+            if self._same_content(path, digest, files.get(path)):
+                files[path] = digest
+                self.skipped += 1
+                return False
+
+        d = os.path.dirname(path)
+        fd, tmp = tempfile.mkstemp(dir=d, prefix='.%s.' % os.path.basename(path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        with self.lock:
+            self.index.setdefault(mac, {})[path] = digest
+            self.written += 1
+        return True
+
+    def files_of(self, mac):
+        with self.lock:
+            return sorted(self.index.get(mac, {}).keys())
+
+    def delete(self, mac):
+        with self.lock:
+            files = self.index.pop(mac, {})
+        for path in files:
+            if os.path.exists(path):
+                os.remove(path)
+        return len(files)
+
+    def delete_all(self):
+        with self.lock:
+            macs = self.index.keys()
+        return sum(self.delete(mac) for mac in macs)
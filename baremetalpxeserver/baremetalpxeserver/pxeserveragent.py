@@ -10,21 +10,34 @@ import struct
 import hashlib
 import traceback
 import simplejson
-from jinja2 import Template
 from netaddr import IPNetwork, IPAddress
 import platform
+import re
 
 import zstacklib.utils.daemon as daemon
 import zstacklib.utils.http as http
 import zstacklib.utils.jsonobject as json_object
 from zstacklib.utils.bash import *
 from imagestore import ImageStoreClient
+from config_store import PxeConfigStore, get_template
+from supervisor import ManagedProcess, NginxService, PxeServiceSupervisor, ServiceError
 
 logger = log.get_logger(__name__)
 
 class PxeServerError(Exception):
     '''baremetal pxeserver error'''
 
+# pxe nic macs name the files of baremetal instances, as aa-bb-cc-dd-ee-ff
+MAC_NAME = "(?:[0-9a-fA-F]{2}-){5}[0-9a-fA-F]{2}"
+
+
+def _mac_in_name(pattern):
+    regex = re.compile(pattern % MAC_NAME)
+    def owner_of(name):
+        m = regex.match(name)
+        return m.group(1) if m else None
+    return owner_of
+
 class AgentResponse(object):
     def __init__(self, success=True, error=None):
         self.success = success
@@ -111,6 +124,7 @@ class PxeServerAgent(object):
     NGINX_TERMINAL_PROXY_CONF_PATH = "/etc/nginx/conf.d/terminal/"
     NOVNC_INSTALL_PATH = BAREMETAL_LIB_PATH + "noVNC/"
     NOVNC_TOKEN_PATH = NOVNC_INSTALL_PATH + "tokens/"
+    NGINX_PID_PATH = "/run/nginx.pid"
 
     NMAP_BROADCAST_DHCP_DISCOVER_PATH = "/usr/share/nmap/scripts/broadcast-dhcp-discover.nse"
 
@@ -139,6 +153,25 @@ class PxeServerAgent(object):
         self.http_server.register_async_uri(self.MOUNT_BM_IMAGE_CACHE_PATH, self.mount_bm_image_cache)
 
         self.imagestore_client = ImageStoreClient()
+        self.nginx = NginxService(self.NGINX_PID_PATH)
+        self.services = PxeServiceSupervisor([
+            ManagedProcess("dnsmasq",
+                           ["dnsmasq", "-k", "-C", self.DNSMASQ_CONF_PATH, "-u", "root"],
+                           ["dnsmasq", self.DNSMASQ_CONF_PATH]),
+            ManagedProcess("vsftpd",
+                           ["vsftpd", "-obackground=NO", self.VSFTPD_CONF_PATH],
+                           ["vsftpd", self.VSFTPD_CONF_PATH]),
+            ManagedProcess("noVNC",
+                           ["python", os.path.join(self.NOVNC_INSTALL_PATH, "utils/websockify/run"),
+                            "--web", self.NOVNC_INSTALL_PATH, "--token-plugin", "TokenFile",
+                            "--token-source=%s" % self.NOVNC_TOKEN_PATH, str(self.WEBSOCKIFY_PORT)],
+                           ["websockify", self.NOVNC_TOKEN_PATH]),
+        ], self.nginx)
+        self.configs = PxeConfigStore({
+            self.PXELINUX_CFG_PATH: _mac_in_name("^01-(%s)$"),
+            self.KS_CFG_PATH: _mac_in_name("^(%s)$"),
+            self.ZSTACK_SCRIPTS_PATH: _mac_in_name("^(?:pre|post)_(%s)\\.sh$"),
+        })
 
     def _set_capacity_to_response(self, rsp):
         total, avail = self._get_capacity()
@@ -151,32 +184,15 @@ class PxeServerAgent(object):
         return total, total - used
 
     def _start_pxe_server(self):
-        ret, _, err = bash_roe("ps -ef | grep -v 'grep' | grep 'dnsmasq -C {0}' || dnsmasq -C {0} -u root".format(self.DNSMASQ_CONF_PATH))
-        if ret != 0:
-            raise PxeServerError("failed to start dnsmasq on baremetal pxeserver[uuid:%s]: %s" % (self.uuid, err))
-
-        ret, _, err = bash_roe("ps -ef | grep -v 'grep' | grep 'vsftpd {0}' || vsftpd {0}".format(self.VSFTPD_CONF_PATH))
-        if ret != 0:
-            raise PxeServerError("failed to start vsftpd on baremetal pxeserver[uuid:%s]: %s" % (self.uuid, err))
-
-        ret, _, err = bash_roe("ps -ef | grep -v 'grep' | grep 'websockify' | grep 'baremetal' || "
-                     "python %s/utils/websockify/run --web %s --token-plugin TokenFile --token-source=%s -D 6080"
-                     % (self.NOVNC_INSTALL_PATH, self.NOVNC_INSTALL_PATH, self.NOVNC_TOKEN_PATH))
-        if ret != 0:
-            raise PxeServerError("failed to start noVNC on baremetal pxeserver[uuid:%s]: %s" % (self.uuid, err))
-
-        # in case nginx config is updated during nginx running
-        ret, _, err = bash_roe("systemctl start nginx && systemctl reload nginx")
-        if ret != 0:
-            raise PxeServerError("failed to start nginx on baremetal pxeserver[uuid:%s]: %s" % (self.uuid, err))
+        try:
+            self.services.ensure()
+        except ServiceError as e:
+            raise PxeServerError("failed to start pxe services on baremetal pxeserver[uuid:%s]: %s" % (self.uuid, e))
 
     # we do not stop nginx on pxeserver because it may be needed by bm with terminal proxy
     # stop pxeserver means stop dnsmasq actually
     def _stop_pxe_server(self):
-        bash_r("kill -9 `ps -ef | grep -v grep | grep 'vsftpd %s' | awk '{ print $2 }'`" % self.VSFTPD_CONF_PATH)
-        bash_r("kill -9 `ps -ef | grep -v grep | grep websockify | grep baremetal | awk '{ print $2 }'`")
-        bash_r("kill -9 `ps -ef | grep -v grep | grep 'dnsmasq -C %s' | awk '{ print $2 }'`" % self.DNSMASQ_CONF_PATH)
-        bash_r("systemctl stop nginx")
+        self.services.stop()
 
     @staticmethod
     def _get_mac_address(ifname):
@@ -465,8 +481,7 @@ http {
             KS_CFG_NAME=ks_cfg_name,
             APPEND=append)
 
-        with open(pxe_cfg_file, 'w') as f:
-            f.write(pxelinux_cfg)
+        self.configs.write(cmd.pxeNicMac, pxe_cfg_file, pxelinux_cfg)
 
     def _create_preconfiguration_file(self, cmd):
         # in case user didn't seleted a preconfiguration template etc.
@@ -493,8 +508,7 @@ http {
 
         ks_cfg_name = cmd.pxeNicMac
         ks_cfg_file = os.path.join(self.KS_CFG_PATH, ks_cfg_name)
-        with open(ks_cfg_file, 'w') as f:
-            f.write(rendered_content)
+        self.configs.write(cmd.pxeNicMac, ks_cfg_file, rendered_content)
 
     def _create_pre_scripts(self, cmd, pxeserver_dhcp_nic_ip, more_script = ""):
         # poweroff and abort the provisioning process if failed to send `deploybegin` command
@@ -513,8 +527,7 @@ poweroff
 """.format(BMUUID=cmd.bmUuid, PXESERVER_DHCP_NIC_IP=pxeserver_dhcp_nic_ip)
 
         pre_script += more_script
-        with open(os.path.join(self.ZSTACK_SCRIPTS_PATH, "pre_%s.sh" % cmd.pxeNicMac), 'w') as f:
-            f.write(pre_script)
+        self.configs.write(cmd.pxeNicMac, os.path.join(self.ZSTACK_SCRIPTS_PATH, "pre_%s.sh" % cmd.pxeNicMac), pre_script)
         logger.debug("create pre_%s.sh with content: %s" % (cmd.pxeNicMac, pre_script))
 
     def _create_post_scripts(self, cmd, pxeserver_dhcp_nic_ip, more_script = ""):
@@ -600,8 +613,7 @@ EOF
 systemctl daemon-reload
 systemctl enable zstack-bm-agent.service
 """.format(BMUUID=cmd.bmUuid, PXESERVER_DHCP_NIC_IP=pxeserver_dhcp_nic_ip)
-        with open(os.path.join(self.ZSTACK_SCRIPTS_PATH, "post_%s.sh" % cmd.pxeNicMac), 'w') as f:
-            f.write(post_script)
+        self.configs.write(cmd.pxeNicMac, os.path.join(self.ZSTACK_SCRIPTS_PATH, "post_%s.sh" % cmd.pxeNicMac), post_script)
         logger.debug("create post_%s.sh with content: %s" % (cmd.pxeNicMac, post_script))
 
     def _render_kickstart_template(self, cmd, pxeserver_dhcp_nic_ip):
@@ -620,7 +632,7 @@ systemctl enable zstack-bm-agent.service
 network --bootproto=static --onboot=yes --noipv6 --activate --device {{ cfg.mac }} --ip={{ cfg.ip }} --netmask={{ cfg.netmask }} --gateway={{ cfg.gateway }} --nameserver={{ cfg.nameserver }}
 {% endfor %}
 """
-        nic_cfg_tmpl = Template(pxe_niccfg_content)
+        nic_cfg_tmpl = get_template(pxe_niccfg_content)
         context['NETWORK_CFGS'] = nic_cfg_tmpl.render(niccfgs=niccfgs)
 
     # post script snippet for network configuration
@@ -725,7 +737,7 @@ echo "ONBOOT=yes" >> $IFCFGFILE
 
 {% endfor %}
 """
-        niccfg_post_tmpl = Template(niccfg_post_script)
+        niccfg_post_tmpl = get_template(niccfg_post_script)
         for cfg in niccfgs:
             if cfg.bondName:
                 cfg.bondSlaves = cfg.bondSlaves.split(',')
@@ -739,7 +751,7 @@ echo "ONBOOT=yes" >> $IFCFGFILE
         custom = simplejson.loads(cmd.customPreconfigurations) if cmd.customPreconfigurations is not None else {}
         context.update(custom)
 
-        tmpl = Template(cmd.preconfigurationContent)
+        tmpl = get_template(cmd.preconfigurationContent)
         return tmpl.render(context)
 
     def _render_preseed_template(self, cmd, pxeserver_dhcp_nic_ip):
@@ -835,7 +847,7 @@ INTERFACES_FILE=/etc/network/interfaces
 
 {% endfor %}
 """
-        niccfg_post_tmpl = Template(niccfg_post_script)
+        niccfg_post_tmpl = get_template(niccfg_post_script)
         for cfg in niccfgs:
             if cfg.bondName:
                 cfg.bondSlaves = cfg.bondSlaves.split(',')
@@ -845,7 +857,7 @@ INTERFACES_FILE=/etc/network/interfaces
         custom = simplejson.loads(cmd.customPreconfigurations) if cmd.customPreconfigurations is not None else {}
         context.update(custom)
 
-        tmpl = Template(cmd.preconfigurationContent)
+        tmpl = get_template(cmd.preconfigurationContent)
         return tmpl.render(context)
 
     def _render_autoyast_template(self, cmd, pxeserver_dhcp_nic_ip):
@@ -938,7 +950,7 @@ echo "STARTMODE='auto'" >> $IFCFGFILE
 
 {% endfor %}
 """
-        niccfg_post_tmpl = Template(niccfg_post_script)
+        niccfg_post_tmpl = get_template(niccfg_post_script)
         for cfg in niccfgs:
             if cfg.bondName:
                 cfg.bondSlaves = cfg.bondSlaves.split(',')
@@ -948,9 +960,18 @@ echo "STARTMODE='auto'" >> $IFCFGFILE
         custom = simplejson.loads(cmd.customPreconfigurations) if cmd.customPreconfigurations is not None else {}
         context.update(custom)
 
-        tmpl = Template(cmd.preconfigurationContent)
+        tmpl = get_template(cmd.preconfigurationContent)
         return tmpl.render(context)
 
+    @staticmethod
+    def _remove_files_in(d):
+        if not os.path.isdir(d):
+            return
+        for name in os.listdir(d):
+            path = os.path.join(d, name)
+            if not os.path.isdir(path):
+                os.remove(path)
+
     @reply_error
     def delete_bm_configs(self, req):
         cmd = json_object.loads(req[http.REQUEST_BODY])
@@ -958,32 +979,11 @@ echo "STARTMODE='auto'" >> $IFCFGFILE
 
         # clean up pxeserver bm configs
         if cmd.pxeNicMac == "*":
-            if os.path.exists(self.PXELINUX_CFG_PATH):
-                bash_r("rm -f %s/*" % self.PXELINUX_CFG_PATH)
-            if os.path.exists(self.KS_CFG_PATH):
-                bash_r("rm -f %s/*" % self.KS_CFG_PATH)
-            if os.path.exists(self.NGINX_MN_PROXY_CONF_PATH):
-                bash_r("rm -f %s/*" % self.NGINX_MN_PROXY_CONF_PATH)
-            if os.path.exists(self.NGINX_TERMINAL_PROXY_CONF_PATH):
-                bash_r("rm -f %s/*" % self.NGINX_TERMINAL_PROXY_CONF_PATH)
-            if os.path.exists(self.NOVNC_TOKEN_PATH):
-                bash_r("rm -f %s/*" % self.NOVNC_TOKEN_PATH)
+            self.configs.delete_all()
+            for d in (self.NGINX_MN_PROXY_CONF_PATH, self.NGINX_TERMINAL_PROXY_CONF_PATH, self.NOVNC_TOKEN_PATH):
+                self._remove_files_in(d)
         else:
-            mac_as_name = cmd.pxeNicMac.replace(":", "-")
-            pxe_cfg_file = os.path.join(self.PXELINUX_CFG_PATH, "01-" + mac_as_name)
-            if os.path.exists(pxe_cfg_file):
-                os.remove(pxe_cfg_file)
-
-            ks_cfg_file = os.path.join(self.KS_CFG_PATH, mac_as_name)
-            if os.path.exists(ks_cfg_file):
-                os.remove(ks_cfg_file)
-
-            pre_script_file = os.path.join(self.ZSTACK_SCRIPTS_PATH, "pre_%s.sh" % mac_as_name)
-            if os.path.exists(pre_script_file):
-                os.remove(pre_script_file)
-            post_script_file = os.path.join(self.ZSTACK_SCRIPTS_PATH, "post_%s.sh" % mac_as_name)
-            if os.path.exists(post_script_file):
-                os.remove(post_script_file)
+            self.configs.delete(cmd.pxeNicMac.replace(":", "-"))
 
         logger.info("successfully deleted pxelinux.cfg and ks.cfg %s" % cmd.pxeNicMac if cmd.pxeNicMac != '*' else 'all')
         return json_object.dumps(rsp)
@@ -996,9 +996,7 @@ echo "STARTMODE='auto'" >> $IFCFGFILE
         nginx_proxy_file = os.path.join(self.NGINX_TERMINAL_PROXY_CONF_PATH, cmd.bmUuid)
         with open(nginx_proxy_file, 'w') as f:
             f.write(cmd.upstream)
-        ret, _, err = bash_roe("systemctl reload nginx || systemctl reload nginx")
-        if ret != 0:
-            logger.debug("failed to reload nginx.service: " + err)
+        self.nginx.config_changed()
 
         logger.info("successfully create terminal nginx proxy for baremetal instance[uuid:%s] on pxeserver[uuid:%s]" % (cmd.bmUuid, self.uuid))
         return json_object.dumps(rsp)
@@ -1011,9 +1009,7 @@ echo "STARTMODE='auto'" >> $IFCFGFILE
         nginx_proxy_file = os.path.join(self.NGINX_TERMINAL_PROXY_CONF_PATH, cmd.bmUuid)
         if os.path.exists(nginx_proxy_file):
             os.remove(nginx_proxy_file)
-        ret, _, err = bash_roe("systemctl reload nginx || systemctl reload nginx")
-        if ret != 0:
-            logger.debug("failed to reload nginx.service: " + err)
+        self.nginx.config_changed()
 
         logger.info("successfully deleted terminal nginx proxy for baremetal instance[uuid:%s] on pxeserver[uuid:%s]" % (cmd.bmUuid, self.uuid))
         return json_object.dumps(rsp)
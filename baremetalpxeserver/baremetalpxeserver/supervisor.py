@@ -0,0 +1,263 @@
+'''
+
+pxe services run by the pxeserver agent itself: dnsmasq, vsftpd and
+websockify are kept in the foreground as its children, nginx stays with
+systemd and the config changes of concurrent requests share its reloads
+'''
+import os
+import os.path
+import signal
+import subprocess
+import threading
+import time
+
+from zstacklib.utils import log
+from zstacklib.utils.bash import bash_roe
+
+logger = log.get_logger(__name__)
+
+# a daemon that is still up after this long has taken its config
+STARTUP_GRACE = 0.2
+STOP_TIMEOUT = 5
+NGINX_RELOAD_TIMEOUT = 60
+# config changes asked for this soon after a reload is due share it
+NGINX_RELOAD_WINDOW = 0.1
+
+
+class ServiceError(Exception):
+    '''pxe service error'''
+
+
+def read_cmdline(pid, proc_dir='/proc'):
+    try:
+        with open(os.path.join(proc_dir, str(pid), 'cmdline')) as fd:
+            return fd.read().rstrip('\0').split('\0')
+    except IOError:
+        return None
+
+
+class ManagedProcess(object):
+    '''
+    a daemon started by the agent. `markers` pick it out of /proc when it was
+    left by an earlier agent, each must be found in one of its arguments
+    '''
+
+    def __init__(self, name, args, markers, proc_dir='/proc'):
+        self.name = name
+        self.args = args
+        self.markers = markers
+        self.proc_dir = proc_dir
+        self.popen = None
+        self.pid = None
+        self.cmdline = None
+
+    def matches(self, cmdline):
+        return all(any(m in a for a in cmdline) for m in self.markers)
+
+    def adopt(self, pid, cmdline):
+        self.popen = None
+        self.pid = pid
+        self.cmdline = cmdline
+        logger.debug('adopted %s[pid:%s]' % (self.name, pid))
+
+    def is_alive(self):
+        if self.popen:
+            return self.popen.poll() is None
+        if self.pid:
+            return read_cmdline(self.pid, self.proc_dir) == self.cmdline
+        return False
+
+    def start(self):
+        with open(os.devnull, 'r+') as devnull:
+            try:
+                self.popen = subprocess.Popen(self.args, stdin=devnull, stdout=devnull, stderr=devnull,
+                                              close_fds=True, preexec_fn=os.setsid)
+            except OSError as e:
+                raise ServiceError('cannot run %s: %s' % (self.args[0], e))
+
+        self.pid = self.popen.pid
+        self.cmdline = None
+        time.sleep(STARTUP_GRACE)
+        ret = self.popen.poll()
+        if ret is not None:
+            raise ServiceError('%s exited with %s right after start' % (self.name, ret))
+        logger.debug('started %s[pid:%s]' % (self.name, self.pid))
+
+    def stop(self):
+        if not self.is_alive():
+            self.popen = self.pid = self.cmdline = None
+            return
+
+        self._signal(signal.SIGTERM)
+        deadline = time.time() + STOP_TIMEOUT
+        while self.is_alive() and time.time() < deadline:
+            time.sleep(0.05)
+        if self.is_alive():
+            self._signal(signal.SIGKILL)
+            if self.popen:
+                self.popen.wait()
+
+        logger.debug('stopped %s[pid:%s]' % (self.name, self.pid))
+        self.popen = self.pid = self.cmdline = None
+
+    def _signal(self, sig):
+        try:
+            os.kill(self.pid, sig)
+        except OSError:
+            pass
+
+
+class NginxService(object):
+    '''
+    nginx is shared with the terminal proxies of baremetal instances and
+    stays a systemd unit. config_changed() returns once nginx has loaded
+    the change. A reload waits `reload_window` seconds before it runs and
+    loads the changes asked for meanwhile too, the changes asked for while
+    it runs are loaded together by the next one
+    '''
+
+    def __init__(self, pid_file='/run/nginx.pid', proc_dir='/proc', reload_timeout=NGINX_RELOAD_TIMEOUT,
+                 reload_window=NGINX_RELOAD_WINDOW):
+        self.pid_file = pid_file
+        self.proc_dir = proc_dir
+        self.reload_timeout = reload_timeout
+        self.reload_window = reload_window
+        self.dirty = True
+        self.reloads = 0
+        # config changes asked for, tried by a reload and loaded by nginx
+        self.changes = 0
+        self.tried = 0
+        self.loaded = 0
+        self.reload_error = None
+        self.reloading = False
+        self.lock = threading.Lock()
+        self.reloaded = threading.Condition(self.lock)
+
+    def is_running(self):
+        try:
+            with open(self.pid_file) as fd:
+                pid = fd.read().strip()
+        except IOError:
+            return False
+        return pid.isdigit() and os.path.exists(os.path.join(self.proc_dir, pid))
+
+    def _wait_reload(self):
+        deadline = time.time() + self.reload_timeout
+        while self.reloading:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ServiceError("nginx has not reloaded in %s seconds" % self.reload_timeout)
+            self.reloaded.wait(remaining)
+
+    def start(self):
+        with self.lock:
+            self._wait_reload()
+            if self.is_running():
+                if self.dirty:
+                    self._reload()
+                return
+
+            ret, _, err = bash_roe("systemctl start nginx")
+            if ret != 0:
+                raise ServiceError("failed to start nginx: %s" % err)
+            self._loaded(self.changes, None)
+
+    def stop(self):
+        with self.lock:
+            self._wait_reload()
+            bash_roe("systemctl stop nginx")
+            self.dirty = True
+
+    def config_changed(self):
+        '''
+        ask nginx to load the changed config, return when it has. Nothing is
+        reloaded when nginx is not running, start() loads the config then
+        '''
+        with self.lock:
+            self.dirty = True
+            self.changes += 1
+            change = self.changes
+            while self.tried < change:
+                if self.reloading:
+                    self._wait_reload()
+                elif self.is_running():
+                    self._reload()
+                else:
+                    return
+
+            if self.loaded < change:
+                raise ServiceError("failed to reload nginx: %s" % self.reload_error)
+
+    def _loaded(self, changes, error):
+        self.dirty = self.changes > changes
+        self.tried = changes
+        if error is None:
+            self.loaded = changes
+        self.reload_error = error
+        self.reloaded.notify_all()
+
+    def _reload(self):
+        # called with the lock held, which is released while nginx reloads.
+        # The changes asked for in the window are loaded by this reload, those
+        # asked for while nginx reloads wait for the next one
+        self.reloading = True
+        self.reloads += 1
+        self.lock.release()
+        try:
+            time.sleep(self.reload_window)
+            with self.lock:
+                changes = self.changes
+            ret, _, err = bash_roe("systemctl reload nginx || systemctl reload nginx")
+        finally:
+            self.lock.acquire()
+            self.reloading = False
+            self.reloaded.notify_all()
+
+        if ret != 0:
+            logger.debug("failed to reload nginx.service: " + err)
+        self._loaded(changes, err.strip() if ret != 0 else None)
+
+
+class PxeServiceSupervisor(object):
+    '''
+    pids and health of the pxe services are kept in memory, ensure() only
+    forks a daemon that is not running
+    '''
+
+    def __init__(self, processes, nginx, proc_dir='/proc'):
+        self.processes = processes     # type: list[ManagedProcess]
+        self.nginx = nginx             # type: NginxService
+        self.proc_dir = proc_dir
+        self.scanned = False
+        self.lock = threading.Lock()
+
+    def _adopt_orphans(self):
+        # daemons outlive the agent, an agent restart takes them over
+        self.scanned = True
+        for pid in os.listdir(self.proc_dir):
+            if not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            cmdline = read_cmdline(pid, self.proc_dir)
+            if not cmdline:
+                continue
+            for p in self.processes:
+                if not p.is_alive() and p.matches(cmdline):
+                    p.adopt(int(pid), cmdline)
+                    break
+
+    def ensure(self):
+        with self.lock:
+            if not self.scanned:
+                self._adopt_orphans()
+            for p in self.processes:
+                if not p.is_alive():
+                    p.start()
+        self.nginx.start()
+
+    def stop(self):
+        with self.lock:
+            if not self.scanned:
+                self._adopt_orphans()
+            for p in self.processes:
+                p.stop()
+        self.nginx.stop()
@@ -0,0 +1,133 @@
+'''
+
+benchmark provisioning the configs of 1,000 baremetal instances in a temp
+directory: the first pass renders and writes, the second only renders as
+every file is unchanged
+'''
+import hashlib
+import os
+import shutil
+import simplejson
+import sys
+import tempfile
+import time
+import unittest
+
+from baremetalpxeserver import pxeserveragent
+from zstacklib.utils import http
+from zstacklib.utils import jsonobject
+
+INSTANCES = 1000
+
+KICKSTART = '''install
+{{ REPO_URL }}
+{{ extra_repo }}
+rootpw --plaintext {{ PASSWORD }}
+{{ FORCE_INSTALL }}
+{{ NETWORK_CFGS }}
+%pre
+{{ PRE_SCRIPTS }}
+%end
+%post
+{{ POST_SCRIPTS }}
+%end
+'''
+
+
+class TestPxeConfigStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        root = self.dir + '/'
+
+        class Agent(pxeserveragent.PxeServerAgent):
+            PXELINUX_CFG_PATH = root + 'tftpboot/pxelinux.cfg/'
+            VSFTPD_ROOT_PATH = root + 'ftp/'
+            KS_CFG_PATH = root + 'ftp/ks/'
+            ZSTACK_SCRIPTS_PATH = root + 'ftp/scripts/'
+            NGINX_MN_PROXY_CONF_PATH = root + 'nginx/pxe_mn/'
+            NGINX_TERMINAL_PROXY_CONF_PATH = root + 'nginx/terminal/'
+            NOVNC_TOKEN_PATH = root + 'noVNC/tokens/'
+
+            @staticmethod
+            def _get_ip_address(ifname):
+                return '10.0.0.1'
+
+        for d in (Agent.PXELINUX_CFG_PATH, Agent.KS_CFG_PATH, Agent.ZSTACK_SCRIPTS_PATH,
+                  Agent.NGINX_MN_PROXY_CONF_PATH, Agent.NGINX_TERMINAL_PROXY_CONF_PATH, Agent.NOVNC_TOKEN_PATH):
+            os.makedirs(d)
+        # written by init, not by any instance
+        open(Agent.PXELINUX_CFG_PATH + 'default', 'w').close()
+        open(Agent.KS_CFG_PATH + 'inspector_ks.cfg', 'w').close()
+
+        self.Agent = Agent
+        self.agent = Agent()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    @staticmethod
+    def _mac(i):
+        return '00:16:3e:%02x:%02x:%02x' % (i >> 16, (i >> 8) & 0xff, i & 0xff)
+
+    def _cmd(self, i, password='password'):
+        niccfgs = [{'mac': self._mac(i), 'ip': '10.0.%d.%d' % (i / 250, i % 250 + 2), 'netmask': '255.255.0.0',
+                    'gateway': '10.0.0.1', 'nameserver': '223.5.5.5', 'pxe': True}]
+        return {http.REQUEST_BODY: jsonobject.dumps({
+            'uuid': 'pxeserver',
+            'bmUuid': 'bm-%d' % i,
+            'pxeNicMac': self._mac(i),
+            'dhcpInterface': 'eth0',
+            'imageUuid': 'image',
+            'preconfigurationType': 'kickstart',
+            'preconfigurationContent': KICKSTART,
+            'preconfigurationMd5sum': hashlib.md5(KICKSTART).hexdigest(),
+            'username': 'root',
+            'password': password,
+            'forceInstall': True,
+            'nicCfgs': simplejson.dumps(niccfgs),
+        })}
+
+    def _provision(self):
+        start = time.time()
+        for i in range(INSTANCES):
+            rsp = jsonobject.loads(self.agent.create_bm_configs(self._cmd(i)))
+            self.assertTrue(rsp.success, rsp.error)
+        return time.time() - start
+
+    def _count_files(self):
+        return sum(len(os.listdir(d)) for d in (self.Agent.PXELINUX_CFG_PATH, self.Agent.KS_CFG_PATH,
+                                                self.Agent.ZSTACK_SCRIPTS_PATH))
+
+    def test_provision_and_delete(self):
+        store = self.agent.configs
+        render_and_write = self._provision()
+        self.assertEqual(INSTANCES * 4, store.written)
+        self.assertEqual(INSTANCES * 4 + 2, self._count_files())
+
+        render_only = self._provision()
+        self.assertEqual(INSTANCES * 4, store.written)
+        self.assertEqual(INSTANCES * 4, store.skipped)
+        sys.stderr.write('\n%d instances: %.3fs rendered and written, %.3fs rendered with unchanged files\n'
+                         % (INSTANCES, render_and_write, render_only))
+
+        # only the preconfiguration file holds the password
+        self.agent.create_bm_configs(self._cmd(7, password='changed'))
+        self.assertEqual(INSTANCES * 4 + 1, store.written)
+
+        mac = self._mac(7).replace(':', '-')
+        self.assertEqual(4, len(store.files_of(mac)))
+        self.agent.delete_bm_configs({http.REQUEST_BODY: jsonobject.dumps({'pxeNicMac': self._mac(7)})})
+        self.assertEqual([], store.files_of(mac))
+        self.assertEqual((INSTANCES - 1) * 4 + 2, self._count_files())
+
+        # a restarted agent finds the files of every instance again
+        agent = self.Agent()
+        self.assertEqual(INSTANCES - 1, len(agent.configs.index))
+        agent.delete_bm_configs({http.REQUEST_BODY: jsonobject.dumps({'pxeNicMac': '*'})})
+        self.assertEqual(['default'], os.listdir(self.Agent.PXELINUX_CFG_PATH))
+        self.assertEqual(['inspector_ks.cfg'], os.listdir(self.Agent.KS_CFG_PATH))
+        self.assertEqual([], os.listdir(self.Agent.ZSTACK_SCRIPTS_PATH))
+
+
+if __name__ == "__main__":
+    unittest.main()
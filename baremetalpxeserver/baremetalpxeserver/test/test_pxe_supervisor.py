@@ -0,0 +1,210 @@
+'''
+
+pxe services supervised by the agent against stub dnsmasq, vsftpd,
+websockify and systemctl binaries, counting the processes forked and the
+nginx reloads of back-to-back proxy changes, each replied to after the
+reload loading it
+'''
+import os
+import shutil
+import signal
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from baremetalpxeserver import pxeserveragent
+from baremetalpxeserver import supervisor
+from zstacklib.utils import http
+from zstacklib.utils import jsonobject
+
+# every run of a stub is logged, daemons then stay up
+STUB = '''#!%(python)s
+import os, sys, time
+with open(os.environ['FAKE_PXE_LOG'], 'a') as fd:
+    fd.write(' '.join([os.path.basename(sys.argv[0])] + sys.argv[1:]) + '\\n')
+time.sleep(600)
+'''
+
+FAKE_SYSTEMCTL = '''#!%(python)s
+import os, sys
+with open(os.environ['FAKE_PXE_LOG'], 'a') as fd:
+    fd.write(' '.join(['systemctl'] + sys.argv[1:]) + '\\n')
+pid_file = os.environ['FAKE_NGINX_PID_FILE']
+if sys.argv[1:] == ['start', 'nginx']:
+    with open(pid_file, 'w') as fd:
+        fd.write(os.environ['FAKE_NGINX_PID'])
+elif sys.argv[1:] == ['stop', 'nginx'] and os.path.exists(pid_file):
+    os.remove(pid_file)
+elif sys.argv[1:] == ['reload', 'nginx']:
+    # the terminal proxies loaded by the reload
+    conf_dir = os.environ['FAKE_NGINX_CONF_DIR']
+    with open(os.path.join(os.path.dirname(conf_dir), 'loaded'), 'w') as fd:
+        fd.write(' '.join(os.listdir(conf_dir)))
+'''
+
+PROXIES = 200
+
+
+class TestPxeSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bin = os.path.join(self.dir, 'bin')
+        self.log = os.path.join(self.dir, 'forks.log')
+        lib = os.path.join(self.dir, 'lib') + '/'
+        novnc = lib + 'noVNC/'
+        for d in (self.bin, novnc + 'tokens', novnc + 'utils/websockify', os.path.join(self.dir, 'terminal')):
+            os.makedirs(d)
+
+        self._write_bin(os.path.join(self.bin, 'dnsmasq'), STUB)
+        self._write_bin(os.path.join(self.bin, 'vsftpd'), STUB)
+        self._write_bin(os.path.join(self.bin, 'python'), STUB)
+        self._write_bin(os.path.join(self.bin, 'systemctl'), FAKE_SYSTEMCTL)
+        open(novnc + 'utils/websockify/run', 'w').close()
+
+        self.env = dict(os.environ)
+        os.environ['PATH'] = '%s:%s' % (self.bin, os.environ.get('PATH', ''))
+        os.environ['FAKE_PXE_LOG'] = self.log
+        os.environ['FAKE_NGINX_PID_FILE'] = os.path.join(self.dir, 'nginx.pid')
+        os.environ['FAKE_NGINX_PID'] = str(os.getpid())
+        os.environ['FAKE_NGINX_CONF_DIR'] = os.path.join(self.dir, 'terminal')
+
+        class Agent(pxeserveragent.PxeServerAgent):
+            DNSMASQ_CONF_PATH = lib + 'dnsmasq/dnsmasq.conf'
+            VSFTPD_CONF_PATH = lib + 'vsftpd/vsftpd.conf'
+            NOVNC_INSTALL_PATH = novnc
+            NOVNC_TOKEN_PATH = novnc + 'tokens/'
+            NGINX_TERMINAL_PROXY_CONF_PATH = os.path.join(self.dir, 'terminal')
+            NGINX_PID_PATH = os.path.join(self.dir, 'nginx.pid')
+
+        self.Agent = Agent
+        self.agents = []
+
+    def tearDown(self):
+        for agent in self.agents:
+            for p in agent.services.processes:
+                if p.pid:
+                    try:
+                        os.kill(p.pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _write_bin(self, path, content):
+        with open(path, 'w') as fd:
+            fd.write(content % {'python': sys.executable})
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+    def _agent(self):
+        agent = self.Agent()
+        self.agents.append(agent)
+        return agent
+
+    def _loaded(self):
+        with open(os.path.join(self.dir, 'loaded')) as fd:
+            return set(fd.read().split())
+
+    def _forks(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as fd:
+            return fd.read().splitlines()
+
+    @staticmethod
+    def _req(**kwargs):
+        return {http.REQUEST_BODY: jsonobject.dumps(kwargs)}
+
+    def test_daemons_started_once(self):
+        agent = self._agent()
+        agent._start_pxe_server()
+        forks = self._forks()
+        self.assertEqual(['dnsmasq', 'vsftpd', 'python', 'systemctl'], [f.split()[0] for f in forks])
+
+        # ping keeps the services up with in memory checks only
+        for _ in range(100):
+            agent._start_pxe_server()
+        self.assertEqual(forks, self._forks())
+
+        dnsmasq = agent.services.processes[0]
+        os.kill(dnsmasq.pid, signal.SIGKILL)
+        dnsmasq.popen.wait()
+        agent._start_pxe_server()
+        self.assertEqual(len(forks) + 1, len(self._forks()))
+        self.assertTrue(self._forks()[-1].startswith('dnsmasq'))
+
+    def test_restarted_agent_adopts_daemons(self):
+        agent = self._agent()
+        agent._start_pxe_server()
+        pids = [p.pid for p in agent.services.processes]
+        forks = len(self._forks())
+
+        agent = self._agent()
+        agent._start_pxe_server()
+        self.assertEqual(pids, [p.pid for p in agent.services.processes])
+        # a single nginx reload in case its config was changed meanwhile
+        self.assertEqual(['systemctl reload nginx'], self._forks()[forks:])
+
+        agent._stop_pxe_server()
+        self.assertTrue(all(not p.is_alive() for p in agent.services.processes))
+
+    def test_proxy_changes_coalesced(self):
+        agent = self._agent()
+        agent._start_pxe_server()
+        forks = len(self._forks())
+
+        errors = []
+
+        def create(i):
+            try:
+                uuid = 'bm-%d' % i
+                rsp = jsonobject.loads(agent.create_bm_nginx_proxy(
+                    self._req(bmUuid=uuid, upstream='location /%s { }' % uuid)))
+                self.assertTrue(rsp.success)
+                # nginx has loaded the proxy by the reply
+                self.assertIn(uuid, self._loaded())
+                agent.create_bm_novnc_proxy(self._req(bmUuid=uuid, upstream='%s: 127.0.0.1:5900' % uuid))
+            except Exception as e:
+                errors.append(e)
+
+        # requests sent back to back, each served by a thread of the http server
+        start = time.time()
+        threads = []
+        for i in range(PROXIES):
+            t = threading.Thread(target=create, args=(i,))
+            t.start()
+            threads.append(t)
+            time.sleep(0.0005)
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        self.assertEqual([], errors)
+
+        new_forks = self._forks()[forks:]
+        reloads = [f for f in new_forks if f.startswith('systemctl reload nginx')]
+        sys.stderr.write('\n%d nginx and %d novnc proxies back to back in %.3fs, %d reloads, %d forks\n'
+                         % (PROXIES, PROXIES, elapsed, len(reloads), len(new_forks)))
+        self.assertEqual(reloads, new_forks)
+        # one reload for the window, one for the changes asked for while it ran
+        self.assertLessEqual(len(reloads), 2)
+        self.assertEqual(PROXIES, len(os.listdir(self.Agent.NOVNC_TOKEN_PATH)))
+        self.assertEqual(PROXIES, len(os.listdir(self.Agent.NGINX_TERMINAL_PROXY_CONF_PATH)))
+
+        agent.delete_bm_nginx_proxy(self._req(bmUuid='bm-0'))
+        self.assertNotIn('bm-0', self._loaded())
+        self.assertEqual(len(reloads) + 1, agent.nginx.reloads)
+
+    def test_failed_reload_replied(self):
+        agent = self._agent()
+        agent._start_pxe_server()
+        self._write_bin(os.path.join(self.bin, 'systemctl'), '#!/bin/sh\necho "nginx.conf invalid" >&2\nexit 1\n')
+        rsp = jsonobject.loads(agent.create_bm_nginx_proxy(self._req(bmUuid='bm-0', upstream='location / { }')))
+        self.assertFalse(rsp.success)
+        self.assertIn('nginx.conf invalid', rsp.error)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,9 +4,8 @@ import os
 import os.path
 import pprint
 import traceback
-import urllib2
 import urlparse
-import tempfile
+import threading
 
 import zstacklib.utils.daemon as daemon
 import zstacklib.utils.http as http
@@ -18,8 +17,11 @@ from zstacklib.utils.bash import *
 from zstacklib.utils.report import Report
 from zstacklib.utils import shell
 from zstacklib.utils import ceph
-from zstacklib.utils import qemu_img
+from zstacklib.utils import image_import
 from zstacklib.utils import traceable_shell
+from cephbackupstorage import image_fetch
+from cephbackupstorage import metadata_store
+from cephbackupstorage import upload_stream
 from zstacklib.utils.rollback import rollback, rollbackable
 
 logger = log.get_logger(__name__)
@@ -145,12 +147,11 @@ def replyerror(func):
 
 class UploadTask(object):
 
-    def __init__(self, imageUuid, installPath, dstPath, tmpPath):
+    def __init__(self, imageUuid, installPath, dstPath):
         self.completed = False
         self.imageUuid = imageUuid
         self.installPath = installPath
         self.dstPath = dstPath # without 'ceph://'
-        self.tmpPath = tmpPath # where image firstly imported to
         self.expectedSize = 0
         self.downloadedSize = 0
         self.progress = 0
@@ -207,37 +208,6 @@ class UploadTasks(object):
 
 # ------------------------------------------------------------------ #
 
-class ProgressedFileWriter(object):
-    def __init__(self, wfd, pfunc):
-        self.wfd = wfd
-        self.pfunc = pfunc
-        self.bytesWritten = 0
-
-    def write(self, s):
-        self.wfd.write(s)
-        self.bytesWritten += len(s)
-        self.pfunc(self.bytesWritten)
-
-    def seek(self, offset, whence=None):
-        pass
-
-import cherrypy
-class CustomPart(cherrypy._cpreqbody.Part):
-    """A customized multipart"""
-    maxrambytes = 0
-
-    def __init__(self, fp, headers, boundary, fifopath, pfunc):
-        cherrypy._cpreqbody.Part.__init__(self, fp, headers, boundary)
-        self.wfd = None
-        self.file = None
-        self.value = None
-        self.fifopath = fifopath
-        self.pfunc = pfunc
-
-    def make_file(self):
-        self.wfd = open(self.fifopath, 'w')
-        return ProgressedFileWriter(self.wfd, self.pfunc)
-
 def get_boundary(entity):
     ib = ""
     if 'boundary' in entity.content_type.params:
@@ -264,88 +234,49 @@ def get_boundary(entity):
 
     return ib
 
-def get_image_format_from_buf(qhdr):
-    if qhdr[:4] == 'QFI\xfb':
-        if qhdr[16:20] == '\x00\x00\x00\00':
-            return "qcow2"
-        else:
-            return "derivedQcow2"
-
-    if qhdr[0x8001:0x8006] == 'CD001':
-        return 'iso'
-
-    if qhdr[0x8801:0x8806] == 'CD001':
-        return 'iso'
-
-    if qhdr[0x9001:0x9006] == 'CD001':
-        return 'iso'
-    return "raw"
-
-
-def stream_body(task, fpath, entity, boundary):
+def stream_body(task, entity, boundary):
     def _progress_consumer(total):
         task.downloadedSize = total
 
-    @thread.AsyncThread
-    def _do_import(task, fpath):
-        shell.check_run("cat %s | rbd import --image-format 2 - %s" % (fpath, task.tmpPath))
-
-    while True:
-        headers = cherrypy._cpreqbody.Part.read_headers(entity.fp)
-        p = CustomPart(entity.fp, headers, boundary, fpath, _progress_consumer)
-        if not p.filename:
-            continue
-
-        # start consumer
-        _do_import(task, fpath)
-        try:
-            p.process()
-        except Exception as e:
-            logger.warn('process image %s failed: %s' % (task.imageUuid, str(e)))
-            pass
-        finally:
-            if p.wfd is not None:
-                p.wfd.close()
-        break
-
-    if task.downloadedSize != task.expectedSize:
-        task.fail('incomplete upload, got %d, expect %d' % (task.downloadedSize, task.expectedSize))
-        shell.run('rbd rm %s' % task.tmpPath)
-        return
-
-    file_format = None
-
+    # qcow2 is converted to raw while it is written to the image
+    target = image_import.RbdTarget(task.dstPath)
+    importer = image_import.ImageImporter(target)
+    sink = upload_stream.ProgressedSink(importer, _progress_consumer)
+    reader = upload_stream.MultipartReader(entity.fp, boundary)
+    import_error = None
     try:
-        file_format = linux.get_img_fmt('rbd:'+task.tmpPath)
+        while True:
+            headers = reader.next_part()
+            if headers is None:
+                break
+            if not upload_stream.part_filename(headers):
+                reader.copy_part()
+                continue
+
+            reader.copy_part(sink.write)
+            break
+    except image_import.ImageImportError as e:
+        import_error = e
     except Exception as e:
-        task.fail('upload image %s failed: %s' % (task.imageUuid, str(e)))
-        return
+        logger.warn('process image %s failed: %s' % (task.imageUuid, str(e)))
+    sink.report()
 
-    if file_format == 'qcow2':
-        if linux.qcow2_get_backing_file('rbd:'+task.tmpPath):
-            task.fail('Qcow2 image %s has backing file' % task.imageUuid)
-            shell.run('rbd rm %s' % task.tmpPath)
-            return
+    if import_error is None and task.downloadedSize != task.expectedSize:
+        import_error = 'incomplete upload, got %d, expect %d' % (task.downloadedSize, task.expectedSize)
 
-        conf_path = None
+    if import_error is None:
         try:
-            with open('/etc/ceph/ceph.conf', 'r') as fd:
-                conf = fd.read()
-                conf = '%s\n%s\n' % (conf, 'rbd default format = 2')
-                conf_path = linux.write_to_temp_file(conf)
-
-            shell.check_run('%s -f qcow2 -O rbd rbd:%s rbd:%s:conf=%s' % 
-                    (qemu_img.subcmd('convert'), task.tmpPath, task.dstPath, conf_path))
+            importer.close()
         except Exception as e:
-            task.fail('cannot convert Qcow2 image %s to rbd' % task.imageUuid)
-            logger.warn('convert image %s failed: %s', (task.imageUuid, str(e)))
-            return
-        finally:
-            shell.run('rbd rm %s' % task.tmpPath)
-            if conf_path:
-                os.remove(conf_path)
-    else:
-        shell.check_run('rbd mv %s %s' % (task.tmpPath, task.dstPath))
+            import_error = 'upload image %s failed: %s' % (task.imageUuid, str(e))
+
+    if import_error is not None:
+        importer.abort()
+        task.fail(str(import_error))
+        # not an image of the same path made by others
+        if target.created:
+            shell.run('rbd rm %s' % task.dstPath)
+        return
 
     task.success()
 
@@ -370,7 +301,6 @@ class CephAgent(object):
     GET_LOCAL_FILE_SIZE = "/ceph/backupstorage/getlocalfilesize/"
     MIGRATE_IMAGE_PATH = "/ceph/backupstorage/image/migrate"
 
-    CEPH_METADATA_FILE = "bs_ceph_info.json"
     UPLOAD_PROTO = "upload://"
     LENGTH_OF_UUID = 32
 
@@ -379,6 +309,8 @@ class CephAgent(object):
     upload_tasks = UploadTasks()
 
     def __init__(self):
+        self.metadata_stores = {}
+        self.metadata_stores_lock = threading.Lock()
         self.http_server.register_async_uri(self.INIT_PATH, self.init)
         self.http_server.register_async_uri(self.DOWNLOAD_IMAGE_PATH, self.download)
         self.http_server.register_raw_uri(self.UPLOAD_IMAGE_PATH, self.upload)
@@ -470,105 +402,77 @@ class CephAgent(object):
         with open(path) as f:
             return f.read()
 
+    def _get_metadata_store(self, pool_name):
+        bs_uuid = pool_name.split("-")[-1]
+        with self.metadata_stores_lock:
+            store = self.metadata_stores.get(bs_uuid)
+            if store is None:
+                store = metadata_store.ImageMetadataStore(metadata_store.RadosObjectStore("bak-t-%s" % bs_uuid))
+                self.metadata_stores[bs_uuid] = store
+            return store
+
     @in_bash
     @replyerror
     def get_images_metadata(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        pool_name = cmd.poolName
-        bs_uuid = pool_name.split("-")[-1]
-        valid_images_info = ""
-        self.get_metadata_file(bs_uuid, self.CEPH_METADATA_FILE)
+        images_info = self._get_metadata_store(cmd.poolName).list()
+
+        images = []
+        for image_info in images_info:
+            image_json = jsonobject.loads(image_info)
+            # todo support multiple bs
+            images.append((image_json['uuid'], image_json["backupStorageRefs"][0]["installPath"], image_info))
+
+        # one listing of every pool instead of checking images one by one
+        pool_images = {}
+        for pool in set(install_path.split("//")[1].split("/")[0] for _, install_path, _ in images):
+            ret, output = bash_ro("rbd ls %s" % pool)
+            pool_images[pool] = set(output.split()) if ret == 0 else set()
+
+        valid_images_info = []
         last_image_install_path = ""
-        bs_ceph_info_file = "/tmp/%s" % self.CEPH_METADATA_FILE
-        with open(bs_ceph_info_file) as fd:
-            images_info = fd.read()
-            for image_info in images_info.split('\n'):
-                if image_info != '':
-                    image_json = jsonobject.loads(image_info)
-                    # todo support multiple bs
-                    image_uuid = image_json['uuid']
-                    image_install_path = image_json["backupStorageRefs"][0]["installPath"]
-                    ret = bash_r("rbd info %s" % image_install_path.split("//")[1])
-                    if ret == 0 :
-                        logger.info("Check image %s install path %s successfully!" % (image_uuid, image_install_path))
-                        if image_install_path != last_image_install_path:
-                            valid_images_info = image_info + '\n' + valid_images_info
-                            last_image_install_path = image_install_path
-                    else:
-                        logger.warn("Image %s install path %s is invalid!" % (image_uuid, image_install_path))
-
-        self.put_metadata_file(bs_uuid, self.CEPH_METADATA_FILE)
+        for image_uuid, image_install_path, image_info in images:
+            pool, image_name = image_install_path.split("//")[1].split("/", 1)
+            if image_name in pool_images[pool]:
+                if image_install_path != last_image_install_path:
+                    valid_images_info.append(image_info)
+                    last_image_install_path = image_install_path
+            else:
+                logger.warn("Image %s install path %s is invalid!" % (image_uuid, image_install_path))
+        logger.info("Checked install paths of %d images, %d are valid" % (len(images), len(valid_images_info)))
+
         rsp = GetImageMetaDataResponse()
-        rsp.imagesMetadata= valid_images_info
+        rsp.imagesMetadata = ''.join(image_info + '\n' for image_info in reversed(valid_images_info))
         return jsonobject.dumps(rsp)
 
     @in_bash
     @replyerror
     def check_image_metadata_file_exist(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        pool_name = cmd.poolName
-        bs_uuid = pool_name.split("-")[-1]
         rsp = CheckImageMetaDataFileExistResponse()
-        rsp.backupStorageMetaFileName = self.CEPH_METADATA_FILE
-        ret, output = bash_ro("rados -p bak-t-%s stat %s" % (bs_uuid,self.CEPH_METADATA_FILE))
-        if ret == 0:
-            rsp.exist = True
-        else:
-            rsp.exist = False
+        # the metadata is kept as objects of metadata_store, in no file
+        rsp.exist = self._get_metadata_store(cmd.poolName).exists()
         return jsonobject.dumps(rsp)
 
-    def get_metadata_file(self, bs_uuid, file_name):
-        local_file_name = "/tmp/%s" % file_name
-        linux.rm_file_force(local_file_name)
-        bash_ro("rados -p bak-t-%s get %s %s" % (bs_uuid, file_name, local_file_name))
-
-    def put_metadata_file(self, bs_uuid, file_name):
-        local_file_name = "/tmp/%s" % file_name
-        ret, output = bash_ro("rados -p bak-t-%s put %s %s" % (bs_uuid, file_name, local_file_name))
-        if ret == 0:
-            linux.rm_file_force(local_file_name)
-
     @in_bash
     @replyerror
     def dump_image_metadata_to_file(self, req):
-
-        def _write_info_to_metadata_file(fd):
-            strip_list_content = content[1:-1]
-            data_list = strip_list_content.split('},')
-            for item in data_list:
-                if item.endswith("}") is not True:
-                    item = item + "}"
-                    fd.write(item + '\n')
-
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        pool_name = cmd.poolName
-        bs_uuid = pool_name.split("-")[-1]
         content = cmd.imageMetaData
-        dump_all_metadata = cmd.dumpAllMetaData
-        if dump_all_metadata is True:
-            # this means no metadata exist in ceph
-            bash_r("touch /tmp/%s" % self.CEPH_METADATA_FILE)
-        else:
-            self.get_metadata_file(bs_uuid, self.CEPH_METADATA_FILE)
-        bs_ceph_info_file = "/tmp/%s" % self.CEPH_METADATA_FILE
+        lines = []
         if content is not None:
             if '[' == content[0] and ']' == content[-1]:
-                if dump_all_metadata is True:
-                    with open(bs_ceph_info_file, 'w') as fd:
-                        _write_info_to_metadata_file(fd)
-                else:
-                    with open(bs_ceph_info_file, 'a') as fd:
-                        _write_info_to_metadata_file(fd)
+                lines = [jsonobject.dumps(item) for item in jsonobject.loads(content)]
             else:
                 # one image info
-                if dump_all_metadata is True:
-                    with open(bs_ceph_info_file, 'w') as fd:
-                        fd.write(content + '\n')
-                else:
-                    with open(bs_ceph_info_file, 'a') as fd:
-                        fd.write(content + '\n')
-
-        self.put_metadata_file(bs_uuid, self.CEPH_METADATA_FILE)
+                lines = [content]
+
+        store = self._get_metadata_store(cmd.poolName)
+        if cmd.dumpAllMetaData is True:
+            # this means no metadata exist in ceph
+            store.reset(lines)
+        else:
+            store.add(lines)
         rsp = DumpImageMetaDataToFileResponse()
         return jsonobject.dumps(rsp)
 
@@ -576,15 +480,9 @@ class CephAgent(object):
     @replyerror
     def delete_image_metadata_from_file(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        image_uuid = cmd.imageUuid
-        pool_name = cmd.poolName
-        bs_uuid = pool_name.split("-")[-1]
-        self.get_metadata_file(bs_uuid, self.CEPH_METADATA_FILE)
-        bs_ceph_info_file = "/tmp/%s" % self.CEPH_METADATA_FILE
-        ret, output = bash_ro("sed -i.bak '/%s/d' %s" % (image_uuid, bs_ceph_info_file))
-        self.put_metadata_file(bs_uuid, self.CEPH_METADATA_FILE)
+        self._get_metadata_store(cmd.poolName).delete(cmd.imageUuid)
         rsp = DeleteImageMetaDataResponse()
-        rsp.ret = ret
+        rsp.ret = 0
         return jsonobject.dumps(rsp)
 
 
@@ -644,11 +542,6 @@ class CephAgent(object):
         task.fail(reason)
         raise Exception(reason)
 
-    def _get_fifopath(self, uu):
-        import tempfile
-        d = tempfile.gettempdir()
-        return os.path.join(d, uu)
-
     # handler for multipart upload, requires:
     # - header X-IMAGE-UUID
     # - header X-IMAGE-SIZE
@@ -671,26 +564,16 @@ class CephAgent(object):
             self._fail_task(task, 'unexpected post form')
 
         try:
-            # prepare the fifo to save image upload
-            fpath = self._get_fifopath(imageUuid)
-            linux.rm_file_force(fpath)
-            os.mkfifo(fpath)
-            stream_body(task, fpath, entity, boundary)
+            stream_body(task, entity, boundary)
         except Exception as e:
             self._fail_task(task, str(e))
-        finally:
-            linux.rm_file_force(fpath)
 
     def _prepare_upload(self, cmd):
         start = len(self.UPLOAD_PROTO)
         imageUuid = cmd.url[start:start+self.LENGTH_OF_UUID]
         dstPath = self._normalize_install_path(cmd.installPath)
 
-        pool, image_name = self._parse_install_path(cmd.installPath)
-        tmp_image_name = 'tmp-%s' % image_name
-        tmpPath = '%s/%s' % (pool, tmp_image_name)
-
-        task = UploadTask(imageUuid, cmd.installPath, dstPath, tmpPath)
+        task = UploadTask(imageUuid, cmd.installPath, dstPath)
         self.upload_tasks.add_task(task)
 
     def _get_upload_path(self, req):
@@ -726,61 +609,16 @@ class CephAgent(object):
     def download(self, req):
         rsp = DownloadRsp()
 
-        def _get_origin_format(path):
-            qcow2_length = 0x9007
-            if path.startswith('http://') or path.startswith('https://') or path.startswith('ftp://'):
-                resp = urllib2.urlopen(path)
-                qhdr = resp.read(qcow2_length)
-                resp.close()
-            elif path.startswith('sftp://'):
-                fd, tmp_file = tempfile.mkstemp()
-                get_header_from_pipe_cmd = "timeout 60 head --bytes=%d %s > %s" % (qcow2_length, pipe_path, tmp_file)
-                clean_cmd = "pkill -f %s" % pipe_path
-                shell.run('%s & %s && %s' % (scp_to_pipe_cmd, get_header_from_pipe_cmd, clean_cmd))
-                qhdr = os.read(fd, qcow2_length)
-                if os.path.exists(tmp_file):
-                    os.remove(tmp_file)
-            else:
-                resp = open(path)
-                qhdr = resp.read(qcow2_length)
-                resp.close()
-            if len(qhdr) < qcow2_length:
-                return "raw"
-
-            return get_image_format_from_buf(qhdr)
-
-        def get_origin_format(fpath, fail_if_has_backing_file=True):
-            image_format = _get_origin_format(fpath)
-            if image_format == "derivedQcow2" and fail_if_has_backing_file:
-                raise Exception('image has backing file or %s is not exist!' % fpath)
-            return image_format
-
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         shell = traceable_shell.get_shell(cmd)
         pool, image_name = self._parse_install_path(cmd.installPath)
-        tmp_image_name = 'tmp-%s' % image_name
+        # the format is sniffed from the stream, a qcow2 image is converted
+        # to raw while it is written to the image
+        import_cmd = image_import.get_import_cmd('rbd:%s/%s' % (pool, image_name))
 
         @rollbackable
         def _1():
-            shell.check_run('rbd rm %s/%s' % (pool, tmp_image_name))
-
-        def _getRealSize(length):
-            '''length looks like: 10245K'''
-            logger.debug(length)
-            if not length[-1].isalpha():
-                return length
-            units = {
-                "g": lambda x: x * 1024 * 1024 * 1024,
-                "m": lambda x: x * 1024 * 1024,
-                "k": lambda x: x * 1024,
-            }
-            try:
-                if not length[-1].isalpha():
-                    return length
-                return units[length[-1].lower()](int(length[:-1]))
-            except:
-                logger.warn(linux.get_exception_stacktrace())
-                return length
+            shell.check_run('rbd rm %s/%s' % (pool, image_name))
 
         # whether we have an upload request
         if cmd.url.startswith(self.UPLOAD_PROTO):
@@ -799,126 +637,41 @@ class CephAgent(object):
         report.progress_report("0", "start")
 
         url = urlparse.urlparse(cmd.url)
-        if url.scheme in ('http', 'https', 'ftp'):
-            image_format = get_origin_format(cmd.url, True)
-            cmd.url = linux.shellquote(cmd.url)
-            # roll back tmp ceph file after import it
+        if url.scheme in ('http', 'https', 'ftp', 'sftp'):
+            stream = image_fetch.open_url(cmd.url)
+            # roll back the image if the import fails
             _1()
 
-            _, PFILE = tempfile.mkstemp()
-            content_length = shell.call("""curl -sLI %s|awk '/[cC]ontent-[lL]ength/{print $NF}'""" % cmd.url).splitlines()[-1]
-            total = _getRealSize(content_length)
-
-            def _getProgress(synced):
-                last = linux.tail_1(PFILE).strip()
-                if not last or len(last.split()) < 1 or 'HTTP request sent, awaiting response' in last:
-                    return synced
-                logger.debug("last synced: %s" % last)
-                written = _getRealSize(last.split()[0])
-                if total > 0 and synced < written:
-                    synced = written
-                    if synced < total:
-                        percent = int(round(float(synced) / float(total) * 90))
-                        report.progress_report(percent, "report")
-                return synced
-
-            logger.debug("content-length is: %s" % total)
-
-            _, _, err = shell.bash_progress_1('set -o pipefail;wget --no-check-certificate -O - %s 2>%s| rbd import --image-format 2 - %s/%s'
-                       % (cmd.url, PFILE, pool, tmp_image_name), _getProgress)
-            if err:
-                raise err
-            actual_size = linux.get_file_size_by_http_head(cmd.url)
-
-            if os.path.exists(PFILE):
-                os.remove(PFILE)
-
-        elif url.scheme == 'sftp':
-            port = (url.port, 22)[url.port is None]
-            _, PFILE = tempfile.mkstemp()
-            ssh_pswd_file = None
-            pipe_path = PFILE + "fifo"
-            scp_to_pipe_cmd = "scp -P %d -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %s@%s:%s %s" % (port, url.username, url.hostname, url.path, pipe_path)
-            sftp_command = "sftp -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o BatchMode=no -P %s -b /dev/stdin %s@%s" % (port, url.username, url.hostname) + " <<EOF\n%s\nEOF\n"
-            if url.password is not None:
-                ssh_pswd_file = linux.write_to_temp_file(url.password)
-                scp_to_pipe_cmd = 'sshpass -f %s %s' % (ssh_pswd_file, scp_to_pipe_cmd)
-                sftp_command = 'sshpass -f %s %s' % (ssh_pswd_file, sftp_command)
-
-            actual_size = shell.call(sftp_command % ("ls -l " + url.path)).splitlines()[1].strip().split()[4]
-            os.mkfifo(pipe_path)
-            image_format = get_origin_format(cmd.url, True)
-            cmd.url = linux.shellquote(cmd.url)
-            # roll back tmp ceph file after import it
-            _1()
+            last_percent = [0]
 
-            def _get_progress(synced):
-                if not os.path.exists(PFILE):
-                    return synced
-                last = linux.tail_1(PFILE).strip()
-                if not last or not last.isdigit():
-                    return synced
-                report.progress_report(int(last)*90/100, "report")
-                return synced
+            def _report_progress(consumed):
+                if not stream.size:
+                    return
+                percent = int(consumed * 90 / stream.size)
+                if percent > last_percent[0]:
+                    last_percent[0] = percent
+                    report.progress_report(percent, "report")
 
-            get_content_from_pipe_cmd = "pv -s %s -n %s 2>%s" % (actual_size, pipe_path, PFILE)
-            import_from_pipe_cmd = "rbd import --image-format 2 - %s/%s" % (pool, tmp_image_name)
-            _, _, err = shell.bash_progress_1('set -o pipefail; %s & %s | %s' %
-                                        (scp_to_pipe_cmd, get_content_from_pipe_cmd, import_from_pipe_cmd), _get_progress)
-
-            if ssh_pswd_file:
-                linux.rm_file_force(ssh_pswd_file)
-
-            linux.rm_file_force(PFILE)
-            linux.rm_file_force(pipe_path)
-
-            if err:
-                raise err
+            # the traceable wrapper lets a job cancel kill the import
+            out = image_fetch.import_stream(stream, shell.wrap_bash_cmd(import_cmd), _report_progress)
+            actual_size = stream.size if stream.size is not None else stream.consumed
 
         elif url.scheme == 'file':
             src_path = cmd.url.lstrip('file:')
             src_path = os.path.normpath(src_path)
             if not os.path.isfile(src_path):
                 raise Exception('cannot find the file[%s]' % src_path)
-            image_format = get_origin_format(src_path, True)
-            # roll back tmp ceph file after import it
+            # roll back the image if the import fails
             _1()
 
-            shell.check_run("rbd import --image-format 2 %s %s/%s" % (src_path, pool, tmp_image_name))
+            out = shell.call("%s < %s" % (import_cmd, src_path))
             actual_size = os.path.getsize(src_path)
         else:
             raise Exception('unknown url[%s]' % cmd.url)
 
-        file_format = shell.call("set -o pipefail; %s rbd:%s/%s | grep 'file format' | cut -d ':' -f 2" %
-                (qemu_img.subcmd('info'), pool, tmp_image_name))
-        file_format = file_format.strip()
-        if file_format not in ['qcow2', 'raw']:
-            raise Exception('unknown image format: %s' % file_format)
-
-        if file_format == 'qcow2':
-            conf_path = None
-            try:
-                with open('/etc/ceph/ceph.conf', 'r') as fd:
-                    conf = fd.read()
-                    conf = '%s\n%s\n' % (conf, 'rbd default format = 2')
-                    conf_path = linux.write_to_temp_file(conf)
-
-                shell.check_run('%s -f qcow2 -O rbd rbd:%s/%s rbd:%s/%s:conf=%s' % 
-                        (qemu_img.subcmd('convert'), pool, tmp_image_name, pool, image_name, conf_path))
-                shell.check_run('rbd rm %s/%s' % (pool, tmp_image_name))
-            finally:
-                if conf_path:
-                    os.remove(conf_path)
-        else:
-            shell.check_run('rbd mv %s/%s %s/%s' % (pool, tmp_image_name, pool, image_name))
+        image_format = jsonobject.loads(out.strip().splitlines()[-1]).format
         report.progress_report("100", "finish")
 
-        @rollbackable
-        def _2():
-            shell.check_run('rbd rm %s/%s' % (pool, image_name))
-        _2()
-
-
         o = shell.call('rbd --format json info %s/%s' % (pool, image_name))
         image_stats = jsonobject.loads(o)
 
@@ -0,0 +1,308 @@
+'''
+
+image downloads of the ceph backup storage, read by the agent and fed to
+the import command: one request per image and no probing round trips.
+
+The size comes with the transfer, from the content length of the http
+response or, for sftp, from `wc -c` printed by the same ssh session just
+before the data. Http connections are kept alive in a pool and ssh
+sessions to a host share one connection, so concurrent and successive
+imports from one server do not connect again. The master sockets are kept
+in a directory only the agent can enter.
+'''
+import errno
+import httplib
+import os
+import signal
+import socket
+import ssl
+import stat
+import subprocess
+import tempfile
+import threading
+import urllib2
+import urlparse
+
+from zstacklib.utils import linux
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+READ_SIZE = 1024 * 1024
+MAX_REDIRECTS = 5
+MAX_IDLE_CONNECTIONS = 4
+HTTP_TIMEOUT = 60
+SSH_OPTIONS = ['-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null', '-o', 'BatchMode=no',
+               '-o', 'ControlMaster=auto', '-o', 'ControlPersist=60']
+SSH_CONTROL_DIR = '/var/run/zstack/cephbs-ssh'
+
+
+class FetchError(Exception):
+    '''image fetch error'''
+
+
+class HttpStream(object):
+    def __init__(self, pool, key, conn, resp):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        length = resp.getheader('content-length')
+        self.size = long(length) if length and length.isdigit() else None
+        self.consumed = 0
+
+    def read(self, size):
+        data = self.resp.read(size)
+        self.consumed += len(data)
+        return data
+
+    def close(self):
+        # a connection is reused only after its response was read to the end
+        if self.resp.isclosed() and not self.resp.will_close:
+            self.pool.put(self.key, self.conn)
+        else:
+            self.conn.close()
+
+
+class HttpPool(object):
+    '''kept alive http connections by scheme, host and port'''
+
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS):
+        self.max_idle = max_idle
+        self.idle = {}  # type: dict[tuple, list[httplib.HTTPConnection]]
+        self.lock = threading.Lock()
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'http':
+            return httplib.HTTPConnection(host, port, timeout=HTTP_TIMEOUT)
+
+        # as `wget --no-check-certificate` did
+        if hasattr(ssl, '_create_unverified_context'):
+            return httplib.HTTPSConnection(host, port, timeout=HTTP_TIMEOUT,
+                                           context=ssl._create_unverified_context())
+        return httplib.HTTPSConnection(host, port, timeout=HTTP_TIMEOUT)
+
+    def _get(self, key):
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop(), True
+        return self._connect(key), False
+
+    def put(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def _request(self, key, path, headers):
+        conn, reused = self._get(key)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+        # the server closed the idle connection meanwhile
+        conn = self._connect(key)
+        conn.request('GET', path, headers=headers)
+        return conn, conn.getresponse()
+
+    def open(self, url):
+        for _ in range(MAX_REDIRECTS + 1):
+            u = urlparse.urlparse(url)
+            key = (u.scheme, u.hostname, u.port or (443 if u.scheme == 'https' else 80))
+            headers = {}
+            if u.username is not None:
+                auth = '%s:%s' % (urlparse.unquote(u.username), urlparse.unquote(u.password or ''))
+                headers['Authorization'] = 'Basic ' + auth.encode('base64').replace('\n', '')
+            path = (u.path or '/') + ('?' + u.query if u.query else '')
+
+            try:
+                conn, resp = self._request(key, path, headers)
+            except (httplib.HTTPException, socket.error) as e:
+                raise FetchError('cannot get %s: %s' % (url, e))
+
+            stream = HttpStream(self, key, conn, resp)
+            if resp.status in (301, 302, 303, 307, 308) and resp.getheader('location'):
+                resp.read()
+                stream.close()
+                url = urlparse.urljoin(url, resp.getheader('location'))
+                continue
+            if resp.status != 200:
+                stream.conn.close()
+                raise FetchError('cannot get %s: %s %s' % (url, resp.status, resp.reason))
+            return stream
+
+        raise FetchError('too many redirects from %s' % url)
+
+
+class FtpStream(object):
+    def __init__(self, url):
+        try:
+            self.resp = urllib2.urlopen(url, timeout=HTTP_TIMEOUT)
+        except (urllib2.URLError, socket.error) as e:
+            raise FetchError('cannot get %s: %s' % (url, e))
+        length = self.resp.info().getheader('content-length')
+        self.size = long(length) if length and length.isdigit() else None
+        self.consumed = 0
+
+    def read(self, size):
+        data = self.resp.read(size)
+        self.consumed += len(data)
+        return data
+
+    def close(self):
+        self.resp.close()
+
+
+def _ssh_control_dir():
+    '''
+    the directory of the ssh master sockets, owned by the agent and closed
+    to everyone else, as anyone able to connect to a socket rides on its
+    session
+    '''
+    try:
+        os.makedirs(SSH_CONTROL_DIR, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise FetchError('cannot create %s: %s' % (SSH_CONTROL_DIR, e))
+
+    st = os.lstat(SSH_CONTROL_DIR)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise FetchError('%s is not a directory of the agent' % SSH_CONTROL_DIR)
+    if stat.S_IMODE(st.st_mode) != 0700:
+        os.chmod(SSH_CONTROL_DIR, 0700)
+    return SSH_CONTROL_DIR
+
+
+class SshStream(object):
+    '''a remote file printed after its size by one ssh session'''
+
+    def __init__(self, url):
+        u = urlparse.urlparse(url)
+        self.process = None
+        self.password_file = None
+        self.err = tempfile.TemporaryFile()
+        self.consumed = 0
+
+        args = ['ssh'] + SSH_OPTIONS + ['-o', 'ControlPath=%s/%%C' % _ssh_control_dir(),
+                                        '-p', str(u.port or 22), '%s@%s' % (u.username, u.hostname),
+                                        'wc -c < %s && exec cat %s' % (linux.shellquote(u.path), linux.shellquote(u.path))]
+        try:
+            if u.password is not None:
+                self.password_file = linux.write_to_temp_file(u.password)
+                args = ['sshpass', '-f', self.password_file] + args
+
+            # stderr goes to a file, a persisted master connection keeps it open
+            with open(os.devnull) as devnull:
+                self.process = subprocess.Popen(args, stdin=devnull, stdout=subprocess.PIPE, stderr=self.err,
+                                                close_fds=True)
+            size = self.process.stdout.readline().strip()
+        except (OSError, IOError) as e:
+            self.close()
+            raise FetchError('cannot get %s: %s' % (url, e))
+        except:
+            self.close()
+            raise
+
+        if not size.isdigit():
+            self.close()
+            raise FetchError('cannot get %s: %s' % (url, self._error()))
+        self.size = long(size)
+
+    def _error(self):
+        self.err.seek(0)
+        return self.err.read().strip() or 'ssh exits with %s' % self.process.returncode
+
+    def read(self, size):
+        data = self.process.stdout.read(size)
+        if not data and self.process.wait() != 0:
+            raise FetchError('cannot read image stream: %s' % self._error())
+        self.consumed += len(data)
+        return data
+
+    def close(self):
+        if self.process:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+        if self.password_file:
+            linux.rm_file_force(self.password_file)
+            self.password_file = None
+
+
+http_pool = HttpPool()
+
+
+def open_url(url):
+    '''
+    a stream of the image at `url` with its `size`, None if the server did
+    not tell. `consumed` counts the bytes read from it
+    '''
+    scheme = urlparse.urlparse(url).scheme
+    if scheme in ('http', 'https'):
+        return http_pool.open(url)
+    if scheme == 'ftp':
+        return FtpStream(url)
+    if scheme == 'sftp':
+        return SshStream(url)
+    raise FetchError('unsupported url %s' % url)
+
+
+def import_stream(stream, import_cmd, on_progress=None):
+    '''
+    write `stream` to the stdin of the shell command `import_cmd` and
+    return its output. `on_progress(consumed)` is called after every read
+    '''
+    out = tempfile.TemporaryFile()
+    err = tempfile.TemporaryFile()
+    # in a process group of its own, so a failed import is killed with the
+    # commands the shell started
+    p = subprocess.Popen(import_cmd, shell=True, stdin=subprocess.PIPE, stdout=out, stderr=err, close_fds=True,
+                         preexec_fn=os.setsid)
+    error = None
+    try:
+        while True:
+            data = stream.read(READ_SIZE)
+            if not data:
+                break
+            p.stdin.write(data)
+            if on_progress:
+                on_progress(stream.consumed)
+
+        if stream.size is not None and stream.consumed != stream.size:
+            error = 'image stream ends at %d of %d bytes' % (stream.consumed, stream.size)
+    except IOError as e:
+        # the import exits early, or is killed by a job cancel
+        if e.errno != errno.EPIPE:
+            error = 'cannot read image stream: %s' % e
+    except (httplib.HTTPException, socket.error) as e:
+        error = 'cannot read image stream: %s' % e
+    except FetchError as e:
+        error = str(e)
+
+    if error:
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    try:
+        p.stdin.close()
+    except IOError:
+        pass
+    ret = p.wait()
+    stream.close()
+
+    if error:
+        raise FetchError(error)
+    err.seek(0)
+    if ret != 0:
+        raise FetchError('import exits with %d: %s' % (ret, err.read().strip()))
+    out.seek(0)
+    return out.read()
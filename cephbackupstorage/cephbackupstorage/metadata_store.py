@@ -0,0 +1,342 @@
+'''
+
+image metadata of a ceph backup storage, kept as rados objects.
+
+The catalog is a compacted index object of some generation, plus a
+journal of the images changed since, both named by the generation. A head
+object names the current generation and how many records of the previous
+journal its index holds.
+
+A writer appends the metadata lines of the images it adds, or the uuids of
+the images it deletes, to the journal of the head generation, all of one
+call at once. A reader loads an index once and then only reads the journal
+records after what it has read before. When the journal grows long, it is
+compacted into the index of the next generation. The switch is versioned
+by an exclusively created claim object, so one writer wins and the others
+go on. Records appended to the old journal after it was compacted are
+carried to the new one, by the compactor and by the writer which finds the
+head moved. A carried record may land after a later write of its image, so
+it is marked and does not override a record of the image before it.
+
+A reader finding the head one generation on reads the rest of the previous
+journal up to the records held by the new index instead of the index. Only
+a reader more than one generation behind, or one after a reset, reads the
+whole index again.
+'''
+import collections
+import re
+import subprocess
+import threading
+import time
+
+from zstacklib.utils import jsonobject
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+PREFIX = 'zs-image-metadata.'
+HEAD = PREFIX + 'head'
+LEGACY_METADATA_FILE = 'bs_ceph_info.json'
+
+# journal records compacted into a new index
+COMPACT_RECORDS = 1000
+# a compaction claimed longer ago is taken as crashed
+CLAIM_TIMEOUT = 60
+# the mark of a journal record carried from the previous journal
+CARRIED = '+'
+
+
+def _index(gen):
+    return '%sindex.%d' % (PREFIX, gen)
+
+
+def _journal(gen):
+    return '%sjournal.%d' % (PREFIX, gen)
+
+
+def _claim(gen):
+    return '%scompact.%d' % (PREFIX, gen)
+
+
+def _carried(record):
+    return record if record.startswith(CARRIED) else CARRIED + record
+
+
+class MetadataStoreError(Exception):
+    ''' metadata store error '''
+
+
+class RadosObjectStore(object):
+    '''
+    objects of a pool, through the rados command. put() and append() are
+    atomic, create() is exclusive
+    '''
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def _rados(self, args, data=None):
+        p = subprocess.Popen(['rados', '-p', self.pool] + args, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        out, err = p.communicate(data)
+        return p.returncode, out, err
+
+    def _check(self, args, data=None, missing_ok=False):
+        ret, out, err = self._rados(args, data)
+        if ret == 0:
+            return out
+        if missing_ok and 'No such file or directory' in err:
+            return None
+        raise MetadataStoreError('rados %s %s failed, return code: %s, stderr: %s' %
+                                 (args[0], args[1], ret, err.strip()))
+
+    def get(self, name):
+        return self._check(['get', name, '-'], missing_ok=True)
+
+    def put(self, name, data):
+        self._check(['put', name, '-'], data)
+
+    def append(self, name, data):
+        self._check(['append', name, '-'], data)
+
+    def create(self, name):
+        ret, _, err = self._rados(['create', name])
+        if ret == 0:
+            return True
+        if 'File exists' in err:
+            return False
+        raise MetadataStoreError('rados create %s failed, return code: %s, stderr: %s' % (name, ret, err.strip()))
+
+    def remove(self, name):
+        return self._check(['rm', name], missing_ok=True) is not None
+
+    def stat(self, name):
+        '''
+        (size, mtime) of the object, None if it does not exist
+        '''
+        out = self._check(['stat', name], missing_ok=True)
+        if out is None:
+            return None
+        m = re.search(r'mtime (\d{4}-\d\d-\d\d)[ T](\d\d:\d\d:\d\d).*size (\d+)', out)
+        if not m:
+            raise MetadataStoreError('unexpected rados stat output: %s' % out)
+        mtime = time.mktime(time.strptime('%s %s' % (m.group(1), m.group(2)), '%Y-%m-%d %H:%M:%S'))
+        return int(m.group(3)), mtime
+
+
+def get_image_uuid(line):
+    return jsonobject.loads(line)['uuid']
+
+
+class ImageMetadataStore(object):
+    '''
+    the metadata lines of the images of a backup storage in `store`, in the
+    order they were written. Instances keep what they have read, one is
+    meant to be used per pool for the life of the agent
+    '''
+
+    def __init__(self, store, compact_records=COMPACT_RECORDS):
+        self.store = store
+        self.compact_records = compact_records
+        self.lock = threading.Lock()
+        self.gen = None
+        self.images = collections.OrderedDict()
+        # journal records of self.gen already read
+        self.records = 0
+        # images of the records of self.gen read which were not carried
+        self.written = set()
+
+    def _head_info(self):
+        '''
+        (generation, records of the previous journal in its index) of the
+        head, the records are None after a reset
+        '''
+        head = self.store.get(HEAD)
+        if not head:
+            return None, None
+        fields = head.split()
+        return int(fields[0]), int(fields[1]) if len(fields) > 1 else None
+
+    def _head(self):
+        return self._head_info()[0]
+
+    def _parse_index(self, data):
+        header, _, body = data.partition('\n')
+        images = collections.OrderedDict()
+        for line in body.splitlines():
+            uuid, _, metadata = line.partition(' ')
+            images[uuid] = metadata
+        return jsonobject.loads(header), images
+
+    def _dump_index(self, gen, images, merged):
+        header = jsonobject.dumps({'gen': gen, 'merged': merged}, pretty=False)
+        return '\n'.join([header] + ['%s %s' % kv for kv in images.items()]) + '\n'
+
+    def _legacy_images(self):
+        images = collections.OrderedDict()
+        for line in (self.store.get(LEGACY_METADATA_FILE) or '').splitlines():
+            if not line:
+                continue
+            try:
+                uuid = get_image_uuid(line)
+            except Exception:
+                logger.warn('skip the bad line of %s: %s' % (LEGACY_METADATA_FILE, line))
+                continue
+            images.pop(uuid, None)
+            images[uuid] = line
+        return images
+
+    def _switch(self, gen, images, merged=None):
+        '''
+        make `images` the index of generation `gen`, if the claim of it is
+        won. `merged` is the number of records of the journal of the
+        previous generation in `images`, the later ones are carried over
+        '''
+        claim = _claim(gen)
+        if not self.store.create(claim):
+            stat = self.store.stat(claim)
+            if stat and time.time() - stat[1] > CLAIM_TIMEOUT:
+                logger.warn('remove the stale claim %s of image metadata compaction' % claim)
+                self.store.remove(claim)
+            return False
+
+        try:
+            self.store.put(_index(gen), self._dump_index(gen, images, merged))
+            self.store.put(HEAD, str(gen) if merged is None else '%d %d' % (gen, merged))
+        except Exception:
+            self.store.remove(claim)
+            raise
+
+        if merged is not None:
+            records = (self.store.get(_journal(gen - 1)) or '').splitlines()
+            if len(records) > merged:
+                self.store.append(_journal(gen), ''.join('%s\n' % _carried(r) for r in records[merged:]))
+
+        for name in (_index(gen - 2), _journal(gen - 2), _claim(gen - 1)):
+            self.store.remove(name)
+        return True
+
+    def _init(self):
+        while self._head() is None:
+            if self._switch(1, self._legacy_images()):
+                logger.debug('image metadata index created in generation 1')
+                return
+            time.sleep(0.1)
+
+    def exists(self):
+        return self._head() is not None or self.store.stat(LEGACY_METADATA_FILE) is not None
+
+    def _move_to(self, gen):
+        self.gen = gen
+        self.records = 0
+        self.written = set()
+
+    def _apply(self, records):
+        for record in records:
+            carried = record.startswith(CARRIED)
+            uuid, _, metadata = record.lstrip(CARRIED).partition(' ')
+            if carried and uuid in self.written:
+                # written again after the record was, before it was carried
+                continue
+            if not carried:
+                self.written.add(uuid)
+            self.images.pop(uuid, None)
+            if metadata:
+                self.images[uuid] = metadata
+
+    def _catch_up(self, gen, merged):
+        '''
+        move the images to generation `gen` compacted by another writer,
+        through the records of the previous journal its index holds
+        '''
+        if self.gen is None or gen != self.gen + 1 or merged is None:
+            return False
+        records = (self.store.get(_journal(self.gen)) or '').splitlines()
+        if len(records) < merged:
+            # removed by a later compaction, or recreated by a late writer
+            return False
+        self._apply(records[self.records:merged])
+        # the records after `merged` are carried to the new journal
+        self._move_to(gen)
+        return True
+
+    def _read(self):
+        '''
+        bring the images up to the current head and journal, return the
+        head generation and the number of its journal records
+        '''
+        while True:
+            gen, merged = self._head_info()
+            if gen is None:
+                self._init()
+                continue
+
+            if gen != self.gen and not self._catch_up(gen, merged):
+                data = self.store.get(_index(gen))
+                if data is None:
+                    # compacted again meanwhile
+                    continue
+                _, self.images = self._parse_index(data)
+                self._move_to(gen)
+
+            records = (self.store.get(_journal(gen)) or '').splitlines()
+            self._apply(records[self.records:])
+            self.records = len(records)
+            return gen, len(records)
+
+    def list(self):
+        '''
+        the metadata lines of the images, the earliest written first
+        '''
+        with self.lock:
+            gen, records = self._read()
+            if records >= self.compact_records:
+                if self._switch(gen + 1, self.images, records):
+                    # the records appended meanwhile are carried to the new journal
+                    self._move_to(gen + 1)
+                    logger.debug('image metadata journal of %d records compacted into generation %d' % (records, gen + 1))
+            return self.images.values()
+
+    def _record(self, records):
+        gen = self._head()
+        if gen is None:
+            self._init()
+            gen = self._head()
+
+        data = ''.join('%s\n' % r for r in records)
+        while True:
+            self.store.append(_journal(gen), data)
+            head = self._head()
+            if head == gen:
+                return
+            # the journal may have been compacted before the records were
+            # appended, the records are idempotent
+            gen = head
+
+    def add(self, lines):
+        records = []
+        for line in lines:
+            line = line.strip('\n')
+            records.append('%s %s' % (get_image_uuid(line), line))
+        if records:
+            self._record(records)
+
+    def delete(self, uuid):
+        self._record([uuid])
+
+    def reset(self, lines):
+        '''
+        replace all the images by `lines`
+        '''
+        images = collections.OrderedDict()
+        for line in lines:
+            line = line.strip('\n')
+            uuid = get_image_uuid(line)
+            images.pop(uuid, None)
+            images[uuid] = line
+
+        while True:
+            gen = self._head() or 0
+            if self._switch(gen + 1, images):
+                return
+            time.sleep(0.1)
@@ -0,0 +1,275 @@
+'''
+
+image metadata store on a directory backed fake object store, with 50k
+images, writers racing compactions, and the objects read by a listing
+against the whole file the agent used to read and write back
+'''
+import errno
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from cephbackupstorage import metadata_store
+
+
+class DirObjectStore(object):
+    '''
+    objects as files, with the atomicity of rados: a put replaces the
+    whole object, an append adds its data at once, a create is exclusive
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ops = {}
+        self.bytes_read = 0
+
+    def _count(self, op):
+        with self.lock:
+            self.ops[op] = self.ops.get(op, 0) + 1
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def get(self, name):
+        self._count('get')
+        try:
+            with open(self._file(name)) as fd:
+                data = fd.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        with self.lock:
+            self.bytes_read += len(data)
+        return data
+
+    def put(self, name, data):
+        self._count('put')
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.rename(tmp, self._file(name))
+
+    def append(self, name, data):
+        self._count('append')
+        fd = os.open(self._file(name), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def create(self, name):
+        self._count('create')
+        try:
+            os.close(os.open(self._file(name), os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+            return True
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+
+    def remove(self, name):
+        self._count('remove')
+        try:
+            os.remove(self._file(name))
+            return True
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+
+    def stat(self, name):
+        try:
+            st = os.stat(self._file(name))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+
+def image_line(uuid, n=0):
+    return ('{"uuid": "%s", "name": "image-%d", "size": 10737418240, "format": "qcow2", '
+            '"backupStorageRefs": [{"installPath": "ceph://pool/%s", "status": "Ready"}]}' % (uuid, n, uuid))
+
+
+def uuid_of(i):
+    return '%032x' % i
+
+
+class TestMetadataStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.objects = DirObjectStore(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _store(self, compact_records=metadata_store.COMPACT_RECORDS):
+        return metadata_store.ImageMetadataStore(self.objects, compact_records)
+
+    def test_add_delete_and_order(self):
+        store = self._store(compact_records=3)
+        self.assertFalse(store.exists())
+        store.add([image_line(uuid_of(i)) for i in range(3)])
+        store.delete(uuid_of(1))
+        store.add([image_line(uuid_of(0), 1)])
+        self.assertEqual([image_line(uuid_of(2)), image_line(uuid_of(0), 1)], store.list())
+        self.assertTrue(store.exists())
+
+        # compacted, a fresh reader sees the same
+        self.assertEqual('2 5', self.objects.get(metadata_store.HEAD))
+        self.assertEqual(store.list(), self._store().list())
+
+        store.reset([image_line(uuid_of(9))])
+        self.assertEqual([image_line(uuid_of(9))], store.list())
+
+    def test_writes_are_batched(self):
+        store = self._store()
+        store.reset([image_line(uuid_of(i)) for i in range(1000)])
+        # the index and the head, no object per image
+        self.assertEqual(2, self.objects.ops['put'])
+
+        store.add([image_line(uuid_of(i)) for i in range(1000, 1100)])
+        store.delete(uuid_of(0))
+        self.assertEqual(2, self.objects.ops['put'])
+        self.assertEqual(2, self.objects.ops['append'])
+        self.assertEqual(1099, len(self._store().list()))
+
+    def test_carried_record_does_not_override(self):
+        store = self._store()
+        store.add([image_line(uuid_of(0), 0)])
+        compactor = self._store()
+        compactor.list()
+        # appended after the compactor read the journal, before the head moved
+        store.add([image_line(uuid_of(0), 1)])
+        reader = self._store()
+        self.assertEqual([image_line(uuid_of(0), 1)], reader.list())
+
+        put = self.objects.put
+
+        def put_then_write(name, data):
+            put(name, data)
+            if name == metadata_store.HEAD:
+                # a later write lands in the new journal before the carried record
+                self._store().add([image_line(uuid_of(0), 2)])
+
+        self.objects.put = put_then_write
+        self.assertTrue(compactor._switch(2, compactor.images, compactor.records))
+        self.objects.put = put
+        for s in (compactor, reader, self._store()):
+            self.assertEqual([image_line(uuid_of(0), 2)], s.list())
+
+    def test_legacy_file(self):
+        lines = [image_line(uuid_of(i)) for i in range(3)] + ['not json', image_line(uuid_of(1), 1)]
+        self.objects.put(metadata_store.LEGACY_METADATA_FILE, '\n'.join(lines) + '\n')
+        store = self._store()
+        self.assertTrue(store.exists())
+        self.assertEqual([image_line(uuid_of(0)), image_line(uuid_of(2)), image_line(uuid_of(1), 1)], store.list())
+
+    def test_stale_claim(self):
+        store = self._store()
+        store.add([image_line(uuid_of(0))])
+        claim = os.path.join(self.dir, metadata_store._claim(2))
+        open(claim, 'w').close()
+        self.assertFalse(store._switch(2, store.images))
+        os.utime(claim, (time.time() - metadata_store.CLAIM_TIMEOUT - 1,) * 2)
+        self.assertFalse(store._switch(2, store.images))
+        self.assertTrue(store._switch(2, store.images))
+
+    def test_50k_images_with_concurrent_writers(self):
+        count = 50000
+        lines = [image_line(uuid_of(i), i) for i in range(count)]
+        legacy_file = ''.join(l + '\n' for l in lines)
+        self._store().reset(lines)
+
+        expected = dict((uuid_of(i), lines[i]) for i in range(count))
+        expected_lock = threading.Lock()
+        errors = []
+
+        def writer(n):
+            # every agent has its own store, writers own disjoint images
+            store = self._store(compact_records=200)
+            rand = random.Random(n)
+            try:
+                for i in range(300):
+                    uuid = uuid_of(rand.randrange(count) / 8 * 8 + n)
+                    if rand.random() < 0.3:
+                        store.delete(uuid)
+                        with expected_lock:
+                            expected.pop(uuid, None)
+                    else:
+                        line = image_line(uuid, count + i)
+                        store.add([line])
+                        with expected_lock:
+                            expected[uuid] = line
+                    if i % 50 == 0:
+                        store.list()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+
+        reader = self._store(compact_records=200)
+        self.assertEqual(sorted(expected.values()), sorted(reader.list()))
+        self.assertGreater(reader._head(), 2)
+
+        # a listing after a change reads the head and the journal
+        reader.delete(uuid_of(0))
+        reader.add([image_line(uuid_of(1), -1)])
+        images, read = self._timed_list(reader, 'listing after a change', len(legacy_file))
+        self.assertEqual(image_line(uuid_of(1), -1), images[-1])
+        self.assertNotIn(image_line(uuid_of(0)), images)
+        self.assertLess(read * 100, len(legacy_file))
+
+        # another agent compacts, the reader goes on from the previous journal
+        gen = reader._head()
+        other = self._store(compact_records=1)
+        other.add([image_line(uuid_of(2), -1)])
+        other.list()
+        self.assertEqual(gen + 1, reader._head())
+        other.delete(uuid_of(3))
+        images, read = self._timed_list(reader, 'listing after a compaction elsewhere', len(legacy_file))
+        self.assertEqual(self._store().list(), images)
+        self.assertEqual(other.list(), images)
+        self.assertLess(read * 100, len(legacy_file))
+
+        # its own compaction does not make it read the new index
+        gen = reader._head()
+        for i in range(200):
+            reader.add([image_line(uuid_of(4), i)])
+        reader.list()
+        self.assertEqual(gen + 1, reader._head())
+        reader.delete(uuid_of(5))
+        images, read = self._timed_list(reader, 'listing after its own compaction', len(legacy_file))
+        self.assertEqual(self._store().list(), images)
+        self.assertLess(read * 100, len(legacy_file))
+
+        # a reset is read in full
+        reader.reset(images[:10])
+        other.add([image_line(uuid_of(count), -1)])
+        self.assertEqual(images[:10] + [image_line(uuid_of(count), -1)], other.list())
+
+    def _timed_list(self, store, what, legacy_size):
+        read_before, gets_before = self.objects.bytes_read, self.objects.ops['get']
+        start = time.time()
+        images = store.list()
+        elapsed = time.time() - start
+        read = self.objects.bytes_read - read_before
+        print '\n%d images: %s reads %d objects, %d bytes in %.1f ms; ' \
+              'the metadata file is %d KB to read and write back' % (
+                  len(images), what, self.objects.ops['get'] - gets_before, read, elapsed * 1000,
+                  legacy_size >> 10)
+        return images, read
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,257 @@
+'''
+
+synthetic images uploaded as multipart forms by an http client process to a
+local server, written to a fake import sink: throughput and server cpu per
+gigabyte of the block reader against the line by line cherrypy part the
+agent used before. UPLOAD_BENCH_MB sets the size of the uploaded image, 64
+MB unless a larger run such as 2048 is asked for
+'''
+import BaseHTTPServer
+import httplib
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import unittest
+import zlib
+
+from cephbackupstorage import upload_stream
+
+try:
+    import cherrypy
+except ImportError:
+    cherrypy = None
+
+MB = 1024 * 1024
+IMAGE_SIZE = int(os.environ.get('UPLOAD_BENCH_MB', 64)) * MB
+# the line by line parser is measured on less
+LEGACY_IMAGE_SIZE = min(IMAGE_SIZE, 256 * MB)
+BOUNDARY = '----zstack-upload-b0undary'
+
+
+def _image_block():
+    # random data with CRLFs and beginnings of the delimiter in it
+    rnd = random.Random(7)
+    data = bytearray(rnd.getrandbits(8) for _ in range(MB))
+    for _ in range(64):
+        i = rnd.randrange(MB - 64)
+        n = rnd.randrange(1, len(BOUNDARY) + 4)
+        data[i:i + n] = ('\r\n--' + BOUNDARY)[:n]
+    data[-3:] = '\r\n-'
+    return str(data)
+
+
+BLOCK = _image_block()
+
+
+def _form():
+    head = ('--%s\r\nContent-Disposition: form-data; name="name"\r\n\r\nimage\r\n'
+            '--%s\r\nContent-Disposition: form-data; name="file"; filename="image.qcow2"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n' % (BOUNDARY, BOUNDARY))
+    tail = '\r\n--%s--\r\n' % BOUNDARY
+    return head, tail
+
+
+def _upload(port, path, size):
+    head, tail = _form()
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    conn.putrequest('POST', path)
+    conn.putheader('Content-Type', 'multipart/form-data; boundary=%s' % BOUNDARY)
+    conn.putheader('Content-Length', str(len(head) + size + len(tail)))
+    conn.endheaders()
+    conn.send(head)
+    for _ in range(size / MB):
+        conn.send(BLOCK)
+    conn.send(tail)
+    conn.getresponse().read()
+    conn.close()
+
+
+class FakeImportSink(object):
+    def __init__(self):
+        self.size = 0
+        self.checksum = zlib.adler32('')
+
+    def write(self, data):
+        self.size += len(data)
+        self.checksum = zlib.adler32(data, self.checksum)
+
+
+class LimitedReader(object):
+    def __init__(self, fp, length):
+        self.fp = fp
+        self.remaining = length
+
+    def read(self, size):
+        data = self.fp.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=65536):
+        data = self.fp.readline(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+
+def stream_blocks(fp, sink, pfunc):
+    assert fp.readline().rstrip('\r\n') == '--' + BOUNDARY
+    reader = upload_stream.MultipartReader(fp, '--' + BOUNDARY)
+    progressed = upload_stream.ProgressedSink(sink, pfunc)
+    while True:
+        headers = reader.next_part()
+        if headers is None:
+            break
+        reader.copy_part(progressed.write if upload_stream.part_filename(headers) else None)
+    progressed.report()
+
+
+def stream_lines(fp, sink, pfunc):
+    # what the agent did with cherrypy
+    class ProgressedFileWriter(object):
+        def __init__(self):
+            self.bytesWritten = 0
+
+        def write(self, s):
+            sink.write(s)
+            self.bytesWritten += len(s)
+            pfunc(self.bytesWritten)
+
+        def seek(self, offset, whence=None):
+            pass
+
+    class CustomPart(cherrypy._cpreqbody.Part):
+        maxrambytes = 0
+
+        def make_file(self):
+            return ProgressedFileWriter()
+
+    # the request body as cherrypy hands it to the parts, finish() is
+    # called at the closing delimiter
+    fp = cherrypy._cpreqbody.SizedReader(fp, fp.remaining, None)
+    assert fp.readline().rstrip('\r\n') == '--' + BOUNDARY
+    while True:
+        headers = cherrypy._cpreqbody.Part.read_headers(fp)
+        p = cherrypy._cpreqbody.Part(fp, headers, '--' + BOUNDARY)
+        if not p.filename:
+            # a form field, read into memory
+            p.read_lines_to_boundary()
+            continue
+        CustomPart(fp, headers, '--' + BOUNDARY).process()
+        break
+
+
+class UploadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        fp = LimitedReader(self.rfile, int(self.headers['Content-Length']))
+        sink = FakeImportSink()
+        server.progress_calls = 0
+
+        def pfunc(total):
+            server.progress_calls += 1
+
+        start = time.time()
+        cpu = resource.getrusage(resource.RUSAGE_SELF)
+        server.streams[self.path](fp, sink, pfunc)
+        end = resource.getrusage(resource.RUSAGE_SELF)
+        server.result = (sink, time.time() - start,
+                         end.ru_utime - cpu.ru_utime + end.ru_stime - cpu.ru_stime)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SlicedReader(object):
+    '''a reader returning its data in slices of random sizes'''
+
+    def __init__(self, data, rnd):
+        self.data = data
+        self.offset = 0
+        self.rnd = rnd
+
+    def read(self, size):
+        n = min(size, self.rnd.randint(1, 97))
+        data = self.data[self.offset:self.offset + n]
+        self.offset += len(data)
+        return data
+
+
+class TestUploadStream(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), UploadHandler)
+        self.server.streams = {'/blocks': stream_blocks, '/lines': stream_lines}
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _expected_checksum(self, size):
+        checksum = zlib.adler32('')
+        for _ in range(size / MB):
+            checksum = zlib.adler32(BLOCK, checksum)
+        return checksum
+
+    def _upload(self, path, size):
+        client = multiprocessing.Process(target=_upload, args=(self.server.server_address[1], path, size))
+        client.start()
+        client.join()
+        self.assertEqual(0, client.exitcode)
+
+        sink, elapsed, cpu = self.server.result
+        self.assertEqual(size, sink.size)
+        self.assertEqual(self._expected_checksum(size), sink.checksum)
+        gb = float(size) / (1024 * MB)
+        sys.stderr.write('\n%s: %d MB, %.0f MB/s, %.2fs cpu per GB, %d progress updates\n'
+                         % (path, size / MB, size / MB / elapsed, cpu / gb, self.server.progress_calls))
+        return cpu / gb
+
+    def test_upload_throughput(self):
+        cpu_per_gb = self._upload('/blocks', IMAGE_SIZE)
+        self.assertLessEqual(self.server.progress_calls, IMAGE_SIZE / upload_stream.PROGRESS_STEP + 1)
+
+        if cherrypy is None:
+            sys.stderr.write('no cherrypy, line by line parser not measured\n')
+            return
+        legacy_cpu_per_gb = self._upload('/lines', LEGACY_IMAGE_SIZE)
+        self.assertLess(cpu_per_gb, legacy_cpu_per_gb)
+
+    def test_short_reads(self):
+        rnd = random.Random(11)
+        head, tail = _form()
+        data = BLOCK[:rnd.randint(0, 4096)] + BLOCK[-rnd.randint(0, 4096):]
+        # past the first boundary line
+        body = (head + data + tail)[len(BOUNDARY) + 4:]
+        for read_size in (1, 2, 7, 31, 64, 4096):
+            reader = upload_stream.MultipartReader(SlicedReader(body, rnd), '--' + BOUNDARY, read_size)
+
+            self.assertEqual(None, upload_stream.part_filename(reader.next_part()))
+            self.assertEqual(5, reader.copy_part())
+            headers = reader.next_part()
+            self.assertEqual('image.qcow2', upload_stream.part_filename(headers))
+            self.assertEqual('application/octet-stream', headers['content-type'])
+
+            got = []
+            self.assertEqual(len(data), reader.copy_part(got.append))
+            self.assertEqual(data, ''.join(got))
+            self.assertEqual(None, reader.next_part())
+
+    def test_truncated_body(self):
+        head, _ = _form()
+        body = head + BLOCK[:1000] + '\r\n--' + BOUNDARY[:5]
+        reader = upload_stream.MultipartReader(SlicedReader(body[len(BOUNDARY) + 4:], random.Random(3)),
+                                               '--' + BOUNDARY)
+        reader.next_part()
+        reader.copy_part()
+        reader.next_part()
+        self.assertRaises(upload_stream.MultipartError, reader.copy_part)
+
+
+if __name__ == "__main__":
+    unittest.main()
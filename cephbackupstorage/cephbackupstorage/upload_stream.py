@@ -0,0 +1,159 @@
+'''
+
+multipart/form-data bodies of image uploads, read in large blocks.
+
+cherrypy parses a part line by line, an image has no lines to speak of, so
+its data went through many small reads and writes. Here a part is read in
+blocks of `READ_SIZE`, searched for the delimiter and handed on as is; only
+the bytes that may start a delimiter are held back to the next block.
+'''
+import cgi
+
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+READ_SIZE = 4 * 1024 * 1024
+MAX_HEADER_SIZE = 64 * 1024
+# the upload progress is a percentage of images of gigabytes
+PROGRESS_STEP = 64 * 1024 * 1024
+
+
+class MultipartError(Exception):
+    '''malformed multipart body'''
+
+
+def part_filename(headers):
+    _, params = cgi.parse_header(headers.get('content-disposition', ''))
+    return params.get('filename')
+
+
+class MultipartReader(object):
+    '''
+    the parts of a multipart body, `fp` is past the first boundary line and
+    `boundary` is that line without its CRLF
+    '''
+
+    def __init__(self, fp, boundary, read_size=READ_SIZE):
+        self.fp = fp
+        self.delimiter = '\r\n' + boundary
+        self.read_size = read_size
+        self.pending = ''
+        self.done = False
+
+    def _read(self):
+        if self.pending:
+            data, self.pending = self.pending, ''
+            return data
+
+        data = self.fp.read(self.read_size)
+        if not data:
+            raise MultipartError('multipart body ends before its last boundary')
+        return data
+
+    def next_part(self):
+        '''headers of the next part by lower case name, None after the last part'''
+        if self.done:
+            return None
+
+        buf = self._read()
+        while not buf.startswith('\r\n') and '\r\n\r\n' not in buf:
+            if len(buf) > MAX_HEADER_SIZE:
+                raise MultipartError('part headers longer than %d bytes' % MAX_HEADER_SIZE)
+            buf += self._read()
+
+        if buf.startswith('\r\n'):
+            self.pending = buf[2:]
+            return {}
+
+        end = buf.index('\r\n\r\n')
+        self.pending = buf[end + 4:]
+        headers = {}
+        for line in buf[:end].split('\r\n'):
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise MultipartError('invalid part header: %r' % line)
+            headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def copy_part(self, write=None):
+        '''
+        pass the data of the current part to `write`, or skip it. Returns
+        the size of the part
+        '''
+        delimiter = self.delimiter
+        # a delimiter not found in a block may still start in its last bytes
+        keep = len(delimiter) - 1
+        tail = ''
+        size = 0
+        while True:
+            data = self._read()
+            if len(data) < 2 * keep:
+                data, tail = tail + data, ''
+            elif tail:
+                i = (tail + data[:keep]).find(delimiter)
+                if 0 <= i < len(tail):
+                    if i and write:
+                        write(tail[:i])
+                    self._end_part(data[i + len(delimiter) - len(tail):])
+                    return size + i
+
+                if write:
+                    write(tail)
+                size += len(tail)
+                tail = ''
+
+            i = data.find(delimiter)
+            if i >= 0:
+                if i and write:
+                    write(data[:i])
+                self._end_part(data[i + len(delimiter):])
+                return size + i
+
+            if len(data) <= keep:
+                tail = data
+                continue
+
+            if write:
+                write(data[:-keep])
+            size += len(data) - keep
+            tail = data[-keep:]
+
+    def _end_part(self, rest):
+        while len(rest) < 2:
+            rest += self._read()
+
+        if rest.startswith('--'):
+            # the epilogue is of no interest
+            self.done = True
+            self.pending = ''
+            return
+
+        # linear white space may be padded after a boundary
+        while '\r\n' not in rest:
+            rest += self._read()
+        self.pending = rest[rest.index('\r\n') + 2:]
+
+
+class ProgressedSink(object):
+    '''
+    writes to `sink`, telling `pfunc` the bytes written once every `step`
+    of them and on report()
+    '''
+
+    def __init__(self, sink, pfunc, step=PROGRESS_STEP):
+        self.sink = sink
+        self.pfunc = pfunc
+        self.step = step
+        self.written = 0
+        self.reported = 0
+
+    def write(self, data):
+        self.sink.write(data)
+        self.written += len(data)
+        if self.written - self.reported >= self.step:
+            self.report()
+
+    def report(self):
+        self.reported = self.written
+        self.pfunc(self.written)
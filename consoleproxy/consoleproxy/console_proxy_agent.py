@@ -7,9 +7,12 @@ from zstacklib.utils import daemon
 from zstacklib.utils import linux
 from zstacklib.utils import filedb
 from zstacklib.utils import lock
+from zstacklib.utils import thread
 from zstacklib.utils.bash import *
 import os.path
 import atexit
+import socket
+import struct
 import time
 import traceback
 import pprint
@@ -82,6 +85,14 @@ def replyerror(func):
 class ConsoleProxyError(Exception):
     ''' console proxy error '''
 
+# requests for the same console are serialized by a lock picked by the token
+# prefix from a fixed set, no lock is kept per vm ever seen
+TOKEN_LOCK_STRIPES = 64
+_token_locks = [threading.RLock() for _ in xrange(TOKEN_LOCK_STRIPES)]
+
+def token_lock(prefix):
+    return _token_locks[hash(prefix) % TOKEN_LOCK_STRIPES]
+
 class ConsoleProxyAgent(object):
 
     PORT = 7758
@@ -109,9 +120,10 @@ class ConsoleProxyAgent(object):
         if not os.path.exists(self.TOKEN_FILE_DIR):
             os.makedirs(self.TOKEN_FILE_DIR, 0755)
 
-        self.db = filedb.FileDB(self.DB_NAME)
+        self.db = filedb.JournaledFileDB(self.DB_NAME)
 
-        self.token_ctrl = ConsoleTokenFileController()
+        self.token_ctrl = ConsoleTokenFileController(self.TOKEN_FILE_DIR)
+        self.proxies = WebsockifyProcesses()
 
 
     def _make_token_file_name(self, prefix, timeout):
@@ -122,19 +134,8 @@ class ConsoleProxyAgent(object):
         return '_'.join(cmd.token.split('_')[:2])
 
     def _get_pid_on_port(self, port):
-        out = shell.ShellCmd('netstat -anp | grep ":%s" | grep LISTEN' % port)
-        out(False)
-        out = out.stdout.strip()
-        if "" == out:
-            return None
-
-        pid = out.split()[-1].split('/')[0]
-        try:
-            pid = int(pid)
-            return pid
-        except:
-            return None
-
+        procs = self.proxies.get_by_port(port)
+        return procs[0].pid if procs else None
 
     def _check_proxy_availability(self, args):
         proxyPort = args['proxyPort']
@@ -190,36 +191,68 @@ class ConsoleProxyAgent(object):
         return jsonobject.dumps(rsp)
 
     @replyerror
-    @lock.lock('console-proxy')
     def delete(self, req):
-        def kill_proxy_process():
-            out = shell.ShellCmd(
-                "netstat -ntp | grep '%s:%s *ESTABLISHED.*python'" % (cmd.targetHostname, cmd.targetPort))
-            out(False)
-            pids = [line.strip().split(' ')[-1].split('/')[0] for line in out.stdout.splitlines()]
-            for pid in pids:
-                try:
-                    os.kill(int(pid), 15)
-                except OSError:
-                    continue
-
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         token_file = ConsoleTokenFile(cmd.token)
-        self.token_ctrl.delete_by_prefix(token_file.prefix)
-        kill_proxy_process()
+        with token_lock(token_file.prefix):
+            self.token_ctrl.delete_by_prefix(token_file.prefix)
+
+        for pid in self.proxies.get_pids_connected_to(cmd.targetHostname, cmd.targetPort):
+            try:
+                os.kill(pid, 15)
+            except OSError:
+                continue
         logger.debug('deleted a proxy by command: %s' % req[http.REQUEST_BODY])
 
         rsp = AgentResponse()
         return jsonobject.dumps(rsp)
 
+    def _check_port_conflict(self, proxy_port):
+        try:
+            with open('/proc/sys/net/ipv4/ip_local_port_range') as fd:
+                port_range = fd.read().split()
+        except IOError as e:
+            logger.warn('cannot read net.ipv4.ip_local_port_range: %s' % e)
+            return None
+
+        if len(port_range) == 2 and str(port_range[0]).isdigit() and str(port_range[1]).isdigit():
+            if int(port_range[0]) < int(proxy_port) < int(port_range[1]):
+                port_conflict_msg = "cmd.proxyPort [%s] is probably conflict with linux ip_local_port_range: %s" % (proxy_port, port_range)
+                logger.warn(port_conflict_msg)
+                return port_conflict_msg
+        return None
+
+    def _start_proxy(self, cmd, log_file, timeout, port_conflict_msg):
+        @in_bash
+        def start_proxy():
+            LOG_FILE = log_file
+            PROXY_HOST_NAME = cmd.proxyHostname
+            PROXY_PORT = cmd.proxyPort
+            TOKEN_FILE_DIR = self.TOKEN_FILE_DIR
+            TIMEOUT = timeout
+            start_cmd = '''python -c "from zstacklib.utils import log; import websockify; log.configure_log('{{LOG_FILE}}'); websockify.websocketproxy.websockify_init()" {{PROXY_HOST_NAME}}:{{PROXY_PORT}} -D --target-config={{TOKEN_FILE_DIR}} --idle-timeout={{TIMEOUT}}'''
+            if cmd.sslCertFile:
+                start_cmd += ' --cert=%s' % cmd.sslCertFile
+            ret,out,err = bash_roe(start_cmd)
+            if ret != 0:
+                err = []
+                if port_conflict_msg is not None:
+                    err.append(port_conflict_msg)
+                else:
+                    err.append('failed to execute bash command: %s' % start_cmd)
+                    err.append('return code: %s' % ret)
+                    err.append('stdout: %s' % out)
+                    err.append('stderr: %s' % err)
+                raise ConsoleProxyError('\n'.join(err))
+
+        start_proxy()
+
     @replyerror
-    @lock.lock('console-proxy')
     def establish_new_proxy(self, req):
         # check parameters, generate token file,set db,check process is alive,start process if not,
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         rsp = EstablishProxyRsp()
         log_file = os.path.join(self.PROXY_LOG_DIR, cmd.proxyHostname)
-        port_conflict_msg = None
         ##
         def check_parameters():
             if not cmd.targetHostname:
@@ -230,26 +263,12 @@ class ConsoleProxyAgent(object):
                 raise ConsoleProxyError('token cannot be null')
             if not cmd.proxyHostname:
                 raise ConsoleProxyError('proxyHostname cannot be null')
-
-        def check_port_conflict():
             if cmd.proxyPort is None or str(cmd.proxyPort).isdigit() is False:
                 raise ConsoleProxyError('proxyPort is None or is not a Number')
-            system_port_cmd = 'sysctl -n net.ipv4.ip_local_port_range'
-            ret, out, err = bash_roe(system_port_cmd)
-            if ret != 0:
-                logger.warn(err)
-            elif out.strip() is None:
-                logger.warn("None is net.ipv4.ip_local_port_range in current system")
-            else:
-                port_range = out.strip().split()
-                if len(port_range) == 2 and str(port_range[0]).isdigit() and str(port_range[1]).isdigit():
-                    if int(port_range[0]) < int(cmd.proxyPort) < int(port_range[1]):
-                        port_conflict_msg = "cmd.proxyPort [%s] is probably conflict with linux ip_local_port_range: %s" % (cmd.proxyPort, port_range)
-                        logger.warn(port_conflict_msg)
 
         try:
             check_parameters()
-            check_port_conflict()
+            port_conflict_msg = self._check_port_conflict(cmd.proxyPort)
         except ConsoleProxyError as e:
             err = linux.get_exception_stacktrace()
             logger.warn(err)
@@ -257,83 +276,60 @@ class ConsoleProxyAgent(object):
             rsp.success = False
             return jsonobject.dumps(rsp)
 
+        # consoles of different vms only share the proxy process, a token is
+        # only locked against requests for the same console
         token_file = ConsoleTokenFile(cmd.token)
-        exist_token = self.token_ctrl.search_by_prefix(token_file.prefix)
-
-        # this logic only execute when request from ZStack API
-        if not exist_token or exist_token.is_stale():
-            self.token_ctrl.delete_by_prefix(token_file.prefix)
-            token_file = self.token_ctrl.create_token_file(token_file.prefix, cmd.vncTokenTimeout)
-            self.token_ctrl.submit_delete_token_task(token_file)
-        else:
-            token_file = exist_token
-
-        rsp.token = token_file.get_full_name()
-        token_file.flush_write('%s: %s:%s' % (token_file.get_full_name(), cmd.targetHostname, cmd.targetPort))
-        info = {
-                 'proxyHostname': cmd.proxyHostname,
-                 'proxyPort': cmd.proxyPort,
-                 'targetHostname': cmd.targetHostname,
-                 'targetPort': cmd.targetPort,
-                 'token': cmd.token,
-                 'logFile': log_file,
-                 'tokenFile': token_file.get_absolute_path(),
-                }
-        info_str = jsonobject.dumps(info)
-        self.db.set(cmd.token, info_str)
+        with token_lock(token_file.prefix):
+            exist_token = self.token_ctrl.search_by_prefix(token_file.prefix)
+
+            # this logic only execute when request from ZStack API
+            if not exist_token or exist_token.is_stale():
+                self.token_ctrl.delete_by_prefix(token_file.prefix)
+                token_file = self.token_ctrl.create_token_file(token_file.prefix, cmd.vncTokenTimeout)
+                self.token_ctrl.submit_delete_token_task(token_file)
+            else:
+                token_file = exist_token
+
+            rsp.token = token_file.get_full_name()
+            token_file.flush_write('%s: %s:%s' % (token_file.get_full_name(), cmd.targetHostname, cmd.targetPort))
+            info = {
+                     'proxyHostname': cmd.proxyHostname,
+                     'proxyPort': cmd.proxyPort,
+                     'targetHostname': cmd.targetHostname,
+                     'targetPort': cmd.targetPort,
+                     'token': cmd.token,
+                     'logFile': log_file,
+                     'tokenFile': token_file.get_absolute_path(),
+                    }
+            info_str = jsonobject.dumps(info)
+            self.db.set(cmd.token, info_str)
         rsp.proxyPort = cmd.proxyPort
         logger.debug('successfully add new proxy token file %s' % info_str)
 
-        ## kill garbage websockify process: same proxyip:proxyport, different cert file
-        if not cmd.sslCertFile:
-            command = "ps aux | grep '[z]stack.*websockify_init' | grep '%s:%d' | grep 'cert=' | awk '{ print $2 }'" % (cmd.proxyHostname, cmd.proxyPort)
-        else:
-            command = "ps aux | grep '[z]stack.*websockify_init' | grep '%s:%d' | grep -v '%s' | awk '{ print $2 }'" % (cmd.proxyHostname, cmd.proxyPort, cmd.sslCertFile)
-        ret,out,err = bash_roe(command)
-        for pid in out.splitlines():
-            try:
-                os.kill(int(pid), 15)
-            except OSError:
-                continue
+        with lock.NamedLock('console-proxy-%s:%s' % (cmd.proxyHostname, cmd.proxyPort)):
+            ## kill garbage websockify process: same proxyip:proxyport, different cert file
+            alive = False
+            for proc in self.proxies.get(cmd.proxyHostname, cmd.proxyPort):
+                if proc.cert == (cmd.sslCertFile or None):
+                    alive = True
+                    continue
+                try:
+                    os.kill(proc.pid, 15)
+                except OSError:
+                    continue
 
-        ## if websockify process exists, then return
-        alive = False
-        ret,out,err = bash_roe("ps aux | grep '[z]stack.*websockify_init'")
-        for o in out.splitlines():
-            if o.find("%s:%d" % (cmd.proxyHostname, cmd.proxyPort)) != -1:
-                alive = True
-                break
-        if alive:
-            return jsonobject.dumps(rsp)
+            ## if websockify process exists, then return
+            if alive:
+                return jsonobject.dumps(rsp)
 
-        ##start a new websockify process
-        timeout = cmd.idleTimeout
-        if not timeout:
-            timeout = 600
+            ##start a new websockify process
+            timeout = cmd.idleTimeout
+            if not timeout:
+                timeout = 600
 
-        @in_bash
-        def start_proxy():
-            LOG_FILE = log_file
-            PROXY_HOST_NAME = cmd.proxyHostname
-            PROXY_PORT = cmd.proxyPort
-            TOKEN_FILE_DIR = self.TOKEN_FILE_DIR 
-            TIMEOUT = timeout
-            start_cmd = '''python -c "from zstacklib.utils import log; import websockify; log.configure_log('{{LOG_FILE}}'); websockify.websocketproxy.websockify_init()" {{PROXY_HOST_NAME}}:{{PROXY_PORT}} -D --target-config={{TOKEN_FILE_DIR}} --idle-timeout={{TIMEOUT}}'''
-            if cmd.sslCertFile:
-                start_cmd += ' --cert=%s' % cmd.sslCertFile
-            ret,out,err = bash_roe(start_cmd)
-            if ret != 0:
-                err = []
-                if port_conflict_msg is not None:
-                    err.append(port_conflict_msg)
-                else:
-                    err.append('failed to execute bash command: %s' % start_cmd)
-                    err.append('return code: %s' % ret)
-                    err.append('stdout: %s' % out)
-                    err.append('stderr: %s' % err)
-                raise ConsoleProxyError('\n'.join(err))
+            self._start_proxy(cmd, log_file, timeout, port_conflict_msg)
+            self.proxies.forget(cmd.proxyHostname, cmd.proxyPort)
 
-        start_proxy()
         logger.debug('successfully establish new proxy%s' % info_str)
         return jsonobject.dumps(rsp)
 
@@ -359,7 +355,10 @@ class ConsoleTokenFile(object):
         tmp = raw.split('_')
         self.prefix = '_'.join(tmp[:2])
         if len(tmp) > 2:
-            self.timeout_stamp = tmp[2]
+            try:
+                self.timeout_stamp = float(tmp[2])
+            except ValueError:
+                self.timeout_stamp = 0
 
     def get_full_name(self):
         return "%s_%s" % (self.prefix, self.timeout_stamp)
@@ -376,25 +375,221 @@ class ConsoleTokenFile(object):
 
 
 class ConsoleTokenFileController(object):
+    '''
+    token files indexed by prefix in memory. The files in the token
+    directory are what websockify reads, and what the index is loaded from
+    when the agent starts
+    '''
+
     def __init__(self, token_dir=ConsoleProxyAgent.TOKEN_FILE_DIR):
         self.token_dir = token_dir
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self._load()
 
-    def search_by_prefix(self, prefix):
-        token_prefix_path = os.path.join(self.token_dir, prefix)
-        token_full_name = shell.call("find %s* -type f -exec basename {} \; | head -1" % token_prefix_path).strip()
-        if token_full_name:
-            return ConsoleTokenFile(token_full_name)
+    def _load(self):
+        if not os.path.isdir(self.token_dir):
+            return
+
+        for name in os.listdir(self.token_dir):
+            t = ConsoleTokenFile(name, self.token_dir)
+            if not t.prefix:
+                continue
+            if t.is_stale():
+                self._remove_file(t)
+                continue
+            old = self.tokens.get(t.prefix)
+            if old and old.timeout_stamp >= t.timeout_stamp:
+                self._remove_file(t)
+                continue
+            if old:
+                self._remove_file(old)
+            self.tokens[t.prefix] = t
+
+        for t in self.tokens.values():
+            self.submit_delete_token_task(t)
+
+    def _remove_file(self, token_file):
+        try:
+            os.remove(token_file.get_absolute_path())
+        except OSError:
+            pass
 
-    def delete_by_prefix(self, prefix):
-        token_prefix_path = os.path.join(self.token_dir, prefix)
-        shell.call("rm -f %s*" % token_prefix_path)
+    def search_by_prefix(self, prefix):
+        with self.lock:
+            return self.tokens.get(prefix)
+
+    def delete_by_prefix(self, prefix, token_file=None):
+        '''
+        delete the token of `prefix`, only if it is still `token_file` when
+        that is given
+        '''
+        with self.lock:
+            t = self.tokens.get(prefix)
+            if not t or (token_file and t is not token_file):
+                return
+            del self.tokens[prefix]
+        self._remove_file(t)
 
     def submit_delete_token_task(self, token_file):
-        threading.Timer(token_file.timeout_stamp - time.time(), self.delete_by_prefix, args=[token_file.prefix]).start()
+        thread.get_timer_wheel().schedule(max(0, token_file.timeout_stamp - time.time()), self.delete_by_prefix,
+                                          (token_file.prefix, token_file))
 
     def create_token_file(self, prefix, timeout):
         t = ConsoleTokenFile()
         t.prefix = prefix
         t.timeout_stamp = time.time() + timeout
         t.directory = self.token_dir
+        with self.lock:
+            self.tokens[prefix] = t
         return t
+
+
+class WebsockifyProcess(object):
+    def __init__(self, pid, args, host, port, cert):
+        self.pid = pid
+        self.args = args
+        self.host = host
+        self.port = port
+        self.cert = cert
+
+
+class WebsockifyProcesses(object):
+    '''
+    websockify processes of the agent by proxy address, read from the
+    command lines in /proc. Known processes are checked to still run with
+    the same command line, /proc is scanned again when none is left
+    '''
+
+    def __init__(self, proc_dir='/proc'):
+        self.proc_dir = proc_dir
+        self.by_address = {}
+        self.lock = threading.Lock()
+
+    def _cmdline(self, pid):
+        try:
+            with open(os.path.join(self.proc_dir, str(pid), 'cmdline')) as fd:
+                return fd.read().split('\0')
+        except IOError:
+            return None
+
+    @staticmethod
+    def _parse(pid, args):
+        if not any('websockify_init' in a for a in args) or not any('zstack' in a for a in args):
+            return None
+
+        host = port = cert = None
+        for a in args[1:]:
+            if a.startswith('--cert='):
+                cert = a[len('--cert='):]
+            elif not a.startswith('-') and host is None and 'websockify_init' not in a:
+                h, _, p = a.rpartition(':')
+                if h and p.isdigit():
+                    host, port = h, int(p)
+        if host is None:
+            return None
+        return WebsockifyProcess(pid, args, host, port, cert)
+
+    def scan(self):
+        procs = []
+        for pid in os.listdir(self.proc_dir):
+            if not pid.isdigit():
+                continue
+            args = self._cmdline(pid)
+            proc = self._parse(int(pid), args) if args else None
+            if proc:
+                procs.append(proc)
+        return procs
+
+    def _refresh(self):
+        self.by_address = {}
+        for proc in self.scan():
+            self.by_address.setdefault((proc.host, proc.port), []).append(proc)
+
+    def _alive(self, procs):
+        return [p for p in procs if self._cmdline(p.pid) == p.args]
+
+    def get(self, host, port):
+        with self.lock:
+            key = (host, int(port))
+            procs = self._alive(self.by_address.get(key, []))
+            if not procs:
+                self._refresh()
+                procs = self.by_address.get(key, [])
+            return procs
+
+    def get_by_port(self, port):
+        with self.lock:
+            port = int(port)
+            procs = self._alive([p for k, v in self.by_address.items() if k[1] == port for p in v])
+            if not procs:
+                self._refresh()
+                procs = [p for k, v in self.by_address.items() if k[1] == port for p in v]
+            return procs
+
+    def forget(self, host, port):
+        with self.lock:
+            self.by_address.pop((host, int(port)), None)
+
+    def _tcp_addresses(self, host, port):
+        # /proc/net/tcp* print addresses as 32 bits words in host byte order,
+        # ipv4 peers of ipv6 sockets as ipv4 mapped addresses
+        addresses = {'tcp': set(), 'tcp6': set()}
+        try:
+            infos = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            logger.warn('cannot resolve %s: %s' % (host, e))
+            return addresses
+
+        for family, _, _, _, sockaddr in infos:
+            if family == socket.AF_INET:
+                packed = socket.inet_aton(sockaddr[0])
+                addresses['tcp'].add('%08X:%04X' % (struct.unpack('=I', packed)[0], int(port)))
+                packed = '\0' * 10 + '\xff\xff' + packed
+            elif family == socket.AF_INET6:
+                packed = socket.inet_pton(socket.AF_INET6, sockaddr[0])
+            else:
+                continue
+            addresses['tcp6'].add('%s:%04X' % (''.join('%08X' % w for w in struct.unpack('=4I', packed)), int(port)))
+        return addresses
+
+    def _tcp_inodes(self, host, port):
+        inodes = set()
+        for name, addresses in self._tcp_addresses(host, port).items():
+            if not addresses:
+                continue
+            try:
+                with open(os.path.join(self.proc_dir, 'net', name)) as fd:
+                    lines = fd.readlines()[1:]
+            except IOError:
+                continue
+            for line in lines:
+                fields = line.split()
+                # 01 is ESTABLISHED
+                if len(fields) > 9 and fields[2] in addresses and fields[3] == '01':
+                    inodes.add('socket:[%s]' % fields[9])
+        return inodes
+
+    def get_pids_connected_to(self, host, port):
+        '''
+        pids of the websockify processes with a connection to host:port
+        '''
+        inodes = self._tcp_inodes(host, port)
+        if not inodes:
+            return []
+
+        pids = []
+        for proc in self.scan():
+            fd_dir = os.path.join(self.proc_dir, str(proc.pid), 'fd')
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                continue
+            for fd in fds:
+                try:
+                    if os.readlink(os.path.join(fd_dir, fd)) in inodes:
+                        pids.append(proc.pid)
+                        break
+                except OSError:
+                    continue
+        return pids
@@ -0,0 +1,212 @@
+'''
+
+console tokens indexed in process, proxies found in /proc, and the setup
+latency of consoles opened in parallel against dummy proxy processes
+'''
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from consoleproxy import console_proxy_agent
+from zstacklib.utils import http
+from zstacklib.utils import jsonobject
+from zstacklib.utils import lock
+from zstacklib.utils import thread
+
+# a process the agent takes for a websockify it started
+DUMMY_PROXY = 'import socket, sys, time\n' \
+              'if sys.argv[-1].isdigit(): s = socket.create_connection(("127.0.0.1", int(sys.argv[-1])))\n' \
+              'if sys.argv[-1].startswith("["): s = socket.create_connection(("::1", int(sys.argv[-1][5:])))\n' \
+              'time.sleep(60)  # zstacklib websockify_init'
+
+# websockify daemonizes once it listens
+FAKE_START_COST = 0.05
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class TestConsoleProxyAgent(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.procs = []
+        self.started = []
+        procs, started = self.procs, self.started
+
+        class Agent(console_proxy_agent.ConsoleProxyAgent):
+            TOKEN_FILE_DIR = os.path.join(self.dir, 'tokens')
+            PROXY_LOG_DIR = os.path.join(self.dir, 'logs')
+            DB_NAME = os.path.join(self.dir, 'consoleProxy')
+
+            def _start_proxy(self, cmd, log_file, timeout, port_conflict_msg):
+                args = [sys.executable, '-c', DUMMY_PROXY, '%s:%s' % (cmd.proxyHostname, cmd.proxyPort)]
+                if cmd.sslCertFile:
+                    args.append('--cert=%s' % cmd.sslCertFile)
+                procs.append(subprocess.Popen(args))
+                started.append((cmd.proxyHostname, cmd.proxyPort))
+                time.sleep(FAKE_START_COST)
+
+        self.Agent = Agent
+        self.agent = Agent()
+        self.agent.proxies.scan = self._own_processes(self.agent.proxies.scan)
+
+    def _own_processes(self, scan):
+        # proxies of other agents on this host are none of the test's business
+        def wrap():
+            pids = set(p.pid for p in self.procs)
+            return [p for p in scan() if p.pid in pids]
+        return wrap
+
+    def tearDown(self):
+        for p in self.procs:
+            if p.poll() is None:
+                p.kill()
+            p.wait()
+        shutil.rmtree(self.dir)
+
+    def _establish(self, n, port, cert=None, timeout=60):
+        cmd = {
+            'token': '%032x_vnc' % n,
+            'targetHostname': '127.0.0.1',
+            'targetPort': 5900 + n,
+            'proxyHostname': '127.0.0.1',
+            'proxyPort': port,
+            'vncTokenTimeout': timeout,
+            'sslCertFile': cert,
+        }
+        return jsonobject.loads(self.agent.establish_new_proxy({http.REQUEST_BODY: jsonobject.dumps(cmd)}))
+
+    def _token_files(self):
+        return os.listdir(self.Agent.TOKEN_FILE_DIR)
+
+    def test_establish_in_parallel(self):
+        ports = [24900 + i for i in range(5)]
+        latencies = []
+
+        def establish(n):
+            start = time.time()
+            rsp = self._establish(n, ports[n % len(ports)])
+            latencies.append(time.time() - start)
+            return rsp
+
+        pool = thread.ThreadPool(50, 'console-test')
+        start = time.time()
+        futures = [pool.submit(establish, n) for n in range(500)]
+        rsps = [f.result() for f in futures]
+        elapsed = time.time() - start
+        pool.shutdown()
+
+        print '\n500 consoles in %.2fs: setup p50 %.1fms, p99 %.1fms' % (
+            elapsed, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000)
+        for rsp in rsps:
+            self.assertTrue(rsp.success, rsp.error)
+        self.assertEqual(sorted(('127.0.0.1', p) for p in ports), sorted(self.started))
+        self.assertEqual(500, len(self._token_files()))
+        self.assertEqual(sorted(r.token for r in rsps), sorted(self._token_files()))
+        for n in range(500):
+            self.assertTrue(self.agent._check_proxy_availability({
+                'proxyPort': ports[n % len(ports)], 'targetHostname': '127.0.0.1',
+                'targetPort': 5900 + n, 'token': '%032x_vnc' % n}))
+
+    def test_reuse_token_and_proxy(self):
+        rsp1 = self._establish(1, 24910)
+        rsp2 = self._establish(1, 24910)
+        self.assertEqual(rsp1.token, rsp2.token)
+        self.assertEqual([rsp1.token], self._token_files())
+        self.assertEqual(1, len(self.started))
+
+    def test_proxy_of_other_cert_is_replaced(self):
+        self._establish(1, 24911)
+        old = self.procs[0]
+        self._establish(2, 24911, cert='/tmp/cert.pem')
+        self.assertEqual(2, len(self.started))
+        old.wait()
+        self.assertEqual('/tmp/cert.pem', self.agent.proxies.get('127.0.0.1', 24911)[0].cert)
+
+    def test_exited_proxy_is_started_again(self):
+        self._establish(1, 24912)
+        self.procs[0].kill()
+        self.procs[0].wait()
+        self.assertFalse(self.agent._check_proxy_availability({
+            'proxyPort': 24912, 'targetHostname': '127.0.0.1', 'targetPort': 5901, 'token': '%032x_vnc' % 1}))
+        self._establish(1, 24912)
+        self.assertEqual(2, len(self.started))
+
+    def test_index_is_loaded_from_token_files(self):
+        rsp = self._establish(1, 24913)
+        stale = console_proxy_agent.ConsoleTokenFile('%032x_vnc_%s' % (2, time.time() - 1), self.Agent.TOKEN_FILE_DIR)
+        stale.flush_write('stale')
+        older = console_proxy_agent.ConsoleTokenFile('%032x_vnc_%s' % (1, time.time() + 1), self.Agent.TOKEN_FILE_DIR)
+        older.flush_write('older')
+
+        ctrl = console_proxy_agent.ConsoleTokenFileController(self.Agent.TOKEN_FILE_DIR)
+        self.assertEqual(rsp.token, ctrl.search_by_prefix('%032x_vnc' % 1).get_full_name())
+        self.assertIsNone(ctrl.search_by_prefix('%032x_vnc' % 2))
+        self.assertEqual([rsp.token], self._token_files())
+
+    def test_token_expires(self):
+        rsp = self._establish(1, 24914, timeout=0.2)
+        self.assertEqual([rsp.token], self._token_files())
+        time.sleep(0.5)
+        self.assertEqual([], self._token_files())
+        self.assertIsNone(self.agent.token_ctrl.search_by_prefix('%032x_vnc' % 1))
+
+    def test_delete_kills_connected_proxies(self):
+        target = socket.socket()
+        target.bind(('127.0.0.1', 0))
+        target.listen(5)
+        port = target.getsockname()[1]
+        try:
+            connected = subprocess.Popen([sys.executable, '-c', DUMMY_PROXY, '127.0.0.1:24915', str(port)])
+            other = subprocess.Popen([sys.executable, '-c', DUMMY_PROXY, '127.0.0.1:24916'])
+            self.procs.extend([connected, other])
+            conn, _ = target.accept()
+            rsp = self._establish(1, 24915)
+
+            cmd = {'token': rsp.token, 'targetHostname': '127.0.0.1', 'targetPort': port}
+            rsp = jsonobject.loads(self.agent.delete({http.REQUEST_BODY: jsonobject.dumps(cmd)}))
+            self.assertTrue(rsp.success, rsp.error)
+            self.assertEqual(-15, connected.wait())
+            self.assertIsNone(other.poll())
+            self.assertEqual([], self._token_files())
+            conn.close()
+        finally:
+            target.close()
+
+    def test_delete_kills_proxies_connected_over_ipv6(self):
+        try:
+            target = socket.socket(socket.AF_INET6)
+            target.bind(('::1', 0))
+        except socket.error:
+            self.skipTest('no ipv6 loopback')
+        target.listen(5)
+        port = target.getsockname()[1]
+        try:
+            connected = subprocess.Popen([sys.executable, '-c', DUMMY_PROXY, '127.0.0.1:24917', '[::1]%d' % port])
+            self.procs.append(connected)
+            conn, _ = target.accept()
+
+            cmd = {'token': '%032x_vnc' % 2, 'targetHostname': '::1', 'targetPort': port}
+            rsp = jsonobject.loads(self.agent.delete({http.REQUEST_BODY: jsonobject.dumps(cmd)}))
+            self.assertTrue(rsp.success, rsp.error)
+            self.assertEqual(-15, connected.wait())
+            conn.close()
+        finally:
+            target.close()
+
+    def test_no_lock_kept_per_console(self):
+        locks = len(lock._locks)
+        for n in range(200):
+            self._establish(n, 24918)
+        self.assertLessEqual(len(lock._locks), locks + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
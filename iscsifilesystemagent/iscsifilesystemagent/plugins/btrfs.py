@@ -10,6 +10,8 @@ from zstacklib.utils import lock
 from zstacklib.utils import qemu_img
 import cherrypy
 from iscsifilesystemagent import  iscsiagent
+import tempfile
+import threading
 import time
 import os
 
@@ -76,6 +78,133 @@ class DeleteSymlinkRsp(AgentCapacityResponse):
 def update_target(target_name):
     shell.call('tgt-admin --update %s --force' % target_name)
 
+class TgtTargets(object):
+    '''
+    targets of tgtd, loaded from one `tgt-admin --show` and kept in step with
+    the changes made here.
+
+    add() blocks until the target is live. Targets added while no request has
+    come for `batch_idle` seconds, or for at most `batch_max_wait` seconds,
+    are set up by one `tgt-admin --execute` of their configs. When the batch
+    fails, each of its targets is set up by its own `tgt-admin --update` so
+    only the bad ones fail, and the targets are read again from tgtd
+    '''
+
+    class Batch(object):
+        def __init__(self):
+            self.confs = {}
+            self.opened = self.last = time.time()
+            self.done = False
+            # target name -> the error setting it up
+            self.errors = {}
+
+    def __init__(self, batch_idle=0.05, batch_max_wait=0.5):
+        self.batch_idle = batch_idle
+        self.batch_max_wait = batch_max_wait
+        self.targets = None
+        self.batch = None
+        self.cond = threading.Condition(threading.Lock())
+
+    @staticmethod
+    def _show():
+        targets = set()
+        for l in shell.call('tgt-admin --show').split('\n'):
+            # Target 1: iqn.2015-06.org.zstack:uuid
+            if l.startswith('Target ') and ':' in l:
+                targets.add(l.split(':', 1)[1].strip())
+        return targets
+
+    def _loaded(self):
+        if self.targets is None:
+            self.targets = self._show()
+        return self.targets
+
+    def exists(self, target_name):
+        with self.cond:
+            return target_name in self._loaded()
+
+    def discard(self, target_name):
+        with self.cond:
+            if self.targets is not None:
+                self.targets.discard(target_name)
+
+    def add(self, target_name, conf):
+        with self.cond:
+            if target_name in self._loaded():
+                return
+
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = TgtTargets.Batch()
+            batch.confs[target_name] = conf
+            batch.last = time.time()
+            self.cond.notify_all()
+
+            if not leader:
+                while not batch.done:
+                    self.cond.wait()
+                if target_name in batch.errors:
+                    raise batch.errors[target_name]
+                return
+
+            while True:
+                timeout = min(batch.last + self.batch_idle, batch.opened + self.batch_max_wait) - time.time()
+                if timeout <= 0:
+                    break
+                self.cond.wait(timeout)
+            self.batch = None
+
+        try:
+            self._execute(batch.confs)
+            failed = False
+        except Exception as e:
+            logger.warn('failed to set up %d iscsi targets in one tgt-admin run, set up them one by one: %s'
+                        % (len(batch.confs), e))
+            failed = True
+            for name in batch.confs:
+                try:
+                    update_target(name)
+                except Exception as e:
+                    batch.errors[name] = e
+
+        with self.cond:
+            if failed:
+                self._reconcile(batch)
+            else:
+                self._loaded().update(batch.confs.keys())
+            batch.done = True
+            self.cond.notify_all()
+
+        if target_name in batch.errors:
+            raise batch.errors[target_name]
+
+    def _reconcile(self, batch):
+        # what tgtd took of a failed batch is read back from it
+        try:
+            self.targets = self._show()
+        except Exception as e:
+            logger.warn('cannot read iscsi targets from tgtd: %s' % e)
+            self.targets = None
+            return
+
+        for name in batch.confs:
+            if name in self.targets:
+                batch.errors.pop(name, None)
+            elif name not in batch.errors:
+                batch.errors[name] = Exception('iscsi target %s is not set up in tgtd' % name)
+
+    @lock.lock('tgt-admin-update')
+    def _execute(self, confs):
+        fd, path = tempfile.mkstemp(suffix='.conf')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(''.join(confs.values()))
+            shell.call('tgt-admin --execute --conf %s' % path)
+        finally:
+            linux.rm_file_force(path)
+        logger.debug('set up %d iscsi targets in one tgt-admin run' % len(confs))
+
 class BtrfsPlugin(plugin.Plugin):
     TYPE = "btrfs"
     INIT_PATH = "/%s/init" % TYPE
@@ -91,19 +220,16 @@ class BtrfsPlugin(plugin.Plugin):
     CREATE_SUBVOLUME_PATH = "/%s/subvolume/create" % TYPE
     GET_CAPACITY_PATH = "/%s/capacity/get" % TYPE
 
-    def _get_disk_capacity(self):
-        total = linux.get_total_disk_size(self.root)
-
-        out = shell.call('df')
-        avail = None
-        for l in out.split('\n'):
-            if self.root in l:
-                _, _, _, avail, _, _ = l.split()
+    TGT_CONF_DIR = '/etc/tgt/conf.d'
 
-        if not avail:
-            raise Exception('cannot find available capacity, "df" output":\n %s' % out)
+    def __init__(self):
+        super(BtrfsPlugin, self).__init__()
+        self.root = None
+        self.targets = TgtTargets()
 
-        return total, long(avail) * 1024
+    def _get_disk_capacity(self):
+        st = os.statvfs(self.root)
+        return st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize
 
     @iscsiagent.replyerror
     def init(self, req):
@@ -129,8 +255,7 @@ class BtrfsPlugin(plugin.Plugin):
         rsp = DownloadBitsFromSftpBackupStorageRsp()
         sub_vol_dir = os.path.dirname(cmd.primaryStorageInstallPath)
         if not os.path.exists(sub_vol_dir):
-            parent_dir = os.path.dirname(sub_vol_dir)
-            shell.call('mkdir -p %s' % parent_dir)
+            linux.mkdir(os.path.dirname(sub_vol_dir))
             shell.call('btrfs subvolume create %s' % sub_vol_dir)
 
         linux.scp_download(cmd.hostname, cmd.sshKey, cmd.backupStorageInstallPath, cmd.primaryStorageInstallPath)
@@ -146,7 +271,7 @@ class BtrfsPlugin(plugin.Plugin):
         f = get_image_format()
         if 'qcow2' in f:
             shell.call('%s -f qcow2 -O raw %s %s.img' % (qemu_img.subcmd('convert'), cmd.primaryStorageInstallPath, cmd.primaryStorageInstallPath))
-            shell.call('mv %s.img %s' % (cmd.primaryStorageInstallPath, cmd.primaryStorageInstallPath))
+            os.rename('%s.img' % cmd.primaryStorageInstallPath, cmd.primaryStorageInstallPath)
         elif 'raw' in f:
             pass
         else:
@@ -164,14 +289,14 @@ class BtrfsPlugin(plugin.Plugin):
         return jsonobject.dumps(rsp)
 
     def _delete_target(self, target_name, conf_uuid):
-        conf_file = os.path.join('/etc/tgt/conf.d/%s.conf' % conf_uuid)
+        conf_file = os.path.join(self.TGT_CONF_DIR, '%s.conf' % conf_uuid)
         linux.rm_file_force(conf_file)
 
-        output = shell.call('tgt-admin --show')
-        if target_name not in output:
+        if not self.targets.exists(target_name):
             return
 
         update_target(target_name)
+        self.targets.discard(target_name)
 
     @iscsiagent.replyerror
     def delete_bits(self, req):
@@ -217,19 +342,25 @@ write-cache on
         else:
             conf = VOLUME_CONF % (target_name, install_path)
 
-        conf_dir = '/etc/tgt/conf.d'
-        shell.call('mkdir -p %s' % conf_dir)
+        linux.mkdir(self.TGT_CONF_DIR)
 
-        conf_file = os.path.join(conf_dir, '%s.conf' % vol_uuid)
+        conf_file = os.path.join(self.TGT_CONF_DIR, '%s.conf' % vol_uuid)
         if os.path.exists(conf_file):
             with open(conf_file, 'r') as fd:
                 current_conf = fd.read()
                 if current_conf == conf:
+                    self.targets.add(target_name, conf)
                     return target_name, conf_file
 
         with open(conf_file, 'w') as fd:
             fd.write(conf)
 
+        if self.targets.exists(target_name):
+            # the config of a live target changed
+            update_target(target_name)
+        else:
+            self.targets.add(target_name, conf)
+
         return target_name, conf_file
 
     @iscsiagent.replyerror
@@ -242,15 +373,13 @@ write-cache on
 
         template_sub_vol = os.path.dirname(cmd.templatePathInCache)
         root_volume_sub_vol = os.path.dirname(cmd.installPath)
-        parent_root_volume_sub_vol = os.path.dirname(root_volume_sub_vol)
-        shell.call('mkdir -p %s' % parent_root_volume_sub_vol)
+        linux.mkdir(os.path.dirname(root_volume_sub_vol))
         shell.call('btrfs subvolume snapshot %s %s' % (template_sub_vol, root_volume_sub_vol))
         src_vol_name = os.path.join(root_volume_sub_vol, os.path.basename(cmd.templatePathInCache))
         if src_vol_name != cmd.installPath:
-            shell.call('mv %s %s' % (src_vol_name, cmd.installPath))
+            os.rename(src_vol_name, cmd.installPath)
 
         target_name, conf_file = self._create_iscsi_target(cmd.volumeUuid, cmd.installPath, cmd.chapUsername, cmd.chapPassword)
-        update_target(target_name)
 
         rsp.totalCapacity, rsp.availableCapacity = self._get_disk_capacity()
         rsp.iscsiPath = target_name
@@ -261,7 +390,7 @@ write-cache on
 
     def _create_subvolume(self, src, dst):
         src_volume = os.path.dirname(src)
-        shell.call('mkdir -p %s' % os.path.dirname(dst))
+        linux.mkdir(os.path.dirname(dst))
         shell.call('btrfs subvolume snapshot %s %s' % (src_volume, dst))
         src_file_name = os.path.basename(src)
         dst_path = os.path.join(dst, src_file_name)
@@ -289,13 +418,11 @@ write-cache on
         if os.path.exists(sub_vol_path):
             raise Exception('cannot create empty volume; %s already exists' % sub_vol_path)
 
-        parent_dir = os.path.dirname(sub_vol_path)
-        shell.call('mkdir -p %s' % parent_dir)
+        linux.mkdir(os.path.dirname(sub_vol_path))
         shell.call('btrfs subvolume create %s' % sub_vol_path)
 
         linux.raw_create(cmd.installPath, cmd.size)
         target_name, conf_file = self._create_iscsi_target(cmd.volumeUuid, cmd.installPath, cmd.chapUsername, cmd.chapPassword)
-        update_target(target_name)
 
         rsp.iscsiPath = target_name
         rsp.totalCapacity, rsp.availableCapacity = self._get_disk_capacity()
@@ -322,7 +449,6 @@ write-cache on
         rsp = CreateIscsiTargetRsp()
 
         target_name, conf_file = self._create_iscsi_target(cmd.volumeUuid, cmd.installPath, cmd.chapUsername, cmd.chapPassword)
-        update_target(target_name)
 
         rsp.target = target_name
         rsp.lun = 1
@@ -344,8 +470,6 @@ write-cache on
         return jsonobject.dumps(rsp)
 
     def start(self):
-        self.root = None
-
         http_server = self.config.http_server
         http_server.register_async_uri(self.INIT_PATH, self.init)
         http_server.register_async_uri(self.DOWNLOAD_FROM_SFTP_PATH, self.download_from_sftp)
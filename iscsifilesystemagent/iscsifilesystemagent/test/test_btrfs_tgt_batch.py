@@ -0,0 +1,175 @@
+'''
+
+100 root volumes created at once against fake btrfs and tgt-admin scripts
+recording their calls: the targets are set up by one tgt-admin run, or one
+by one when the batch has a target tgtd rejects
+'''
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+from iscsifilesystemagent.plugins import btrfs
+from zstacklib.utils import http
+from zstacklib.utils import jsonobject
+
+VOLUMES = 100
+
+FAKE_BTRFS = '''#!/bin/sh
+echo "btrfs $*" >> "$FAKE_LOG"
+case "$2" in
+    create) mkdir "$3" ;;
+    snapshot) cp -r "$3" "$4" ;;
+    delete) rm -rf "$3" ;;
+esac
+'''
+
+# targets live in tgtd are the lines of $FAKE_TGT_STATE, the one of the
+# volume $FAKE_TGT_BAD is rejected
+FAKE_TGT_ADMIN = '''#!/bin/sh
+echo "tgt-admin $*" >> "$FAKE_LOG"
+touch "$FAKE_TGT_STATE"
+sleep 0.05
+reject() {
+    case "$1" in *:"$FAKE_TGT_BAD") echo "tgtadm: invalid request" >&2; exit 22 ;; esac
+}
+case "$1" in
+    --show)
+        n=1
+        while read t; do echo "Target $n: $t"; n=$((n+1)); done < "$FAKE_TGT_STATE" ;;
+    --execute)
+        for t in $(sed -n 's/^<target \\(.*\\)>$/\\1/p' "$3"); do
+            reject "$t"
+            echo "$t" >> "$FAKE_TGT_STATE"
+        done ;;
+    --update)
+        if cat "$FAKE_TGT_CONF_DIR"/*.conf 2>/dev/null | grep -q -x "<target $2>"; then
+            reject "$2"
+            grep -q -x "$2" "$FAKE_TGT_STATE" || echo "$2" >> "$FAKE_TGT_STATE"
+        else
+            grep -v -x "$2" "$FAKE_TGT_STATE" > "$FAKE_TGT_STATE.new"
+            mv "$FAKE_TGT_STATE.new" "$FAKE_TGT_STATE"
+        fi ;;
+esac
+'''
+
+
+class TestBtrfsTgtBatch(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.dir, 'bin')
+        os.makedirs(bin_dir)
+        for name, content in (('btrfs', FAKE_BTRFS), ('tgt-admin', FAKE_TGT_ADMIN)):
+            path = os.path.join(bin_dir, name)
+            with open(path, 'w') as fd:
+                fd.write(content)
+            os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+        self.log = os.path.join(self.dir, 'calls.log')
+        self.state = os.path.join(self.dir, 'tgtd')
+        self.root = os.path.join(self.dir, 'root')
+        conf_dir = os.path.join(self.dir, 'conf.d')
+
+        self.env = dict(os.environ)
+        os.environ['PATH'] = '%s:%s' % (bin_dir, os.environ.get('PATH', ''))
+        os.environ['FAKE_LOG'] = self.log
+        os.environ['FAKE_TGT_STATE'] = self.state
+        os.environ['FAKE_TGT_CONF_DIR'] = conf_dir
+
+        self.template = os.path.join(self.root, 'imagecache', 'template', 'image', 'image.img')
+        os.makedirs(os.path.dirname(self.template))
+        with open(self.template, 'w') as fd:
+            fd.write('\0' * 4096)
+
+        class Plugin(btrfs.BtrfsPlugin):
+            TGT_CONF_DIR = conf_dir
+
+        self.plugin = Plugin()
+        self.plugin.root = self.root
+        self.plugin.targets.batch_idle = 0.2
+        self.plugin.targets.batch_max_wait = 5
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _calls(self, prefix):
+        with open(self.log) as fd:
+            return [l for l in fd.read().splitlines() if l.startswith(prefix)]
+
+    def _install_path(self, i):
+        return os.path.join(self.root, 'rootVolumes', 'acct', 'vol-%d' % i, 'vol-%d.img' % i)
+
+    def _create_at_once(self, count):
+        rsps = [None] * count
+
+        def create(i):
+            req = {http.REQUEST_BODY: jsonobject.dumps({
+                'templatePathInCache': self.template,
+                'installPath': self._install_path(i),
+                'volumeUuid': 'vol-%d' % i,
+            })}
+            rsps[i] = jsonobject.loads(self.plugin.create_root_volume(req))
+
+        threads = [threading.Thread(target=create, args=(i,)) for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return rsps
+
+    def _live_targets(self):
+        with open(self.state) as fd:
+            return set(fd.read().split())
+
+    def test_create_root_volumes_at_once(self):
+        rsps = self._create_at_once(VOLUMES)
+
+        for i, rsp in enumerate(rsps):
+            self.assertTrue(rsp.success, rsp.error)
+            self.assertTrue(rsp.iscsiPath.endswith(':vol-%d' % i))
+            self.assertTrue(rsp.totalCapacity > 0)
+
+        self.assertEqual(VOLUMES, len(self._calls('btrfs subvolume snapshot')))
+        self.assertEqual(1, len(self._calls('tgt-admin --show')))
+        self.assertEqual(1, len(self._calls('tgt-admin --execute')))
+        with open(self.state) as fd:
+            self.assertEqual(VOLUMES, len(fd.read().split()))
+        for i in range(VOLUMES):
+            self.assertTrue(os.path.exists(self._install_path(i)))
+
+        # the registry answers for live targets, only the removed ones are updated
+        for i in range(10):
+            req = {http.REQUEST_BODY: jsonobject.dumps({
+                'volumeUuid': 'vol-%d' % i,
+                'iscsiPath': 'iscsi://127.0.0.1/%s/1' % rsps[i].iscsiPath,
+                'installPath': self._install_path(i),
+            })}
+            rsp = jsonobject.loads(self.plugin.delete_bits(req))
+            self.assertTrue(rsp.success, rsp.error)
+
+        self.assertEqual(1, len(self._calls('tgt-admin --show')))
+        self.assertEqual(10, len(self._calls('tgt-admin --update')))
+        with open(self.state) as fd:
+            self.assertEqual(VOLUMES - 10, len(fd.read().split()))
+
+    def test_failed_batch_sets_up_each_target(self):
+        os.environ['FAKE_TGT_BAD'] = 'vol-7'
+        rsps = self._create_at_once(20)
+
+        # only the rejected target fails
+        self.assertEqual([7], [i for i, rsp in enumerate(rsps) if not rsp.success])
+        self.assertIn('invalid request', rsps[7].error)
+        self.assertEqual(1, len(self._calls('tgt-admin --execute')))
+        self.assertEqual(20, len(self._calls('tgt-admin --update')))
+        # the registry is read back from tgtd
+        self.assertEqual(2, len(self._calls('tgt-admin --show')))
+        self.assertEqual(19, len(self._live_targets()))
+        self.assertEqual(self._live_targets(), self.plugin.targets.targets)
+
+
+if __name__ == "__main__":
+    unittest.main()
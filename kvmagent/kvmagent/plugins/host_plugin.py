@@ -17,6 +17,7 @@ import string
 from kvmagent import kvmagent
 from kvmagent.plugins import vm_plugin
 from kvmagent.plugins.imagestore import ImageStoreClient
+from zstacklib.utils import fact_cache
 from zstacklib.utils import http
 from zstacklib.utils import linux
 from zstacklib.utils import iptables
@@ -40,6 +41,12 @@ IPTABLES_CMD = iptables.get_iptables_cmd()
 COLO_QEMU_KVM_VERSION = '/var/lib/zstack/colo/qemu_kvm_version'
 COLO_LIB_PATH = '/var/lib/zstack/colo/'
 
+# static host facts are probed again if any of these files changes
+STATIC_FACT_WATCHED_PATHS = ["/usr/bin/qemu-img", "/usr/libexec/qemu-kvm", "/usr/sbin/libvirtd",
+                             "/usr/sbin/dmidecode", "/etc/os-release", "/etc/redhat-release"]
+# the cpu count is probed again after a cpu is hotplugged or taken offline
+STATIC_CAPACITY_WATCHED_CONTENTS = ["/sys/devices/system/cpu/online"]
+
 class ConnectResponse(kvmagent.AgentResponse):
     def __init__(self):
         super(ConnectResponse, self).__init__()
@@ -649,30 +656,36 @@ class HostPlugin(kvmagent.KvmAgent):
     @kvmagent.replyerror
     def fact(self, req):
         rsp = HostFactResponse()
-        rsp.osDistribution, rsp.osVersion, rsp.osRelease = platform.dist()
-        rsp.osRelease = rsp.osRelease if rsp.osRelease else "Core"
+        for k, v in self.static_facts.get().items():
+            setattr(rsp, k, v)
+
+        ipV4Addrs = shell.call("ip addr | grep -w inet | grep -v 127.0.0.1 | awk '!/zs$/{print $2}' | cut -d/ -f1")
+        rsp.libvirtVersion = self.libvirt_version
+        rsp.ipAddresses = ipV4Addrs.splitlines()
+        return jsonobject.dumps(rsp)
+
+    def _probe_static_facts(self):
+        facts = {}
+        facts['osDistribution'], facts['osVersion'], osRelease = platform.dist()
+        facts['osRelease'] = osRelease if osRelease else "Core"
         # to be compatible with both `2.6.0` and `2.9.0(qemu-kvm-ev-2.9.0-16.el7_4.8.1)`
         qemu_img_version = shell.call("qemu-img --version | grep 'qemu-img version' | cut -d ' ' -f 3 | cut -d '(' -f 1")
-        qemu_img_version = qemu_img_version.strip('\t\r\n ,')
-        ipV4Addrs = shell.call("ip addr | grep -w inet | grep -v 127.0.0.1 | awk '!/zs$/{print $2}' | cut -d/ -f1")
-        rsp.systemProductName = 'unknown'
-        rsp.systemSerialNumber = 'unknown'
+        facts['qemuImgVersion'] = qemu_img_version.strip('\t\r\n ,')
+        facts['systemProductName'] = 'unknown'
+        facts['systemSerialNumber'] = 'unknown'
         is_dmidecode = shell.run("dmidecode")
         if str(is_dmidecode) == '0' and kvmagent.os_arch == "x86_64":
             system_product_name = shell.call('dmidecode -s system-product-name').strip()
             baseboard_product_name = shell.call('dmidecode -s baseboard-product-name').strip()
             system_serial_number = shell.call('dmidecode -s system-serial-number').strip()
-            rsp.systemSerialNumber = system_serial_number if system_serial_number else 'unknown'
-            rsp.systemProductName = system_product_name if system_product_name else baseboard_product_name
+            facts['systemSerialNumber'] = system_serial_number if system_serial_number else 'unknown'
+            facts['systemProductName'] = system_product_name if system_product_name else baseboard_product_name
 
-        rsp.qemuImgVersion = qemu_img_version
-        rsp.libvirtVersion = self.libvirt_version
-        rsp.ipAddresses = ipV4Addrs.splitlines()
-        rsp.cpuArchitecture = platform.machine()
+        facts['cpuArchitecture'] = platform.machine()
 
         if IS_AARCH64:
             # FIXME how to check vt of aarch64?
-            rsp.hvmCpuFlag = 'vt'
+            facts['hvmCpuFlag'] = 'vt'
             cpu_model = None
             try:
                 cpu_model = self._get_host_cpu_model()
@@ -681,46 +694,41 @@ class HostPlugin(kvmagent.KvmAgent):
                 if cpu_model is None:
                     cpu_model = os.uname()[-1]
 
-            rsp.cpuModelName = cpu_model
-            rsp.hostCpuModelName = "aarch64"
+            facts['cpuModelName'] = cpu_model
+            facts['hostCpuModelName'] = "aarch64"
 
             cpuMHz = shell.call("lscpu | awk '/max MHz/{ print $NF }'")
             # in case lscpu doesn't show cpu max mhz
             cpuMHz = "2500.0000" if cpuMHz.strip() == '' else cpuMHz
-            rsp.cpuGHz = '%.2f' % (float(cpuMHz) / 1000)
-        elif IS_MIPS64EL:
-            rsp.hvmCpuFlag = 'vt'
-            rsp.cpuModelName = self._get_host_cpu_model()
-
-            host_cpu_info = shell.call("grep -m2 -P -o -i '(model name|cpu MHz)\s*:\s*\K.*' /proc/cpuinfo").splitlines()
-            host_cpu_model_name = host_cpu_info[0]
-            rsp.hostCpuModelName = host_cpu_model_name
-
-            transient_cpuGHz = '%.2f' % (float(host_cpu_info[1]) / 1000)
-            static_cpuGHz_re = re.search('[0-9.]*GHz', host_cpu_model_name)
-            rsp.cpuGHz = static_cpuGHz_re.group(0)[:-3] if static_cpuGHz_re else transient_cpuGHz
-        else:
-            if shell.run('grep vmx /proc/cpuinfo') == 0:
-                rsp.hvmCpuFlag = 'vmx'
-
-            if not rsp.hvmCpuFlag:
-                if shell.run('grep svm /proc/cpuinfo') == 0:
-                    rsp.hvmCpuFlag = 'svm'
-
-            if shell.run('grep -w ept /proc/cpuinfo') == 0:
-                rsp.eptFlag = 'ept'
-
-            rsp.cpuModelName = self._get_host_cpu_model()
-
-            host_cpu_info = shell.call("grep -m2 -P -o '(model name|cpu MHz)\s*:\s*\K.*' /proc/cpuinfo").splitlines()
-            host_cpu_model_name = host_cpu_info[0]
-            rsp.hostCpuModelName = host_cpu_model_name
-
-            transient_cpuGHz = '%.2f' % (float(host_cpu_info[1]) / 1000)
-            static_cpuGHz_re = re.search('[0-9.]*GHz', host_cpu_model_name)
-            rsp.cpuGHz = static_cpuGHz_re.group(0)[:-3] if static_cpuGHz_re else transient_cpuGHz
-
-        return jsonobject.dumps(rsp)
+            facts['cpuGHz'] = '%.2f' % (float(cpuMHz) / 1000)
+            return facts
+
+        _, _, cpu_flags, host_cpu_model_name, cpu_mhz = fact_cache.read_cpuinfo()
+        if IS_MIPS64EL:
+            facts['hvmCpuFlag'] = 'vt'
+        elif 'vmx' in cpu_flags:
+            facts['hvmCpuFlag'] = 'vmx'
+        elif 'svm' in cpu_flags:
+            facts['hvmCpuFlag'] = 'svm'
+
+        if not IS_MIPS64EL and 'ept' in cpu_flags:
+            facts['eptFlag'] = 'ept'
+
+        facts['cpuModelName'] = self._get_host_cpu_model()
+        facts['hostCpuModelName'] = host_cpu_model_name
+
+        transient_cpuGHz = '%.2f' % (float(cpu_mhz) / 1000)
+        static_cpuGHz_re = re.search('[0-9.]*GHz', host_cpu_model_name)
+        facts['cpuGHz'] = static_cpuGHz_re.group(0)[:-3] if static_cpuGHz_re else transient_cpuGHz
+        return facts
+
+    def _probe_static_capacity(self):
+        processors, sockets, _, _, _ = fact_cache.read_cpuinfo()
+        return {
+            'cpuNum': processors,
+            'cpuSpeed': linux.get_cpu_speed(),
+            'cpuSockets': sockets if sockets else 1
+        }
 
     @vm_plugin.LibvirtAutoReconnect
     def _get_host_cpu_model(conn):
@@ -732,21 +740,16 @@ class HostPlugin(kvmagent.KvmAgent):
         return conn.getInfo()
 
     @kvmagent.replyerror
-    @in_bash
     def capacity(self, req):
         rsp = HostCapacityResponse()
-        rsp.cpuNum = linux.get_cpu_num()
-        rsp.cpuSpeed = linux.get_cpu_speed()
+        for k, v in self.static_capacity.get().items():
+            setattr(rsp, k, v)
+
         (used_cpu, used_memory) = vm_plugin.get_cpu_memory_used_by_running_vms()
         rsp.usedCpu = used_cpu
-        rsp.totalMemory = _get_total_memory()
+        rsp.totalMemory = fact_cache.read_meminfo()['MemTotal']
         rsp.usedMemory = used_memory
 
-        sockets = bash_o('grep "physical id" /proc/cpuinfo | sort -u | wc -l').strip()
-        rsp.cpuSockets = int(sockets)
-        if rsp.cpuSockets == 0:
-            rsp.cpuSockets = 1
-
         ret = jsonobject.dumps(rsp)
         logger.debug('get host capacity: %s' % ret)
         return ret
@@ -806,7 +809,9 @@ class HostPlugin(kvmagent.KvmAgent):
             if not os.path.exists(hb_dir):
                 os.makedirs(hb_dir, 0755)
 
-            t = thread.timer(cmd.heartbeatInterval, self._heartbeat_func, args=[hb], stop_on_exception=False)
+            # a write to a hung nfs mount blocks for good, off the shared timer workers
+            t = thread.timer(cmd.heartbeatInterval, self._heartbeat_func, args=[hb], stop_on_exception=False,
+                             wheel=thread.get_blocking_timer_wheel())
             t.start()
             self.heartbeat_timer[hb] = t
             logger.debug('create heartbeat file at[%s]' % hb)
@@ -2032,6 +2037,9 @@ done
         http_server.register_async_uri(self.DEPLOY_COLO_QEMU_PATH, self.deploy_colo_qemu)
 
         self.heartbeat_timer = {}
+        self.static_facts = fact_cache.FactCache(self._probe_static_facts, STATIC_FACT_WATCHED_PATHS)
+        self.static_capacity = fact_cache.FactCache(self._probe_static_capacity,
+                                                    watched_contents=STATIC_CAPACITY_WATCHED_CONTENTS)
         self.libvirt_version = linux.get_libvirt_version()
         self.qemu_version = linux.get_qemu_version()
         filepath = r'/etc/libvirt/qemu/networks/autostart/default.xml'
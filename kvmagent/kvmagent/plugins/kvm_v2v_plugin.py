@@ -10,6 +10,7 @@ import urlparse
 import re
 
 from kvmagent import kvmagent
+from kvmagent.plugins.v2v_blockcopy import BlockCopyScheduler
 from zstacklib.utils import jsonobject
 from zstacklib.utils import linux
 from zstacklib.utils import lock
@@ -252,6 +253,18 @@ def getVolumes(dom, dxml=None):
 
     return volumes
 
+def registerBlockJobEvents(conn, dom, scheduler):
+    def blockJobCallback(conn, dom, disk, jobType, status, opaque):
+        scheduler.on_block_job_event(disk, status)
+
+    # events are dispatched by the default event loop run in vm_plugin,
+    # the scheduler polls job states when they cannot be subscribed
+    try:
+        return conn.domainEventRegisterAny(dom, libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2, blockJobCallback, None)
+    except libvirt.libvirtError as e:
+        logger.warn("cannot listen to block job events of {}: {}".format(dom.name(), e))
+        return None
+
 def getVerNumber(major, minor, build=0):
     return major * 1000000 + minor * 1000 + build
 
@@ -492,67 +505,54 @@ class KVMV2VPlugin(kvmagent.KvmAgent):
                 dom.undefine()
                 needDefine = True
 
-            for v in volumes:
-                localpath = os.path.join(storage_dir, v.name)
-                info = dom.blockJobInfo(v.name, 0)
-                if os.path.exists(localpath) and not info:
-                    os.remove(localpath)
-                if not os.path.exists(localpath) and info:
-                    raise Exception("blockjob already exists on disk: "+v.name)
-                if info:
-                    continue
-
+            def startCopy(v):
                 logger.info("start copying {}/{} ...".format(cmd.srcVmUuid, v.name))
 
                 # c.f. https://github.com/OpenNebula/one/issues/2646
-                linux.touch_file(localpath)
+                linux.touch_file(os.path.join(storage_dir, v.name))
 
                 dom.blockCopy(v.name,
                     "<disk type='file'><source file='{}'/><driver type='{}'/></disk>".format(os.path.join(vm_v2v_dir, v.name), cmd.format),
-                    None,
+                    params,
                     flags)
 
             end_progress = 60
-            total_volume_size = sum(volume.size for volume in volumes)
 
             if cmd.sendCommandUrl:
                 Report.url = cmd.sendCommandUrl
 
             report = Report(cmd.threadContext, cmd.threadContextStack)
             report.processType = "KVM-V2V"
-            while True:
-                current_progress = 0.0
-                job_canceled = False
-                for v in volumes:
-                    if v.endTime:
-                        current_progress += 1.0 * float(v.size) / float(total_volume_size)
-                        continue
 
-                    info = dom.blockJobInfo(v.name, 0)
-                    if not info:
-                        err_msg = 'blockjob not found on disk %s, maybe job has been canceled' % v.name
-                        logger.warn(err_msg)
-                        job_canceled = True
-                        continue
-                    end = info['end']
-                    cur = info['cur']
-                    if cur == end :
-                        v.endTime = time.time()
-                        logger.info("completed copying {}/{} ...".format(cmd.srcVmUuid, v.name))
-                        progress = 1.0
-                    else:
-                        progress = float(cur) / float(end)
-
-                    current_progress += progress * float(v.size) / float(total_volume_size)
-
-                report.progress_report(str(int(current_progress * float(end_progress))), "start")
-                if all(map(lambda v: v.endTime, volumes)) or job_canceled:
-                    break
-                time.sleep(5)
-
-            if job_canceled:
-                rsp.success = False
-                rsp.error = "cannot find blockjob on vm %s, maybe it has been canceled" % cmd.srcVmUuid
+            def reportProgress(fraction):
+                report.progress_report(str(int(fraction * end_progress)), "start")
+
+            params = None
+            if cmd.copyBandwidth:
+                params = {libvirt.VIR_DOMAIN_BLOCK_COPY_BANDWIDTH: long(cmd.copyBandwidth)}
+
+            scheduler = BlockCopyScheduler(dom, volumes, startCopy,
+                                           on_progress=reportProgress,
+                                           max_jobs=cmd.maxConcurrentCopies,
+                                           progress_step=1.0 / end_progress)
+            for v in volumes:
+                localpath = os.path.join(storage_dir, v.name)
+                info = dom.blockJobInfo(v.name, 0)
+                if os.path.exists(localpath) and not info:
+                    os.remove(localpath)
+                if not os.path.exists(localpath) and info:
+                    raise Exception("blockjob already exists on disk: "+v.name)
+                if info:
+                    scheduler.adopt(v)
+
+            callbackId = registerBlockJobEvents(c, dom, scheduler)
+            try:
+                if not scheduler.run():
+                    rsp.success = False
+                    rsp.error = "cannot find blockjob on vm %s, maybe it has been canceled" % cmd.srcVmUuid
+            finally:
+                if callbackId is not None:
+                    c.domainEventDeregisterAny(callbackId)
 
             if not cmd.pauseVm and oldstat != libvirt.VIR_DOMAIN_PAUSED:
                 dom.suspend()
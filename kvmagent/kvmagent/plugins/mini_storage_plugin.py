@@ -1037,6 +1037,8 @@ class MiniStoragePlugin(kvmagent.KvmAgent):
         # type: () -> CheckBitsRsp
         r = CheckBitsRsp()
         raw = linux.read_file("/proc/drbd")
+        index = drbd.get_config_index()
+        refreshed = False
 
         for line in raw.splitlines():
             try:
@@ -1047,10 +1049,17 @@ class MiniStoragePlugin(kvmagent.KvmAgent):
                     info.networkStatus = splited[1].split(":")[1]
                     info.diskStatus = splited[3].split(":")[1].split("/")[0]
                     info.role = splited[2].split(":")[1].split("/")[0]
-                    configPath = bash.bash_o("grep 'minor %s;' /etc/drbd.d/*.res -l | awk -F '.res' '{print $1}'" % info.minor).strip()
-                    info.name = configPath.split("/")[-1]
-                    size = lvm.get_lv_size(
-                        bash.bash_o("grep -E 'disk .*/dev' %s.res | head -n1  | awk '{print $2}'" % configPath).strip().strip(";"))
+                    config = index.get_by_minor(info.minor)
+                    if config is None and not refreshed:
+                        # a config rewritten in place leaves the directory mtime alone
+                        index.invalidate()
+                        refreshed = True
+                        config = index.get_by_minor(info.minor)
+                    if config is None:
+                        logger.warn("no drbd config of minor %s, skip it" % info.minor)
+                        continue
+                    info.name = config.path.split("/")[-1][:-len(".res")]
+                    size = lvm.get_lv_size(config.local_host.disk)
                     if size != '':
                         info.size = int(size)
 
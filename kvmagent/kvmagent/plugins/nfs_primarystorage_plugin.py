@@ -18,14 +18,19 @@ from zstacklib.utils import linux
 from zstacklib.utils import log
 from zstacklib.utils import shell
 from zstacklib.utils import lock
+from zstacklib.utils import plugin
 from zstacklib.utils import qemu_img
 from zstacklib.utils import traceable_shell
+from zstacklib.utils import verified_copy
 from zstacklib.utils.bash import *
 from zstacklib.utils.report import *
 from zstacklib.utils.plugin import completetask
 
 logger = log.get_logger(__name__)
 
+# files copied at the same time by migrate_bits unless the command sets parallelism
+MIGRATE_BITS_PARALLELISM = 4
+
 class NfsResponse(kvmagent.AgentResponse):
     def __init__(self):
         super(NfsResponse, self).__init__()
@@ -259,9 +264,6 @@ class NfsPrimaryStoragePlugin(kvmagent.KvmAgent):
         mount_path = cmd.mountPath
         dst_folder_path = cmd.dstFolderPath
         temp_dir = None
-        fd, PFILE = tempfile.mkstemp()
-        os.close(fd)
-        f = open(PFILE, 'r')
 
         try:
             if not cmd.isMounted:
@@ -276,49 +278,37 @@ class NfsPrimaryStoragePlugin(kvmagent.KvmAgent):
                 if not linux.is_mounted(mount_path, cmd.url):
                     linux.mount(cmd.url, mount_path, cmd.options, "nfs4")
 
-            # begin migration, then check md5 sums
+            # read every source file once, each destination file is read
+            # back and checked against the checksum of its source stream
             linux.mkdir(dst_folder_path)
 
-            t_shell = traceable_shell.get_shell(cmd)
-            rsync_excludes = ""
-            md5_excludes = ""
-            if cmd.filtPaths:
-                for filtPath in cmd.filtPaths:
-                    # filtPath cannot start with '/', because it must be a relative path
-                    if filtPath.startswith('/'):
-                        filtPath = filtPath[1:]
-                    if filtPath != '':
-                        rsync_excludes = rsync_excludes + " --exclude=%s" % filtPath
-                        md5_excludes = md5_excludes + " ! -path %s/%s" % (cmd.srcFolderPath, filtPath)
-
-            total_size = int(shell.call("rsync -aznv %s/ %s %s | grep -o -P 'total size is \K\d*'" %
-                                        (cmd.srcFolderPath, dst_folder_path, rsync_excludes)))
-
             stage = get_task_stage(cmd)
             reporter = Report.from_spec(cmd, "MigrateVolume")
 
-            def _get_progress(synced):
-                def get_written(regex):
-                    matcher = re.match(regex, line)
-                    return int(matcher.group(1)) if matcher else 0
-
-                lines = f.readlines()
-                writing = 0
-                for line in lines:
-                    if line[1] == ' ' and line[-1] == '\n':
-                        synced += get_written(r'\s.*?(\d+)\s+100%')
-                    elif line[-1] == '\r' and line[1] == ' ':
-                        writing = get_written(r'.*?(\d+)\s+\d+%[^\r]*\r$')
-                reporter.progress_report(get_exact_percent(float(synced + writing) / total_size * 100, stage))
-                return synced
-
-            t_shell.bash_progress_1("rsync -az --progress %s/ %s %s > %s" % (cmd.srcFolderPath, dst_folder_path, rsync_excludes, PFILE), _get_progress)
-
-            src_md5 = t_shell.call(
-                "find %s -type f %s -exec md5sum {} \; | awk '{ print $1 }' | sort | md5sum" % (cmd.srcFolderPath, md5_excludes))
-            dst_md5 = t_shell.call("find %s -type f -exec md5sum {} \; | awk '{ print $1 }' | sort | md5sum" % dst_folder_path)
-            if src_md5 != dst_md5:
-                rsp.error = "failed to copy files from %s to %s, md5sum not match" % (cmd.srcFolderPath, dst_folder_path)
+            def _report_progress(copied, total):
+                reporter.progress_report(get_exact_percent(float(copied) / total * 100, stage))
+
+            copier = verified_copy.VerifiedCopier(cmd.srcFolderPath, dst_folder_path, excludes=cmd.filtPaths,
+                                                  parallel=cmd.parallelism or MIGRATE_BITS_PARALLELISM,
+                                                  progress=_report_progress)
+
+            # the copy runs in the agent, a job cancel reaches it through the task daemon
+            class MigrateBitsDaemon(plugin.TaskDaemon):
+                def __init__(self):
+                    super(MigrateBitsDaemon, self).__init__(cmd, 'MigrateVolume', report_progress=False)
+
+                def _get_percent(self):
+                    pass
+
+                def _cancel(self):
+                    copier.cancel()
+
+            copier.plan()
+            try:
+                with MigrateBitsDaemon():
+                    copier.copy()
+            except verified_copy.ChecksumMismatchError as e:
+                rsp.error = "failed to copy files from %s to %s, %s" % (cmd.srcFolderPath, dst_folder_path, str(e))
                 rsp.success = False
 
             if not cmd.isMounted:
@@ -335,9 +325,6 @@ class NfsPrimaryStoragePlugin(kvmagent.KvmAgent):
                         logger.warn("delete temp_dir %s failed: %s", (temp_dir, str(e)))
                 else:
                     logger.warn("temp_dir %s still had mounted destination primary storage, skip cleanup operation" % temp_dir)
-
-            f.close()
-            linux.rm_file_force(PFILE)
         return jsonobject.dumps(rsp)
 
     @kvmagent.replyerror
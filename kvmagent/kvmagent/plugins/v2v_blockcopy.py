@@ -0,0 +1,135 @@
+'''
+
+runs the block copies of a kvm v2v conversion: a bounded number at a time,
+the largest disks first, woken by libvirt block job events
+'''
+import threading
+import time
+
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+# the values of libvirt.VIR_DOMAIN_BLOCK_JOB_*, the status of a block job event
+BLOCK_JOB_COMPLETED = 0
+BLOCK_JOB_FAILED = 1
+BLOCK_JOB_CANCELED = 2
+BLOCK_JOB_READY = 3
+
+DEFAULT_MAX_JOBS = 2
+DEFAULT_PROGRESS_STEP = 0.01
+DEFAULT_POLL_INTERVAL = 5
+
+
+class BlockCopyScheduler(object):
+    '''
+    start_copy(volume) starts the block job of a volume, on_progress(fraction)
+    is called when the overall progress moves by progress_step.
+
+    block job events, fed through on_block_job_event() from the libvirt event
+    thread, wake the scheduler as soon as a copy is ready or gone. Without
+    them, job states are polled every poll_interval seconds.
+    '''
+
+    def __init__(self, dom, volumes, start_copy, on_progress=None, max_jobs=None,
+                 progress_step=DEFAULT_PROGRESS_STEP, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.dom = dom
+        self.volumes = volumes
+        self.start_copy = start_copy
+        self.on_progress = on_progress
+        self.max_jobs = max(1, max_jobs or DEFAULT_MAX_JOBS)
+        self.progress_step = progress_step
+        self.poll_interval = poll_interval
+
+        self.total_size = float(sum(v.size for v in volumes)) or 1.0
+        self.pending = sorted(volumes, key=lambda v: v.size, reverse=True)
+        self.running = {}       # type: dict[str, VolumeInfo]
+        self.progress = {}      # type: dict[str, float]
+        self.canceled = []      # type: list[str]
+        self.last_reported = None
+
+        self._events = {}
+        self._cond = threading.Condition()
+
+    def adopt(self, volume):
+        # the block job was started by an earlier convert of this vm
+        self.pending.remove(volume)
+        self.running[volume.name] = volume
+        self.progress[volume.name] = 0.0
+
+    def on_block_job_event(self, disk, status):
+        with self._cond:
+            self._events[disk] = status
+            self._cond.notify()
+
+    def run(self):
+        events = self._take_events(wait=False)
+        while True:
+            self._collect(events)
+            if self.canceled:
+                break
+
+            self._fill()
+            self._report()
+            if not self.pending and not self.running:
+                break
+
+            events = self._take_events(wait=True)
+
+        return not self.canceled
+
+    def _take_events(self, wait):
+        with self._cond:
+            if wait and not self._events:
+                self._cond.wait(self.poll_interval)
+            events, self._events = self._events, {}
+        return events
+
+    def _collect(self, events):
+        for name, v in list(self.running.items()):
+            status = events.get(name)
+            if status in (BLOCK_JOB_FAILED, BLOCK_JOB_CANCELED):
+                logger.warn('blockjob on disk %s is %s' % (name, 'failed' if status == BLOCK_JOB_FAILED else 'canceled'))
+                self.canceled.append(name)
+                continue
+
+            info = self.dom.blockJobInfo(name, 0)
+            if not info:
+                logger.warn('blockjob not found on disk %s, maybe job has been canceled' % name)
+                self.canceled.append(name)
+                continue
+
+            # a job just started may report 0/0
+            if status == BLOCK_JOB_READY or (info['end'] and info['cur'] == info['end']):
+                self._done(v)
+            elif info['end']:
+                self.progress[name] = float(info['cur']) / float(info['end'])
+
+    def _done(self, v):
+        v.endTime = time.time()
+        self.progress[v.name] = 1.0
+        del self.running[v.name]
+        logger.info('completed copying %s' % v.name)
+
+    def _fill(self):
+        while self.pending and len(self.running) < self.max_jobs:
+            v = self.pending.pop(0)
+            self.start_copy(v)
+            self.running[v.name] = v
+            self.progress[v.name] = 0.0
+
+    def _report(self):
+        if not self.on_progress:
+            return
+
+        if not self.pending and not self.running:
+            current = 1.0
+        else:
+            sizes = dict((v.name, v.size) for v in self.volumes)
+            current = sum(p * sizes[name] for name, p in self.progress.items()) / self.total_size
+        last = self.last_reported
+        if last is not None and current - last < self.progress_step and (current < 1.0 or last >= 1.0):
+            return
+
+        self.last_reported = current
+        self.on_progress(current)
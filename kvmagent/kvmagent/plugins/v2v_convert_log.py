@@ -0,0 +1,104 @@
+'''
+
+the end of virt-v2v logs for conversion progress, each read on from where
+the last progress poll stopped instead of forking tail
+'''
+import collections
+import os
+import os.path
+import threading
+
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+# a log first seen when it is larger is only read from this far back
+MAX_CATCH_UP = 64 * 1024
+
+
+def _compact(line):
+    # the copy progress of a disk is redrawn after carriage returns on one
+    # line, its start and latest drawing are all that is parsed
+    first = line.find('\r')
+    if first < 0:
+        return line
+    last = line.rstrip('\r').rfind('\r')
+    if last <= first:
+        return line
+    return line[:first] + line[last:]
+
+
+class ConvertLogTracker(object):
+    def __init__(self, path):
+        self.path = path
+        self.ino = None
+        self.offset = 0
+        self.lines = collections.deque(maxlen=2)
+        self.partial = ''
+        self.bytes_read = 0
+        self.lock = threading.Lock()
+
+    def _reset(self, ino, offset):
+        self.ino = ino
+        self.offset = offset
+        self.lines.clear()
+        self.partial = ''
+
+    def _feed(self, data):
+        lines = (self.partial + data).split('\n')
+        self.partial = _compact(lines.pop())
+        for line in lines[-2:]:
+            self.lines.append(_compact(line))
+
+    def tail(self):
+        '''the last two lines of the log as `tail -2` prints them, None if it cannot be read'''
+        with self.lock:
+            return self._tail()
+
+    def _tail(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+
+        # virt-v2v truncates the log when a conversion is rerun
+        if st.st_ino != self.ino or st.st_size < self.offset:
+            self._reset(st.st_ino, 0)
+        if st.st_size - self.offset > MAX_CATCH_UP:
+            self._reset(st.st_ino, st.st_size - MAX_CATCH_UP)
+
+        if st.st_size > self.offset:
+            try:
+                with open(self.path) as fd:
+                    fd.seek(self.offset)
+                    data = fd.read(st.st_size - self.offset)
+            except IOError:
+                return None
+            self.offset += len(data)
+            self.bytes_read += len(data)
+            self._feed(data)
+
+        if self.partial:
+            return ''.join(l + '\n' for l in list(self.lines)[-1:]) + self.partial
+        return ''.join(l + '\n' for l in self.lines)
+
+
+class ConvertLogs(object):
+    '''trackers of the logs of running conversions, by log path'''
+
+    def __init__(self):
+        self.trackers = {}  # type: dict[str, ConvertLogTracker]
+        self.lock = threading.Lock()
+
+    def tail(self, path):
+        with self.lock:
+            tracker = self.trackers.get(path)
+            if tracker is None:
+                tracker = self.trackers[path] = ConvertLogTracker(path)
+        return tracker.tail()
+
+    def forget(self, dir_path):
+        prefix = os.path.join(dir_path, '')
+        with self.lock:
+            for path in [p for p in self.trackers if p.startswith(prefix)]:
+                del self.trackers[path]
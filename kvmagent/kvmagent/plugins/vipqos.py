@@ -1,6 +1,9 @@
+import os
+
 from kvmagent import kvmagent
 from zstacklib.utils import http
 from zstacklib.utils import jsonobject
+from zstacklib.utils import linux
 from zstacklib.utils import lock
 from zstacklib.utils import log
 from zstacklib.utils.bash import *
@@ -12,12 +15,151 @@ class AgentRsp(object):
         self.success = True
         self.error = None
 
+VIPQOS_DEFAULT_RULE_BANDWIDTH = 10737418240          #bandwidth is 10G
+VIPQOS_MAX_CLASS_ID = 0xFFF
+
+class VipQosNic(object):
+    '''
+    qdisc, class and filter tree of a vip qos nic, loaded from one tc dump.
+    Rules are applied to the model, which returns the tc batch commands
+    doing the same to the nic.
+
+    The default rule is htb class 1:1. A port rule is htb class 1:N with a
+    sfq qdisc and a u32 filter matching the port. The class minor N is
+    written in decimal digits as it always has been; tc reads them as hex
+    and dumps the same digits back. The filter handle is 800::N with N in
+    hex, three digits, as tc prints filter handles
+    '''
+
+    def __init__(self, nic):
+        self.nic = nic
+        # nic suffix "_ei" is for outbound, so match sport
+        self.outbound = nic.find("_ei") != -1
+        self.htb = False
+        self.class_ids = set()
+        # port -> (class id, filter handle)
+        self.filters = {}
+        # class ids below it are all used
+        self.lowest_free = 2
+
+    @staticmethod
+    def dump_commands(nic):
+        return ['qdisc show dev %s' % nic, 'class show dev %s' % nic, 'filter show dev %s' % nic]
+
+    def load(self, dump):
+        '''
+        `dump` is the output of dump_commands()
+        '''
+        flow = None
+        for line in dump.splitlines():
+            words = line.split()
+            if not words:
+                continue
+
+            if words[0] == 'qdisc':
+                if words[1:3] == ['htb', '1:'] and 'root' in words:
+                    self.htb = True
+            elif words[0] == 'class' and len(words) > 2:
+                minor = words[2].split(':')[-1]
+                if minor.isdigit():
+                    self.class_ids.add(int(minor))
+            elif words[0] == 'filter':
+                # the match lines of a filter follow it
+                flow = None
+                flowids = [words[i + 1] for i, w in enumerate(words[:-1]) if w.endswith('flowid')]
+                if 'fh' in words and flowids and flowids[0].split(':')[-1].isdigit():
+                    flow = (int(flowids[0].split(':')[-1]), words[words.index('fh') + 1])
+            elif words[0] == 'match' and flow and len(words) > 1:
+                port = self._port_of_match(words[1])
+                if port is not None:
+                    self.filters[port] = flow
+
+    def _port_of_match(self, match):
+        value, _, mask = match.partition('/')
+        if len(value) != 8:
+            return None
+        if self.outbound and mask == 'ffff0000':
+            return int(value[:4], 16)
+        if not self.outbound and mask == '0000ffff':
+            return int(value[4:], 16)
+        return None
+
+    def _init_htb(self):
+        if self.htb:
+            return []
+
+        self.htb = True
+        self.class_ids = set([1])
+        self.filters = {}
+        self.lowest_free = 2
+        bandwith = VIPQOS_DEFAULT_RULE_BANDWIDTH
+        return ['qdisc replace dev %s root handle 1: htb default 1' % self.nic,
+                'class add dev %s parent 1:0 classid 1:1 htb rate %s ceil %s' % (self.nic, bandwith, bandwith),
+                'qdisc add dev %s parent 1:1 sfq' % self.nic,
+                'filter add dev %s parent 1:0 prio 1 protocol ip u32' % self.nic]
+
+    def _change_default_rule_bandwidth(self, bandwith):
+        '''
+            qos rule without port will is the default rule, its classid is 1:1
+            so only need to do is change the bandwith in class 1:1
+        '''
+        return ['class change dev %s parent 1:0 classid 1:1 htb rate %s ceil %s burst 15k cburst 15k' %
+                (self.nic, bandwith, bandwith)]
+
+    def _allocate_class_id(self):
+        for class_id in xrange(self.lowest_free, VIPQOS_MAX_CLASS_ID + 1):
+            if class_id not in self.class_ids:
+                self.class_ids.add(class_id)
+                self.lowest_free = class_id + 1
+                return class_id
+        raise Exception('Too much qos rules added to %s' % self.nic)
+
+    def apply(self, port, bandwith):
+        cmds = self._init_htb()
+        if port == 0:
+            return cmds + self._change_default_rule_bandwidth(bandwith)
+
+        cmds.extend(self.delete(port))
+        class_id = self._allocate_class_id()
+        handle = '800::%03x' % class_id
+        cmds.extend([
+            'class add dev %s parent 1:0 classid 1:%d htb rate %s ceil %s burst 15736 cburst 15736' %
+            (self.nic, class_id, bandwith, bandwith),
+            'qdisc add dev %s parent 1:%d sfq' % (self.nic, class_id),
+            'filter add dev %s parent 1:0 prio 1 handle %s protocol ip u32 match ip %s %s 0xffff flowid 1:%d' %
+            (self.nic, handle, 'sport' if self.outbound else 'dport', port, class_id)])
+        self.filters[port] = (class_id, handle)
+        return cmds
+
+    def delete(self, port):
+        if not self.htb:
+            return []
+        if port == 0:
+            return self._change_default_rule_bandwidth(VIPQOS_DEFAULT_RULE_BANDWIDTH)
+
+        flow = self.filters.pop(port, None)
+        if flow is None:
+            return []
+
+        class_id, handle = flow
+        self.class_ids.discard(class_id)
+        self.lowest_free = min(self.lowest_free, class_id)
+        return ['filter del dev %s parent 1:0 prio 1 handle %s protocol ip u32' % (self.nic, handle),
+                'qdisc del dev %s parent 1:%d sfq' % (self.nic, class_id),
+                'class del dev %s parent 1:0 classid 1:%d' % (self.nic, class_id)]
+
+
 class VipQos(kvmagent.KvmAgent):
 
     APPLY_VIPQOS_PATH = "/flatnetworkprovider/vipqos/apply"
     DELETE_VIPQOS_PATH = "/flatnetworkprovider/vipqos/delete"
     DELETE_VIPALLQOS_PATH = "/flatnetworkprovider/vipqos/deleteall"
-    VIPQOS_DEFAULT_RULE_BANDWIDTH = 10737418240          #bandwidth is 10G
+    VIPQOS_DEFAULT_RULE_BANDWIDTH = VIPQOS_DEFAULT_RULE_BANDWIDTH
+
+    def __init__(self):
+        super(VipQos, self).__init__()
+        # (namespace, nic) -> VipQosNic, what the agent last did to the nic
+        self.nics = {}
 
     def start(self):
         http_server = kvmagent.get_http_server()
@@ -49,48 +191,105 @@ class VipQos(kvmagent.KvmAgent):
 
     @lock.lock('vipqos')
     def _apply_vipqos_rules(self, rules):
+        '''
+        qos rules format:
+        {
+            "vipUuid":              "1a81681c6e42457788c851cb4db62d1c",  ############# This is the eip uuid which bound to vip
+            "vip":                  "11.168.100.95",
+            "port":                 0,
+            "inboundBandwidth":     1048576,
+            "outboundBandwidth":    0
+        }
+        '''
+        ops = []
         for rule in rules:
-            self._apply_vipqos_rule(rule)
+            EIP_UUID = rule['vipUuid'][-9:]
+            if rule['inboundBandwidth'] != 0:
+                ops.append((rule['vip'], "%s_i" % EIP_UUID, rule['port'], rule['inboundBandwidth']))
+            if rule['outboundBandwidth'] != 0:
+                ops.append((rule['vip'], "%s_ei" % EIP_UUID, rule['port'], rule['outboundBandwidth']))
+        self._change_nics(ops)
 
     @lock.lock('vipqos')
     def _delete_vipqos_rules(self, rules):
+        ops = []
         for rule in rules:
-            self._delete_vipqos_rule(rule)
+            EIP_UUID = rule['vipUuid'][-9:]
+            if rule['inboundBandwidth'] != 0:
+                ops.append((rule['vip'], "%s_i" % EIP_UUID, rule['port'], None))
+            if rule['outboundBandwidth'] != 0:
+                ops.append((rule['vip'], "%s_ei" % EIP_UUID, rule['port'], None))
+        self._change_nics(ops)
 
     @lock.lock('vipqos')
     def _delete_vipallqos_rules(self, rules):
         for rule in rules:
             self._delete_vipallqos_rule(rule)
 
-    @in_bash
-    def _apply_vipqos_rule(self, rule):
+    def _change_nics(self, ops):
         '''
-        qos rules format:
-        {
-            "vipUuid":              "1a81681c6e42457788c851cb4db62d1c",  ############# This is the eip uuid which bound to vip
-            "vip":                  "11.168.100.95",
-            "port":                 0,
-            "inboundBandwidth":     1048576,
-            "outboundBandwidth":    0
-        }
+        `ops` are (vip, nic, port, bandwidth), a None bandwidth deletes the
+        rule of the port. The changes to the nics of a namespace go in one
+        tc batch
         '''
+        ns_ops = {}
+        ns_names = {}
+        for vip, nic, port, bandwith in ops:
+            if vip not in ns_names:
+                ns_names[vip] = self._find_ns_name(vip).strip('\n')
+                if ns_names[vip] == "":
+                    raise Exception('namespace for Vip %s is not created' % vip)
+            ns_ops.setdefault(ns_names[vip], []).append((nic, port, bandwith))
+
+        for ns_name, nic_ops in ns_ops.items():
+            self._change_nics_in_ns(ns_name, nic_ops)
+
+    def _change_nics_in_ns(self, ns_name, ops):
+        for retry in (False, True):
+            cmds = []
+            for nic, port, bandwith in ops:
+                model = self._get_nic(ns_name, nic)
+                if bandwith is not None:
+                    cmds.extend(model.apply(port, bandwith))
+                    continue
+                if port != 0 and port not in model.filters:
+                    logger.warn("can not find classid for nic %s port %s" % (nic, port))
+                cmds.extend(model.delete(port))
+
+            if not cmds:
+                return
+            ret, _, err = self._tc_batch(ns_name, cmds)
+            if ret == 0:
+                return
 
-        EIP_UUID = rule['vipUuid'][-9:]
-
-        PUB_IDEV = "%s_ei" % (EIP_UUID)
-        PRI_IDEV = "%s_i" % (EIP_UUID)
-        NS_NAME = self._find_ns_name(rule['vip'])
-        NS_CMD = "ip netns exec %s " % NS_NAME.strip('\n')
-        if NS_NAME == "":
-            raise Exception('namespace for Vip %s is not created' % rule['vip'])
-
-        if rule['inboundBandwidth'] != 0:
-            self._delete_vipqos_rule_from_nic(PRI_IDEV, NS_CMD, rule['port'])
-            self._apply_vipqos_rule_to_nic(PRI_IDEV, NS_CMD, rule['port'], rule['inboundBandwidth'])
+            # the model is not what the nics have, a part of the batch
+            # may also be done. Read them again and redo the changes
+            logger.warn('tc batch of %d commands failed in namespace %s: %s' % (len(cmds), ns_name, err))
+            for nic, _, _ in ops:
+                self.nics.pop((ns_name, nic), None)
+            if retry:
+                raise Exception('failed to change vip qos in namespace %s: %s' % (ns_name, err))
+
+    def _get_nic(self, ns_name, nic):
+        model = self.nics.get((ns_name, nic))
+        if model is not None:
+            return model
+
+        ret, out, err = self._tc_batch(ns_name, VipQosNic.dump_commands(nic))
+        if ret != 0:
+            raise Exception('failed to read tc of %s in namespace %s: %s' % (nic, ns_name, err))
+        model = VipQosNic(nic)
+        model.load(out)
+        self.nics[(ns_name, nic)] = model
+        return model
 
-        if rule['outboundBandwidth'] != 0:
-            self._delete_vipqos_rule_from_nic(PUB_IDEV, NS_CMD, rule['port'])
-            self._apply_vipqos_rule_to_nic(PUB_IDEV, NS_CMD, rule['port'], rule['outboundBandwidth'])
+    @in_bash
+    def _tc_batch(self, ns_name, cmds):
+        batch_file = linux.write_to_temp_file('\n'.join(cmds) + '\n')
+        try:
+            return bash_roe("ip netns exec {{ns_name}} tc -batch {{batch_file}}")
+        finally:
+            os.remove(batch_file)
 
     @in_bash
     def _find_ns_name(self, vip):
@@ -98,111 +297,6 @@ class VipQos(kvmagent.KvmAgent):
         o = bash_o("ip netns | grep {{vip}} | awk '{print $1}'")
         return o
 
-    @in_bash
-    def _apply_vipqos_rule_to_nic(self, nic, ns_cmd, port, bandiwith):
-        self._init_vipqos_rules(nic, ns_cmd)
-
-        if port == 0:
-            self._change_vipqos_default_rule_bandwidth(nic, ns_cmd, bandiwith)
-            return
-
-        classId = self._find_empty_classid(nic, ns_cmd)
-        if classId == 0:
-            raise Exception('Too much qos rules added to %s' % nic)
-
-        bash_r("{{ns_cmd}} tc class add dev {{nic}} parent 1:0 classid 1:{{classId}} htb rate {{bandiwith}} ceil {{bandiwith}} burst 15736 cburst 15736; "+
-               "{{ns_cmd}} tc qdisc add dev {{nic}} parent 1:{{classId}} sfq")
-
-        #if nic suffix is "_ei", use for outbound, so match sport
-        handleId = format(classId, '03x')
-        if nic.find("_ei") == -1:
-            bash_r("{{ns_cmd}} tc filter add dev {{nic}} parent 1:0 prio 1 handle 800::{{handleId}} protocol ip u32 match ip dport {{port}} 0xffff flowid 1:{{classId}}")
-        else:
-            bash_r("{{ns_cmd}} tc filter add dev {{nic}} parent 1:0 prio 1 handle 800::{{handleId}} protocol ip u32 match ip sport {{port}} 0xffff flowid 1:{{classId}}")
-
-    @in_bash
-    def _find_empty_classid(self, nic, ns_cmd):
-        classIds = bash_o("{{ns_cmd}} tc class show dev {{nic}} | awk '{print $3}' | awk -F ':' '{print $2}'")
-        classIds = classIds.split('\n')
-
-        classMap = {}
-        for id in classIds:
-            classMap[id] = ''
-
-        classId = 0
-        for index in range(2, 0xFFF + 1):
-            if classMap.has_key(str(index)) == False:
-                classId = index
-                break
-
-        return classId
-
-    @in_bash
-    def _change_vipqos_default_rule_bandwidth(self, nic, ns_cmd, bandiwith):
-        '''
-            qos rule without port will is the default rule, its classid is 1:1
-            so only need to do is change the bandwith in class 1:1
-        '''
-        bash_r("{{ns_cmd}} tc class change dev {{nic}} parent 1:0 classid 1:1 htb rate {{bandiwith}} ceil {{bandiwith}} burst 15k cburst 15k")
-
-    @in_bash
-    def _init_vipqos_rules(self, nic, ns_cmd):
-        qdisc_type = bash_o("{{ns_cmd}} tc qdisc show dev {{nic}} | grep -m1 \"\" | awk '{print $2}'")
-        qdisc_type = qdisc_type.strip('\n').strip(' ')
-
-        if qdisc_type == "htb":
-            return
-
-        bandwith = self.VIPQOS_DEFAULT_RULE_BANDWIDTH
-        bash_r("{{ns_cmd}} tc qdisc replace dev {{nic}} root handle 1: htb default 1;"+
-               "{{ns_cmd}} tc class add dev {{nic}} parent 1:0 classid 1:1 htb rate {{bandwith}} ceil {{bandwith}};"+
-               "{{ns_cmd}} tc qdisc add dev {{nic}} parent 1:1 sfq;" +
-               "{{ns_cmd}} tc filter add dev {{nic}} parent 1:0 prio 1 protocol ip u32")
-
-    @in_bash
-    def _delete_vipqos_rule(self, rule):
-        EIP_UUID = rule['vipUuid'][-9:]
-
-        PUB_IDEV = "%s_ei" % (EIP_UUID)
-        PRI_IDEV = "%s_i" % (EIP_UUID)
-        NS_NAME = self._find_ns_name(rule['vip'])
-        if NS_NAME == "":
-            raise Exception('namespace for Vip %s is not created' % rule['vip'])
-        NS_CMD = "ip netns exec %s " % NS_NAME.strip('\n')
-
-        if rule['inboundBandwidth'] != 0:
-            self._delete_vipqos_rule_from_nic(PRI_IDEV, NS_CMD, rule['port'])
-
-        if rule['outboundBandwidth'] != 0:
-            self._delete_vipqos_rule_from_nic(PUB_IDEV, NS_CMD, rule['port'])
-
-    @in_bash
-    def _find_classid_with_port(self, nic, ns_cmd, port):
-        portstr = format(port, '04x')
-        if nic.find("_ei") == -1:
-            filter = "0000%s/0000ffff" % portstr
-        else:
-            filter = "%s0000/ffff0000" % portstr
-
-        classId = bash_o("{{ns_cmd}} tc filter show dev {{nic}} | grep -B 1 {{filter}} | grep -m1 \"\" | awk '{print $19}' | awk -F ':' '{print $2}'")
-        return classId
-
-    @in_bash
-    def _delete_vipqos_rule_from_nic(self, nic, ns_cmd, port):
-        if port == 0:
-            self._change_vipqos_default_rule_bandwidth(nic, ns_cmd, self.VIPQOS_DEFAULT_RULE_BANDWIDTH)
-        else:
-            classid = self._find_classid_with_port(nic, ns_cmd, port)
-            if classid == "":
-                logger.warn("can not find classid for nic %s port %s" % (nic, port))
-                return
-
-            classidx = int(classid)
-            classidHex = format(classidx, '03x')
-            bash_r("{{ns_cmd}} tc filter del dev {{nic}} parent 1:0 prio 1 handle 800::{{classidHex}} protocol ip u32;"+
-                   "{{ns_cmd}} tc qdisc del dev {{nic}} parent 1:{{classidx}} sfq;"+
-                   "{{ns_cmd}} tc class del dev {{nic}} parent 1:0 classid 1:{{classidx}};")
-
     @in_bash
     def _delete_vipallqos_rule(self, rule):
         EIP_UUID = rule['vipUuid'][-9:]
@@ -211,8 +305,11 @@ class VipQos(kvmagent.KvmAgent):
         NS_NAME = self._find_ns_name(rule['vip'])
         if NS_NAME == "":
             raise Exception('namespace for Vip %s is not created' % rule['vip'])
-        NS_CMD = "ip netns exec %s " % NS_NAME.strip('\n')
+        NS_NAME = NS_NAME.strip('\n')
+        NS_CMD = "ip netns exec %s " % NS_NAME
 
+        self.nics.pop((NS_NAME, PUB_IDEV), None)
+        self.nics.pop((NS_NAME, PRI_IDEV), None)
         bash_r("{{NS_CMD}} tc qdisc del dev {{PUB_IDEV}} root")
         bash_r("{{NS_CMD}} tc qdisc del dev {{PRI_IDEV}} root")
 
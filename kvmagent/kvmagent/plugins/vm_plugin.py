@@ -32,6 +32,7 @@ import zstacklib.utils.lock as lock
 from kvmagent import kvmagent
 from kvmagent.plugins.imagestore import ImageStoreClient
 from zstacklib.utils import bash, plugin
+from zstacklib.utils import fact_cache
 from zstacklib.utils.bash import in_bash
 from zstacklib.utils import http
 from zstacklib.utils import jsonobject
@@ -47,6 +48,7 @@ from zstacklib.utils import qemu_img
 from zstacklib.utils import ebtables
 from zstacklib.utils import vm_operator
 from zstacklib.utils import pci
+from zstacklib.utils import xml_template
 from zstacklib.utils.report import *
 from zstacklib.utils.vm_plugin_queue_singleton import VmPluginQueueSingleton
 
@@ -813,12 +815,12 @@ QEMU_VERSION = linux.get_qemu_version()
 def is_namespace_used():
     return compare_version(LIBVIRT_VERSION, '1.3.3') >= 0
 
-def is_hv_freq_supported():
-    return compare_version(QEMU_VERSION, '2.12.0') >= 0
+def is_hv_freq_supported(qemu_version=None):
+    return compare_version(qemu_version or QEMU_VERSION, '2.12.0') >= 0
 
 @linux.with_arch(todo_list=['x86_64'])
-def is_ioapic_supported():
-    return compare_version(LIBVIRT_VERSION, '3.4.0') >= 0 
+def is_ioapic_supported(libvirt_version=None):
+    return compare_version(libvirt_version or LIBVIRT_VERSION, '3.4.0') >= 0 
 
 def is_kylin402():
     zstack_release = linux.read_file('/etc/zstack-release')
@@ -1350,7 +1352,7 @@ def get_vm_by_uuid(uuid, exception_if_not_existing=True, conn=None):
                 return conn.lookupByName(uuid)
 
         vm = Vm.from_virt_domain(retry_call_libvirt())
-        logger.debug("find xm xml: %s" % vm.domain_xml)
+        logger.debug("find xm xml: %s", log.payload(vm.domain_xml))
         return vm
     except libvirt.libvirtError as e:
         error_code = e.get_error_code()
@@ -1457,13 +1459,32 @@ def get_running_vms():
     return vms
 
 
+current_memory_re = re.compile(r'<currentMemory[^>]*>\s*(\d+)\s*</currentMemory>')
+
+
 def get_cpu_memory_used_by_running_vms():
-    runnings = get_running_vms()
+    # read the domain list and virDomainGetInfo directly instead of building
+    # a Vm of every running domain; the memory is still the currentMemory of
+    # the domain xml, as Vm.get_memory() reports it, not the balloon value
+    @LibvirtAutoReconnect
+    def get_active_domains(conn):
+        return conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+
     used_cpu = 0
     used_memory = 0
-    for vm in runnings:
-        used_cpu += vm.get_cpu_num()
-        used_memory += vm.get_memory()
+    for domain in get_active_domains():
+        try:
+            # (state, maxMem, memory, nrVirtCpu, cpuTime)
+            (_, _, _, cpu_num, _) = domain.info()
+            memory = current_memory_re.search(domain.XMLDesc(0))
+        except libvirt.libvirtError as ex:
+            if ex.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                continue
+            raise ex
+
+        used_cpu += cpu_num
+        if memory:
+            used_memory += long(memory.group(1)) * 1024
 
     return (used_cpu, used_memory)
 
@@ -1540,6 +1561,34 @@ def is_spice_tls():
     return bash.bash_r("grep '^[[:space:]]*spice_tls[[:space:]]*=[[:space:]]*1' /etc/libvirt/qemu.conf")
 
 
+def _probe_domain_host_facts():
+    # versions are read again, QEMU_VERSION and LIBVIRT_VERSION are of the
+    # binaries the agent started with
+    qemu_version = linux.get_qemu_version()
+    libvirt_version = linux.get_libvirt_version()
+    return {
+        'spice_tls': is_spice_tls(),
+        'spiceport_supported': is_spiceport_driver_supported(),
+        'virtual_machine': HOST_ARCH == 'aarch64' and is_virtual_machine(),
+        'host_os_type': kvmagent.get_host_os_type(),
+        'cpu_model': linux.get_cpu_model(),
+        'qemu_path': kvmagent.get_qemu_path(),
+        'hv_freq_supported': is_hv_freq_supported(qemu_version),
+        'ioapic_supported': bool(is_ioapic_supported(libvirt_version)),
+        'q35_supported': is_q35_supported(),
+    }
+
+# host facts the domain xml depends on, they were probed by forking on every
+# vm start and only change on reboot, on qemu or libvirt upgrade or with
+# qemu.conf
+DOMAIN_HOST_FACTS = fact_cache.FactCache(_probe_domain_host_facts, [
+    '/usr/libexec/qemu-kvm', '/bin/qemu-kvm', '/usr/bin/qemu-system-%s' % HOST_ARCH, '/usr/sbin/libvirtd',
+    '/etc/libvirt/qemu.conf'])
+
+# domain xml skeletons by vm shape, see Vm._domain_shape()
+DOMAIN_XML_TEMPLATES = xml_template.TemplateCache()
+
+
 def get_dom_error(uuid):
     try:
         domblkerror = shell.call('virsh domblkerror %s' % uuid)
@@ -3218,16 +3267,116 @@ class Vm(object):
 
     @staticmethod
     def from_StartVmCmd(cmd):
-        use_numa = cmd.useNuma
-        machine_type = get_machineType(cmd.machineType)
         if HOST_ARCH == "aarch64" and cmd.bootMode == 'Legacy':
             raise kvmagent.KvmError("Aarch64 does not support legacy, please change boot mode to UEFI instead of Legacy on your VM or Image.")
+
+        xml = Vm._build_domain_xml(cmd)
+
+        vm = Vm()
+        vm.uuid = cmd.vmInstanceUuid
+        if cmd.addons["userDefinedXml"] is not None:
+            vm.domain_xml = base64.b64decode(cmd.addons["userDefinedXml"])
+            vm.domain_xmlobject = xmlobject.loads(vm.domain_xml)
+        else:
+            vm.domain_xml = xml
+            vm.domain_xmlobject = xmlobject.loads(xml)
+        return vm
+
+    @staticmethod
+    def _build_domain_xml(cmd, templated=True):
+        '''
+        the skeleton compiled for the shape of the vm is filled with its slot
+        values and sections, which gives the same bytes as building the whole
+        tree with etree, templated=False
+        '''
+        facts = DOMAIN_HOST_FACTS.get()
+        values = Vm._domain_slot_values(cmd)
+        if not templated:
+            build, _ = Vm._domain_xml_builder(cmd, facts, values)
+            return etree.tostring(build())
+
+        def compile_skeleton():
+            # empty values are kept, they decide whether an element has text
+            markers = dict((k, xml_template.slot(k) if v else v) for k, v in values.items())
+            build, _ = Vm._domain_xml_builder(cmd, facts, markers)
+            return etree.tostring(build(compiling=True))
+
+        template = DOMAIN_XML_TEMPLATES.get(Vm._domain_shape(cmd, facts, values), compile_skeleton)
+        _, sections = Vm._domain_xml_builder(cmd, facts, values)
+        rendered = {}
+        for name in template.sections:
+            parent = etree.Element('section')
+            sections[name](parent)
+            rendered[name] = xml_template.serialize_children(parent)
+        return template.render(values, rendered)
+
+    @staticmethod
+    def _domain_slot_values(cmd):
+        '''
+        values of the vm written into the domain xml as they are, they do not
+        change its skeleton
+        '''
+        return {
+            'name': cmd.vmInstanceUuid,
+            'uuid': uuidhelper.to_full_uuid(cmd.vmInstanceUuid),
+            'description': cmd.vmName,
+            'internal_id': str(cmd.vmInternalId),
+            'host_management_ip': str(cmd.hostManagementIp),
+            'cpu_num': str(cmd.cpuNum),
+            'socket_num': str(cmd.socketNum),
+            'cpu_on_socket': str(cmd.cpuOnSocket),
+            'memory': str(cmd.memory / 1024),
+            'nvram': '/var/lib/libvirt/qemu/nvram/%s.fd' % cmd.vmInstanceUuid,
+            'serial': cmd.systemSerialNumber,
+            'asset_tag': cmd.chassisAssetTag,
+            'console_password': str(cmd.consolePassword) if cmd.consolePassword is not None else None,
+        }
+
+    @staticmethod
+    def _domain_shape(cmd, facts, values):
+        '''
+        everything but the slot values the static part of the domain xml
+        depends on. Any field read outside of the sections of
+        _domain_xml_builder() is either a slot or part of the shape
+        '''
+        addons = cmd.addons
+        qxl = cmd.qxlMemory
+        colo = cmd.coloPrimary or cmd.coloSecondary
+        return (
+            tuple(sorted(facts.items())),
+            get_machineType(cmd.machineType), cmd.bootMode, cmd.useBootMenu, addons['loaderRom'],
+            cmd.chassisAssetTag is not None,
+            cmd.useNuma, cmd.nestedVirtualization, cmd.vmCpuModel,
+            tuple((r.vCpu, r.pCpuSet) for r in addons.cpuPinning or []),
+            cmd.coloPrimary, cmd.coloSecondary, cmd.useColoBinary, len(cmd.nics) if colo else None,
+            addons['onCrash'], cmd.clock,
+            cmd.kvmHiddenState is True, cmd.vmPortOff is True, cmd.emulateHyperV is True,
+            get_gic_version(cmd.cpuNum),
+            addons and addons['qemuPath'], bool(addons) and addons['noConsole'] is True, cmd.isApplianceVm,
+            cmd.videoType, cmd.VDIMonitorNumber, (qxl.ram, qxl.vram, qxl.vgamem) if qxl is not None else None,
+            cmd.consoleMode, cmd.soundType, cmd.consolePassword is None,
+            tuple(cmd.spiceChannels) if cmd.spiceChannels is not None else None, cmd.spiceStreamingMode,
+            addons['useMemBalloon'] is False,
+            cmd.pciePortNums, cmd.predefinedPciBridgeNum, cmd.additionalQmp, cmd.useHugePage,
+            tuple(sorted(k for k, v in values.items() if not v)),
+        )
+
+    @staticmethod
+    def _domain_xml_builder(cmd, facts, values):
+        '''
+        return (build, sections). build() makes the domain element, with the
+        slot `values` in place. sections add the parts built for every vm
+        anew to a parent element, with compiling=True build() leaves
+        placeholders for them
+        '''
+        use_numa = cmd.useNuma
+        machine_type = get_machineType(cmd.machineType)
         default_bus_type = ('ide', 'sata', 'scsi')[max(machine_type == 'q35', (HOST_ARCH in ['aarch64', 'mips64el']) * 2)]
         elements = {}
 
         def make_root():
             root = etree.Element('domain')
-            root.set('type', get_domain_type())
+            root.set('type', "qemu" if HOST_ARCH == "aarch64" and facts['virtual_machine'] else "kvm")
             root.set('xmlns:qemu', 'http://libvirt.org/schemas/domain/qemu/1.0')
             elements['root'] = root
 
@@ -3243,7 +3392,7 @@ class Vm(object):
                 root = elements['root']
                 tune = e(root, 'cputune')
                 def on_x86_64():
-                    e(root, 'vcpu', '128', {'placement': 'static', 'current': str(cmd.cpuNum)})
+                    e(root, 'vcpu', '128', {'placement': 'static', 'current': values['cpu_num']})
                     # e(root,'vcpu',str(cmd.cpuNum),{'placement':'static'})
                     if cmd.nestedVirtualization == 'host-model':
                         cpu = e(root, 'cpu', attrib={'mode': 'host-model'})
@@ -3257,34 +3406,31 @@ class Vm(object):
                     else:
                         cpu = e(root, 'cpu')
                         # e(cpu, 'topology', attrib={'sockets': str(cmd.socketNum), 'cores': str(cmd.cpuOnSocket), 'threads': '1'})
-                    mem = cmd.memory / 1024
                     e(cpu, 'topology', attrib={'sockets': '32', 'cores': '4', 'threads': '1'})
                     numa = e(cpu, 'numa')
-                    e(numa, 'cell', attrib={'id': '0', 'cpus': '0-127', 'memory': str(mem), 'unit': 'KiB'})
+                    e(numa, 'cell', attrib={'id': '0', 'cpus': '0-127', 'memory': values['memory'], 'unit': 'KiB'})
 
                 def on_aarch64():
-                    e(root, 'vcpu', '128', {'placement': 'static', 'current': str(cmd.cpuNum)})
+                    e(root, 'vcpu', '128', {'placement': 'static', 'current': values['cpu_num']})
                     cpu = e(root, 'cpu', attrib={'mode': 'host-passthrough'})
-                    mem = cmd.memory / 1024
                     e(cpu, 'topology', attrib={'sockets': '32', 'cores': '4', 'threads': '1'})
                     numa = e(cpu, 'numa')
-                    e(numa, 'cell', attrib={'id': '0', 'cpus': '0-127', 'memory': str(mem), 'unit': 'KiB'})
+                    e(numa, 'cell', attrib={'id': '0', 'cpus': '0-127', 'memory': values['memory'], 'unit': 'KiB'})
 
                 def on_mips64el():
-                    e(root, 'vcpu', '8', {'placement': 'static', 'current': str(cmd.cpuNum)})
+                    e(root, 'vcpu', '8', {'placement': 'static', 'current': values['cpu_num']})
                     # e(root,'vcpu',str(cmd.cpuNum),{'placement':'static'})
                     cpu = e(root, 'cpu', attrib={'mode': 'custom', 'match': 'exact', 'check': 'partial'})
                     e(cpu, 'model', 'Loongson-3A4000-COMP', attrib={'fallback': 'allow'})
-                    mem = cmd.memory / 1024
                     e(cpu, 'topology', attrib={'sockets': '2', 'cores': '4', 'threads': '1'})
                     numa = e(cpu, 'numa')
-                    e(numa, 'cell', attrib={'id': '0', 'cpus': '0-7', 'memory': str(mem), 'unit': 'KiB'})
+                    e(numa, 'cell', attrib={'id': '0', 'cpus': '0-7', 'memory': values['memory'], 'unit': 'KiB'})
 
                 eval("on_{}".format(HOST_ARCH))()
             else:
                 root = elements['root']
                 # e(root, 'vcpu', '128', {'placement': 'static', 'current': str(cmd.cpuNum)})
-                e(root, 'vcpu', str(cmd.cpuNum), {'placement': 'static'})
+                e(root, 'vcpu', values['cpu_num'], {'placement': 'static'})
                 tune = e(root, 'cputune')
                 # enable nested virtualization
                 def on_x86_64():
@@ -3302,7 +3448,7 @@ class Vm(object):
                     return cpu
                     
                 def on_aarch64():
-                    if is_virtual_machine():
+                    if facts['virtual_machine']:
                         cpu = e(root, 'cpu')
                         e(cpu, 'model', 'cortex-a57')
                     else :
@@ -3316,7 +3462,7 @@ class Vm(object):
                     return cpu
 
                 cpu = eval("on_{}".format(HOST_ARCH))()
-                e(cpu, 'topology', attrib={'sockets': str(cmd.socketNum), 'cores': str(cmd.cpuOnSocket), 'threads': '1'})
+                e(cpu, 'topology', attrib={'sockets': values['socket_num'], 'cores': values['cpu_on_socket'], 'threads': '1'})
 
             if cmd.addons.cpuPinning:
                 for rule in cmd.addons.cpuPinning:
@@ -3324,14 +3470,13 @@ class Vm(object):
 
         def make_memory():
             root = elements['root']
-            mem = cmd.memory / 1024
             if use_numa:
                 e(root, 'maxMemory', str(34359738368), {'slots': str(16), 'unit': 'KiB'})
                 # e(root,'memory',str(mem),{'unit':'k'})
-                e(root, 'currentMemory', str(mem), {'unit': 'k'})
+                e(root, 'currentMemory', values['memory'], {'unit': 'k'})
             else:
-                e(root, 'memory', str(mem), {'unit': 'k'})
-                e(root, 'currentMemory', str(mem), {'unit': 'k'})
+                e(root, 'memory', values['memory'], {'unit': 'k'})
+                e(root, 'currentMemory', values['memory'], {'unit': 'k'})
 
         def make_os():
             root = elements['root']
@@ -3343,10 +3488,10 @@ class Vm(object):
                 # if boot mode is UEFI
                 if cmd.bootMode == "UEFI":
                     e(os, 'loader', '/usr/share/edk2.git/ovmf-x64/OVMF_CODE-pure-efi.fd', attrib={'readonly': 'yes', 'type': 'pflash'})
-                    e(os, 'nvram', '/var/lib/libvirt/qemu/nvram/%s.fd' % cmd.vmInstanceUuid, attrib={'template': '/usr/share/edk2.git/ovmf-x64/OVMF_VARS-pure-efi.fd'})
+                    e(os, 'nvram', values['nvram'], attrib={'template': '/usr/share/edk2.git/ovmf-x64/OVMF_VARS-pure-efi.fd'})
                 elif cmd.bootMode == "UEFI_WITH_CSM":
                     e(os, 'loader', '/usr/share/edk2.git/ovmf-x64/OVMF_CODE-with-csm.fd', attrib={'readonly': 'yes', 'type': 'pflash'})
-                    e(os, 'nvram', '/var/lib/libvirt/qemu/nvram/%s.fd' % cmd.vmInstanceUuid, attrib={'template': '/usr/share/edk2.git/ovmf-x64/OVMF_VARS-with-csm.fd'})
+                    e(os, 'nvram', values['nvram'], attrib={'template': '/usr/share/edk2.git/ovmf-x64/OVMF_VARS-with-csm.fd'})
                 elif cmd.addons['loaderRom'] is not None:
                     e(os, 'loader', cmd.addons['loaderRom'], {'type': 'rom'})
 
@@ -3355,14 +3500,14 @@ class Vm(object):
                 def on_redhat():
                     e(os, 'type', 'hvm', attrib={'arch': 'aarch64', 'machine': 'virt'})
                     e(os, 'loader', '/usr/share/edk2/aarch64/QEMU_EFI-pflash.raw', attrib={'readonly': 'yes', 'type': 'pflash'})
-                    e(os, 'nvram', '/var/lib/libvirt/qemu/nvram/%s.fd' % cmd.vmInstanceUuid, attrib={'template': '/usr/share/edk2/aarch64/vars-template-pflash.raw'})
+                    e(os, 'nvram', values['nvram'], attrib={'template': '/usr/share/edk2/aarch64/vars-template-pflash.raw'})
 
                 def on_debian():
                     e(os, 'type', 'hvm', attrib={'arch': 'aarch64', 'machine': 'virt'})
                     e(os, 'loader', '/usr/share/OVMF/QEMU_EFI-pflash.raw', attrib={'readonly': 'yes', 'type': 'rom'})
-                    e(os, 'nvram', '/var/lib/libvirt/qemu/nvram/%s.fd' % cmd.vmInstanceUuid, attrib={'template': '/usr/share/OVMF/vars-template-pflash.raw'})
+                    e(os, 'nvram', values['nvram'], attrib={'template': '/usr/share/OVMF/vars-template-pflash.raw'})
                     
-                eval("on_{}".format(kvmagent.get_host_os_type()))()
+                eval("on_{}".format(facts['host_os_type']))()
 
             def on_mips64el():
                 e(os, 'type', 'hvm', attrib={'arch': 'mips64el', 'machine': 'loongson3a'})
@@ -3383,11 +3528,11 @@ class Vm(object):
             root = elements['root']
             sysinfo = e(root, 'sysinfo', attrib={'type': 'smbios'})
             system = e(sysinfo, 'system')
-            e(system, 'entry', cmd.systemSerialNumber, attrib={'name': 'serial'})
+            e(system, 'entry', values['serial'], attrib={'name': 'serial'})
 
             if cmd.chassisAssetTag is not None:
                 chassis = e(sysinfo, 'chassis')
-                e(chassis, 'entry', cmd.chassisAssetTag, attrib={'name': 'asset'})
+                e(chassis, 'entry', values['asset_tag'], attrib={'name': 'asset'})
 
         def make_features():
             root = elements['root']
@@ -3409,11 +3554,11 @@ class Vm(object):
                 hyperv = e(features, "hyperv")
                 e(hyperv, 'relaxed', attrib={'state': 'on'})
                 e(hyperv, 'vapic', attrib={'state': 'on'})
-                if is_hv_freq_supported(): e(hyperv, 'frequencies', attrib={'state': 'on'})
+                if facts['hv_freq_supported']: e(hyperv, 'frequencies', attrib={'state': 'on'})
                 e(hyperv, 'spinlocks', attrib={'state': 'on', 'retries': '4096'})
                 e(hyperv, 'vendor_id', attrib={'state': 'on', 'value': 'ZStack_Org'})
             # always set ioapic driver to kvm after libvirt 3.4.0
-            if is_ioapic_supported():
+            if facts['ioapic_supported']:
                 e(features, "ioapic", attrib={'driver': 'kvm'})
 
             if get_gic_version(cmd.cpuNum) == 2:
@@ -3422,13 +3567,12 @@ class Vm(object):
 
 
 
-        def make_qemu_commandline():
+        def make_qemu_commandline(root):
             if not os.path.exists(QMP_SOCKET_PATH):
                 os.mkdir(QMP_SOCKET_PATH)
 
-            root = elements['root']
             qcmd = e(root, 'qemu:commandline')
-            vendor_id, model_name = linux.get_cpu_model()
+            vendor_id, model_name = facts['cpu_model']
             if "hygon" in model_name.lower():
                 if isinstance(cmd.imagePlatform, str) and cmd.imagePlatform.lower() not in ["other", "paravirtualization"]:
                     e(qcmd, "qemu:arg", attrib={"value": "-cpu"})
@@ -3517,7 +3661,7 @@ class Vm(object):
                 if cmd.coloPrimary or cmd.coloSecondary or cmd.useColoBinary:
                     e(devices, 'emulator', kvmagent.get_colo_qemu_path())
                 else:
-                    e(devices, 'emulator', kvmagent.get_qemu_path())
+                    e(devices, 'emulator', facts['qemu_path'])
             # no default usb controller and tablet device for appliance vm
             if cmd.isApplianceVm:
                 e(devices, 'controller', None, {'type': 'usb', 'model': 'none'})
@@ -3535,9 +3679,7 @@ class Vm(object):
             set_keyboard()
             elements['devices'] = devices
 
-        def make_cdrom():
-            devices = elements['devices']
-
+        def make_cdrom(devices):
             max_cdrom_num = len(Vm.ISO_DEVICE_LETTERS)
             empty_cdrom_configs = None
 
@@ -3616,8 +3758,7 @@ class Vm(object):
                     e(cdrom, 'source', None, {'file': iso.path})
 
 
-        def make_volumes():
-            devices = elements['devices']
+        def make_volumes(devices):
             #guarantee rootVolume is the first of the set
             volumes = [cmd.rootVolume]
             volumes.extend(cmd.dataVolumes)
@@ -3882,7 +4023,7 @@ class Vm(object):
                 volume_native_aio(vol)
                 devices.append(vol)
 
-        def make_nics():
+        def make_nics(devices):
             if not cmd.nics:
                 return
 
@@ -3894,7 +4035,6 @@ class Vm(object):
                 if cmd.coloPrimary or cmd.coloSecondary:
                     Vm._ignore_colo_vm_nic_rom_file_on_interface(nic_xml_object)
 
-            devices = elements['devices']
             vhostSrcPath = cmd.addons['vhostSrcPath'] if cmd.addons else None
             for nic in cmd.nics:
                 interface = Vm._build_interface_xml(nic, devices, vhostSrcPath, action='Attach')
@@ -3903,12 +4043,12 @@ class Vm(object):
         def make_meta():
             root = elements['root']
 
-            e(root, 'name', cmd.vmInstanceUuid)
+            e(root, 'name', values['name'])
 
             if cmd.coloPrimary or cmd.coloSecondary:
                 e(root, 'iothreads', str(len(cmd.nics)))
-            e(root, 'uuid', uuidhelper.to_full_uuid(cmd.vmInstanceUuid))
-            e(root, 'description', cmd.vmName)
+            e(root, 'uuid', values['uuid'])
+            e(root, 'description', values['description'])
             e(root, 'on_poweroff', 'destroy')
             e(root, 'on_reboot', 'restart')
             on_crash = cmd.addons['onCrash']
@@ -3917,8 +4057,8 @@ class Vm(object):
             e(root, 'on_crash', on_crash)
             meta = e(root, 'metadata')
             zs = e(meta, 'zstack', usenamesapce=True)
-            e(zs, 'internalId', str(cmd.vmInternalId))
-            e(zs, 'hostManagementIp', str(cmd.hostManagementIp))
+            e(zs, 'internalId', values['internal_id'])
+            e(zs, 'hostManagementIp', values['host_management_ip'])
             # <clock offset="utc" />
             clock = e(root, 'clock', None, {'offset': cmd.clock})
             # <rom bar='off'/>
@@ -3934,7 +4074,7 @@ class Vm(object):
                 vnc = e(devices, 'graphics', None, {'type': 'vnc', 'port': '5900', 'autoport': 'yes'})
             else:
                 vnc = e(devices, 'graphics', None,
-                        {'type': 'vnc', 'port': '5900', 'autoport': 'yes', 'passwd': str(cmd.consolePassword)})
+                        {'type': 'vnc', 'port': '5900', 'autoport': 'yes', 'passwd': values['console_password']})
             e(vnc, "listen", None, {'type': 'address', 'address': '0.0.0.0'})
 
         def make_spice():
@@ -3943,10 +4083,10 @@ class Vm(object):
                 spice = e(devices, 'graphics', None, {'type': 'spice', 'port': '5900', 'autoport': 'yes'})
             else:
                 spice = e(devices, 'graphics', None,
-                          {'type': 'spice', 'port': '5900', 'autoport': 'yes', 'passwd': str(cmd.consolePassword)})
+                          {'type': 'spice', 'port': '5900', 'autoport': 'yes', 'passwd': values['console_password']})
             e(spice, "listen", None, {'type': 'address', 'address': '0.0.0.0'})
 
-            if is_spice_tls() == 0 and cmd.spiceChannels != None:
+            if facts['spice_tls'] == 0 and cmd.spiceChannels != None:
                 for channel in cmd.spiceChannels:
                     e(spice, "channel", None, {'name': channel, 'mode': "secure"})
             e(spice, "image", None, {'compression': 'auto_glz'})
@@ -4041,11 +4181,10 @@ class Vm(object):
             else:
                 return
 
-        def make_addons():
+        def make_addons(devices):
             if not cmd.addons:
                 return
 
-            devices = elements['devices']
             channel = cmd.addons['channel']
             if channel:
                 basedir = os.path.dirname(channel.socketPath)
@@ -4061,24 +4200,23 @@ class Vm(object):
 
             pciDevices = cmd.addons['pciDevice']
             if pciDevices:
-                make_pci_device(pciDevices)
+                make_pci_device(devices, pciDevices)
 
             mdevDevices = cmd.addons['mdevDevice']
             if mdevDevices:
-                make_mdev_device(mdevDevices)
+                make_mdev_device(devices, mdevDevices)
 
             storageDevices = cmd.addons['storageDevice']
             if storageDevices:
-                make_storage_device(storageDevices)
+                make_storage_device(devices, storageDevices)
 
             usbDevices = cmd.addons['usbDevice']
             if usbDevices:
-                make_usb_device(usbDevices)
+                make_usb_device(devices, usbDevices)
 
         # FIXME: manage scsi device in one place.
-        def make_storage_device(storageDevices):
+        def make_storage_device(devices, storageDevices):
             lvm.unpriv_sgio()
-            devices = elements['devices']
             for volume in storageDevices:
                 if match_storage_device(volume.installPath):
                     if HOST_ARCH in ['aarch64', 'mips64el']:
@@ -4090,8 +4228,7 @@ class Vm(object):
                     e(disk, 'target', None, {'dev': 'sd%s' % Vm.DEVICE_LETTERS[volume.deviceId], 'bus': 'scsi'})
                     Vm.set_device_address(disk, volume)
 
-        def make_pci_device(pciDevices):
-            devices = elements['devices']
+        def make_pci_device(devices, pciDevices):
             for pci in pciDevices:
                 addr, spec_uuid = pci.split(',')
 
@@ -4118,22 +4255,20 @@ class Vm(object):
                     if os.path.exists(rom_file):
                         e(hostdev, "rom", None, {'bar': 'on', 'file': rom_file})
 
-        def make_mdev_device(mdevUuids):
-            devices = elements['devices']
+        def make_mdev_device(devices, mdevUuids):
             for mdevUuid in mdevUuids:
                 hostdev = e(devices, "hostdev", None, {'mode': 'subsystem', 'type': 'mdev', 'model': 'vfio-pci', 'managed': 'yes'})
                 source = e(hostdev, "source")
                 # convert mdevUuid to 8-4-4-4-12 format
                 e(source, "address", None, { "uuid": uuidhelper.to_full_uuid(mdevUuid) })
 
-        def make_usb_device(usbDevices):
+        def make_usb_device(devices, usbDevices):
             if HOST_ARCH in ['aarch64', 'mips64el']:
                 next_uhci_port = 3
             else:
                 next_uhci_port = 2
             next_ehci_port = 1
             next_xhci_port = 1
-            devices = elements['devices']
             for usb in usbDevices:
                 if match_usb_device(usb):
                     if usb.split(":")[5] == "PassThrough":
@@ -4212,7 +4347,7 @@ class Vm(object):
             devices = elements['devices']
             b = e(devices, 'memballoon', None, {'model': 'virtio'})
             e(b, 'stats', None, {'period': '10'})
-            if kvmagent.get_host_os_type() == "debian":
+            if facts['host_os_type'] == "debian":
                 e(b, 'address', None, {'type': 'pci', 'controller': '0', 'bus': '0x00', 'slot': '0x04', 'function':'0x0'})
 
         def make_console():
@@ -4230,7 +4365,7 @@ class Vm(object):
             devices = elements['devices']
             e(devices, 'controller', None, {'type': 'scsi', 'model': 'virtio-scsi'})
 
-            if (machine_type == "q35" or machine_type == "virt") and is_q35_supported():
+            if (machine_type == "q35" or machine_type == "virt") and facts['q35_supported']:
                 controller = e(devices, 'controller', None, {'type': 'sata', 'index': '0'})
                 e(controller, 'alias', None, {'name': 'sata'})
                 e(controller, 'address', None, {'type': 'pci', 'domain': '0', 'bus': '0', 'slot': '0x1f', 'function': '2'})
@@ -4251,52 +4386,58 @@ class Vm(object):
                     e(devices, 'controller', None, {'type': 'pci', 'index': str(i + 1), 'model': 'pci-bridge'})
 
 
-        make_root()
-        make_meta()
-        make_cpu()
-        make_memory()
-        make_os()
-        make_sysinfo()
-        make_features()
-        make_devices()
-        make_video()
-        make_sound()
-        make_nics()
-        make_volumes()
-
-        if not cmd.addons or cmd.addons['noConsole'] is not True:
-            make_graphic_console()
-        make_addons()
-        make_balloon_memory()
-        make_console()
-        make_sec_label()
-        make_controllers()
-        if is_spiceport_driver_supported() and cmd.consoleMode in ["spice", "vncAndSpice"] and not cmd.coloPrimary and not cmd.coloSecondary:
-            make_folder_sharing()
-        # appliance vm doesn't need any cdrom or usb controller
-        if not cmd.isApplianceVm:
-            make_cdrom()
-            if not cmd.coloPrimary and not cmd.coloSecondary and not cmd.useColoBinary:
-                make_usb_redirect()
-
-        if cmd.additionalQmp:
-            make_qemu_commandline()
-
-        if cmd.useHugePage:
-            make_memory_backing()
-
-        root = elements['root']
-        xml = etree.tostring(root)
+        sections = {
+            'nics': make_nics,
+            'volumes': make_volumes,
+            'addons': make_addons,
+            'cdrom': make_cdrom,
+            'qemu_commandline': make_qemu_commandline,
+        }
 
-        vm = Vm()
-        vm.uuid = cmd.vmInstanceUuid
-        if cmd.addons["userDefinedXml"] is not None:
-            vm.domain_xml = base64.b64decode(cmd.addons["userDefinedXml"])
-            vm.domain_xmlobject = xmlobject.loads(vm.domain_xml)
-        else:
-            vm.domain_xml = xml
-            vm.domain_xmlobject = xmlobject.loads(xml)
-        return vm
+        def build(compiling=False):
+            def section(parent, name):
+                if compiling:
+                    xml_template.add_section(parent, name)
+                else:
+                    sections[name](parent)
+
+            make_root()
+            make_meta()
+            make_cpu()
+            make_memory()
+            make_os()
+            make_sysinfo()
+            make_features()
+            make_devices()
+            make_video()
+            make_sound()
+            section(elements['devices'], 'nics')
+            section(elements['devices'], 'volumes')
+
+            if not cmd.addons or cmd.addons['noConsole'] is not True:
+                make_graphic_console()
+            section(elements['devices'], 'addons')
+            make_balloon_memory()
+            make_console()
+            make_sec_label()
+            make_controllers()
+            if facts['spiceport_supported'] and cmd.consoleMode in ["spice", "vncAndSpice"] and not cmd.coloPrimary and not cmd.coloSecondary:
+                make_folder_sharing()
+            # appliance vm doesn't need any cdrom or usb controller
+            if not cmd.isApplianceVm:
+                section(elements['devices'], 'cdrom')
+                if not cmd.coloPrimary and not cmd.coloSecondary and not cmd.useColoBinary:
+                    make_usb_redirect()
+
+            if cmd.additionalQmp:
+                section(elements['root'], 'qemu_commandline')
+
+            if cmd.useHugePage:
+                make_memory_backing()
+
+            return elements['root']
+
+        return build, sections
 
     @staticmethod
     def _build_interface_xml(nic, devices=None, vhostSrcPath=None, action=None):
@@ -4310,7 +4451,7 @@ class Vm(object):
             iftype = 'bridge'
             device_attr = {'type': iftype}
 
-        if devices:
+        if devices is not None:
             interface = e(devices, 'interface', None, device_attr)
         else:
             interface = etree.Element('interface', attrib=device_attr)
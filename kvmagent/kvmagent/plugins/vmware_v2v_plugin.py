@@ -10,6 +10,8 @@ import re
 import tempfile
 
 from kvmagent import kvmagent
+from kvmagent.plugins import v2v_convert_log
+from zstacklib.utils import fact_cache
 from zstacklib.utils import jsonobject
 from zstacklib.utils import linux
 from zstacklib.utils import log
@@ -64,6 +66,9 @@ ADAPTED_VDDK_VERSION_PATH = '/var/lib/zstack/v2v/nbdkit_build_lib/vddk_version'
 WINDOWS_VIRTIO_DRIVE_ISO_VERSION = '/var/lib/zstack/v2v/windows_virtio_version'
 V2V_LIB_PATH = '/var/lib/zstack/v2v/'
 LIBGUESTFS_TEST_LOG_PATH = '/var/lib/zstack/v2v/libguestfs-test.log'
+LIBGUESTFS_TEST_TOOL_PATH = '/usr/bin/libguestfs-test-tool'
+# libguestfs-test-tool boots the appliance, it is rerun when any of these changes
+LIBGUESTFS_WATCHED_PATHS = ['/usr/bin/virt-v2v', '/usr/lib64/guestfs', '/usr/libexec/qemu-kvm']
 
 class VMwareV2VPlugin(kvmagent.KvmAgent):
     INIT_PATH = "/vmwarev2v/conversionhost/init"
@@ -75,6 +80,13 @@ class VMwareV2VPlugin(kvmagent.KvmAgent):
     DELETE_QOS_PATH = "/vmwarev2v/conversionhost/qos/delete"
     CANCEL_CONVERT_PATH = "/vmwarev2v/conversionhost/convert/cancel"
 
+    def __init__(self):
+        super(VMwareV2VPlugin, self).__init__()
+        self.nbdkit_probe = fact_cache.FactCache(self._probe_nbdkit, self._get_nbdkit_watched_paths)
+        self.libguestfs_probe = fact_cache.FactCache(self._probe_libguestfs,
+                                                     [LIBGUESTFS_TEST_TOOL_PATH] + LIBGUESTFS_WATCHED_PATHS)
+        self.convert_logs = v2v_convert_log.ConvertLogs()
+
     def start(self):
         http_server = kvmagent.get_http_server()
         http_server.register_async_uri(self.INIT_PATH, self.init)
@@ -136,9 +148,7 @@ class VMwareV2VPlugin(kvmagent.KvmAgent):
         cmd.nbdkitUrl = nbdkitUrl.substitute(tmpl)
 
         def check_libguestfs():
-            cmd = "/usr/bin/libguestfs-test-tool > {} 2>&1".format(LIBGUESTFS_TEST_LOG_PATH)
-
-            if shell.run(cmd) != 0:
+            if not self._libguestfs_is_work():
                 rsp.success = False
                 rsp.error = "libguestfs test failed, log file: %s" % LIBGUESTFS_TEST_LOG_PATH
                 return jsonobject.dumps(rsp)
@@ -265,11 +275,8 @@ class VMwareV2VPlugin(kvmagent.KvmAgent):
 
         v2v_log_file = "%s/virt_v2v_log" % storage_dir
 
-        tail_log_cmd = shell.ShellCmd('tail -2 %s' % v2v_log_file)
-        tail_log_cmd(False)
-
-        if tail_log_cmd.return_code == 0 and tail_log_cmd.stdout:
-            out = tail_log_cmd.stdout
+        out = self.convert_logs.tail(v2v_log_file)
+        if out:
             if 'Converting' in out and 'to run on KVM' in out:
                 rsp.currentDiskNum = '0'
                 rsp.currentProgress = '10'
@@ -305,17 +312,42 @@ class VMwareV2VPlugin(kvmagent.KvmAgent):
         return jsonobject.dumps(rsp)
 
     @staticmethod
-    def _ndbkit_is_work():
+    def _get_nbdkit_path():
+        nbd_version = linux.read_file(NBDKIT_VERSION_PATH)
+        return "%s%s/nbdkit" % (NBDKIT_BUILD_LIB_PATH, nbd_version.strip('.tar.gz'))
+
+    @staticmethod
+    def _get_nbdkit_watched_paths():
+        if not os.path.exists(NBDKIT_VERSION_PATH):
+            return [NBDKIT_VERSION_PATH]
+        return [NBDKIT_VERSION_PATH, VMwareV2VPlugin._get_nbdkit_path()]
+
+    @staticmethod
+    def _probe_nbdkit():
         if not os.path.exists(NBDKIT_VERSION_PATH):
             return False
 
-        nbd_version = linux.read_file(NBDKIT_VERSION_PATH)
-        check_cmd = shell.ShellCmd(".%s%s/nbdkit --version" % (NBDKIT_BUILD_LIB_PATH, nbd_version.strip('.tar.gz')))
+        check_cmd = shell.ShellCmd("%s --version" % VMwareV2VPlugin._get_nbdkit_path())
         check_cmd(False)
+        return check_cmd.return_code == 0
 
-        if check_cmd.return_code != 0:
-            return False
-        return True
+    @staticmethod
+    def _probe_libguestfs():
+        return shell.run("{} > {} 2>&1".format(LIBGUESTFS_TEST_TOOL_PATH, LIBGUESTFS_TEST_LOG_PATH)) == 0
+
+    @staticmethod
+    def _get_probed(probe):
+        works = probe.get()
+        if not works:
+            # only a working tool is remembered, a broken one may be fixed by then
+            probe.invalidate()
+        return works
+
+    def _ndbkit_is_work(self):
+        return self._get_probed(self.nbdkit_probe)
+
+    def _libguestfs_is_work(self):
+        return self._get_probed(self.libguestfs_probe)
 
     @staticmethod
     def _get_nbdkit_dir_path():
@@ -576,6 +608,7 @@ class VMwareV2VPlugin(kvmagent.KvmAgent):
         else:
             cleanUpPath = os.path.join(cmd.storagePath, cmd.srcVmUuid)
             shell.run("pkill -9 -f '%s'" % cleanUpPath)
+        self.convert_logs.forget(cleanUpPath)
         if cmd.needCleanDnat:
             clean_dnat(cmd.dnatInfo)
         linux.rm_dir_force(cleanUpPath)
@@ -589,6 +622,7 @@ class VMwareV2VPlugin(kvmagent.KvmAgent):
 
         clean_up_path = os.path.join(cmd.storagePath, cmd.srcVmUuid)
         shell.run("pkill -9 -f '%s'" % clean_up_path)
+        self.convert_logs.forget(clean_up_path)
         linux.rm_dir_force(clean_up_path)
         return jsonobject.dumps(rsp)
 
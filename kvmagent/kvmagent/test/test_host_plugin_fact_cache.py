@@ -0,0 +1,83 @@
+'''
+
+benchmark cold and warm host fact latency with mocked commands
+'''
+import time
+import unittest
+
+from kvmagent.plugins import host_plugin
+from zstacklib.utils import jsonobject
+from zstacklib.utils import log
+from zstacklib.utils import shell
+
+logger = log.get_logger(__name__)
+
+# the cost of forking a shell pipeline on a loaded host
+FAKE_FORK_COST = 0.01
+
+
+class FakeShell(object):
+    def __init__(self):
+        self.calls = []
+
+    def call(self, cmd, exception=True, workdir=None):
+        self.calls.append(cmd)
+        time.sleep(FAKE_FORK_COST)
+        if cmd.startswith('qemu-img'):
+            return '2.12.0\n'
+        if cmd.startswith('ip addr'):
+            return '192.168.0.10\n10.0.0.1\n'
+        if cmd.startswith('dmidecode'):
+            return 'fake\n'
+        return ''
+
+    def run(self, cmd, workdir=None):
+        self.calls.append(cmd)
+        time.sleep(FAKE_FORK_COST)
+        return 0
+
+
+class TestHostFactCache(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeShell()
+        self.origin = (shell.call, shell.run)
+        shell.call, shell.run = self.fake.call, self.fake.run
+
+        self.plugin = host_plugin.HostPlugin()
+        self.plugin.libvirt_version = '4.9.0'
+        self.plugin._get_host_cpu_model = lambda: 'Broadwell'
+        self.plugin.static_facts = host_plugin.fact_cache.FactCache(self.plugin._probe_static_facts,
+                                                                   host_plugin.STATIC_FACT_WATCHED_PATHS)
+
+    def tearDown(self):
+        shell.call, shell.run = self.origin
+
+    def _fact(self):
+        del self.fake.calls[:]
+        start = time.time()
+        rsp = jsonobject.loads(self.plugin.fact(None))
+        return time.time() - start, len(self.fake.calls), rsp
+
+    def test_cold_and_warm_fact(self):
+        cold, cold_forks, cold_rsp = self._fact()
+
+        rounds = 20
+        warm = 0
+        for _ in range(rounds):
+            cost, warm_forks, warm_rsp = self._fact()
+            warm += cost
+        warm = warm / rounds
+
+        logger.debug('fact latency cold: %.4fs (%d forks), warm: %.4fs (%d forks)' %
+                     (cold, cold_forks, warm, warm_forks))
+        self.assertTrue(cold_rsp.success)
+        self.assertEqual(cold_rsp.qemuImgVersion, warm_rsp.qemuImgVersion)
+        self.assertEqual(cold_rsp.cpuModelName, warm_rsp.cpuModelName)
+        # only the ip addresses are probed on a warm cache
+        self.assertEqual(1, warm_forks)
+        self.assertTrue(cold_forks > warm_forks)
+        self.assertTrue(warm < cold)
+
+
+if __name__ == "__main__":
+    unittest.main()
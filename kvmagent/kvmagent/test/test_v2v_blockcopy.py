@@ -0,0 +1,127 @@
+'''
+
+v2v block copies scheduled against a fake libvirt domain whose block jobs
+copy at given throughputs and raise events when they are ready
+'''
+import threading
+import time
+import unittest
+
+from kvmagent.plugins import v2v_blockcopy
+
+
+class FakeVolume(object):
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.endTime = None
+
+
+class FakeDomain(object):
+    def __init__(self, throughput):
+        self.throughput = throughput    # bytes per second of one block job
+        self.sizes = {}
+        self.jobs = {}
+        self.started = []
+        self.max_running = 0
+        self.listener = None
+        self.lock = threading.Lock()
+
+    def blockCopy(self, disk, xml, params, flags):
+        with self.lock:
+            self.jobs[disk] = time.time()
+            self.started.append(disk)
+            running = len([d for d in self.jobs if not self._ready(d)])
+            self.max_running = max(self.max_running, running)
+
+        t = threading.Timer(float(self.sizes[disk]) / self.throughput, self._fire, args=(disk,))
+        t.daemon = True
+        t.start()
+
+    def blockJobInfo(self, disk, flags):
+        with self.lock:
+            start = self.jobs.get(disk)
+            if start is None:
+                return {}
+            end = self.sizes[disk]
+            return {'cur': min(end, int((time.time() - start) * self.throughput)), 'end': end}
+
+    def blockJobAbort(self, disk):
+        with self.lock:
+            self.jobs.pop(disk, None)
+
+    def _ready(self, disk):
+        return time.time() - self.jobs[disk] >= float(self.sizes[disk]) / self.throughput
+
+    def _fire(self, disk):
+        if self.listener:
+            self.listener(disk, v2v_blockcopy.BLOCK_JOB_READY)
+
+
+class TestBlockCopyScheduler(unittest.TestCase):
+    MB = 1024 * 1024
+
+    def make(self, sizes, max_jobs, throughput=100 * MB, poll_interval=60):
+        dom = FakeDomain(throughput)
+        volumes = []
+        for i, size in enumerate(sizes):
+            v = FakeVolume('vd%s' % chr(ord('a') + i), size)
+            dom.sizes[v.name] = size
+            volumes.append(v)
+
+        reports = []
+        scheduler = v2v_blockcopy.BlockCopyScheduler(
+            dom, volumes, lambda v: dom.blockCopy(v.name, None, None, 0),
+            on_progress=reports.append, max_jobs=max_jobs,
+            progress_step=1.0 / 60, poll_interval=poll_interval)
+        dom.listener = scheduler.on_block_job_event
+        return dom, volumes, scheduler, reports
+
+    def test_largest_first_bounded(self):
+        MB = self.MB
+        # vdb takes 0.2s on one slot while vda and vdc take 0.1s each on the other,
+        # vdd starts once either is free
+        dom, volumes, scheduler, reports = self.make([10 * MB, 20 * MB, 10 * MB, 10 * MB], max_jobs=2)
+
+        start = time.time()
+        self.assertTrue(scheduler.run())
+        elapsed = time.time() - start
+
+        self.assertEqual('vdb', dom.started[0])
+        self.assertEqual(4, len(dom.started))
+        self.assertEqual(2, dom.max_running)
+        self.assertTrue(all(v.endTime for v in volumes))
+        # events drive the schedule, the 60s poll interval is never waited out
+        self.assertGreaterEqual(elapsed, 0.28)
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(1.0, reports[-1])
+
+    def test_progress_reported_by_step(self):
+        MB = self.MB
+        dom, volumes, scheduler, reports = self.make([50 * MB] * 3, max_jobs=3, poll_interval=0.005)
+
+        self.assertTrue(scheduler.run())
+        # a poll every 5ms over 0.5s, but at most one report per 1/60 of the progress
+        self.assertLessEqual(len(reports), 61)
+        self.assertEqual(sorted(reports), reports)
+        for a, b in zip(reports, reports[1:-1]):
+            self.assertGreaterEqual(b - a, 1.0 / 60)
+        self.assertEqual(1.0, reports[-1])
+
+    def test_canceled_job(self):
+        MB = self.MB
+        dom, volumes, scheduler, reports = self.make([100 * MB, 10 * MB], max_jobs=2)
+
+        def cancel():
+            dom.blockJobAbort('vda')
+            scheduler.on_block_job_event('vda', v2v_blockcopy.BLOCK_JOB_CANCELED)
+        threading.Timer(0.2, cancel).start()
+
+        start = time.time()
+        self.assertFalse(scheduler.run())
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEqual(['vda'], scheduler.canceled)
+
+
+if __name__ == "__main__":
+    unittest.main()
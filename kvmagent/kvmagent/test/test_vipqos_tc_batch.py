@@ -0,0 +1,287 @@
+'''
+
+vip qos of 1,000 ports applied through the tc model, against fake `ip` and
+`tc` binaries keeping the qdisc, class and filter tree of each nic
+'''
+import os
+import shutil
+import simplejson
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+from kvmagent.plugins import vipqos
+
+FAKE_IP = '''#!%(python)s
+import os, sys
+state = os.environ['FAKE_TC_STATE']
+if sys.argv[1:] == ['netns']:
+    with open(os.path.join(state, 'netns')) as fd:
+        for i, ns in enumerate(fd.read().split()):
+            print '%%s (id: %%d)' %% (ns, i)
+    sys.exit(0)
+assert sys.argv[1:3] == ['netns', 'exec']
+os.environ['FAKE_NETNS'] = sys.argv[3]
+os.execvp(sys.argv[4], sys.argv[4:])
+'''
+
+FAKE_TC = '''#!%(python)s
+import os, sys, json
+state_dir = os.environ['FAKE_TC_STATE']
+netns = os.environ.get('FAKE_NETNS', '')
+state_file = os.path.join(state_dir, 'tc.json')
+state = json.load(open(state_file)) if os.path.exists(state_file) else {}
+
+def nic(dev):
+    return state.setdefault('%%s/%%s' %% (netns, dev), {'htb': False, 'classes': {}, 'sfq': [], 'filters': {}})
+
+def minor(classid):
+    return classid.split(':')[1]
+
+def run(words):
+    obj, op, dev = words[0], words[1], words[3]
+    n = nic(dev)
+    if op == 'show':
+        if obj == 'qdisc':
+            if not n['htb']:
+                print 'qdisc noqueue 0: root refcnt 2'
+                return
+            print 'qdisc htb 1: root refcnt 2 r2q 10 default 1 direct_packets_stat 0 direct_qlen 1000'
+            for i, m in enumerate(n['sfq']):
+                print 'qdisc sfq %%x: parent 1:%%s limit 127p quantum 1514b depth 127 divisor 1024' %% (0x8001 + i, m)
+        elif obj == 'class':
+            for m, rate in sorted(n['classes'].items()):
+                print 'class htb 1:%%s root leaf 8001: prio 0 rate %%s ceil %%s burst 1375b cburst 1375b' %% (m, rate, rate)
+        elif n['htb'] and n.get('u32'):
+            print 'filter parent 1: protocol ip pref 1 u32 chain 0 '
+            print 'filter parent 1: protocol ip pref 1 u32 chain 0 fh 800: ht divisor 1 '
+            for h, (match, port, flow) in sorted(n['filters'].items()):
+                print 'filter parent 1: protocol ip pref 1 u32 chain 0 fh 800::%%x order %%s key ht 800 bkt 0 flowid 1:%%s not_in_hw ' %% (int(h), h, flow)
+                if match == 'sport':
+                    print '  match %%04x0000/ffff0000 at 20' %% port
+                else:
+                    print '  match 0000%%04x/0000ffff at 20' %% port
+        return
+
+    if obj == 'qdisc' and words[4] == 'root':
+        if op == 'del':
+            assert n['htb'], 'no root qdisc'
+        n.update({'htb': op == 'replace', 'classes': {}, 'sfq': [], 'filters': {}, 'u32': False})
+        return
+
+    assert n['htb'], 'no htb on %%s' %% dev
+    if obj == 'class':
+        m = minor(words[words.index('classid') + 1])
+        if op == 'add':
+            assert m not in n['classes'], 'class 1:%%s exists' %% m
+        else:
+            assert m in n['classes'], 'no class 1:%%s' %% m
+        if op == 'del':
+            assert m not in n['sfq'], 'class 1:%%s has a qdisc' %% m
+            assert m not in [f[2] for f in n['filters'].values()], 'class 1:%%s has a filter' %% m
+            del n['classes'][m]
+        else:
+            n['classes'][m] = words[words.index('rate') + 1]
+    elif obj == 'qdisc':
+        m = minor(words[5])
+        assert m in n['classes'], 'no class 1:%%s' %% m
+        if op == 'add':
+            assert m not in n['sfq'], 'qdisc exists'
+            n['sfq'].append(m)
+        else:
+            n['sfq'].remove(m)
+    elif 'handle' not in words:
+        n['u32'] = True
+    else:
+        h = str(int(words[words.index('handle') + 1].split('::')[1], 16))
+        if op == 'add':
+            assert n['u32'] and h not in n['filters'], 'filter 800::%%s exists' %% h
+            i = words.index('match')
+            m = minor(words[words.index('flowid') + 1])
+            assert m in n['classes'], 'no class 1:%%s' %% m
+            n['filters'][h] = (words[i + 2], int(words[i + 3]), m)
+        else:
+            del n['filters'][h]
+
+def save():
+    json.dump(state, open(state_file, 'w'))
+
+if sys.argv[1] == '-batch':
+    lines = open(sys.argv[2]).read().splitlines()
+    with open(os.path.join(state_dir, 'batches'), 'a') as fd:
+        fd.write(json.dumps([netns, lines]) + '\\n')
+    for i, line in enumerate(lines):
+        try:
+            run(line.split())
+        except (AssertionError, KeyError, ValueError) as e:
+            save()
+            sys.stderr.write('%%s\\nCommand failed %%s:%%d\\n' %% (e, sys.argv[2], i + 1))
+            sys.exit(1)
+else:
+    try:
+        run(sys.argv[1:])
+    except (AssertionError, KeyError) as e:
+        sys.stderr.write('%%s\\n' %% e)
+        sys.exit(2)
+save()
+'''
+
+VIP = '10.86.1.51'
+VIP_UUID = '2a342b3ddd0f408c945c3576940a5a3a'
+NS_NAME = 'vip_10_86_1_51'
+PRI_IDEV = '%s_i' % VIP_UUID[-9:]
+PUB_IDEV = '%s_ei' % VIP_UUID[-9:]
+
+# tc dump of rules made by earlier agents, classes 1:2 and 1:10
+LEGACY_DUMP = '''qdisc htb 1: root refcnt 2 r2q 10 default 1 direct_packets_stat 0
+qdisc sfq 8001: parent 1:1 limit 127p quantum 1514b divisor 1024
+class htb 1:1 root leaf 8001: prio 0 rate 10Gbit ceil 10Gbit burst 1375b cburst 1375b
+class htb 1:2 root leaf 8002: prio 0 rate 1Mbit ceil 1Mbit burst 15736b cburst 15736b
+class htb 1:10 root leaf 8003: prio 0 rate 2Mbit ceil 2Mbit burst 15736b cburst 15736b
+filter parent 1: protocol ip pref 1 u32
+filter parent 1: protocol ip pref 1 u32 fh 800: ht divisor 1
+filter parent 1: protocol ip pref 1 u32 fh 800::2 order 2 key ht 800 bkt 0 flowid 1:2
+  match 00000064/0000ffff at 20
+filter parent 1: protocol ip pref 1 u32 fh 800::a order 10 key ht 800 bkt 0 flowid 1:10
+  match 000000c8/0000ffff at 20
+'''
+
+
+def rule(port, inbound=1048576, outbound=2097152):
+    return {'vipUuid': VIP_UUID, 'vip': VIP, 'port': port,
+            'inboundBandwidth': inbound, 'outboundBandwidth': outbound}
+
+
+class TestVipQosTcBatch(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bin = os.path.join(self.dir, 'bin')
+        os.mkdir(self.bin)
+        for name, script in (('ip', FAKE_IP), ('tc', FAKE_TC)):
+            path = os.path.join(self.bin, name)
+            with open(path, 'w') as fd:
+                fd.write(script % {'python': sys.executable})
+            os.chmod(path, stat.S_IRWXU)
+        with open(os.path.join(self.dir, 'netns'), 'w') as fd:
+            fd.write('%s\n' % NS_NAME)
+
+        self.saved_env = dict(os.environ)
+        os.environ['PATH'] = '%s:%s' % (self.bin, os.environ['PATH'])
+        os.environ['FAKE_TC_STATE'] = self.dir
+        self.qos = vipqos.VipQos()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+        shutil.rmtree(self.dir)
+
+    def _batches(self):
+        path = os.path.join(self.dir, 'batches')
+        if not os.path.exists(path):
+            return []
+        with open(path) as fd:
+            return [simplejson.loads(l) for l in fd]
+
+    def _changes(self):
+        return [lines for _, lines in self._batches() if not lines[0].endswith(' show dev %s' % lines[0].split()[-1])]
+
+    def _state(self, nic):
+        with open(os.path.join(self.dir, 'tc.json')) as fd:
+            return simplejson.load(fd)['%s/%s' % (NS_NAME, nic)]
+
+    def _reloaded(self, nic):
+        ret, out, _ = self.qos._tc_batch(NS_NAME, vipqos.VipQosNic.dump_commands(nic))
+        self.assertEqual(0, ret)
+        model = vipqos.VipQosNic(nic)
+        model.load(out)
+        return model
+
+    def _assert_model_is_nic(self, nic):
+        model = self.qos.nics[(NS_NAME, nic)]
+        reloaded = self._reloaded(nic)
+        self.assertTrue(reloaded.htb)
+        self.assertEqual(model.class_ids, reloaded.class_ids)
+        self.assertEqual(dict((p, f[0]) for p, f in model.filters.items()),
+                         dict((p, f[0]) for p, f in reloaded.filters.items()))
+
+    def test_legacy_dump(self):
+        model = vipqos.VipQosNic(PRI_IDEV)
+        model.load(LEGACY_DUMP)
+        self.assertTrue(model.htb)
+        self.assertEqual(set([1, 2, 10]), model.class_ids)
+        self.assertEqual({100: (2, '800::2'), 200: (10, '800::a')}, model.filters)
+        self.assertEqual(['filter del dev %s parent 1:0 prio 1 handle 800::a protocol ip u32' % PRI_IDEV,
+                          'qdisc del dev %s parent 1:10 sfq' % PRI_IDEV,
+                          'class del dev %s parent 1:0 classid 1:10' % PRI_IDEV], model.delete(200))
+
+    def test_thousand_ports(self):
+        start = time.time()
+        self.qos._apply_vipqos_rules([rule(0)] + [rule(p) for p in range(1, 1001)])
+        elapsed = time.time() - start
+
+        changes = self._changes()
+        self.assertEqual(1, len(changes))
+        print '\n1000 ports on 2 nics: %d tc commands in 1 batch, %d tc runs, %.2fs' % (
+            len(changes[0]), len(self._batches()), elapsed)
+
+        pri, pub = self._state(PRI_IDEV), self._state(PUB_IDEV)
+        self.assertEqual(1001, len(pri['classes']))
+        self.assertEqual('1048576', pri['classes']['1'])
+        self.assertEqual('2097152', pub['classes']['1'])
+        self.assertEqual(set(range(1, 1001)), set(f[1] for f in pri['filters'].values()))
+        self.assertEqual(set(['dport']), set(f[0] for f in pri['filters'].values()))
+        self.assertEqual(set(['sport']), set(f[0] for f in pub['filters'].values()))
+        self._assert_model_is_nic(PRI_IDEV)
+        self._assert_model_is_nic(PUB_IDEV)
+
+        self.qos._delete_vipqos_rules([rule(p) for p in range(1, 1001, 2)])
+        self.assertEqual(2, len(self._changes()))
+        self.assertEqual(501, len(self._state(PRI_IDEV)['classes']))
+
+        # freed class ids are used again, from the lowest
+        self.qos._apply_vipqos_rules([rule(p, inbound=4096, outbound=0) for p in range(2001, 2011)])
+        model = self.qos.nics[(NS_NAME, PRI_IDEV)]
+        self.assertEqual(range(2, 21, 2), sorted(model.filters[p][0] for p in range(2001, 2011)))
+        self.assertEqual(500, len(self._state(PUB_IDEV)['filters']))
+        self._assert_model_is_nic(PRI_IDEV)
+
+        # a new agent reads the same tree back
+        qos = vipqos.VipQos()
+        qos._apply_vipqos_rules([rule(3000)])
+        self.assertEqual(self.qos.nics[(NS_NAME, PRI_IDEV)].class_ids | set([22]),
+                         qos.nics[(NS_NAME, PRI_IDEV)].class_ids)
+
+    def test_port_changed_again(self):
+        self.qos._apply_vipqos_rules([rule(100)])
+        self.qos._apply_vipqos_rules([rule(100, inbound=8192)])
+        pri = self._state(PRI_IDEV)
+        self.assertEqual({'1': '10737418240', '2': '8192'}, pri['classes'])
+        self.assertEqual(2, len(self._changes()))
+
+    def test_nic_changed_behind_the_model(self):
+        self.qos._apply_vipqos_rules([rule(100), rule(200)])
+        self.qos._tc_batch(NS_NAME, ['qdisc del dev %s root' % PRI_IDEV])
+
+        self.qos._apply_vipqos_rules([rule(200, inbound=8192)])
+        pri = self._state(PRI_IDEV)
+        self.assertEqual({'1': '10737418240', '2': '8192'}, pri['classes'])
+        self._assert_model_is_nic(PRI_IDEV)
+        self._assert_model_is_nic(PUB_IDEV)
+
+    def test_delete_all(self):
+        self.qos._apply_vipqos_rules([rule(100)])
+        self.qos._delete_vipallqos_rules([rule(0)])
+        self.assertFalse(self._state(PRI_IDEV)['htb'])
+        self.assertFalse(self._state(PUB_IDEV)['htb'])
+        self.assertEqual({}, self.qos.nics)
+
+    def test_no_namespace(self):
+        with open(os.path.join(self.dir, 'netns'), 'w') as fd:
+            fd.write('')
+        self.assertRaises(Exception, self.qos._apply_vipqos_rules, [rule(100)])
+
+
+if __name__ == '__main__':
+    unittest.main()
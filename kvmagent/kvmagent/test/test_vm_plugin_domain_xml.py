@@ -0,0 +1,143 @@
+'''
+
+domain xml of StartVmCmd fixtures against golden files, templated against
+the etree builder, and a benchmark of vm starts per second
+'''
+import glob
+import os
+import time
+import unittest
+
+from kvmagent import kvmagent
+from kvmagent.plugins import vm_plugin
+from zstacklib.utils import fact_cache
+from zstacklib.utils import jsonobject
+from zstacklib.utils import linux
+from zstacklib.utils import xml_template
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'start_vm_cmds')
+
+# the host the golden files were generated on
+HOST_FACTS = {
+    'spice_tls': 0,
+    'spiceport_supported': True,
+    'virtual_machine': False,
+    'host_os_type': 'redhat',
+    'cpu_model': ('GenuineIntel', 'Intel(R) Xeon(R) Gold 6130 CPU @ 2.10GHz'),
+    'qemu_path': '/usr/libexec/qemu-kvm',
+    'hv_freq_supported': True,
+    'ioapic_supported': True,
+    'q35_supported': True,
+}
+
+
+def load_fixtures():
+    ret = []
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.json'))):
+        with open(path) as fd:
+            cmd = fd.read()
+        with open(path[:-len('.json')] + '.xml') as fd:
+            golden = fd.read()
+        ret.append((os.path.basename(path), cmd, golden))
+    return ret
+
+
+def another_vm(cmd_json, n):
+    '''
+    a vm of the same shape with other slot values
+    '''
+    cmd = jsonobject.loads(cmd_json)
+    d = jsonobject.loads(cmd_json)
+    cmd.vmInstanceUuid = '%032x' % (0xabc000 + n)
+    cmd.vmName = 'vm-%d <&>' % n
+    cmd.vmInternalId = 1000 + n
+    cmd.memory = d.memory + n * 1048576
+    cmd.cpuNum = d.cpuNum + n % 3
+    for i, nic in enumerate(cmd.nics or []):
+        nic.mac = 'fa:16:3e:%02x:%02x:%02x' % (n / 256, n % 256, i)
+    return cmd
+
+
+@unittest.skipUnless(vm_plugin.HOST_ARCH == 'x86_64', 'golden files are of x86_64 hosts')
+class TestDomainXml(unittest.TestCase):
+    def setUp(self):
+        self.saved = [(vm_plugin, 'DOMAIN_HOST_FACTS', vm_plugin.DOMAIN_HOST_FACTS),
+                      (vm_plugin, 'DOMAIN_XML_TEMPLATES', vm_plugin.DOMAIN_XML_TEMPLATES),
+                      (vm_plugin, 'LIBVIRT_VERSION', vm_plugin.LIBVIRT_VERSION),
+                      (vm_plugin, 'QEMU_VERSION', vm_plugin.QEMU_VERSION),
+                      (vm_plugin, 'DIST_NAME', vm_plugin.DIST_NAME),
+                      (vm_plugin, 'is_kylin402', vm_plugin.is_kylin402),
+                      (kvmagent, 'get_qemu_path', kvmagent.get_qemu_path),
+                      (linux, 'get_img_fmt', linux.get_img_fmt)]
+        vm_plugin.DOMAIN_HOST_FACTS = fact_cache.FactCache(lambda: HOST_FACTS)
+        vm_plugin.LIBVIRT_VERSION = '4.9.0'
+        vm_plugin.QEMU_VERSION = '4.2.0'
+        vm_plugin.DIST_NAME = 'centos'
+        vm_plugin.is_kylin402 = lambda: False
+        kvmagent.get_qemu_path = lambda: '/usr/libexec/qemu-kvm'
+        linux.get_img_fmt = lambda path: 'qcow2'
+        vm_plugin.DOMAIN_XML_TEMPLATES = xml_template.TemplateCache()
+        self.fixtures = load_fixtures()
+
+    def tearDown(self):
+        for obj, name, value in self.saved:
+            setattr(obj, name, value)
+
+    def test_golden_files(self):
+        self.assertTrue(self.fixtures)
+        for _ in range(2):
+            # compiled in the first round, from the cache in the second
+            for name, cmd_json, golden in self.fixtures:
+                cmd = jsonobject.loads(cmd_json)
+                self.assertEqual(golden, vm_plugin.Vm.from_StartVmCmd(cmd).domain_xml, name)
+                self.assertEqual(golden, vm_plugin.Vm._build_domain_xml(cmd, templated=False), name)
+        self.assertEqual(len(self.fixtures), vm_plugin.DOMAIN_XML_TEMPLATES.misses)
+
+    def test_same_shape_other_values(self):
+        for name, cmd_json, _ in self.fixtures:
+            for n in range(20):
+                cmd = another_vm(cmd_json, n)
+                self.assertEqual(vm_plugin.Vm._build_domain_xml(cmd, templated=False),
+                                 vm_plugin.Vm._build_domain_xml(cmd), name)
+
+    def test_empty_value_is_another_shape(self):
+        _, cmd_json, _ = self.fixtures[0]
+        cmd = jsonobject.loads(cmd_json)
+        vm_plugin.Vm._build_domain_xml(cmd)
+        cmd.vmName = ''
+        xml = vm_plugin.Vm._build_domain_xml(cmd)
+        self.assertIn('<description />', xml)
+        self.assertEqual(vm_plugin.Vm._build_domain_xml(cmd, templated=False), xml)
+        self.assertEqual(2, vm_plugin.DOMAIN_XML_TEMPLATES.misses)
+
+    def test_upgraded_host_is_another_shape(self):
+        _, cmd_json, _ = self.fixtures[0]
+        cmd = jsonobject.loads(cmd_json)
+        self.assertIn('<ioapic driver="kvm" />', vm_plugin.Vm._build_domain_xml(cmd))
+
+        # as probed again after libvirt and qemu are replaced
+        facts = dict(HOST_FACTS, ioapic_supported=False, qemu_path='/usr/bin/qemu-system-x86_64')
+        vm_plugin.DOMAIN_HOST_FACTS = fact_cache.FactCache(lambda: facts)
+        xml = vm_plugin.Vm._build_domain_xml(cmd)
+        self.assertNotIn('ioapic', xml)
+        self.assertIn('<emulator>/usr/bin/qemu-system-x86_64</emulator>', xml)
+        self.assertEqual(vm_plugin.Vm._build_domain_xml(cmd, templated=False), xml)
+        self.assertEqual(2, vm_plugin.DOMAIN_XML_TEMPLATES.misses)
+
+    def test_starts_per_second(self):
+        cmds = [another_vm(cmd_json, n) for n in range(40) for _, cmd_json, _ in self.fixtures]
+
+        def run(build):
+            start = time.time()
+            for cmd in cmds:
+                build(cmd)
+            return len(cmds) / (time.time() - start)
+
+        etree_rate = run(lambda cmd: vm_plugin.Vm._build_domain_xml(cmd, templated=False))
+        templated_rate = run(vm_plugin.Vm._build_domain_xml)
+        print '\n%d vm starts: etree builder %.0f/s, templated %.0f/s' % (len(cmds), etree_rate, templated_rate)
+        self.assertGreater(templated_rate, etree_rate)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+'''
+
+conversion host probes against fake nbdkit and libguestfs-test-tool binaries
+counting their runs, and progress polls of a growing virt-v2v log reading
+only what was appended since the last poll
+'''
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+from kvmagent.plugins import v2v_convert_log
+from kvmagent.plugins import vmware_v2v_plugin
+from zstacklib.utils import http
+from zstacklib.utils import jsonobject
+
+FAKE_TOOL = '''#!/bin/sh
+echo "$0 $*" >> %s
+'''
+
+DEBUG_LINE = 'libguestfs: trace: v2v: guestfs_is_file "/windows/system32/config/software"\n'
+POLLS = 200
+
+
+class TestVMwareV2VProbeCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.calls = os.path.join(self.dir, 'calls.log')
+        lib = os.path.join(self.dir, 'nbdkit_build_lib') + '/'
+        self.nbdkit = lib + 'nbdkit-1.2.3/nbdkit'
+        self.test_tool = os.path.join(self.dir, 'libguestfs-test-tool')
+        os.makedirs(os.path.dirname(self.nbdkit))
+        self._write_bin(self.nbdkit)
+        self._write_bin(self.test_tool)
+
+        self.origin = dict((n, getattr(vmware_v2v_plugin, n)) for n in (
+            'NBDKIT_BUILD_LIB_PATH', 'NBDKIT_VERSION_PATH', 'LIBGUESTFS_TEST_TOOL_PATH',
+            'LIBGUESTFS_TEST_LOG_PATH', 'LIBGUESTFS_WATCHED_PATHS'))
+        vmware_v2v_plugin.NBDKIT_BUILD_LIB_PATH = lib
+        vmware_v2v_plugin.NBDKIT_VERSION_PATH = lib + 'nbdkit_version'
+        vmware_v2v_plugin.LIBGUESTFS_TEST_TOOL_PATH = self.test_tool
+        vmware_v2v_plugin.LIBGUESTFS_TEST_LOG_PATH = os.path.join(self.dir, 'libguestfs-test.log')
+        vmware_v2v_plugin.LIBGUESTFS_WATCHED_PATHS = []
+        with open(vmware_v2v_plugin.NBDKIT_VERSION_PATH, 'w') as fd:
+            fd.write('nbdkit-1.2.3.tar.gz')
+
+        self.plugin = vmware_v2v_plugin.VMwareV2VPlugin()
+
+    def tearDown(self):
+        for name, value in self.origin.items():
+            setattr(vmware_v2v_plugin, name, value)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _write_bin(self, path):
+        with open(path, 'w') as fd:
+            fd.write(FAKE_TOOL % self.calls)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+    def _runs(self, path):
+        if not os.path.exists(self.calls):
+            return 0
+        with open(self.calls) as fd:
+            return len([l for l in fd if l.startswith(path + ' ')])
+
+    def test_probes_cached_until_binaries_change(self):
+        for _ in range(10):
+            self.assertTrue(self.plugin._ndbkit_is_work())
+            self.assertTrue(self.plugin._libguestfs_is_work())
+        self.assertEqual(1, self._runs(self.nbdkit))
+        self.assertEqual(1, self._runs(self.test_tool))
+
+        # a rebuilt nbdkit is probed again
+        self._write_bin(self.nbdkit)
+        os.utime(self.nbdkit, (time.time() + 1, time.time() + 1))
+        self.assertTrue(self.plugin._ndbkit_is_work())
+        self.assertEqual(2, self._runs(self.nbdkit))
+
+        # a failed probe is not remembered
+        os.remove(self.nbdkit)
+        self.assertFalse(self.plugin._ndbkit_is_work())
+        self._write_bin(self.nbdkit)
+        self.assertTrue(self.plugin._ndbkit_is_work())
+        self.assertEqual(3, self._runs(self.nbdkit))
+
+    def _progress(self, storage, vm_uuid):
+        req = {http.REQUEST_BODY: jsonobject.dumps({'storagePath': storage, 'srcVmUuid': vm_uuid})}
+        return jsonobject.loads(self.plugin.get_convert_progress(req))
+
+    def test_progress_polls_read_appended_log(self):
+        storage = os.path.join(self.dir, 'storage')
+        vm_dir = os.path.join(storage, 'vm')
+        os.makedirs(vm_dir)
+        with open(os.path.join(vm_dir, 'convert.pid'), 'w') as fd:
+            fd.write(str(os.getpid()))
+
+        log_path = os.path.join(vm_dir, 'virt_v2v_log')
+        with open(log_path, 'w') as fd:
+            fd.write('[   0.0] Opening the source -i libvirt\n')
+            fd.write(DEBUG_LINE * 200000)
+            fd.write('[  12.3] Opening the overlay\n')
+        rsp = self._progress(storage, 'vm')
+        self.assertEqual('3', rsp.currentProgress)
+
+        tracker = self.plugin.convert_logs.trackers[log_path]
+        self.assertLessEqual(tracker.bytes_read, v2v_convert_log.MAX_CATCH_UP)
+
+        with open(log_path, 'a') as fd:
+            fd.write('[ 138.0] Initializing the target -o local -os %s\n' % vm_dir)
+            fd.write('[ 138.3] Copying disk 1/2 to %s/vm-sda (qcow2)\n' % vm_dir)
+        rsp = self._progress(storage, 'vm')
+        self.assertEqual(('1', '0', '2'), (rsp.currentDiskNum, rsp.currentProgress, rsp.totalDiskNum))
+
+        costs = []
+        for i in range(POLLS):
+            with open(log_path, 'a') as fd:
+                fd.write('    (%d.00/100%%)\r' % (i / 2))
+            read = tracker.bytes_read
+            start = time.time()
+            rsp = self._progress(storage, 'vm')
+            costs.append(time.time() - start)
+            self.assertEqual(len('    (%d.00/100%%)\r' % (i / 2)), tracker.bytes_read - read)
+            self.assertEqual(('1', str(i / 2) + '.00', '2'),
+                             (rsp.currentDiskNum, rsp.currentProgress, rsp.totalDiskNum))
+
+        # the line redrawn by every progress update is kept short
+        self.assertLess(len(tracker.partial), 64)
+        sys.stderr.write('\n%d MB log, %d polls, first %.6fs, last %.6fs per poll\n' % (
+            os.path.getsize(log_path) / 1024 / 1024, POLLS, sum(costs[:20]) / 20, sum(costs[-20:]) / 20))
+
+        # a rerun truncates the log
+        with open(log_path, 'w') as fd:
+            fd.write('[   5.0] Converting Windows 10 to run on KVM\n')
+        self.assertEqual('10', self._progress(storage, 'vm').currentProgress)
+
+        self.plugin.clean_convert({http.REQUEST_BODY: jsonobject.dumps({'storagePath': storage, 'srcVmUuid': 'vm'})})
+        self.assertEqual({}, self.plugin.convert_logs.trackers)
+
+
+if __name__ == "__main__":
+    unittest.main()
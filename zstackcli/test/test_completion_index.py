@@ -0,0 +1,184 @@
+'''
+
+completion index of zstack-cli against a generated-like inventory module of
+some thousands of APIs: cold build, cached start and per-keystroke latency
+'''
+import os
+import shutil
+import tempfile
+import time
+import types
+import unittest
+
+from zstackcli import completion_index
+from zstackcli import history
+
+API_COUNT = 3000
+RESOURCES = ['VmInstance', 'Volume', 'Image', 'L3Network', 'Host', 'Zone', 'Cluster', 'PrimaryStorage']
+
+
+def make_inventory(folder):
+    '''
+    a module shaped like apibinding.inventory, its file is what the index
+    is keyed on
+    '''
+    inv = types.ModuleType('fake_inventory')
+    inv.__file__ = os.path.join(folder, 'inventory.py')
+    with open(inv.__file__, 'w') as fd:
+        fd.write('# generated\n')
+
+    for i, r in enumerate(RESOURCES):
+        fields = ['uuid', 'name', 'description', 'state', 'createDate', 'lastOpDate'] + \
+                 ['%sField%d' % (r.lower(), n) for n in range(30)]
+        child = RESOURCES[(i + 1) % len(RESOURCES)]
+
+        class Inv(object):
+            PRIMITIVE_FIELDS = fields
+            EXPANDED_FIELDS = [child[0].lower() + child[1:]]
+            QUERY_OBJECT_MAP = {EXPANDED_FIELDS[0]: '%sInventory' % child}
+
+        Inv.__name__ = '%sInventory' % r
+        setattr(inv, Inv.__name__, Inv)
+
+    inv.api_names = []
+    inv.queryMessageInventoryMap = {}
+    for i in range(API_COUNT):
+        r = RESOURCES[i % len(RESOURCES)]
+        query = i % 4 == 0
+        name = 'API%s%s%dMsg' % ('Query' if query else 'Update', r, i)
+
+        def init(self, n=i):
+            self.uuid = None
+            self.name = None
+            self.session = None
+            self.conditions = []
+            for k in range(n % 7):
+                setattr(self, 'param%d' % k, None)
+
+        cls = type(name, (object,), {'__init__': init})
+        setattr(inv, name, cls)
+        inv.api_names.append(name)
+        if query:
+            inv.queryMessageInventoryMap[name] = getattr(inv, '%sInventory' % r)
+        inv.api_names.append(name.replace('Msg', 'Reply'))
+
+    class LogInventory(object):
+        pass
+
+    inv.LogInventory = LogInventory
+    inv.APIQueryLogMsg = type('APIQueryLogMsg', (object,), {})
+    inv.api_names.append('APIQueryLogMsg')
+    inv.queryMessageInventoryMap['APIQueryLogMsg'] = LogInventory
+    return inv
+
+
+class TestCompletionIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.inventory = make_inventory(self.tmp)
+        self.folder = os.path.join(self.tmp, 'cli')
+        self.cli_cmds = ['help', 'history', 'more', 'quit', 'exit', 'save']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _load(self):
+        return completion_index.CompletionIndex.load(self.inventory, self.cli_cmds, self.folder, ['QueryLog'])
+
+    def test_cold_and_cached_start(self):
+        start = time.time()
+        cold = self._load()
+        cold_time = time.time() - start
+
+        start = time.time()
+        cached = self._load()
+        cached_time = time.time() - start
+
+        self.assertEqual(cold.data, cached.data)
+        self.assertEqual(1, len([f for f in os.listdir(self.folder) if f.startswith('completion_index.')]))
+        print '\n%d apis: cold start %.1f ms, cached start %.1f ms' % (API_COUNT, cold_time * 1000,
+                                                                      cached_time * 1000)
+
+        # a new apibinding build rebuilds the index and drops the old one
+        with open(self.inventory.__file__, 'a') as fd:
+            fd.write('# upgraded\n')
+        os.utime(self.inventory.__file__, (time.time() + 10, time.time() + 10))
+        self._load()
+        self.assertEqual(1, len([f for f in os.listdir(self.folder) if f.startswith('completion_index.')]))
+
+    def test_keystroke_latency(self):
+        index = self._load()
+        typed = 'QueryVmInstance1'
+        samples = []
+        # first use of a trie builds it, count it in
+        for n in range(1, len(typed) + 1):
+            start = time.time()
+            matches = index.match_commands(typed[:n])
+            samples.append(time.time() - start)
+        self.assertTrue(matches[0].startswith(typed))
+
+        params = index.match_params('QueryVmInstance0', 'vm')
+        self.assertEqual('vminstanceField0=', params[0])
+        self.assertIn('__systemTag__=', index.match_params('QueryVmInstance0', ''))
+        self.assertNotIn('conditions=', index.match_params('QueryVmInstance0', ''))
+        self.assertNotIn('session=', index.match_params('UpdateVolume1', ''))
+
+        worst = max(samples)
+        print '\nper keystroke: worst %.2f ms, mean %.2f ms' % (worst * 1000, sum(samples) / len(samples) * 1000)
+        self.assertLess(worst, 0.05)
+
+    def test_match_order(self):
+        trie = completion_index.Trie(['CreateVm', 'QueryVmInstance', 'StartVm', 'vmHelper'])
+        self.assertEqual(['vmHelper', 'CreateVm', 'QueryVmInstance', 'StartVm'], trie.match('vm'))
+        self.assertEqual(['QueryVmInstance'], trie.match('que'))
+        self.assertEqual([], trie.match('volume'))
+
+    def test_expanded_fields(self):
+        index = self._load()
+        self.assertEqual('VolumeInventory', index.resolve_expanded('QueryVmInstance0', ['volume']))
+        self.assertEqual('ImageInventory', index.resolve_expanded('QueryVmInstance0', ['volume', 'image']))
+        self.assertIsNone(index.resolve_expanded('QueryVmInstance0', ['host']))
+        self.assertIsNone(index.resolve_expanded('UpdateVolume1', ['image']))
+        self.assertIn('volume.uuid=', index.match_query_fields('VolumeInventory', 'volume.', 'volume.u'))
+        fields = index.match_fields('QueryVmInstance0', ['uuid', 'name'], '')
+        self.assertNotIn('uuid,', fields)
+        self.assertIn('state,', fields)
+        self.assertEqual([], index.match_fields('QueryLog', [], ''))
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_bounded_tail_and_compaction(self):
+        path = os.path.join(self.tmp, 'command_history')
+        h = history.HistoryFile(path, 10)
+        for i in range(39):
+            h.append('cmd %d' % i)
+        self.assertEqual(39, len(open(path).readlines()))
+        h.append('cmd 39')
+        self.assertEqual(10, len(open(path).readlines()))
+
+        h = history.HistoryFile(path, 10)
+        self.assertEqual(['cmd %d' % i for i in range(30, 40)], h.entries())
+
+    def test_results(self):
+        folder = os.path.join(self.tmp, 'result_history')
+        os.makedirs(folder)
+        h = history.ResultHistory(folder, 3)
+        for i in range(5):
+            h.add('cmd %d' % i, 'result %d' % i, i != 3)
+
+        h = history.ResultHistory(folder, 3)
+        self.assertEqual(('cmd 4', 'result 4', True), h.get(1))
+        self.assertEqual(('cmd 3', 'result 3', False), h.get(2))
+        self.assertIsNone(h.get(4))
+        self.assertEqual([('cmd 4', True), ('cmd 3', False), ('cmd 2', True)], h.commands())
+        self.assertEqual(3, len([f for f in os.listdir(folder) if f.startswith('result') and f[6:].isdigit()]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -35,10 +35,11 @@ log.configure_log('/var/log/zstack/zstack-cli', log_to_console=False)
 import apibinding.inventory as inventory
 import apibinding.api as api
 import zstacklib.utils.jsonobject as jsonobject
-import zstacklib.utils.filedb as filedb
 import zstackcli.parse_config as parse_config
 import zstackcli.deploy_config as deploy_config
 import zstackcli.read_config as read_config
+import zstackcli.completion_index as completion_index
+import zstackcli.history as history
 
 cld = termcolor.colored
 cprint = termcolor.cprint
@@ -48,8 +49,6 @@ text_doc = pydoc.TextDoc()
 CLI_LIB_FOLDER = os.path.expanduser('~/.zstack/cli')
 CLI_HISTORY = '%s/command_history' % CLI_LIB_FOLDER
 CLI_RESULT_HISTORY_FOLDER = '%s/result_history' % CLI_LIB_FOLDER
-CLI_RESULT_HISTORY_KEY = '%s/result_key' % CLI_RESULT_HISTORY_FOLDER
-CLI_RESULT_FILE = '%s/result' % CLI_RESULT_HISTORY_FOLDER
 SESSION_FILE = '%s/session' % CLI_LIB_FOLDER
 CLI_MAX_CMD_HISTORY = 1000
 CLI_MAX_RESULT_HISTORY = 1000
@@ -67,23 +66,17 @@ NOT_QUERY_MYSQL_APIS = [
 def escape_split(str, deli=','):
     return csv.reader(c.StringIO(str), delimiter=deli, escapechar='\\').next()
 
-def clean_password_in_cli_history():
-    cmd_historys = None
-    with open(CLI_HISTORY, 'r') as f: cmd_historys = f.readlines()
-    new_cmd_historys = []
-    for cmd in cmd_historys:
-        if 'password=' in cmd:
-            cmd_params = cmd.split()
-            cmd_list = []
-            for param in cmd_params:
-                if not 'password=' in param:
-                    cmd_list.append(param)
-                else:
-                    cmd_list.append(param.split('=')[0] + '=')
-            new_cmd_historys.append(' '.join(cmd_list))
+def clean_password_in_cli_history(cmd):
+    if 'password=' not in cmd:
+        return cmd
+
+    cmd_list = []
+    for param in cmd.split():
+        if not 'password=' in param:
+            cmd_list.append(param)
         else:
-            new_cmd_historys.append(cmd)
-    with open(CLI_HISTORY, 'w') as f: f.write('\n'.join(new_cmd_historys))
+            cmd_list.append(param.split('=')[0] + '=')
+    return ' '.join(cmd_list)
 
 
 class CliError(Exception):
@@ -141,127 +134,36 @@ class Cli(object):
         complete will be kept calling, until it return None.
         """
 
-        def prepare_primitive_fields_words(apiname, separator='=', prefix=''):
-            if not prefix:
-                api_map_name = inventory.queryMessageInventoryMap[apiname].__name__
-            else:
-                api_map_name = apiname
-
-            query_pri_fields = eval('inventory.%s().PRIMITIVE_FIELDS' % api_map_name)
-            query_pri_fields = ['%s' % field for field in query_pri_fields]
-            temp_fields = list(query_pri_fields)
-            query_pri_fields = []
-            for field in temp_fields:
-                if prefix:
-                    query_pri_fields.append('%s%s%s' % (prefix, field, separator))
-                else:
-                    query_pri_fields.append('%s%s' % (field, separator))
-
-            self.words.extend(query_pri_fields)
-
-        def prepare_expanded_fields_words(apiname, separator='.', prefix=''):
-            if not prefix:
-                api_map_name = inventory.queryMessageInventoryMap[apiname].__name__
-            else:
-                api_map_name = apiname
-            query_ext_fields = eval('inventory.%s().EXPANDED_FIELDS' % api_map_name)
-            query_ext_fields = ['%s' % field for field in query_ext_fields]
-            temp_fields = list(query_ext_fields)
-            query_ext_fields = []
-            for field in temp_fields:
-                if prefix:
-                    query_ext_fields.append('%s%s%s' % (prefix, field, separator))
-                else:
-                    query_ext_fields.append('%s%s' % (field, separator))
-
-            self.words.extend(query_ext_fields)
-            if 'conditions=' in self.words:
-                self.words.remove('conditions=')
-
-        def prepare_query_words(apiname, prefix=''):
-            prepare_primitive_fields_words(apiname, '=', prefix)
-            prepare_expanded_fields_words(apiname, '.', prefix)
-
-        def prepare_fields_words(apiname, current_fields=[]):
-            prepare_primitive_fields_words(apiname, ',')
-            for field in current_fields:
-                new_field = '%s,' % field
-                if new_field in self.words:
-                    self.words.remove(new_field)
-
-        def prepare_words():
+        def match_words():
             currtext = readline.get_line_buffer()
-            apiname = currtext.split()[0]
-            if apiname in self.words_db and (len(currtext.split()) > 1 or currtext.endswith(' ')):
-                self.is_cmd = False
-                self.words = ['%s=' % field for field in self.api_class_params['API%sMsg' % apiname]]
-                if apiname.startswith('Query') and not apiname in NOT_QUERY_MYSQL_APIS:
-                    real_api_name = 'API%sMsg' % apiname
-                    prepare_query_words(real_api_name)
-                    if not ('UserTag' in apiname or 'SystemTag' in apiname):
-                        self.words.append('__systemTag__=')
-                        self.words.append('__userTag__=')
+            words = currtext.split()
+            apiname = words[0] if words else ''
+            if apiname in self.words_db and (len(words) > 1 or currtext.endswith(' ')):
+                if apiname in self.cli_cmd:
+                    return []
+
+                # need to auto complete expanded fields.
+                if '.' in pattern:
+                    fields_objects = pattern.split('.')
+                    obj_name = self.completion.resolve_expanded(apiname, fields_objects[:-1])
+                    if obj_name:
+                        pattern_prefix = '.'.join(fields_objects[:-1])
+                        return self.completion.match_query_fields(obj_name, '%s.' % pattern_prefix, pattern)
+
+                last_field = words[-1]
+                if not currtext.endswith(' ') and last_field.startswith('fields=') and \
+                        'API%sMsg' % apiname in self.completion.query_inventories:
+                    fields = last_field.split('=')[1]
+                    return self.completion.match_fields(apiname, fields.split(','), pattern)
+
+                return self.completion.match_params(apiname, pattern)
             else:
-                self.is_cmd = True
-                self.words = self.words_db
+                return ['%s ' % w for w in self.completion.match_commands(pattern)]
 
-        if not self.words:
-            return None
-
-        prepare_words()
-
-        # if not self.curr_pattern or pattern.lower() != self.curr_pattern.lower():
-        # self.matching_words = [w for w in self.words if w.lower().startswith(pattern.lower())]
-        if self.is_cmd:
-            self.matching_words = ['%s ' % w for w in self.words if pattern.lower() in w.lower()]
-        else:
-            # need to auto complete expanded fields.
-            if '.' in pattern:
-                currtext = readline.get_line_buffer()
-                fields_objects = pattern.split('.')
-                head_field = fields_objects[0]
-                fields_num = len(fields_objects)
-                apiname = currtext.split()[0]
-                new_api_name = 'API%sMsg' % apiname
-                if inventory.queryMessageInventoryMap.has_key(new_api_name):
-                    api_obj_name = inventory.queryMessageInventoryMap[new_api_name].__name__
-                    query_ext_fields = eval('inventory.%s().EXPANDED_FIELDS' % api_obj_name)
-                    if head_field in query_ext_fields:
-                        current_obj_name = eval('inventory.%s().QUERY_OBJECT_MAP["%s"]' % (api_obj_name, head_field))
-
-                        for i in range(0, fields_num):
-                            if i == fields_num - 2:
-                                break
-                            next_field = fields_objects[i + 1]
-                            query_ext_fields = eval('inventory.%s().EXPANDED_FIELDS' % current_obj_name)
-                            if next_field in query_ext_fields:
-                                current_obj_name = eval(
-                                    'inventory.%s().QUERY_OBJECT_MAP["%s"]' % (current_obj_name, next_field))
-                            else:
-                                current_obj_name = None
-                    else:
-                        current_obj_name = None
-                else:
-                    current_obj_name = None
-
-                if current_obj_name:
-                    self.words = []
-                    pattern_prefix = '.'.join(fields_objects[:-1])
-                    prepare_query_words(current_obj_name, '%s.' % pattern_prefix)
-
-            currtext = readline.get_line_buffer()
-            last_field = currtext.split()[-1]
-            if not currtext.endswith(' ') and last_field.startswith('fields='):
-                apiname = currtext.split()[0]
-                new_api_name = 'API%sMsg' % apiname
-                api_map_name = inventory.queryMessageInventoryMap[new_api_name].__name__
-                self.words = []
-                fields = last_field.split('=')[1]
-                prepare_fields_words(new_api_name, fields.split(','))
-
-            self.matching_words = [w for w in self.words if pattern.lower() in w.lower()]
-
-        self.curr_pattern = pattern
+        # readline asks for the matches one by one, find them only once
+        if index == 0 or self.curr_pattern != pattern or self.matching_words is None:
+            self.matching_words = match_words()
+            self.curr_pattern = pattern
 
         try:
             return self.matching_words[index]
@@ -645,12 +547,6 @@ Parse command parameters error:
 
         exit_code = 0
 
-        import atexit
-        if not os.path.exists(os.path.dirname(CLI_HISTORY)):
-            os.system('mkdir -p %s' % os.path.dirname(CLI_HISTORY))
-        atexit.register(clean_password_in_cli_history)
-        atexit.register(readline.write_history_file, CLI_HISTORY)
-
         while True:
             try:
                 if cmd:
@@ -658,6 +554,7 @@ Parse command parameters error:
                 else:
                     line = raw_input(self.get_prompt_with_account_info())
                     if line:
+                        self.cmd_history.append(clean_password_in_cli_history(line))
                         pairs = shlex.split(line)
                         self.do_command(pairs)
             except CliError as cli_err:
@@ -675,32 +572,6 @@ Parse command parameters error:
             if cmd:
                 sys.exit(exit_code)
 
-    def build_api_parameters(self):
-        def rule_out_unneeded_params(keys):
-            excludes = ['session']
-            for k in excludes:
-                if k in keys:
-                    keys.remove(k)
-            return keys
-
-        for apiname in inventory.api_names:
-            obj = eval("inventory.%s()" % apiname)
-            params = []
-            params.extend(obj.__dict__.keys())
-            self.api_class_params[apiname] = rule_out_unneeded_params(params)
-
-    def _parse_api_name(self, api_names):
-        """
-        Remove API pattern 'API' and appendix 'MSG'
-        """
-        short_api_name = []
-        for api in api_names:
-            if api.endswith('Msg'):
-                short_api_name.append(api[3:-3])
-
-        short_api_name.sort()
-        return short_api_name
-
     def get_prompt_with_account_info(self):
         prompt_with_account_info = ''
         if self.account_name:
@@ -805,38 +676,6 @@ Parse command parameters error:
         # readline.redisplay()
 
     def write_more(self, cmd, result, success=True):
-        if self.hd.get(self.start_key):
-            start_value = int(self.hd.get(self.start_key))
-        else:
-            start_value = 0
-
-        if self.hd.get(self.last_key):
-            last_value = int(self.hd.get(self.last_key))
-        else:
-            last_value = 0
-
-        if last_value <= start_value:
-            if start_value < CLI_MAX_RESULT_HISTORY:
-                start_value += 1
-            else:
-                start_value = 1
-                last_value = 2
-        else:
-            if last_value < CLI_MAX_RESULT_HISTORY:
-                start_value += 1
-                last_value += 1
-            else:
-                start_value += 1
-                last_value = 1
-
-        self.hd.set(self.start_key, start_value)
-        self.hd.set(self.last_key, last_value)
-        # filedb might leave more than 1 same key item.
-        while self.hd.get(str(start_value)):
-            self.hd.rem(str(start_value))
-
-        result_file = '%s%d' % (CLI_RESULT_FILE, start_value)
-        with open(result_file, 'w') as f: f.write(result)
         if not self.no_secure and 'password=' in ' '.join(cmd):
             cmds2 = []
             for cmd2 in cmd:
@@ -844,9 +683,9 @@ Parse command parameters error:
                     cmds2.append(cmd2)
                 else:
                     cmds2.append(cmd2.split('=')[0] + '=' + '******')
-            cmd = ' '.join(cmds2)
+            cmd = cmds2
 
-        self.hd.set(str(start_value), [cmd, success])
+        self.hd.add(' '.join(cmd), result, success)
 
     def read_more(self, num=None, need_print=True, full_info=True):
         """
@@ -855,8 +694,6 @@ Parse command parameters error:
         full_info will indicate whether return command and params information
             when return command results.
         """
-        start_value = self.hd.get(self.start_key)
-        last_value = self.hd.get(self.last_key)
         more_usage_list = [text_doc.bold('Usage:'),
                            text_doc.bold('\t%smore NUM\t #show the No. NUM Command result' % prompt), text_doc.bold(
                 '\t%smore\t\t #show all available NUM and Command.'
@@ -864,7 +701,7 @@ Parse command parameters error:
 
         more_usage = '\n'.join(more_usage_list)
 
-        if not start_value:
+        if not len(self.hd.index):
             print 'No command history to display.'
             return
 
@@ -876,57 +713,29 @@ Parse command parameters error:
                     cprint(more_usage, attrs=['bold'], end='\n')
                     return
 
-                key = start_value - int(num) + 1
-                if key <= 0:
-                    key += CLI_MAX_RESULT_HISTORY
-
-                # print key
-                result_list = self.hd.get(str(key))
-                result = None
-
-                result_file = '%s%d' % (CLI_RESULT_FILE, key)
-                with open(result_file, 'r') as f: result = f.read()
-
-                if result_list:
-                    output = 'Command: \n\t%s\nResult:\n%s' % \
-                             (result_list[0], result)
+                found = self.hd.get(int(num))
+                if found:
+                    cmd, result, _ = found
+                    output = 'Command: \n\t%s\nResult:\n%s' % (cmd, result)
                     if need_print:
                         pydoc.pager(output)
 
                     if full_info:
-                        return [result_list[0], output]
+                        return [cmd, output]
                     else:
-                        return [result_list[0], result]
+                        return [cmd, result]
         else:
             more_list = []
             explamation = text_doc.bold('!')
-            if start_value < last_value:
-                for i in range(CLI_MAX_RESULT_HISTORY):
-                    if start_value - i > 0:
-                        key = start_value - i
-                    else:
-                        key = start_value - i + CLI_MAX_RESULT_HISTORY
-
-                    cmd_result = self.hd.get(str(key))
-                    cmd_result_list = str(cmd_result[0]).split()
-                    cmd = text_doc.bold(cmd_result_list[0])
-                    if len(cmd_result_list) > 1:
-                        cmd = cmd + ' ' + ' '.join(cmd_result_list[1:])
-                    if len(cmd_result) <= 2 or cmd_result[2]:
-                        more_list.append('[%s]\t %s' % (str(i + 1), cmd))
-                    else:
-                        more_list.append('[%s]  %s\t %s' % (str(i + 1), explamation, cmd))
-            else:
-                for i in range(start_value):
-                    cmd_result = self.hd.get(str(start_value - i))
-                    cmd_result_list = str(cmd_result[0]).split()
-                    cmd = text_doc.bold(cmd_result_list[0])
-                    if len(cmd_result_list) > 1:
-                        cmd = cmd + ' ' + ' '.join(cmd_result_list[1:])
-                    if len(cmd_result) <= 2 or cmd_result[2]:
-                        more_list.append('[%s]\t %s' % (str(i + 1), cmd))
-                    else:
-                        more_list.append('[%s]  %s\t %s' % (str(i + 1), explamation, cmd))
+            for i, (cmd_line, success) in enumerate(self.hd.commands()):
+                cmd_result_list = str(cmd_line).split()
+                cmd = text_doc.bold(cmd_result_list[0])
+                if len(cmd_result_list) > 1:
+                    cmd = cmd + ' ' + ' '.join(cmd_result_list[1:])
+                if success:
+                    more_list.append('[%s]\t %s' % (str(i + 1), cmd))
+                else:
+                    more_list.append('[%s]  %s\t %s' % (str(i + 1), explamation, cmd))
 
             more_result = '\n'.join(more_list)
             header = text_doc.bold('[NUM]\tCOMMAND')
@@ -1119,26 +928,17 @@ Parse command parameters error:
         readline.parse_and_bind("tab: complete")
         readline.set_completer(self.complete)
         readline.set_completion_display_matches_hook(self.completer_print)
-        try:
-            readline.read_history_file(CLI_HISTORY)
-        except IOError:
-            pass
-        readline.set_history_length(CLI_MAX_CMD_HISTORY)
 
         if not os.path.isdir(CLI_RESULT_HISTORY_FOLDER):
+            linux.rm_dir_force(CLI_RESULT_HISTORY_FOLDER)
+            os.system('mkdir -p %s' % CLI_RESULT_HISTORY_FOLDER)
 
-            linux.rm_dir_force(os.path.dirname(CLI_RESULT_HISTORY_FOLDER))
-            os.system('mkdir -p %s' % os.path.dirname(CLI_RESULT_HISTORY_FOLDER))
-
-        try:
-            self.hd = filedb.FileDB(CLI_RESULT_HISTORY_KEY, is_abs_path=True)
-        except:
-            linux.rm_dir_force(CLI_RESULT_HISTORY_KEY)
-            self.hd = filedb.FileDB(CLI_RESULT_HISTORY_KEY, is_abs_path=True)
-            print "\nRead history file: %s error. Has recreate it.\n" % CLI_RESULT_HISTORY_KEY
+        # both histories are appended to as commands run, no rewrite at exit
+        self.cmd_history = history.HistoryFile(CLI_HISTORY, CLI_MAX_CMD_HISTORY)
+        for line in self.cmd_history.entries():
+            readline.add_history(line)
+        self.hd = history.ResultHistory(CLI_RESULT_HISTORY_FOLDER, CLI_MAX_RESULT_HISTORY)
 
-        self.start_key = 'start_key'
-        self.last_key = 'last_key'
         self.cli_cmd_func = {'help': self.show_help,
                              'history': self.show_help,
                              'more': self.show_more,
@@ -1147,15 +947,12 @@ Parse command parameters error:
                              'save': self.save_json_to_file}
         self.cli_cmd = self.cli_cmd_func.keys()
 
-        self.raw_words_db = self._parse_api_name(inventory.api_names)
-        self.words_db = list(self.raw_words_db)
-        self.words_db.extend(self.cli_cmd)
-        self.words = list(self.words_db)
-        self.is_cmd = False
+        self.completion = completion_index.CompletionIndex.load(inventory, self.cli_cmd, CLI_LIB_FOLDER,
+                                                                NOT_QUERY_MYSQL_APIS)
+        self.raw_words_db = self.completion.api_names
+        self.words_db = set(self.completion.data['commands'])
         self.curr_pattern = None
         self.matching_words = None
-        self.api_class_params = {}
-        self.build_api_parameters()
         self.api = None
         self.account_name = None
         self.user_name = None
@@ -0,0 +1,226 @@
+'''
+
+prebuilt completion index of zstack-cli.
+
+Walking all API and inventory classes of apibinding.inventory takes most of
+the cli start time, so the words are collected once per apibinding build and
+saved under ~/.zstack/cli. Candidates are looked up in tries built on first
+use.
+'''
+import cPickle
+import hashlib
+import os
+import tempfile
+
+INDEX_FORMAT_VERSION = 1
+
+
+class Trie(object):
+    '''
+    case-insensitive prefix tree of words, a node is a dict of child nodes
+    keyed by character, the words ending at a node are kept under None
+    '''
+
+    def __init__(self, words=None):
+        self.root = {}
+        self.words = []
+        self._lower_words = []
+        for w in words or []:
+            self.insert(w)
+
+    def insert(self, word):
+        node = self.root
+        for ch in word.lower():
+            node = node.setdefault(ch, {})
+        node.setdefault(None, []).append(word)
+        self.words.append(word)
+        self._lower_words.append(word.lower())
+
+    def _collect(self, node, ret):
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            ret.extend(n.get(None, []))
+            stack.extend(n[k] for k in sorted((k for k in n if k is not None), reverse=True))
+
+    def starts_with(self, prefix):
+        node = self.root
+        for ch in prefix.lower():
+            node = node.get(ch)
+            if node is None:
+                return []
+        ret = []
+        self._collect(node, ret)
+        return ret
+
+    def match(self, pattern):
+        '''
+        words containing `pattern`, those starting with it first
+        '''
+        if not pattern:
+            return list(self.words)
+
+        ret = self.starts_with(pattern)
+        pattern = pattern.lower()
+        ret.extend(w for w, lw in zip(self.words, self._lower_words) if pattern in lw and not lw.startswith(pattern))
+        return ret
+
+
+def _fields(obj, name):
+    return ['%s' % f for f in getattr(obj, name, [])]
+
+
+def build_index(inventory, cli_commands, not_query_apis=()):
+    '''
+    collect completion words of every API of the `inventory` module,
+    `not_query_apis` are Query APIs taking no query conditions
+    '''
+    api_params = {}
+    query_inventories = {}
+    inventories = {}
+
+    def inventory_words(name):
+        if name not in inventories:
+            obj = getattr(inventory, name)()
+            inventories[name] = {
+                'primitive': _fields(obj, 'PRIMITIVE_FIELDS'),
+                'expanded': _fields(obj, 'EXPANDED_FIELDS'),
+                'object_map': dict(getattr(obj, 'QUERY_OBJECT_MAP', {}) or {}),
+            }
+            for child in inventories[name]['object_map'].values():
+                if hasattr(inventory, child):
+                    inventory_words(child)
+        return inventories[name]
+
+    short_names = []
+    for apiname in inventory.api_names:
+        if not apiname.endswith('Msg'):
+            continue
+
+        short_name = apiname[3:-3]
+        short_names.append(short_name)
+        obj = getattr(inventory, apiname)()
+        words = ['%s=' % k for k in obj.__dict__.keys() if k != 'session']
+
+        if apiname in inventory.queryMessageInventoryMap:
+            query_inventories[apiname] = inventory.queryMessageInventoryMap[apiname].__name__
+
+        if short_name.startswith('Query') and apiname in query_inventories and short_name not in not_query_apis:
+            inv = inventory_words(query_inventories[apiname])
+            words.extend('%s=' % f for f in inv['primitive'])
+            words.extend('%s.' % f for f in inv['expanded'])
+            if 'conditions=' in words:
+                words.remove('conditions=')
+            if not ('UserTag' in short_name or 'SystemTag' in short_name):
+                words.append('__systemTag__=')
+                words.append('__userTag__=')
+        api_params[short_name] = words
+
+    short_names.sort()
+    return {
+        'api_names': short_names,
+        'commands': short_names + list(cli_commands),
+        'api_params': api_params,
+        'query_inventories': query_inventories,
+        'inventories': inventories,
+    }
+
+
+def index_key(inventory):
+    '''
+    the index is rebuilt when the generated inventory module, which is
+    what an apibinding upgrade changes, is a different file
+    '''
+    path = inventory.__file__
+    if path.endswith('.pyc') or path.endswith('.pyo'):
+        path = path[:-1] if os.path.exists(path[:-1]) else path
+    st = os.stat(path)
+    key = '%s:%s:%s:%s' % (INDEX_FORMAT_VERSION, os.path.realpath(path), st.st_size, st.st_mtime)
+    return hashlib.md5(key).hexdigest()
+
+
+class CompletionIndex(object):
+    def __init__(self, data):
+        self.data = data
+        self.api_names = data['api_names']
+        self.api_params = data['api_params']
+        self.query_inventories = data['query_inventories']
+        self.inventories = data['inventories']
+        self._tries = {}
+
+    @staticmethod
+    def load(inventory, cli_commands, folder, not_query_apis=()):
+        '''
+        load the saved index of this apibinding build, build and save it if
+        there is none
+        '''
+        path = os.path.join(folder, 'completion_index.%s' % index_key(inventory))
+        try:
+            with open(path, 'rb') as fd:
+                data = cPickle.load(fd)
+            if data['commands'][len(data['api_names']):] == list(cli_commands):
+                return CompletionIndex(data)
+        except (IOError, EOFError, KeyError, cPickle.UnpicklingError):
+            pass
+
+        data = build_index(inventory, cli_commands, not_query_apis)
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            for f in os.listdir(folder):
+                if f.startswith('completion_index.'):
+                    os.remove(os.path.join(folder, f))
+            fd, tmp = tempfile.mkstemp(dir=folder)
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            # a read-only home only costs the rebuild on every start
+            pass
+        return CompletionIndex(data)
+
+    def _trie(self, key, words):
+        t = self._tries.get(key)
+        if t is None:
+            t = self._tries[key] = Trie(words)
+        return t
+
+    def match_commands(self, pattern):
+        return self._trie('commands', self.data['commands']).match(pattern)
+
+    def match_params(self, api_name, pattern):
+        return self._trie(('params', api_name), self.api_params.get(api_name, [])).match(pattern)
+
+    def match_query_fields(self, inventory_name, prefix, pattern):
+        '''
+        fields of a queried inventory, prefixed by the path of expanded
+        fields leading to it
+        '''
+        inv = self.inventories[inventory_name]
+        words = ['%s%s=' % (prefix, f) for f in inv['primitive']] + ['%s%s.' % (prefix, f) for f in inv['expanded']]
+        return self._trie(('query', inventory_name, prefix), words).match(pattern)
+
+    def match_fields(self, api_name, current_fields, pattern):
+        # a query api not querying mysql, like QueryLog, has no fields indexed
+        inv = self.inventories.get(self.query_inventories.get('API%sMsg' % api_name))
+        if inv is None:
+            return []
+        words = ['%s,' % f for f in inv['primitive'] if f not in current_fields]
+        return Trie(words).match(pattern)
+
+    def resolve_expanded(self, api_name, path):
+        '''
+        the inventory the expanded field `path` of a query api refers to,
+        None if the path is not valid
+        '''
+        name = self.query_inventories.get('API%sMsg' % api_name)
+        for field in path:
+            if name is None:
+                return None
+            inv = self.inventories.get(name)
+            if inv is None or field not in inv['expanded']:
+                return None
+            name = inv['object_map'].get(field)
+        if name not in self.inventories:
+            return None
+        return name
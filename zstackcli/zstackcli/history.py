@@ -0,0 +1,108 @@
+'''
+
+append-only history files of zstack-cli. New entries are appended as lines,
+only the last `max_entries` are kept in memory, and the file is compacted to
+them once it grows to `compact_factor` times that.
+'''
+import collections
+import os
+import tempfile
+
+import simplejson
+
+
+class HistoryFile(object):
+    def __init__(self, path, max_entries, encode=None, decode=None, compact_factor=4):
+        self.path = path
+        self.max_entries = max_entries
+        self.encode = encode or (lambda e: e)
+        self.decode = decode or (lambda l: l)
+        self.compact_factor = compact_factor
+        self.tail = collections.deque(maxlen=max_entries)
+        self.lines = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as fd:
+            for line in fd:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                self.lines += 1
+                try:
+                    self.tail.append(self.decode(line))
+                except ValueError:
+                    # a line cut by a crash
+                    continue
+
+    def append(self, entry):
+        line = self.encode(entry).replace('\n', ' ')
+        with open(self.path, 'a') as fd:
+            fd.write(line + '\n')
+        self.tail.append(entry)
+        self.lines += 1
+        if self.lines >= self.max_entries * self.compact_factor:
+            self.compact()
+
+    def compact(self):
+        d = os.path.dirname(self.path) or '.'
+        fd, tmp = tempfile.mkstemp(dir=d)
+        with os.fdopen(fd, 'w') as f:
+            for e in self.tail:
+                f.write(self.encode(e).replace('\n', ' ') + '\n')
+        os.rename(tmp, self.path)
+        self.lines = len(self.tail)
+
+    def entries(self):
+        return list(self.tail)
+
+    def __len__(self):
+        return len(self.tail)
+
+
+class ResultHistory(object):
+    '''
+    results of the last `max_entries` commands: an append-only index of
+    (seq, command, success) and one result file per slot, slots are reused
+    round robin
+    '''
+
+    def __init__(self, folder, max_entries):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.index = HistoryFile(os.path.join(folder, 'result_index'), max_entries,
+                                 simplejson.dumps, simplejson.loads)
+        self.seq = self.index.tail[-1][0] if len(self.index) else 0
+
+    def _result_file(self, seq):
+        return os.path.join(self.folder, 'result%d' % (seq % self.max_entries))
+
+    def add(self, cmd, result, success=True):
+        self.seq += 1
+        with open(self._result_file(self.seq), 'w') as f:
+            f.write(result)
+        self.index.append([self.seq, cmd, success])
+
+    def get(self, num):
+        '''
+        the `num`th latest (cmd, result, success), None if not kept
+        '''
+        entries = self.index.tail
+        if num < 1 or num > len(entries):
+            return None
+
+        seq, cmd, success = entries[-num]
+        try:
+            with open(self._result_file(seq)) as f:
+                return cmd, f.read(), success
+        except IOError:
+            return None
+
+    def commands(self):
+        '''
+        (cmd, success) from the latest one
+        '''
+        return [(cmd, success) for _, cmd, success in reversed(self.index.tail)]
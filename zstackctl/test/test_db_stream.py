@@ -0,0 +1,179 @@
+'''
+
+parallel dump against the `(mysqldump; mysqldump; mysqldump) | gzip` pipeline,
+fed by a fake mysqldump printing SQL-like text. The size of every fake dump
+is ZSTACKCTL_DUMP_BENCH_MB (32 MB by default), set it to some thousands for a
+real benchmark.
+'''
+import gzip
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from zstackctl.utils import db_stream
+
+DUMP_MB = int(os.environ.get('ZSTACKCTL_DUMP_BENCH_MB', 32))
+
+# rows are made up once and printed again and again, so the fake mysqldump is
+# not what the benchmark measures. They repeat further apart than the 32 KB
+# window of deflate, the output compresses like a real dump
+FAKE_MYSQLDUMP = r'''
+import random, sys
+rnd = random.Random(int(sys.argv[1]))
+left = int(sys.argv[2]) * 1024 * 1024
+out = sys.stdout
+out.write('CREATE DATABASE /*!32312 IF NOT EXISTS*/ `zstack`;\n')
+out.write('/*!50017 DEFINER=`zstack`@`old-host`*/ /*!50003 TRIGGER t */;\n')
+lines = []
+for _ in xrange(64):
+    rows = ','.join("('%032x','vm-%d',%d,'Running')" % (rnd.getrandbits(128), rnd.randint(0, 1 << 20), rnd.randint(0, 1 << 40))
+                    for _ in xrange(200))
+    lines.append('INSERT INTO `VmInstanceVO` VALUES %s;\n' % rows)
+n = 0
+while left > 0:
+    line = lines[n % len(lines)]
+    out.write(line)
+    left -= len(line)
+    n += 1
+'''
+
+
+def md5_of_gzip(path):
+    md5 = hashlib.md5()
+    size = 0
+    f = gzip.open(path, 'rb')
+    try:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            md5.update(data)
+            size += len(data)
+    finally:
+        f.close()
+    return md5.hexdigest(), size
+
+
+class TestDbStream(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.generator = os.path.join(self.tmp, 'fake_mysqldump.py')
+        with open(self.generator, 'w') as fd:
+            fd.write(FAKE_MYSQLDUMP)
+        self.commands = ['%s %s %d %d' % (sys.executable, self.generator, seed, DUMP_MB) for seed in (1, 2, 3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _serial_dump(self, path):
+        subprocess.check_call('(%s) | gzip > %s' % ('; '.join(self.commands), path), shell=True, executable='/bin/bash')
+
+    def test_parallel_dump_throughput(self):
+        serial_path = os.path.join(self.tmp, 'serial.gz')
+        start = time.time()
+        self._serial_dump(serial_path)
+        serial_time = time.time() - start
+
+        parallel_path = os.path.join(self.tmp, 'parallel.gz')
+        start = time.time()
+        sink = db_stream.DumpSink(parallel_path)
+        raw_size = db_stream.dump(self.commands, sink)
+        sink.close()
+        parallel_time = time.time() - start
+
+        serial_md5, serial_size = md5_of_gzip(serial_path)
+        parallel_md5, parallel_size = md5_of_gzip(parallel_path)
+        self.assertEqual(serial_size, raw_size)
+        self.assertEqual(serial_md5, parallel_md5)
+        self.assertFalse(os.path.exists(parallel_path + '.tmp'))
+
+        mb = raw_size / 1024.0 / 1024
+        workers = db_stream.default_workers()
+        sys.stderr.write('\ndump %.0f MB: serial pipeline %.1f MB/s, parallel %.1f MB/s with %d threads\n' %
+                         (mb, mb / serial_time, mb / parallel_time, workers))
+        if workers > 1:
+            self.assertLess(parallel_time, serial_time)
+        else:
+            # nothing runs in parallel on one cpu, the blocks must not cost much
+            self.assertLess(parallel_time, serial_time * 1.5)
+
+    def test_dump_to_remote_sink(self):
+        local_path = os.path.join(self.tmp, 'local.gz')
+        remote_path = os.path.join(self.tmp, 'remote.gz')
+        # bash -c stands in for ssh running the command on the remote host
+        sink = db_stream.DumpSink(local_path, 'bash -c', remote_path)
+        db_stream.dump(self.commands[:1], sink, block_size=64 * 1024)
+        sink.close()
+        self.assertEqual(md5_of_gzip(local_path), md5_of_gzip(remote_path))
+
+    def test_failed_dump_not_published_on_remote(self):
+        local_path = os.path.join(self.tmp, 'local.gz')
+        remote_path = os.path.join(self.tmp, 'remote.gz')
+        sink = db_stream.DumpSink(local_path, 'bash -c', remote_path)
+        with self.assertRaises(Exception):
+            db_stream.dump(self.commands[:1] + ['echo oops >&2; exit 2'], sink, block_size=64 * 1024)
+        sink.abort()
+        self.assertEqual([], [f for f in os.listdir(self.tmp) if f.startswith('remote') or f.startswith('local')])
+
+    def test_short_remote_not_published(self):
+        local_path = os.path.join(self.tmp, 'local.gz')
+        remote_path = os.path.join(self.tmp, 'remote.gz')
+        # the remote writes less than it was sent
+        sink = db_stream.DumpSink(local_path, "bash -c 'head -c 1000 > /dev/null; exec bash -c \"$0\"'", remote_path)
+        db_stream.dump(self.commands[:1], sink, block_size=64 * 1024)
+        self.assertRaises(Exception, sink.close)
+        self.assertFalse(os.path.exists(remote_path))
+
+    def test_failed_dump(self):
+        sink = db_stream.DumpSink(os.path.join(self.tmp, 'failed.gz'))
+        with self.assertRaises(Exception):
+            db_stream.dump(self.commands[:1] + ['echo oops >&2; exit 2'], sink)
+        sink.abort()
+        self.assertEqual([], [f for f in os.listdir(self.tmp) if f.startswith('failed')])
+
+    def test_failed_write_stops_dump(self):
+        class BrokenSink(object):
+            def write(self, data):
+                raise IOError('disk full')
+
+            def flush(self):
+                pass
+
+        name = 'zs-dump-test-%d' % os.getpid()
+        with self.assertRaises(Exception):
+            db_stream.dump(['exec -a %s yes' % name], BrokenSink(), block_size=64 * 1024)
+        self.assertNotEqual(0, subprocess.call(['pgrep', '-f', name]))
+
+    def test_restore_pipeline(self):
+        backup = os.path.join(self.tmp, 'backup.gz')
+        sink = db_stream.DumpSink(backup)
+        db_stream.dump(["%s %s 4 1" % (sys.executable, self.generator)], sink)
+        sink.close()
+
+        outs = [os.path.join(self.tmp, 'zstack.sql'), os.path.join(self.tmp, 'zstack_rest.sql')]
+        db_stream.restore(backup, ["cat > %s" % o for o in outs], 'new-host')
+
+        with open(outs[0]) as fd:
+            restored = fd.read()
+        with open(outs[1]) as fd:
+            self.assertEqual(restored, fd.read())
+        self.assertNotIn('CREATE DATABASE', restored)
+        self.assertIn('DEFINER=`root`@`new-host`', restored)
+        self.assertTrue(restored.count('INSERT INTO') > 10)
+
+    def test_restore_loader_failure(self):
+        backup = os.path.join(self.tmp, 'backup.gz')
+        sink = db_stream.DumpSink(backup)
+        db_stream.dump(["%s %s 5 4" % (sys.executable, self.generator)], sink)
+        sink.close()
+        with self.assertRaises(Exception):
+            db_stream.restore(backup, ["head -c 10 > /dev/null; exit 1"], 'new-host')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+'''
+
+log collector with a fake remote executor serving tar streams of local
+directories in place of ssh
+'''
+import os
+import shutil
+import StringIO
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+from zstackctl import log_collector
+from zstackctl.utils import bounded_pool
+from zstackctl.utils import collect_archive
+from zstackctl.zstacklib import HostPostInfo
+
+
+class FakeTarStreamer(object):
+    def __init__(self, host_dirs):
+        self.host_dirs = host_dirs
+        self.opened = []
+
+    def open(self, host_post_info, remote_dir):
+        self.opened.append((host_post_info.host, remote_dir))
+        local_dir = self.host_dirs[host_post_info.host]
+        command = collect_archive.SshTarStreamer.TAR_COMMAND % local_dir
+        stderr = tempfile.TemporaryFile()
+        p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=stderr, executable='/bin/bash')
+        return collect_archive.TarStream(p, stderr, command)
+
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+class TestBoundedExecutor(unittest.TestCase):
+    def test_bounded_and_idle_while_waiting(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def work(n):
+            with lock:
+                running.append(n)
+                peak.append(len(running))
+            time.sleep(0.3)
+            with lock:
+                running.remove(n)
+            return n
+
+        executor = bounded_pool.BoundedExecutor(3, 'test')
+        cpu = cpu_time()
+        for i in range(9):
+            executor.submit('host-%d' % i, work, i)
+        finished, timed_out = executor.wait(5)
+        executor.shutdown()
+
+        self.assertEqual(range(9), [t.result for t in finished])
+        self.assertEqual([], timed_out)
+        self.assertEqual(3, max(peak))
+        self.assertTrue(all(0.25 < t.elapsed() < 1 for t in finished))
+        # about one second of waiting must not be spent spinning
+        self.assertLess(cpu_time() - cpu, 0.3)
+
+    def test_timeout_does_not_starve_queue(self):
+        hang = threading.Event()
+        executor = bounded_pool.BoundedExecutor(1, 'test')
+        executor.submit('hung', hang.wait)
+        executor.submit('next', lambda: 'done')
+        finished, timed_out = executor.wait(0.5)
+        hang.set()
+        executor.shutdown()
+
+        self.assertEqual(['hung'], [t.name for t in timed_out])
+        self.assertEqual(['done'], [t.result for t in finished])
+
+    def test_exit_in_task(self):
+        def fail():
+            raise SystemExit(1)
+
+        executor = bounded_pool.BoundedExecutor(1, 'test')
+        executor.submit('fail', fail)
+        executor.submit('ok', lambda: 1)
+        finished, _ = executor.wait(5)
+        self.assertIsInstance(finished[0].error, SystemExit)
+        self.assertEqual(1, finished[1].result)
+
+
+def tar_bytes(files):
+    buf = StringIO.StringIO()
+    tar = tarfile.open(fileobj=buf, mode='w')
+    for name, content in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, StringIO.StringIO(content))
+    tar.close()
+    return buf.getvalue()
+
+
+class StalledReader(object):
+    '''a tar stream stopping in the middle of its first member until resumed'''
+
+    def __init__(self, data, stall_at):
+        self.data = data
+        self.offset = 0
+        self.stall_at = stall_at
+        self.stalled = threading.Event()
+        self.resume = threading.Event()
+
+    def read(self, size):
+        if self.offset >= self.stall_at and not self.resume.is_set():
+            self.stalled.set()
+            self.resume.wait()
+        end = min(self.offset + size, len(self.data))
+        if not self.resume.is_set():
+            end = min(end, self.stall_at)
+        data = self.data[self.offset:end]
+        self.offset = end
+        return data
+
+
+class TestStreamingArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_stalled_host_does_not_hold_archive(self):
+        archive = collect_archive.StreamingArchive(os.path.join(self.tmp, 'logs.tar.gz'), 'logs')
+        slow = StalledReader(tar_bytes([('agent.log', 'slow\n' * 10000)]), 4096)
+        self.addCleanup(slow.resume.set)
+        t = threading.Thread(target=archive.add_stream, args=(slow, 'slow-host'))
+        t.daemon = True
+        t.start()
+        self.assertTrue(slow.stalled.wait(10))
+
+        fast = tar_bytes([('agent.log', 'fast\n' * 10000)])
+        done = []
+        f = threading.Thread(target=lambda: done.append(archive.add_stream(StringIO.StringIO(fast), 'fast-host')))
+        f.daemon = True
+        f.start()
+        f.join(10)
+        self.assertEqual([1], done)
+
+        slow.resume.set()
+        t.join(10)
+        archive.close()
+        with tarfile.open(os.path.join(self.tmp, 'logs.tar.gz')) as tar:
+            self.assertEqual(['logs/fast-host/agent.log', 'logs/slow-host/agent.log'], tar.getnames())
+            self.assertEqual('slow\n' * 10000, tar.extractfile('logs/slow-host/agent.log').read())
+
+    def test_ssh_gives_up_on_dead_hosts(self):
+        info = HostPostInfo()
+        info.host = '10.0.0.1'
+        info.remote_user = 'root'
+        info.remote_port = 22
+        streamer = collect_archive.SshTarStreamer()
+        popen = collect_archive.subprocess.Popen
+        commands = []
+
+        def fake_popen(command, **kwargs):
+            commands.append(command)
+            return popen('true', shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        collect_archive.subprocess.Popen = fake_popen
+        try:
+            streamer.open(info, '/tmp/host-tmp-log/').close()
+        finally:
+            collect_archive.subprocess.Popen = popen
+        self.assertIn('-o ConnectTimeout=', commands[0])
+        self.assertIn('-o ServerAliveInterval=', commands[0])
+
+
+class TestStreamingCollect(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.host_dirs = {}
+        for i in range(6):
+            host = '10.0.0.%d' % i
+            d = os.path.join(self.tmp, 'remote-%s' % host)
+            os.makedirs(os.path.join(d, 'zstack-agent'))
+            with open(os.path.join(d, 'zstack-agent', 'agent.log'), 'w') as fd:
+                fd.write(('%s log line\n' % host) * 20000)
+            with open(os.path.join(d, 'history'), 'w') as fd:
+                fd.write('ls\n')
+            self.host_dirs[host] = d
+
+        self.local_dir = os.path.join(self.tmp, 'collect-log-1.0-now')
+        os.makedirs(self.local_dir)
+        with open(os.path.join(self.local_dir, 'summary'), 'w') as fd:
+            fd.write('{}')
+
+        self.run_remote_command = log_collector.run_remote_command
+        self.removed = []
+        log_collector.run_remote_command = lambda command, host_post_info, **kwargs: self.removed.append(
+            host_post_info.host)
+
+    def tearDown(self):
+        log_collector.run_remote_command = self.run_remote_command
+        shutil.rmtree(self.tmp)
+
+    def test_stream_remote_logs_into_archive(self):
+        collector = log_collector.CollectFromYml.__new__(log_collector.CollectFromYml)
+        collector.archive = collect_archive.StreamingArchive(self.local_dir + '.tar.gz', 'collect-log-1.0-now')
+        collector.tar_streamer = FakeTarStreamer(self.host_dirs)
+
+        executor = bounded_pool.BoundedExecutor(4, 'test')
+        for host in sorted(self.host_dirs):
+            info = HostPostInfo()
+            info.host = host
+            executor.submit('host %s' % host, collector.stream_log, '/tmp/host-tmp-log/', info, 'host')
+        finished, timed_out = executor.wait(30)
+        executor.shutdown()
+        self.assertEqual([], timed_out)
+        self.assertEqual([None] * 6, [t.error for t in finished])
+        self.assertEqual(sorted(self.host_dirs), sorted(self.removed))
+
+        collector.generate_tar_ball(self.local_dir)
+
+        with tarfile.open(self.local_dir + '.tar.gz') as tar:
+            names = set(tar.getnames())
+            for host in self.host_dirs:
+                name = 'collect-log-1.0-now/host-%s/zstack-agent/agent.log' % host
+                self.assertIn(name, names)
+                self.assertEqual(('%s log line\n' % host) * 20000, tar.extractfile(name).read())
+            self.assertIn('collect-log-1.0-now/summary', names)
+        # nothing of the remote hosts is written under the local collect dir
+        self.assertEqual(['summary'], os.listdir(self.local_dir))
+
+    def test_failed_stream(self):
+        collector = log_collector.CollectFromYml.__new__(log_collector.CollectFromYml)
+        collector.archive = collect_archive.StreamingArchive(self.local_dir + '.tar.gz', 'collect-log-1.0-now')
+        collector.tar_streamer = FakeTarStreamer({'10.0.0.9': os.path.join(self.tmp, 'missing')})
+        info = HostPostInfo()
+        info.host = '10.0.0.9'
+        with self.assertRaises(Exception):
+            collector.stream_log('/tmp/host-tmp-log/', info, 'host')
+        # the remote tmp dir is removed anyway
+        self.assertEqual(['10.0.0.9'], self.removed)
+        collector.archive.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+'''
+
+QuerySession against a sqlite database standing in for mysql
+'''
+import sqlite3
+import unittest
+
+from zstackctl import ctl
+from zstackctl.utils import sql_query
+
+
+class SqliteConnector(object):
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.db.executescript('''
+            create table HostVO (uuid text, managementIp text);
+            create table KVMHostVO (uuid text, username text, password text, port integer);
+            create table VmNicVO (ip text, deviceId integer, vmInstanceUuid text);
+            create table VirtualRouterVmVO (uuid text);
+        ''')
+        self.connections = 0
+        self.commits = 0
+        self.executed = []
+
+    def __call__(self, host, port, user, password, database):
+        self.connections += 1
+        return SqliteConnection(self)
+
+
+class SqliteConnection(object):
+    def __init__(self, connector):
+        self.connector = connector
+
+    def cursor(self):
+        return SqliteCursor(self.connector)
+
+    def commit(self):
+        self.connector.commits += 1
+        self.connector.db.commit()
+
+    def close(self):
+        pass
+
+
+class SqliteCursor(object):
+    def __init__(self, connector):
+        self.connector = connector
+        self.cursor = connector.db.cursor()
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def execute(self, sql, params=()):
+        self.connector.executed.append(sql)
+        self.cursor.execute(sql.replace('%s', '?'), params)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+
+class TestQuerySession(unittest.TestCase):
+    def setUp(self):
+        self.connector = SqliteConnector()
+        self.session = sql_query.QuerySession('localhost', 3306, 'root', '', connect=self.connector)
+        for i in range(1200):
+            uuid = 'host-%d' % i
+            ip = '10.0.%d.%d' % (i / 256, i % 256)
+            self.session.query("insert into HostVO values (%s, %s)", (uuid, ip))
+            self.session.query("insert into KVMHostVO values (%s, %s, %s, %s)", (uuid, 'root', 'pass%d' % i, 22))
+
+    def test_one_connection_per_session(self):
+        self.session.query("select * from HostVO")
+        self.session.query_one("select * from KVMHostVO where uuid = %s", ('host-1',))
+        self.assertEqual(1, self.connector.connections)
+        self.assertEqual(2402, self.session.queries)
+
+        self.session.close()
+        self.session.query("select * from HostVO")
+        self.assertEqual(2, self.connector.connections)
+
+    def test_typed_rows(self):
+        r = self.session.query_one("select * from KVMHostVO where uuid = %s", ('host-7',))
+        self.assertEqual({'uuid': 'host-7', 'username': 'root', 'password': 'pass7', 'port': 22}, r)
+        self.assertIsNone(self.session.query_one("select * from HostVO where uuid = %s", ('nope',)))
+
+    def test_query_in_batches(self):
+        ips = ['10.0.%d.%d' % (i / 256, i % 256) for i in range(1200)]
+        self.connector.executed = []
+        rows = self.session.query_in(
+            "select h.managementIp as ip, k.port as port from HostVO h, KVMHostVO k"
+            " where h.uuid = k.uuid and k.username = %s and h.managementIp in (%s)", ips, ['root'])
+
+        self.assertEqual(1200, len(rows))
+        self.assertEqual(set(ips), set(r['ip'] for r in rows))
+        # 1200 ips in batches of 500
+        self.assertEqual(3, len(self.connector.executed))
+        self.assertEqual(1, self.connector.connections)
+
+    def test_params_are_not_interpolated(self):
+        evil = "x' or '1'='1"
+        self.assertIsNone(self.session.query_one("select * from HostVO where uuid = %s", (evil,)))
+
+    def test_cli_fallback_escapes_literals(self):
+        self.assertEqual('NULL', sql_query._escape_literal(None))
+        self.assertEqual('22', sql_query._escape_literal(22))
+        self.assertEqual("'it\\\\'s'", sql_query._escape_literal("it's"))
+        self.assertEqual("'\\\"\\$HOME\\`'", sql_query._escape_literal('"$HOME`'))
+        # both a backslash and a quote, sql escapes doubled again for the shell
+        self.assertEqual("'C:\\\\\\\\dir\\\\\\\\\\\\'s'", sql_query._escape_literal("C:\\dir\\'s"))
+
+    def test_cli_fallback_literals_through_shell(self):
+        value = "C:\\dir\\'s \"$HOME\" `id`"
+        sql = 'select %s' % sql_query._escape_literal(value)
+        # what the mysql cli gets, after bash took its double quotes apart
+        got = sql_query.shell('printf %%s "%s"' % sql)
+        self.assertEqual("select '%s'" % value.replace('\\', '\\\\').replace("'", "\\'"), got)
+
+    def test_reads_do_not_keep_a_snapshot(self):
+        commits = self.connector.commits
+        self.session.query("select * from HostVO")
+        self.session.query_one("select * from KVMHostVO where uuid = %s", ('host-1',))
+        self.assertEqual(commits + 2, self.connector.commits)
+
+
+class TestCtlDbSession(unittest.TestCase):
+    def test_one_connection_per_command(self):
+        connector = SqliteConnector()
+        session = sql_query.QuerySession('localhost', 3306, 'root', '', connect=connector)
+        session.query("insert into HostVO values (%s, %s)", ('host-1', '10.0.0.1'))
+        session.query("insert into VmNicVO values (%s, %s, %s)", ('192.168.0.1', 0, 'vr-1'))
+        session.query("insert into VirtualRouterVmVO values (%s)", ('vr-1',))
+
+        c = ctl.Ctl()
+        c._db_session = session
+        old_ctl = ctl.ctl
+        ctl.ctl = c
+        try:
+            self.assertEqual('10.0.0.1', ctl.get_host_list('HostVO')[0]['managementIp'])
+            self.assertEqual(['192.168.0.1'], ctl.get_vrouter_list())
+            self.assertIs(session, c.db_session())
+        finally:
+            ctl.ctl = old_ctl
+            c.close_db_session()
+
+        self.assertEqual(1, connector.connections)
+        self.assertIsNone(c._db_session)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+'''
+
+zstack-ctl start time benchmark: `zstack-ctl --help` must start faster than
+the same command with every command and lazy module loaded up front, as
+zstack-ctl started before, measured in the same run, and within an absolute
+budget of 150 ms, which ZSTACKCTL_STARTUP_BUDGET_MS changes for slower
+machines. The budget catches a heavy import that slows both starts alike
+'''
+import compileall
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from zstackctl import ctl
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_MS = int(os.environ.get('ZSTACKCTL_STARTUP_BUDGET_MS', 150))
+ROUNDS = 5
+
+LAZY = 'from zstackctl import ctl; ctl.main()'
+EAGER = '''
+from zstackctl import ctl
+for m in (ctl.yaml, ctl.jinja2, ctl.OpenSSL):
+    try:
+        m._load()
+    except ImportError:
+        pass
+ctl.register_commands()
+ctl.ctl.load_all_commands()
+ctl.main()
+'''
+
+
+class TestStartupTime(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # an installed zstack-ctl runs from byte-compiled files, they are
+        # written to a copy of the package instead of the source tree
+        cls.tmp = tempfile.mkdtemp()
+        cls.package_copy = os.path.join(cls.tmp, 'package')
+        shutil.copytree(os.path.join(PACKAGE_ROOT, 'zstackctl'), os.path.join(cls.package_copy, 'zstackctl'),
+                        ignore=shutil.ignore_patterns('*.pyc'))
+        compileall.compile_dir(cls.package_copy, quiet=True)
+
+        cls.zstack_home = os.path.join(cls.tmp, 'zstack')
+        os.makedirs(os.path.join(cls.zstack_home, 'WEB-INF/classes'))
+        with open(os.path.join(cls.zstack_home, 'WEB-INF/classes/zstack.properties'), 'w') as fd:
+            fd.write('DB.url=jdbc:mysql://localhost:3306\n')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def _run(self, code, *args):
+        env = dict(os.environ)
+        env['ZSTACK_HOME'] = self.zstack_home
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        cmd = [sys.executable, '-c', code] + list(args)
+
+        cost = []
+        for _ in range(ROUNDS):
+            start = time.time()
+            p = subprocess.Popen(cmd, cwd=self.package_copy, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+            cost.append((time.time() - start) * 1000)
+            self.assertEqual(0, p.returncode, err)
+        return sorted(cost)[ROUNDS / 2], out
+
+    def _check(self, expected, *args):
+        median, out = self._run(LAZY, *args)
+        baseline, _ = self._run(EAGER, *args)
+        name = ' '.join(('zstack-ctl',) + args)
+        print '%s: %.1f ms, %.1f ms with all commands loaded' % (name, median, baseline)
+        self.assertIn(expected, out)
+        self.assertTrue(median < baseline, '%s took %.1f ms, not less than %.1f ms with all commands loaded'
+                        % (name, median, baseline))
+        self.assertTrue(median < BUDGET_MS, '%s took %.1f ms, over the budget %d ms' % (name, median, BUDGET_MS))
+
+    def test_help_faster_than_eager_start(self):
+        self._check('status', '--help')
+
+    def test_sub_command_help_faster_than_eager_start(self):
+        self._check('--host', 'status', '--help')
+
+
+class TestLazyCommands(unittest.TestCase):
+    def setUp(self):
+        self.origin = ctl.ctl
+        ctl.ctl = ctl.Ctl()
+
+    def tearDown(self):
+        ctl.ctl = self.origin
+
+    def _register(self):
+        for name, cmd_class in ctl.COMMANDS + ctl.UI_COMMANDS:
+            ctl.ctl.register_lazy_command(name, cmd_class)
+
+    def test_only_requested_command_is_instantiated(self):
+        self._register()
+        cmd = ctl.ctl.get_command('status')
+        self.assertTrue(isinstance(cmd, ctl.ShowStatusCmd))
+        self.assertEqual(['status'], ctl.ctl.commands.keys())
+
+    def test_registry_matches_command_names(self):
+        self._register()
+        # get_command() asserts the registered name is the name the command gives itself
+        ctl.ctl.load_all_commands()
+        self.assertEqual(len(ctl.COMMANDS + ctl.UI_COMMANDS), len(ctl.ctl.command_list))
+
+    def test_zstack_release(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, 'ZStack release c76\n')
+        os.close(fd)
+        try:
+            self.assertEqual('c76', ctl.read_zstack_release(path))
+            self.assertEqual('', ctl.read_zstack_release(path + '.not-exist'))
+        finally:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import argparse
+import collections
 import hashlib
 import sys
 import os
@@ -22,17 +23,16 @@ import tempfile
 import pwd, grp
 import traceback
 import uuid
-import yaml
 import re
-import OpenSSL
 import glob
 from shutil import copyfile
 from shutil import rmtree
 
 from utils import linux, lock
+from utils import db_stream
+from utils.lazy import LazyModule
+from utils.sql_query import QuerySession
 from zstacklib import *
-import log_collector
-import jinja2
 import socket
 import struct
 import fcntl
@@ -43,10 +43,14 @@ import platform
 from  datetime import datetime, timedelta
 import multiprocessing
 import base64
-from Crypto.Cipher import AES
 from Crypto.Util.py3compat import *
 from hashlib import md5
 
+# only a few commands need them, import on first use to keep the start fast
+yaml = LazyModule('yaml')
+jinja2 = LazyModule('jinja2')
+OpenSSL = LazyModule('OpenSSL')
+
 mysql_db_config_script='''
 #!/bin/bash
 echo "modify my.cnf"
@@ -349,34 +353,15 @@ def get_yum_repo_from_property():
 
 
 def get_host_list(table_name):
-    db_hostname, db_port, db_user, db_password = ctl.get_live_mysql_portal()
-    query = MySqlCommandLineQuery()
-    query.host = db_hostname
-    query.port = db_port
-    query.user = db_user
-    query.password = db_password
-    query.table = 'zstack'
-    query.sql = "select * from %s" % table_name
-    host_vo = query.query()
-    return host_vo
+    return ctl.db_session().query("select * from %s" % table_name)
 
 def get_mn_list():
     return get_host_list("ManagementNodeVO")
 
 def get_vrouter_list():
-    ip_list = []
-    db_hostname, db_port, db_user, db_password = ctl.get_live_mysql_portal()
-    query = MySqlCommandLineQuery()
-    query.host = db_hostname
-    query.port = db_port
-    query.user = db_user
-    query.password = db_password
-    query.table = 'zstack'
-    query.sql = "select ip from VmNicVO where deviceId = 0 and vmInstanceUuid in (select uuid from VirtualRouterVmVO)"
-    vrouter_ip_list = query.query()
-    for ip in vrouter_ip_list:
-        ip_list.append(ip['ip'])
-    return ip_list
+    vrouter_ip_list = ctl.db_session().query(
+        "select ip from VmNicVO where deviceId = 0 and vmInstanceUuid in (select uuid from VirtualRouterVmVO)")
+    return [ip['ip'] for ip in vrouter_ip_list]
 
 def get_ha_mn_list(conf_file):
     with open(conf_file, 'r') as fd:
@@ -722,6 +707,32 @@ class CtlParser(argparse.ArgumentParser):
         self.print_help()
         sys.exit(1)
 
+class lazy_class_property(object):
+    '''
+    computed on first access and then stored on the class, so probes like
+    reading /etc/zstack-release are not paid by every zstack-ctl start
+    '''
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, owner):
+        value = self.func()
+        setattr(owner, self.func.__name__, value)
+        return value
+
+def read_zstack_release(path='/etc/zstack-release'):
+    # the same as `awk '{print $3}' /etc/zstack-release`, without forking
+    if not os.path.isfile(path):
+        return ''
+    with open(path) as fd:
+        for line in fd:
+            fields = line.split()
+            if len(fields) >= 3:
+                return fields[2]
+    return ''
+
 class Ctl(object):
     IS_AARCH64 = platform.machine() == 'aarch64'
     DEFAULT_ZSTACK_HOME = '/usr/local/zstack/apache-tomcat/webapps/zstack/'
@@ -746,11 +757,18 @@ class Ctl(object):
     NEED_ENCRYPT_PROPERTIES_UI = ['db_password']
     # get basharch and zstack-release
     BASEARCH = platform.machine()
-    ZS_RELEASE = os.popen("awk '{print $3}' /etc/zstack-release").read().strip()
+
+    @lazy_class_property
+    def ZS_RELEASE():
+        return read_zstack_release()
 
     def __init__(self):
         self.commands = {}
         self.command_list = []
+        # command name -> command class, instantiated on first use
+        self.lazy_commands = collections.OrderedDict()
+        self.subparsers = None
+        self._db_session = None
         self.main_parser = CtlParser(prog='zstack-ctl', description="ZStack management tool", formatter_class=argparse.RawTextHelpFormatter)
         self.main_parser.add_argument('-v', help="verbose, print execution details", dest="verbose", action="store_true", default=False)
         self.zstack_home = None
@@ -765,6 +783,38 @@ class Ctl(object):
         self.commands[cmd.name] = cmd
         self.command_list.append(cmd)
 
+    def register_lazy_command(self, name, cmd_class):
+        # the command class registers itself by ctl.register_command() when instantiated
+        self.lazy_commands[name] = cmd_class
+
+    def get_command(self, name):
+        if name not in self.commands and name in self.lazy_commands:
+            cmd = self.lazy_commands[name]()
+            assert cmd.name == name, 'command class %s is registered as %s but named %s' % (cmd.__class__.__name__, name, cmd.name)
+        return self.commands.get(name)
+
+    def load_all_commands(self):
+        for name in self.lazy_commands.keys():
+            self.get_command(name)
+
+    def _find_sub_command_name(self, argv):
+        # the main parser has only flag options, the first positional is the sub command
+        for arg in argv:
+            if not arg.startswith('-'):
+                return arg
+        return None
+
+    def _install_sub_command(self, cmd):
+        if cmd.description is not None:
+            cmd.install_argparse_arguments(self.subparsers.add_parser(cmd.name, help=cmd.description + '\n\n'))
+        else:
+            cmd.install_argparse_arguments(self.subparsers.add_parser(cmd.name))
+        cmd.argparse_installed = True
+
+    def _ensure_sub_command_installed(self, cmd):
+        if not getattr(cmd, 'argparse_installed', False):
+            self._install_sub_command(cmd)
+
     def locate_zstack_home(self):
         env_path = os.path.expanduser(SetEnvironmentVariableCmd.PATH)
         if os.path.isfile(env_path):
@@ -815,6 +865,14 @@ class Ctl(object):
             os.mknod(self.ui_properties_file_path)
             os.chmod(self.ui_properties_file_path, 438)
 
+        # only instantiate and install arguments of the requested command,
+        # help or a mistyped command needs all of them to print the usage
+        cmd_name = self._find_sub_command_name(sys.argv[1:])
+        if cmd_name in self.lazy_commands or cmd_name in self.commands:
+            self.get_command(cmd_name)
+        else:
+            self.load_all_commands()
+
         metavar_list = []
         for n,cmd in enumerate(self.command_list):
             if cmd.hide is False:
@@ -822,13 +880,12 @@ class Ctl(object):
             else:
                 self.command_list[n].description = None
 
+        # the names of not loaded commands still show up in the usage
+        metavar_list.extend([n for n in self.lazy_commands.keys() if n not in self.commands])
         metavar_string = '{' + ','.join(metavar_list) + '}'
-        subparsers = self.main_parser.add_subparsers(help="All sub-commands", dest="sub_command_name", metavar=metavar_string)
+        self.subparsers = self.main_parser.add_subparsers(help="All sub-commands", dest="sub_command_name", metavar=metavar_string)
         for cmd in self.command_list:
-            if cmd.description is not None:
-                cmd.install_argparse_arguments(subparsers.add_parser(cmd.name, help=cmd.description + '\n\n'))
-            else:
-                cmd.install_argparse_arguments(subparsers.add_parser(cmd.name))
+            self._install_sub_command(cmd)
         args, self.extra_arguments = self.main_parser.parse_known_args(sys.argv[1:])
 
         # check the ip address
@@ -852,11 +909,15 @@ class Ctl(object):
         if cmd.need_zstack_user():
             check_zstack_user()
 
-        cmd(args)
+        try:
+            cmd(args)
+        finally:
+            self.close_db_session()
 
     def internal_run(self, cmd_name, args=''):
-        cmd = self.commands[cmd_name]
+        cmd = self.get_command(cmd_name)
         assert cmd, 'cannot find command %s' % cmd_name
+        self._ensure_sub_command_installed(cmd)
 
         params = [cmd_name]
         params.extend(args.split())
@@ -996,6 +1057,20 @@ class Ctl(object):
 
         raise CtlError('\n'.join(errors))
 
+    def db_session(self):
+        '''
+        the database session shared by all queries of the running command
+        '''
+        if self._db_session is None:
+            hostname, port, user, password = self.get_live_mysql_portal()
+            self._db_session = QuerySession(hostname, port, user, password)
+        return self._db_session
+
+    def close_db_session(self):
+        if self._db_session is not None:
+            self._db_session.close()
+            self._db_session = None
+
     def get_database_portal(self):
         db_user = self.read_property("DB.user")
         if not db_user:
@@ -1471,30 +1546,18 @@ class ShowStatusCmd(Command):
 
         def show_version():
             try:
-                db_hostname, db_port, db_user, db_password = ctl.get_live_mysql_portal()
-            except CtlError as e:
-                info('version: %s' % colored('unknown, %s' % e.message.strip(), 'yellow'))
-                return
-
-            if db_password:
-                cmd = ShellCmd('''mysql -u %s -p%s --host %s --port %s -t zstack -e "show tables like 'schema_version'"''' %
-                            (db_user, db_password, db_hostname, db_port))
-            else:
-                cmd = ShellCmd('''mysql -u %s --host %s --port %s -t zstack -e "show tables like 'schema_version'"''' %
-                            (db_user, db_hostname, db_port))
-
-            cmd(False)
-            if cmd.return_code != 0:
-                msg = 'unknown, %s %s' % (cmd.stderr, cmd.stdout)
-                info('version: %s' % colored(msg.strip(), 'yellow'))
+                session = ctl.db_session()
+                tables = session.query("show tables like 'schema_version'")
+                if not tables:
+                    version = '0.6'
+                else:
+                    versions = [str(r['version']) for r in session.query("select version from schema_version")]
+                    versions.sort(cmp=compare_version)
+                    version = versions[0]
+            except Exception as e:
+                info('version: %s' % colored('unknown, %s' % str(e).strip(), 'yellow'))
                 return
 
-            out = cmd.stdout
-            if 'schema_version' not in out:
-                version = '0.6'
-            else:
-                version = get_zstack_version(db_hostname, db_port, db_user, db_password)
-
             detailed_version = get_detail_version()
             if detailed_version is not None:
                 info('version: %s (%s)' % (version, detailed_version))
@@ -1941,6 +2004,7 @@ class AESCipher:
     """
 
     def __init__(self, key='ZStack open source'):
+        from Crypto.Cipher import AES
         self.key = md5(key).hexdigest()
         self.cipher = AES.new(self.key, AES.MODE_ECB)
         self.prefix = "crypt_key_for_v1::"
@@ -4983,21 +5047,34 @@ class DumpMysqlCmd(Command):
         parser.add_argument('--append-sql-file',
                             help="specify a append sql to operate zstack database",
                             required=False)
+        parser.add_argument('--parallel',
+                            action='store_true',
+                            help="run the database dumps concurrently and compress them with multiple threads, "
+                                 "the backup is streamed to the remote host specified by '--host' while it is written",
+                            default=False)
+        parser.add_argument('--compress-threads', type=int,
+                            help="the number of compress threads of '--parallel', default is the number of cpus",
+                            default=None)
 
-    def sync_local_backup_db_to_remote_host(self, args, user, private_key, remote_host_ip, remote_host_port):
-        (status, output, stderr) = shell_return_stdout_stderr("mkdir -p %s" % self.ui_backup_dir)
+    def make_remote_backup_dir(self, user, private_key, remote_host_ip, remote_host_port):
+        command ='timeout 10 sshpass ssh -p %s -i %s %s@%s "mkdir -p %s"' % (remote_host_port, private_key, user, remote_host_ip, self.remote_backup_dir)
+        (status, output, stderr) = shell_return_stdout_stderr(command)
         if status != 0:
             error(stderr)
 
-        command ='timeout 10 sshpass ssh -p %s -i %s %s@%s "mkdir -p %s"' % (remote_host_port, private_key, user, remote_host_ip, self.remote_backup_dir)
-        (status, output, stderr) = shell_return_stdout_stderr(command)
+    def sync_local_backup_db_to_remote_host(self, args, user, private_key, remote_host_ip, remote_host_port, exclude=None):
+        (status, output, stderr) = shell_return_stdout_stderr("mkdir -p %s" % self.ui_backup_dir)
         if status != 0:
             error(stderr)
+
+        self.make_remote_backup_dir(user, private_key, remote_host_ip, remote_host_port)
+        # the streamed backup is already on the remote host
+        exclude_option = "--exclude='%s'" % exclude if exclude else ""
         if args.delete_expired_file is True:
-            sync_command = "rsync -lr --delete -e 'ssh -i %s -p %s'  %s %s %s@%s:%s" % (private_key, remote_host_port, self.mysql_backup_dir,
+            sync_command = "rsync -lr --delete %s -e 'ssh -i %s -p %s'  %s %s %s@%s:%s" % (exclude_option, private_key, remote_host_port, self.mysql_backup_dir,
                                                                                self.ui_backup_dir, user, remote_host_ip, self.remote_backup_dir)
         else:
-            sync_command = "rsync -lr -e 'ssh -i %s -p %s'  %s %s %s@%s:%s" % (private_key, remote_host_port, self.mysql_backup_dir,
+            sync_command = "rsync -lr %s -e 'ssh -i %s -p %s'  %s %s %s@%s:%s" % (exclude_option, private_key, remote_host_port, self.mysql_backup_dir,
                                                                                self.ui_backup_dir, user, remote_host_ip, self.remote_backup_dir)
         (status, output, stderr) = shell_return_stdout_stderr(sync_command)
         if status != 0:
@@ -5068,8 +5145,31 @@ class DumpMysqlCmd(Command):
         else:
             append_sql_command = ""
 
-        cmd = ShellCmd("(%s; %s; %s %s) | gzip > %s" % (command_1, command_2, append_sql_command, command_3, db_backupf_file_path))
-        cmd(True)
+        streamed_file = None
+        if args.parallel:
+            # stream to the remote host only what rsync would have copied there
+            if args.host_info is not None and os.path.dirname(os.path.abspath(db_backupf_file_path)) == db_backup_dir.rstrip('/'):
+                streamed_file = os.path.basename(db_backupf_file_path)
+                self.make_remote_backup_dir(remote_host_user, private_key, remote_host_ip, remote_host_port)
+                sink = db_stream.DumpSink(db_backupf_file_path,
+                                          "ssh -i %s -p %s %s@%s" % (private_key, remote_host_port, remote_host_user, remote_host_ip),
+                                          os.path.join(self.remote_backup_dir, streamed_file))
+            else:
+                sink = db_stream.DumpSink(db_backupf_file_path)
+
+            commands = [command_1, command_2]
+            if append_sql_command:
+                commands.append(append_sql_command)
+            commands.append(command_3)
+            try:
+                db_stream.dump(commands, sink, workers=args.compress_threads)
+                sink.close()
+            except Exception as e:
+                sink.abort()
+                error("Failed to back up database: %s" % e)
+        else:
+            cmd = ShellCmd("(%s; %s; %s %s) | gzip > %s" % (command_1, command_2, append_sql_command, command_3, db_backupf_file_path))
+            cmd(True)
         info("Successfully backed up database. You can check the file at %s" % db_backupf_file_path)
 
         # remove old file
@@ -5081,7 +5181,7 @@ class DumpMysqlCmd(Command):
                     os.remove(db_backup_dir + expired_file)
         #remote backup
         if args.host_info is not None:
-            self.sync_local_backup_db_to_remote_host(args, remote_host_user, private_key, remote_host_ip, remote_host_port)
+            self.sync_local_backup_db_to_remote_host(args, remote_host_user, private_key, remote_host_ip, remote_host_port, exclude=streamed_file)
             if args.delete_expired_file is False:
                 info("Sync ZStack backup to remote host %s:%s successfully! " % (remote_host_ip, self.remote_backup_dir))
             else:
@@ -5189,6 +5289,12 @@ class RestoreMysqlCmd(Command):
                             action="store_true",
                             default=False)
 
+    def restore_from_backup(self, db_backup_name, loaders, definer_host):
+        try:
+            db_stream.restore(db_backup_name, loaders, definer_host)
+        except Exception as e:
+            error("Failed to restore database from %s: %s" % (db_backup_name, e))
+
     def test_mysql_connection(self, db_connect_password, db_port, db_hostname):
         command = "mysql -uroot %s -P %s  %s -e 'show databases'  >> /dev/null 2>&1" \
                       % (db_connect_password, db_port, db_hostname)
@@ -5249,17 +5355,15 @@ class RestoreMysqlCmd(Command):
         restorer.stop_node(args)
 
         info("Restoring database ...")
+        loaders = []
         for database in ['zstack', 'zstack_rest']:
             command = "mysql -uroot %s -P %s  %s -e 'drop database if exists %s; create database %s'  >> /dev/null 2>&1" \
                       % (db_connect_password, db_port, db_hostname, database, database)
             shell_no_pipe(command)
+            loaders.append("mysql -uroot %s %s -P %s --one-database %s" % (db_connect_password, db_hostname, db_port, database))
 
-            # modify DEFINER of view, trigger and so on
-            # from: /* ... */ /*!50017 DEFINER=`old_user`@`old_hostname`*/ /*...
-            # to:   /* ... */ /*!50017 DEFINER=`root`@`new_hostname`*/ /*...
-            command = "gunzip < %s | sed -e '/DROP DATABASE IF EXISTS/d' -e '/CREATE DATABASE .* IF NOT EXISTS/d' |sed 's/DEFINER=`[^\*\/]*`@`[^\*\/]*`/DEFINER=`root`@`%s`/' | mysql -uroot %s %s -P %s --one-database %s" \
-                  % (db_backup_name, db_hostname_origin_cp, db_connect_password, db_hostname, db_port, database)
-            shell_no_pipe(command)
+        # decompress the backup once and load both databases from it concurrently
+        self.restore_from_backup(db_backup_name, loaders, db_hostname_origin_cp)
 
         restorer.restore_other_node(args)
         if args.skip_ui:
@@ -5275,9 +5379,9 @@ class RestoreMysqlCmd(Command):
         command = "mysql -uroot %s -P %s  %s -e 'drop database if exists zstack_ui; create database zstack_ui' >> /dev/null 2>&1" \
                   % (ui_db_connect_password, db_port, ui_db_hostname)
         shell_no_pipe(command)
-        command = "gunzip < %s | sed -e '/DROP DATABASE IF EXISTS/d' -e '/CREATE DATABASE .* IF NOT EXISTS/d' |sed 's/DEFINER=`[^\*\/]*`@`[^\*\/]*`/DEFINER=`root`@`%s`/' | mysql -uroot %s %s -P %s --one-database zstack_ui" \
-              % (db_backup_name, ui_db_hostname_origin_cp, ui_db_connect_password, ui_db_hostname, ui_db_port)
-        shell_no_pipe(command)
+        self.restore_from_backup(db_backup_name,
+                                 ["mysql -uroot %s %s -P %s --one-database zstack_ui" % (ui_db_connect_password, ui_db_hostname, ui_db_port)],
+                                 ui_db_hostname_origin_cp)
 
         info("Successfully restored database. You can start node by running zstack-ctl start.")
 
@@ -6217,6 +6321,7 @@ class ConfiguredCollectLogCmd(Command):
             detail_version = get_zstack_version(hostname, port, user, password)
         # collect_dir used to store the collect-log
         collect_dir = run_command_dir + '/collect-log-%s-%s/' % (detail_version, time_stamp)
+        import log_collector
         log_collector.CollectFromYml(ctl, collect_dir, detail_version, time_stamp, args)
 
 
@@ -9461,26 +9566,12 @@ class ResetAdminPasswordCmd(Command):
             return hashlib.sha512(new_password).hexdigest()
 
         sha512_pwd = get_sha512_pwd('password')
-        db_hostname, db_port, db_user, db_password = ctl.get_live_mysql_portal()
-        query = MySqlCommandLineQuery()
-        query.host = db_hostname
-        query.port = db_port
-        query.user = db_user
-        query.password = db_password
-        query.table = 'zstack'
-        query.sql = "update AccountVO set password='%s' where type='%s'" % (sha512_pwd, self.SYSTEM_ADMIN_TYPE)
-        query.query()
+        session = ctl.db_session()
+        session.query("update AccountVO set password=%s where type=%s", (sha512_pwd, self.SYSTEM_ADMIN_TYPE))
 
         def reset_privilege_admin(origin_password, initial_uuid):
             sha512_pwd = get_sha512_pwd(origin_password)
-            query = MySqlCommandLineQuery()
-            query.host = db_hostname
-            query.port = db_port
-            query.user = db_user
-            query.password = db_password
-            query.table = 'zstack'
-            query.sql = "update IAM2VirtualIDVO set password='%s' where uuid='%s'" % (sha512_pwd, initial_uuid)
-            query.query()
+            session.query("update IAM2VirtualIDVO set password=%s where uuid=%s", (sha512_pwd, initial_uuid))
 
         identy_types = ctl.read_property('IDENTITY_INIT_TYPE')
         if identy_types and 'PRIVILEGE_ADMIN' in identy_types:
@@ -9673,15 +9764,7 @@ class SharedBlockQcow2SharedVolumeFixCmd(Command):
             self._update_format(volume["uuid"], "raw")
 
     def _run_sql(self, sql):
-        db_hostname, db_port, db_user, db_password = ctl.get_live_mysql_portal()
-        query = MySqlCommandLineQuery()
-        query.host = db_hostname
-        query.port = db_port
-        query.user = db_user
-        query.password = db_password
-        query.table = 'zstack'
-        query.sql = sql
-        return query.query()
+        return ctl.db_session().query(sql)
 
     def _deactivate_volume(self, volume, hosts):
         info("deactivating volume[uuid: %s, name: %s, installPath: %s] on hosts[%s]..." %
@@ -9814,83 +9897,104 @@ class SharedBlockQcow2SharedVolumeFixCmd(Command):
         sql = "update VolumeSnapshotTreeEO set VolumeSnapshotTreeEO.deleted=NOW() where VolumeSnapshotTreeEO.volumeUuid='%s'" % volumeUuid
         self._run_sql(sql)
 
-def main():
-    AddManagementNodeCmd()
-    BootstrapCmd()
-    ChangeIpCmd()
-    CollectLogCmd()
-    ConfigureCmd()
-    ConfiguredCollectLogCmd()
-    DumpMysqlCmd()
-    ChangeMysqlPasswordCmd()
-    DeployDBCmd()
-    DeployUIDBCmd()
-    GetEnvironmentVariableCmd()
-    InstallHACmd()
-    InstallDbCmd()
-    InstallRabbitCmd()
-    InstallManagementNodeCmd()
-    InstallLicenseCmd()
-    ClearLicenseCmd()
-    ShowConfiguration()
-    GetConfiguration()
-    SetEnvironmentVariableCmd()
-    SetDeploymentCmd()
-    PullDatabaseBackupCmd()
-    RollbackManagementNodeCmd()
-    RollbackDatabaseCmd()
-    ResetAdminPasswordCmd()
-    ResetRabbitCmd()
-    RestoreConfigCmd()
-    RestartNodeCmd()
-    RestoreMysqlPreCheckCmd()
-    RestoreMysqlCmd()
-    ZBoxBackupScanCmd()
-    ZBoxBackupRestoreCmd()
-    RecoverHACmd()
-    ScanDatabaseBackupCmd()
-    ShowStatusCmd()
-    StartCmd()
-    StopCmd()
-    SaveConfigCmd()
-    StartAllCmd()
-    StopAllCmd()
-    TailLogCmd()
-    UnsetEnvironmentVariableCmd()
-    UpgradeManagementNodeCmd()
-    UpgradeMultiManagementNodeCmd()
-    UpgradeDbCmd()
-    UpgradeUIDbCmd()
-    UpgradeCtlCmd()
-    UpgradeHACmd()
-    StartVDIUICmd()
-    StopVDIUiCmd()
-    VDIUiStatusCmd()
-    ShowSessionCmd()
-    DropSessionCmd()
-    CleanAnsibleCacheCmd()
-    GetZStackVersion()
-    SharedBlockQcow2SharedVolumeFixCmd()
-    MiniResetHostCmd()
-    RefreshAuditCmd()
-    MysqlProcessList()
-    MysqlRestrictConnection()
+# command name -> command class, a command is instantiated only when it is
+# run or when the full usage is printed
+COMMANDS = [
+    ('add_multi_management', AddManagementNodeCmd),
+    ('bootstrap', BootstrapCmd),
+    ('change_ip', ChangeIpCmd),
+    ('collect_log', CollectLogCmd),
+    ('configure', ConfigureCmd),
+    ('configured_collect_log', ConfiguredCollectLogCmd),
+    ('dump_mysql', DumpMysqlCmd),
+    ('change_mysql_password', ChangeMysqlPasswordCmd),
+    ('deploydb', DeployDBCmd),
+    ('deploy_ui_db', DeployUIDBCmd),
+    ('getenv', GetEnvironmentVariableCmd),
+    ('install_ha', InstallHACmd),
+    ('install_db', InstallDbCmd),
+    ('install_rabbitmq', InstallRabbitCmd),
+    ('install_management_node', InstallManagementNodeCmd),
+    ('install_license', InstallLicenseCmd),
+    ('clear_license', ClearLicenseCmd),
+    ('show_configuration', ShowConfiguration),
+    ('get_configuration', GetConfiguration),
+    ('setenv', SetEnvironmentVariableCmd),
+    ('set_deployment', SetDeploymentCmd),
+    ('pull_database_backup', PullDatabaseBackupCmd),
+    ('rollback_management_node', RollbackManagementNodeCmd),
+    ('rollback_db', RollbackDatabaseCmd),
+    ('reset_password', ResetAdminPasswordCmd),
+    ('reset_rabbitmq', ResetRabbitCmd),
+    ('restore_config', RestoreConfigCmd),
+    ('restart_node', RestartNodeCmd),
+    ('check_restore_mysql', RestoreMysqlPreCheckCmd),
+    ('restore_mysql', RestoreMysqlCmd),
+    ('scan_zbox_backup', ZBoxBackupScanCmd),
+    ('restore_zbox_backup', ZBoxBackupRestoreCmd),
+    ('recover_ha', RecoverHACmd),
+    ('scan_database_backup', ScanDatabaseBackupCmd),
+    ('status', ShowStatusCmd),
+    ('start_node', StartCmd),
+    ('stop_node', StopCmd),
+    ('save_config', SaveConfigCmd),
+    ('start', StartAllCmd),
+    ('stop', StopAllCmd),
+    ('taillog', TailLogCmd),
+    ('unsetenv', UnsetEnvironmentVariableCmd),
+    ('upgrade_management_node', UpgradeManagementNodeCmd),
+    ('upgrade_multi_management_node', UpgradeMultiManagementNodeCmd),
+    ('upgrade_db', UpgradeDbCmd),
+    ('upgrade_ui_db', UpgradeUIDbCmd),
+    ('upgrade_ctl', UpgradeCtlCmd),
+    ('upgrade_ha', UpgradeHACmd),
+    ('start_vdi', StartVDIUICmd),
+    ('stop_vdi', StopVDIUiCmd),
+    ('vdi_status', VDIUiStatusCmd),
+    ('show_session_list', ShowSessionCmd),
+    ('drop_account_session', DropSessionCmd),
+    ('clean_ansible_cache', CleanAnsibleCacheCmd),
+    ('get_version', GetZStackVersion),
+    ('fix_sharedvolume', SharedBlockQcow2SharedVolumeFixCmd),
+    ('reset_mini_host', MiniResetHostCmd),
+    ('refresh_audit', RefreshAuditCmd),
+    ('mysql_process_list', MysqlProcessList),
+    ('mysql_restrict_connection', MysqlRestrictConnection),
+]
+
+UI_COMMANDS = [
+    ('install_ui', InstallZstackUiCmd),
+    ('start_ui', StartUiCmd),
+    ('stop_ui', StopUiCmd),
+    ('ui_status', UiStatusCmd),
+    ('config_ui', ConfigUiCmd),
+    ('show_ui_config', ShowUiCfgCmd),
+]
+
+DASHBOARD_COMMANDS = [
+    ('install_ui', InstallDashboardCmd),
+    ('start_ui', StartDashboardCmd),
+    ('stop_ui', StopDashboardCmd),
+    ('ui_status', DashboardStatusCmd),
+]
+
+def register_commands():
+    for name, cmd_class in COMMANDS:
+        ctl.register_lazy_command(name, cmd_class)
 
     # If tools/zstack-ui.war exists, then install zstack-ui
     # else, install zstack-dashboard
     ctl.locate_zstack_home()
     if os.path.exists(ctl.zstack_home + "/WEB-INF/classes/tools/zstack-ui.war"):
-        InstallZstackUiCmd()
-        StartUiCmd()
-        StopUiCmd()
-        UiStatusCmd()
-        ConfigUiCmd()
-        ShowUiCfgCmd()
+        ui_commands = UI_COMMANDS
     else:
-        InstallDashboardCmd()
-        StartDashboardCmd()
-        StopDashboardCmd()
-        DashboardStatusCmd()
+        ui_commands = DASHBOARD_COMMANDS
+
+    for name, cmd_class in ui_commands:
+        ctl.register_lazy_command(name, cmd_class)
+
+def main():
+    register_commands()
 
     try:
         ctl.run()
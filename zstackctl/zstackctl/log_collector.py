@@ -6,7 +6,8 @@ import threading
 from zstacklib import *
 from utils import linux
 from utils import shell
-from utils.sql_query import MySqlCommandLineQuery
+from utils.bounded_pool import BoundedExecutor
+from utils.collect_archive import StreamingArchive, SshTarStreamer
 from termcolor import colored
 from datetime import datetime, timedelta
 
@@ -113,7 +114,6 @@ class CollectFromYml(object):
     logger_dir = '/var/log/zstack/'
     logger_file = 'zstack-ctl.log'
     vrouter_tmp_log_path = '/home'
-    threads = []
     local_type = 'local'
     host_type = 'host'
     check_lock = threading.Lock()
@@ -124,13 +124,16 @@ class CollectFromYml(object):
     check = False
     check_result = {}
     max_thread_num = 20
-    vrouter_task_list = []
     DEFAULT_ZSTACK_HOME = '/usr/local/zstack/apache-tomcat/webapps/zstack/'
     HA_KEEPALIVED_CONF = "/etc/keepalived/keepalived.conf"
     summary = Summary()
 
     def __init__(self, ctl, collect_dir, detail_version, time_stamp, args):
         self.ctl = ctl
+        self.ssh_info_cache = {}
+        self.tasks = []
+        self.archive = None
+        self.tar_streamer = SshTarStreamer()
         self.run(collect_dir, detail_version, time_stamp, args)
 
     def get_host_sql(self, suffix_sql):
@@ -347,120 +350,98 @@ class CollectFromYml(object):
         host_post_info.post_url = ""
         return host_post_info
 
+    # type -> query returning (ip, username, password, port) of the given ips
+    SSH_INFO_QUERIES = {
+        'host': "select h.managementIp as ip, k.username as username, k.password as password, k.port as port"
+                " from HostVO h, KVMHostVO k where h.uuid = k.uuid and h.managementIp in (%s)",
+        'sftp-bs': "select hostname as ip, username, password, sshPort as port"
+                   " from SftpBackupStorageVO where hostname in (%s)",
+        'ceph-bs': "select hostname as ip, sshUsername as username, sshPassword as password, sshPort as port"
+                   " from CephBackupStorageMonVO where hostname in (%s)",
+        'imageStore-bs': "select hostname as ip, username, password, sshPort as port"
+                         " from ImageStoreBackupStorageVO where hostname in (%s)",
+        'ceph-ps': "select hostname as ip, sshUsername as username, sshPassword as password, sshPort as port"
+                   " from CephPrimaryStorageMonVO where hostname in (%s)",
+        'pxeserver': "select hostname as ip, sshUsername as username, sshPassword as password, sshPort as port"
+                     " from BaremetalPxeServerVO where hostname in (%s)",
+    }
+    SSH_INFO_QUERIES['sharedblock'] = SSH_INFO_QUERIES['host']
+
+    def prefetch_host_ssh_info(self, host_list, type):
+        sql = self.SSH_INFO_QUERIES.get(type)
+        host_list = [ip for ip in host_list if ip and (type, ip) not in self.ssh_info_cache]
+        if sql is None or not host_list:
+            return
+
+        for r in self.ctl.db_session().query_in(sql, host_list):
+            self.ssh_info_cache[(type, r['ip'])] = (r['username'], r['password'], r['port'])
+
     def get_host_ssh_info(self, host_ip, type):
-        db_hostname, db_port, db_user, db_password = self.ctl.get_live_mysql_portal()
-        query = MySqlCommandLineQuery()
-        query.host = db_hostname
-        query.port = db_port
-        query.user = db_user
-        query.password = db_password
-        query.table = 'zstack'
-        if type == 'host' or type == 'sharedblock':
-            query.sql = "select * from HostVO where managementIp='%s'" % host_ip
-            host_uuid = query.query()[0]['uuid']
-            query.sql = "select * from KVMHostVO where uuid='%s'" % host_uuid
-            ssh_info = query.query()[0]
-            username = ssh_info['username']
-            password = ssh_info['password']
-            ssh_port = ssh_info['port']
-            return (username, password, ssh_port)
-        elif type == 'sftp-bs':
-            query.sql = "select * from SftpBackupStorageVO where hostname='%s'" % host_ip
-            ssh_info = query.query()[0]
-            username = ssh_info['username']
-            password = ssh_info['password']
-            ssh_port = ssh_info['sshPort']
-            return (username, password, ssh_port)
-        elif type == 'ceph-bs':
-            query.sql = "select * from CephBackupStorageMonVO where hostname='%s'" % host_ip
-            ssh_info = query.query()[0]
-            username = ssh_info['sshUsername']
-            password = ssh_info['sshPassword']
-            ssh_port = ssh_info['sshPort']
-            return (username, password, ssh_port)
-        elif type == 'imageStore-bs':
-            query.sql = "select * from ImageStoreBackupStorageVO where hostname='%s'" % host_ip
-            ssh_info = query.query()[0]
-            username = ssh_info['username']
-            password = ssh_info['password']
-            ssh_port = ssh_info['sshPort']
-            return (username, password, ssh_port)
-        elif type == "ceph-ps":
-            query.sql = "select * from CephPrimaryStorageMonVO where hostname='%s'" % host_ip
-            ssh_info = query.query()[0]
-            username = ssh_info['sshUsername']
-            password = ssh_info['sshPassword']
-            ssh_port = ssh_info['sshPort']
-            return (username, password, ssh_port)
+        if type in self.SSH_INFO_QUERIES:
+            self.prefetch_host_ssh_info([host_ip], type)
+            ssh_info = self.ssh_info_cache.get((type, host_ip))
+            if ssh_info is None:
+                raise CtlError('cannot find ssh info of %s %s in database' % (type, host_ip))
+            return ssh_info
         elif type == "vrouter":
-            query.sql = "select value from GlobalConfigVO where name='vrouter.password'"
-            password = query.query()
+            password = self.ctl.db_session().query("select value from GlobalConfigVO where name='vrouter.password'")
             username = "vyos"
             ssh_port = 22
             return (username, password, ssh_port)
-        elif type == "pxeserver":
-            query.sql = "select * from BaremetalPxeServerVO where hostname='%s'" % host_ip
-            ssh_info = query.query()[0]
-            username = ssh_info['sshUsername']
-            password = ssh_info['sshPassword']
-            ssh_port = ssh_info['sshPort']
-            return (username, password, ssh_port)
         else:
             warn("unknown target type: %s" % type)
 
-    def generate_tar_ball(self, run_command_dir, detail_version, time_stamp):
+    def generate_tar_ball(self, collect_dir):
         info_verbose("Compressing log files ...")
-        (status, output) = commands.getstatusoutput("cd %s && tar zcf collect-log-%s-%s.tar.gz collect-log-%s-%s"
-                                                    % (run_command_dir, detail_version, time_stamp, detail_version,
-                                                       time_stamp))
-        if status != 0:
-            error("Generate tarball failed: %s " % output)
-
-    def compress_and_fetch_log(self, local_collect_dir, tmp_log_dir, host_post_info, type):
-        command = "cd %s && tar zcf ../%s-collect-log.tar.gz . --ignore-failed-read --warning=no-file-changed || true" % (
-            tmp_log_dir, type)
-        run_remote_command(command, host_post_info)
-        fetch_arg = FetchArg()
-        fetch_arg.src = "%s../%s-collect-log.tar.gz " % (tmp_log_dir, type)
-        fetch_arg.dest = local_collect_dir
-        fetch_arg.args = "fail_on_missing=yes flat=yes"
-        fetch(fetch_arg, host_post_info)
-        command = "rm -rf %s../%s-collect-log.tar.gz %s" % (tmp_log_dir, type, tmp_log_dir)
-        run_remote_command(command, host_post_info)
-        (status, output) = commands.getstatusoutput(
-            "cd %s && tar zxf %s-collect-log.tar.gz" % (local_collect_dir, type))
-        if status != 0:
-            warn("Uncompress %s%s-collect-log.tar.gz meet problem: %s" % (local_collect_dir, type, output))
-
-        commands.getstatusoutput("rm -f %s%s-collect-log.tar.gz" % (local_collect_dir, type))
+        try:
+            # remote logs are in the archive already, add what is collected locally
+            self.archive.add_dir(collect_dir)
+            self.archive.close()
+        except Exception as e:
+            error("Generate tarball failed: %s " % e)
+
+    def stream_log(self, tmp_log_dir, host_post_info, type):
+        stream = self.tar_streamer.open(host_post_info, tmp_log_dir)
+        try:
+            self.archive.add_stream(stream.stdout, '%s-%s' % (type, host_post_info.host))
+        finally:
+            try:
+                stream.close()
+            finally:
+                run_remote_command(linux.rm_dir_force(tmp_log_dir, True), host_post_info)
 
     def add_collect_thread(self, type, params):
-        if "vrouter" in params:
-            self.vrouter_task_list.append(params)
-            return
-
         if type == self.host_type:
-            thread = threading.Thread(target=self.get_host_log, args=(params))
+            host_post_info, _, _, log_type = params
+            if log_type == "vrouter":
+                params = params + [self.vrouter_tmp_log_path]
+            self.tasks.append(('%s %s' % (log_type, host_post_info.host), self.get_host_log, params))
         elif type == self.local_type:
-            thread = threading.Thread(target=self.get_local_log, args=(params))
-        else:
-            return
-        thread.daemon = True
-        self.threads.append(thread)
+            self.tasks.append(('%s localhost' % params[2], self.get_local_log, params))
 
     def thread_run(self, timeout):
-        for t in self.threads:
-            t.start()
-            while True:
-                if len(threading.enumerate()) <= int(self.max_thread_num):
-                    break
-        for t in self.threads:
-            t.join(timeout)
+        executor = BoundedExecutor(self.max_thread_num, 'collect-log')
+        for name, fn, params in self.tasks:
+            executor.submit(name, fn, *params)
+
+        finished, timed_out = executor.wait(timeout)
+        executor.shutdown()
+        self.report_task_time(finished, timed_out)
+        return timed_out
+
+    def report_task_time(self, finished, timed_out):
+        if self.check:
+            return
 
-        if len(self.vrouter_task_list) > 0:
-            info_verbose("Start collecting vrouter log...")
-            for param in self.vrouter_task_list:
-                self.get_host_log(param[0], param[1], param[2], param[3], self.vrouter_tmp_log_path)
+        for task in sorted(finished, key=lambda t: t.elapsed(), reverse=True):
+            logger.info("collect log from %s took %.1fs" % (task.name, task.elapsed()))
+        for task in timed_out:
+            warn("collect log from %s timed out after %.1fs" % (task.name, task.elapsed()))
+            logger.warn("collect log from %s timed out after %.1fs" % (task.name, task.elapsed()))
+        if finished:
+            slowest = max(finished, key=lambda t: t.elapsed())
+            info_verbose("Collected log from %d target(s), the slowest is %s (%.1fs)" % (
+                len(finished), slowest.name, slowest.elapsed()))
 
     def get_mn_list(self):
         def find_value_from_conf(content, key, begin, end):
@@ -517,6 +498,7 @@ class CollectFromYml(object):
                         error_verbose('fail to exec %s' % host_list['exec'])
 
         host_list = list(set(host_list))
+        self.prefetch_host_ssh_info([ip for ip in host_list if ip != 'localhost' and ip != get_default_ip()], type)
         for host_ip in host_list:
             if host_ip is None or host_ip == '':
                 return
@@ -682,12 +664,8 @@ class CollectFromYml(object):
             else:
                 info_verbose("Collecting log from %s %s ..." % (type, host_post_info.host))
                 start = datetime.now()
-                local_collect_dir = collect_dir + '%s-%s/' % (type, host_post_info.host)
                 tmp_log_dir = "%s/%s-tmp-log/" % (tmp_path, type)
                 try:
-                    # file system broken shouldn't block collect log process
-                    if not os.path.exists(local_collect_dir):
-                        os.makedirs(local_collect_dir)
                     run_remote_command(linux.rm_dir_force(tmp_log_dir, True), host_post_info)
                     command = "mkdir -p %s " % tmp_log_dir
                     run_remote_command(command, host_post_info)
@@ -756,7 +734,7 @@ class CollectFromYml(object):
                     command = linux.rm_dir_force(tmp_log_dir, True)
                     run_remote_command(command, host_post_info)
                     return 0
-                self.compress_and_fetch_log(local_collect_dir, tmp_log_dir, host_post_info, type)
+                self.stream_log(tmp_log_dir, host_post_info, type)
                 info_verbose("Successfully collect log from %s %s!" % (type, host_post_info.host))
         else:
             warn("%s %s is unreachable!" % (type, host_post_info.host))
@@ -865,6 +843,9 @@ class CollectFromYml(object):
             self.max_thread_num = args.thread
 
         decode_result = self.decode_conf_yml(args)
+        if not args.check:
+            self.archive = StreamingArchive(os.path.join(run_command_dir, 'collect-log-%s-%s.tar.gz' % (
+                detail_version, time_stamp)), 'collect-log-%s-%s' % (detail_version, time_stamp))
 
         if decode_result['decode_error'] is not None:
             error_verbose(decode_result['decode_error'])
@@ -874,16 +855,15 @@ class CollectFromYml(object):
                 continue
             else:
                 self.collect_configure_log(value['list'], value['logs'], collect_dir, key)
-        self.thread_run(int(args.timeout))
+        timed_out = self.thread_run(int(args.timeout))
         if self.check:
             self.get_total_size()
         else:
             self.summary.persist(collect_dir)
-            if len(threading.enumerate()) > 1:
-                info_verbose("It seems that some collect log thread timeout, "
-                             "if compress failed, please use \'cd %s && tar zcf collect-log-%s-%s.tar.gz collect-log-%s-%s\' manually"
-                             % (run_command_dir, detail_version, time_stamp, detail_version, time_stamp))
-            self.generate_tar_ball(run_command_dir, detail_version, time_stamp)
+            if timed_out:
+                info_verbose("Logs of %s are not collected in %s seconds, they are left out of the tarball"
+                             % (', '.join(t.name for t in timed_out), args.timeout))
+            self.generate_tar_ball(collect_dir)
             if self.failed_flag is True:
                 info_verbose("The collect log generate at: %s.tar.gz,success %s,fail %s" % (
                     collect_dir, self.summary.success_count, self.summary.fail_count))
@@ -0,0 +1,106 @@
+import Queue
+import threading
+import time
+
+
+class Task(object):
+    def __init__(self, name, fn, args, kwargs):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.start_time = None
+        self.end_time = None
+        self.result = None
+        self.error = None
+        self.abandoned = False
+        self.started = threading.Event()
+        self.done = threading.Event()
+
+    def elapsed(self):
+        if self.start_time is None:
+            return 0
+        return (self.end_time or time.time()) - self.start_time
+
+    def run(self):
+        self.start_time = time.time()
+        self.started.set()
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except BaseException as e:
+            # SystemExit from error() must not kill the worker
+            self.error = e
+        finally:
+            self.end_time = time.time()
+            self.done.set()
+
+
+class BoundedExecutor(object):
+    '''
+    run tasks on at most `max_workers` daemon threads. Idle workers and
+    waiters block on a queue or an event, nothing polls.
+    '''
+
+    def __init__(self, max_workers, name='worker'):
+        self.max_workers = max(1, int(max_workers))
+        self.name = name
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.tasks = []
+        self._lock = threading.Lock()
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            task.run()
+            with self._lock:
+                if task.abandoned:
+                    # a replacement took this worker's place when the task timed out
+                    return
+
+    def _start_worker(self):
+        t = threading.Thread(target=self._work, name='%s-%d' % (self.name, len(self.workers)))
+        t.daemon = True
+        t.start()
+        self.workers.append(t)
+
+    def submit(self, name, fn, *args, **kwargs):
+        task = Task(name, fn, args, kwargs)
+        with self._lock:
+            self.tasks.append(task)
+            if len(self.workers) < min(self.max_workers, len(self.tasks)):
+                self._start_worker()
+        self.queue.put(task)
+        return task
+
+    def wait(self, timeout=None):
+        '''
+        wait for all tasks, giving up on a task `timeout` seconds after it
+        started. Return (finished, timed_out) task lists. A timed out task
+        keeps its thread until it returns by itself, a new worker takes over
+        the queue meanwhile.
+        '''
+        finished = []
+        timed_out = []
+        for task in list(self.tasks):
+            task.started.wait()
+            if timeout is None:
+                task.done.wait()
+            else:
+                task.done.wait(max(0, task.start_time + timeout - time.time()))
+
+            with self._lock:
+                if task.done.is_set():
+                    finished.append(task)
+                else:
+                    timed_out.append(task)
+                    task.abandoned = True
+                    self._start_worker()
+        return finished, timed_out
+
+    def shutdown(self):
+        with self._lock:
+            for _ in self.workers:
+                self.queue.put(None)
@@ -0,0 +1,138 @@
+import os
+import pipes
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+
+from shell import CtlError
+
+# members up to this size are spooled in memory, larger ones to a file
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+COPY_SIZE = 1024 * 1024
+SSH_CONNECT_TIMEOUT = 10
+# a remote host gone silent is given up after about a minute
+SSH_SERVER_ALIVE_INTERVAL = 15
+SSH_SERVER_ALIVE_COUNT_MAX = 4
+
+
+class StreamingArchive(object):
+    '''
+    the final tar.gz of collect_log. Tar streams of remote hosts are copied
+    into it member by member while they arrive. Each member is spooled
+    first, in memory unless it is large, so a slow host only holds the
+    archive while its spooled member is written. Streams of different hosts
+    interleave at member boundaries.
+    '''
+
+    def __init__(self, path, root_name):
+        self.path = path
+        self.root_name = root_name
+        self.tar = tarfile.open(path, 'w:gz')
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def _arcname(self, prefix, name):
+        name = os.path.normpath(name).lstrip('/')
+        if name == '.':
+            return '/'.join(p for p in (self.root_name, prefix) if p)
+        return '/'.join(p for p in (self.root_name, prefix, name) if p)
+
+    def add_stream(self, fileobj, prefix):
+        '''
+        copy the members of the tar stream `fileobj` (plain or compressed)
+        under `prefix`, return the number of members copied
+        '''
+        count = 0
+        src = tarfile.open(fileobj=fileobj, mode='r|*')
+        for member in src:
+            member.name = self._arcname(prefix, member.name)
+            if member.islnk():
+                member.linkname = self._arcname(prefix, member.linkname)
+            spool = None
+            try:
+                if member.isreg():
+                    spool = tempfile.SpooledTemporaryFile(SPOOL_MAX_MEMORY, dir=os.path.dirname(os.path.abspath(self.path)))
+                    shutil.copyfileobj(src.extractfile(member), spool, COPY_SIZE)
+                    spool.seek(0)
+
+                with self.lock:
+                    if self.closed:
+                        raise CtlError('archive %s is closed' % self.path)
+                    self.tar.addfile(member, spool)
+            finally:
+                if spool:
+                    spool.close()
+            count += 1
+        return count
+
+    def add_dir(self, local_dir, prefix=None):
+        with self.lock:
+            if self.closed:
+                raise CtlError('archive %s is closed' % self.path)
+            self.tar.add(local_dir, arcname=self._arcname(prefix, '.'))
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.tar.close()
+
+
+class SshTarStreamer(object):
+    '''
+    open a tar.gz stream of a remote directory over ssh
+    '''
+
+    TAR_COMMAND = "tar czf - -C %s . --ignore-failed-read --warning=no-file-changed"
+
+    def open(self, host_post_info, remote_dir):
+        remote_command = self.TAR_COMMAND % pipes.quote(remote_dir)
+        password = None
+        if host_post_info.become:
+            # the collected files belong to root
+            remote_command = "sudo -S -p '' %s" % remote_command
+            password = host_post_info.remote_pass
+
+        ssh = "ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o BatchMode=%s -p %s" \
+              " -o ConnectTimeout=%d -o ServerAliveInterval=%d -o ServerAliveCountMax=%d" % (
+                  'no' if host_post_info.remote_pass else 'yes', host_post_info.remote_port or 22,
+                  SSH_CONNECT_TIMEOUT, SSH_SERVER_ALIVE_INTERVAL, SSH_SERVER_ALIVE_COUNT_MAX)
+        if host_post_info.private_key:
+            ssh += " -i %s" % host_post_info.private_key
+        env = dict(os.environ)
+        if host_post_info.remote_pass:
+            # by environment, so the password does not show up in ps
+            ssh = "sshpass -e %s" % ssh
+            env['SSHPASS'] = host_post_info.remote_pass
+
+        command = "%s %s@%s %s" % (ssh, host_post_info.remote_user, host_post_info.host, pipes.quote(remote_command))
+        stderr = tempfile.TemporaryFile()
+        p = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr,
+                             close_fds=True, executable='/bin/bash', env=env)
+        if password:
+            p.stdin.write(password + '\n')
+        p.stdin.close()
+        return TarStream(p, stderr, command)
+
+
+class TarStream(object):
+    def __init__(self, process, stderr, command):
+        self.process = process
+        self.stdout = process.stdout
+        self.stderr = stderr
+        self.command = command
+
+    def close(self):
+        '''
+        raise CtlError if the remote tar failed
+        '''
+        self.stdout.close()
+        try:
+            if self.process.wait() != 0:
+                self.stderr.seek(0)
+                raise CtlError('failed to stream logs by %s, return code: %s, stderr: %s' % (
+                    self.command, self.process.returncode, self.stderr.read()))
+        finally:
+            self.stderr.close()
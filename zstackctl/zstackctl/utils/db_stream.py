@@ -0,0 +1,351 @@
+'''
+
+streaming database dump and restore.
+
+dumps run concurrently and are compressed in blocks by a thread pool; every
+block is an independent gzip member, so the output is still a plain .gz file
+that gunzip reads. zlib releases the GIL while compressing, the threads really
+run in parallel.
+'''
+import collections
+import multiprocessing
+import os
+import Queue
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from shell import CtlError
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+READ_SIZE = 256 * 1024
+# blocks of READ_SIZE waiting for each restore loader
+LOADER_QUEUE_SIZE = 16
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# drop the database statements and rebind DEFINER of views, triggers and so
+# on to the user doing the restore, like
+# from: /* ... */ /*!50017 DEFINER=`old_user`@`old_hostname`*/ /*...
+# to:   /* ... */ /*!50017 DEFINER=`root`@`new_hostname`*/ /*...
+DROP_LINE_PATTERNS = [re.compile(r'DROP DATABASE IF EXISTS'), re.compile(r'CREATE DATABASE .* IF NOT EXISTS')]
+DEFINER_PATTERN = re.compile(r'DEFINER=`[^*/]*`@`[^*/]*`')
+
+
+def default_workers():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _compress_block(data, level):
+    c = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return c.compress(data) + c.flush()
+
+
+class ParallelGzipWriter(object):
+    '''
+    file-like object compressing what is written to `fileobj` as a sequence
+    of gzip members. At most 2 * workers blocks are in flight, so memory use
+    does not depend on the size of the dump.
+    '''
+
+    def __init__(self, fileobj, pool, workers, level=6, block_size=DEFAULT_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.pool = pool
+        self.max_in_flight = max(1, workers) * 2
+        self.level = level
+        self.block_size = block_size
+        self.in_flight = collections.deque()
+        self.buf = []
+        self.buf_size = 0
+        self.raw_size = 0
+        self.compressed_size = 0
+
+    def _submit(self):
+        if not self.buf_size:
+            return
+
+        data = ''.join(self.buf)
+        self.buf = []
+        self.buf_size = 0
+        self.in_flight.append(self.pool.apply_async(_compress_block, (data, self.level)))
+        while len(self.in_flight) >= self.max_in_flight:
+            self._write_oldest()
+
+    def _write_oldest(self):
+        data = self.in_flight.popleft().get()
+        self.fileobj.write(data)
+        self.compressed_size += len(data)
+
+    def write(self, data):
+        self.raw_size += len(data)
+        self.buf.append(data)
+        self.buf_size += len(data)
+        if self.buf_size >= self.block_size:
+            self._submit()
+
+    def close(self):
+        self._submit()
+        while self.in_flight:
+            self._write_oldest()
+        self.fileobj.flush()
+
+
+class DumpSink(object):
+    '''
+    the local backup file, and optionally the same bytes streamed over ssh
+    into `remote_path` while the local file is written, instead of copying
+    the file after the dump is done
+    '''
+
+    def __init__(self, local_path, remote_command=None, remote_path=None):
+        self.local_path = local_path
+        self.remote_command = remote_command
+        self.remote_path = remote_path
+        self.local = open(local_path + '.tmp', 'wb')
+        self.size = 0
+        self.remote = None
+        if remote_command:
+            # a broken connection ends the stream as a finished dump does, so
+            # the file is renamed by close() in another step, after the dump
+            # succeeded and the size on the remote is checked
+            self.remote = self._remote("cat > '%s.tmp'" % remote_path, stdin=subprocess.PIPE)
+
+    def _remote(self, command, stdin=None):
+        return subprocess.Popen("%s \"%s\"" % (self.remote_command, command), shell=True, stdin=stdin,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True,
+                                executable='/bin/bash')
+
+    def write(self, data):
+        self.local.write(data)
+        self.size += len(data)
+        if self.remote:
+            self.remote.stdin.write(data)
+
+    def flush(self):
+        self.local.flush()
+
+    def close(self):
+        self.local.close()
+        os.rename(self.local_path + '.tmp', self.local_path)
+        if self.remote:
+            _, err = self.remote.communicate()
+            if self.remote.returncode != 0:
+                raise CtlError('failed to stream backup to remote %s: %s' % (self.remote_path, err))
+
+            p = self._remote("test \\$(wc -c < '%s.tmp') -eq %d && mv -f '%s.tmp' '%s'" %
+                             (self.remote_path, self.size, self.remote_path, self.remote_path))
+            _, err = p.communicate()
+            if p.returncode != 0:
+                raise CtlError('backup streamed to remote %s.tmp is not %d bytes, it is not published: %s' %
+                               (self.remote_path, self.size, err))
+
+    def abort(self):
+        self.local.close()
+        if os.path.exists(self.local_path + '.tmp'):
+            os.remove(self.local_path + '.tmp')
+        if self.remote:
+            if self.remote.poll() is None:
+                self.remote.kill()
+            self.remote.wait()
+            self._remote("rm -f '%s.tmp'" % self.remote_path).communicate()
+
+
+class _Producer(threading.Thread):
+    def __init__(self, command, writer):
+        super(_Producer, self).__init__(name='dump-producer')
+        self.daemon = True
+        self.command = command
+        self.writer = writer
+        self.error = None
+
+    def run(self):
+        p = None
+        try:
+            p = subprocess.Popen(self.command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 close_fds=True, executable='/bin/bash')
+            # keep the stderr pipe from filling up
+            err = []
+            t = threading.Thread(target=lambda: err.append(p.stderr.read()))
+            t.daemon = True
+            t.start()
+
+            while True:
+                data = p.stdout.read(READ_SIZE)
+                if not data:
+                    break
+                self.writer.write(data)
+            self.writer.close()
+
+            t.join()
+            if p.wait() != 0:
+                self.error = 'failed to execute shell command: %s\nreturn code: %s\nstderr: %s' % (
+                    self.command, p.returncode, ''.join(err))
+        except Exception as e:
+            self.error = str(e)
+            # nobody reads the dump any more, it would block on a full pipe
+            if p is not None and p.poll() is None:
+                p.kill()
+        finally:
+            if p is not None:
+                p.stdout.close()
+                p.wait()
+
+
+def dump(commands, sink, workers=None, level=6, block_size=DEFAULT_BLOCK_SIZE):
+    '''
+    run the dump `commands` concurrently, write their output compressed to
+    `sink` in the order of `commands`. The output of the first one goes to
+    the sink directly, the others are spooled compressed until it is their
+    turn. Return the number of uncompressed bytes dumped.
+    '''
+    workers = workers or default_workers()
+    pool = ThreadPool(workers)
+    spools = []
+    producers = []
+    try:
+        for i, command in enumerate(commands):
+            if i == 0:
+                out = sink
+            else:
+                out = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(sink.local_path))
+                                             if isinstance(sink, DumpSink) else None)
+                spools.append(out)
+            producers.append(_Producer(command, ParallelGzipWriter(out, pool, workers, level, block_size)))
+
+        for p in producers:
+            p.start()
+
+        for p in producers:
+            p.join()
+
+        errors = [p.error for p in producers if p.error]
+        if errors:
+            raise CtlError('\n'.join(errors))
+
+        for s in spools:
+            s.seek(0)
+            shutil.copyfileobj(s, sink, READ_SIZE)
+        return sum(p.writer.raw_size for p in producers)
+    finally:
+        for s in spools:
+            s.close()
+        pool.close()
+        pool.join()
+
+
+def rewrite_for_restore(line, definer_host):
+    if 'DATABASE' in line:
+        for p in DROP_LINE_PATTERNS:
+            if p.search(line):
+                return None
+    if 'DEFINER=' in line:
+        line = DEFINER_PATTERN.sub('DEFINER=`root`@`%s`' % definer_host, line, 1)
+    return line
+
+
+def rewrite_block_for_restore(block, definer_host):
+    '''
+    rewrite_for_restore() on every line of `block`, which ends with a newline.
+    Blocks without the statements to rewrite, nearly all, are passed as is
+    '''
+    if 'DATABASE' not in block and 'DEFINER=' not in block:
+        return block
+    lines = (rewrite_for_restore(l, definer_host) for l in block.splitlines(True))
+    return ''.join(l for l in lines if l is not None)
+
+
+class _Loader(threading.Thread):
+    '''
+    a loader command fed from its own queue, so a slow loader does not hold
+    up writing to the others
+    '''
+
+    def __init__(self, command):
+        super(_Loader, self).__init__(name='restore-loader')
+        self.daemon = True
+        self.command = command
+        self.process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, close_fds=True,
+                                        executable='/bin/bash')
+        self.queue = Queue.Queue(LOADER_QUEUE_SIZE)
+        self.error = None
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error:
+                continue
+            try:
+                self.process.stdin.write(data)
+            except IOError as e:
+                # the loader exited early, its return code tells why
+                self.error = e
+
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+
+
+def restore(backup_file, loaders, definer_host, decompress='gunzip -c'):
+    '''
+    decompress `backup_file` once and feed it to every loader command
+    concurrently, e.g. a `mysql --one-database` per database. Decompressing,
+    rewriting and loading run as a pipeline, in blocks of whole lines.
+    '''
+    source = subprocess.Popen("%s < '%s'" % (decompress, backup_file), shell=True, stdout=subprocess.PIPE,
+                              close_fds=True, executable='/bin/bash')
+    sinks = [_Loader(l) for l in loaders]
+    for s in sinks:
+        s.start()
+
+    def feed(block):
+        block = rewrite_block_for_restore(block, definer_host)
+        for s in sinks:
+            s.queue.put(block)
+
+    broken = None
+    try:
+        pending = ''
+        while True:
+            broken = next((s.error for s in sinks if s.error), None)
+            if broken:
+                source.kill()
+                break
+
+            data = source.stdout.read(READ_SIZE)
+            if not data:
+                if pending:
+                    feed(pending)
+                break
+
+            data = pending + data
+            end = data.rfind('\n') + 1
+            pending = data[end:]
+            if end:
+                feed(data[:end])
+    finally:
+        for s in sinks:
+            s.queue.put(None)
+        for s in sinks:
+            s.join()
+        source.stdout.close()
+
+    broken = broken or next((s.error for s in sinks if s.error), None)
+    errors = []
+    if source.wait() != 0 and not broken:
+        errors.append('failed to decompress %s' % backup_file)
+    for s in sinks:
+        if s.process.wait() != 0:
+            errors.append('failed to execute shell command: %s, return code: %s' % (s.command, s.process.returncode))
+    if broken and not errors:
+        errors.append(str(broken))
+    if errors:
+        raise CtlError('\n'.join(errors))
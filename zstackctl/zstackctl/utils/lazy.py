@@ -0,0 +1,20 @@
+import importlib
+
+
+class LazyModule(object):
+    '''
+    a module imported on the first attribute access, for heavy modules only
+    a few commands need, so they are not paid by every zstack-ctl start
+    '''
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
@@ -1,3 +1,5 @@
+import threading
+
 from shell import ShellCmd
 
 
@@ -53,4 +55,134 @@ class MySqlCommandLineQuery(object):
         if current:
             ret.append(current)
 
-        return ret
\ No newline at end of file
+        return ret
+
+def _escape_literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, long, float)):
+        return str(value)
+    # backslashes first, or the escaped quotes would be escaped again
+    value = str(value).replace('\\', '\\\\').replace("'", "\\'")
+    # the sql is passed to the mysql cli inside double quotes, where the
+    # shell takes one level of backslashes off again
+    value = value.replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$').replace('`', '\\`')
+    return "'%s'" % value
+
+
+def find_mysql_connector():
+    '''
+    return a function opening a DB-API connection, or None if no mysql driver
+    is installed and queries have to go through the mysql cli
+    '''
+    try:
+        import MySQLdb
+
+        def connect(host, port, user, password, database):
+            return MySQLdb.connect(host=host, port=port, user=user, passwd=password, db=database, charset='utf8')
+        return connect
+    except ImportError:
+        pass
+
+    try:
+        import pymysql
+
+        def connect(host, port, user, password, database):
+            return pymysql.connect(host=host, port=port, user=user, password=password, database=database, charset='utf8')
+        return connect
+    except ImportError:
+        return None
+
+
+class QuerySession(object):
+    '''
+    run the queries of one zstack-ctl command over a single connection.
+    rows are returned as dicts of typed values when a mysql driver is
+    available; otherwise every query forks the mysql cli, as
+    MySqlCommandLineQuery does, and values are strings.
+
+    sql uses %s placeholders for params, like MySQLdb does.
+    '''
+
+    # values per `in (...)` list of a batched lookup
+    BATCH_SIZE = 500
+
+    def __init__(self, host, port, user, password, database='zstack', connect=find_mysql_connector):
+        self.host = host
+        self.port = int(port)
+        self.user = user
+        self.password = password
+        self.database = database
+        self.connect = connect() if connect is find_mysql_connector else connect
+        self.connections = 0
+        self.queries = 0
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = self.connect(self.host, self.port, self.user, self.password or '', self.database)
+            self.connections += 1
+        return self._conn
+
+    def _cli_query(self, sql, params):
+        if params:
+            sql = sql % tuple(_escape_literal(p) for p in params)
+
+        self.connections += 1
+        query = MySqlCommandLineQuery()
+        query.host = self.host
+        query.port = self.port
+        query.user = self.user
+        query.password = self.password
+        query.table = self.database
+        query.sql = sql
+        return query.query()
+
+    def query(self, sql, params=None):
+        with self._lock:
+            self.queries += 1
+            if self.connect is None:
+                return self._cli_query(sql, params)
+
+            conn = self._connection()
+            cursor = conn.cursor()
+            try:
+                if params:
+                    cursor.execute(sql, tuple(params))
+                else:
+                    cursor.execute(sql)
+
+                rows = []
+                if cursor.description is not None:
+                    names = [d[0] for d in cursor.description]
+                    rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+                # end the transaction a select opens too, the session lives as
+                # long as the command, the REPEATABLE READ snapshot must not
+                conn.commit()
+                return rows
+            finally:
+                cursor.close()
+
+    def query_one(self, sql, params=None):
+        rows = self.query(sql, params)
+        return rows[0] if rows else None
+
+    def query_in(self, sql, values, params=None):
+        '''
+        run `sql` with its `in (%s)` list filled by batches of `values`, e.g.
+        query_in("select * from HostVO where managementIp in (%s)", ips)
+        '''
+        values = list(values)
+        ret = []
+        for i in xrange(0, len(values), self.BATCH_SIZE):
+            batch = values[i:i + self.BATCH_SIZE]
+            placeholders = ','.join(['%s'] * len(batch))
+            ret.extend(self.query(sql.replace('(%s)', '(%s)' % placeholders, 1), list(params or []) + batch))
+        return ret
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -3,8 +3,6 @@
 import pprint
 import traceback
 
-import ansible.runner
-import ansible.constants
 import os
 import sys
 import urllib2
@@ -15,9 +13,11 @@ import json
 from logging.handlers import TimedRotatingFileHandler
 import time
 import functools
-import jinja2
 import commands
 import re
+from utils.lazy import LazyModule
+
+jinja2 = LazyModule('jinja2')
 
 # set global default value
 start_time = datetime.now()
@@ -28,13 +28,21 @@ host = ""
 pkg_zstacklib = ""
 yum_server = ""
 trusted_host = ""
-ansible.constants.HOST_KEY_CHECKING = False
 
 RPM_BASED_OS = ["centos", "redhat", "alibaba", "kylin10"]
 DEB_BASED_OS = ["ubuntu", "kylin4.0.2", "uos", "debian", "uniontech"]
 DISTRO_WITH_RPM_DEB = ["kylin"]
 
 
+def import_ansible():
+    # importing ansible costs hundreds of milliseconds, only do it when a
+    # runner is really needed instead of on every zstack-ctl start
+    import ansible.runner
+    import ansible.constants
+    ansible.constants.HOST_KEY_CHECKING = False
+    return ansible
+
+
 def ignoreerror(func):
     @functools.wraps(func)
     def wrap(*args, **kwargs):
@@ -179,6 +187,7 @@ class ZstackRunner(object):
         self.become_pass = runner_args.host_post_info.remote_pass
 
     def run(self):
+        ansible = import_ansible()
         runner = ansible.runner.Runner(
             host_list=self.host_inventory,
             private_key_file=self.private_key,
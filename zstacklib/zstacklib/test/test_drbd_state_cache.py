@@ -0,0 +1,243 @@
+'''
+
+drbd resource state from a recorded events2 stream of 500 resources, read
+with no drbdadm process, and kept by the following stream and by refreshes
+after changes made here
+'''
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+from zstacklib.utils import drbd
+
+FAKE_DRBDSETUP = '''#!%(python)s
+import os, sys, time
+d = os.environ['FAKE_DRBD_DIR']
+args = sys.argv[1:]
+with open(os.path.join(d, 'drbdsetup.log'), 'a') as f:
+    f.write(' '.join(args) + '\\n')
+with open(os.path.join(d, 'events2')) as f:
+    snapshot = f.read().splitlines()
+if '--now' in args:
+    for l in snapshot:
+        if args[-1] == 'all' or 'name:%%s ' %% args[-1] in l + ' ':
+            print l
+    print 'exists -'
+    sys.exit(0)
+
+for l in snapshot:
+    print l
+print 'exists -'
+sys.stdout.flush()
+pos = 0
+while True:
+    with open(os.path.join(d, 'changes')) as f:
+        f.seek(pos)
+        data = f.read()
+    data = data[:data.rfind('\\n') + 1]
+    if data:
+        sys.stdout.write(data)
+        sys.stdout.flush()
+        pos += len(data)
+    time.sleep(0.01)
+'''
+
+FAKE_DRBDADM = '''#!/bin/sh
+echo "$@" >> $FAKE_DRBD_DIR/drbdadm.log
+case $1 in
+    role) echo Secondary/Secondary ;;
+    cstate) echo Connected ;;
+    dstate) echo UpToDate/UpToDate ;;
+esac
+'''
+
+CONFIG = '''resource %(name)s {
+  net {
+    protocol C;
+  }
+
+  on host-1 {  # local
+    device    /dev/drbd_%(name)s minor %(minor)d;
+    disk      /dev/vg/%(name)s;
+    address   10.0.0.1:%(port)d;
+    meta-disk internal;
+  }
+  on host-2 {  # remote
+    device    /dev/drbd_%(name)s minor %(minor)d;
+    disk      /dev/vg/%(name)s;
+    address   10.0.0.2:%(port)d;
+    meta-disk internal;
+  }
+}
+'''
+
+
+def events2(name, minor, role='Secondary', connection='Connected', disk='UpToDate', peer_disk='UpToDate'):
+    return [
+        'exists resource name:%s role:%s suspended:no write-ordering:flush' % (name, role),
+        'exists connection name:%s peer-node-id:1 conn-name:host-2 connection:%s role:Secondary' % (name, connection),
+        'exists device name:%s volume:0 minor:%d disk:%s client:no' % (name, minor, disk),
+        'exists peer-device name:%s peer-node-id:1 conn-name:host-2 volume:0 replication:Established '
+        'peer-disk:%s peer-client:no resync-suspended:no' % (name, peer_disk),
+    ]
+
+
+class TestDrbdStateCache(unittest.TestCase):
+    COUNT = 500
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config_dir = os.path.join(self.dir, 'drbd.d')
+        os.mkdir(self.config_dir)
+        for name, script in (('drbdsetup', FAKE_DRBDSETUP % {'python': sys.executable}),
+                             ('drbdadm', FAKE_DRBDADM)):
+            path = os.path.join(self.dir, name)
+            with open(path, 'w') as fd:
+                fd.write(script)
+            os.chmod(path, stat.S_IRWXU)
+
+        self.names = ['res-%d' % i for i in range(self.COUNT)]
+        lines = []
+        for i, name in enumerate(self.names):
+            with open(os.path.join(self.config_dir, '%s.res' % name), 'w') as fd:
+                fd.write(CONFIG % {'name': name, 'minor': i, 'port': 20000 + i})
+            # the odd ones are up
+            if i % 2:
+                lines += events2(name, i, role='Primary' if i % 3 == 0 else 'Secondary')
+        self._write('events2', lines)
+        self._write('changes', [])
+
+        self.saved_env = dict(os.environ)
+        os.environ['PATH'] = '%s:%s' % (self.dir, os.environ['PATH'])
+        os.environ['FAKE_DRBD_DIR'] = self.dir
+
+        self.saved = drbd._config_index, drbd._state_cache
+        drbd._config_index = drbd.DrbdConfigIndex(self.config_dir)
+        drbd._state_cache = self.cache = drbd.DrbdStateCache()
+        self.cache.RESTART_INTERVAL = 0.05
+
+    def tearDown(self):
+        self.cache.stop()
+        drbd._config_index, drbd._state_cache = self.saved
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, lines, mode='w'):
+        with open(os.path.join(self.dir, name), mode) as fd:
+            fd.write(''.join(l + '\n' for l in lines))
+
+    def _log(self, name):
+        path = os.path.join(self.dir, '%s.log' % name)
+        if not os.path.exists(path):
+            return []
+        with open(path) as fd:
+            return fd.read().splitlines()
+
+    def _wait(self, cond, timeout=10):
+        deadline = time.time() + timeout
+        while not cond():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def _ready(self):
+        self._wait(lambda: drbd.get_state_cache() is not None)
+
+    def test_lookups_without_forks(self):
+        self._ready()
+        resources = [drbd.DrbdResource(name, up=False) for name in self.names]
+
+        start = time.time()
+        for i, r in enumerate(resources):
+            allocated = r.minor_allocated()
+            self.assertEqual(bool(i % 2), allocated)
+            self.assertEqual('Connected' if i % 2 else 'Unconfigured', r.get_cstate())
+            if allocated:
+                self.assertEqual('Primary' if i % 3 == 0 else 'Secondary', r.get_role())
+                self.assertEqual('UpToDate', r.get_dstate())
+                self.assertEqual('Secondary', r.get_remote_role())
+                self.assertEqual('UpToDate', r.get_remote_dstate())
+        cached = time.time() - start
+        self.assertEqual([], self._log('drbdadm'))
+        self.assertEqual(['events2 all'], self._log('drbdsetup'))
+
+        # the same queries through drbdadm
+        drbd._state_cache = drbd.DrbdStateCache()
+        drbd._state_cache.running = True
+        start = time.time()
+        for r in resources[1:21:2]:
+            r.minor_allocated(), r.get_cstate(), r.get_role(), r.get_dstate(), r.get_remote_role(), r.get_remote_dstate()
+        forked = (time.time() - start) / 10
+        print '\n%d resources: %.1f us a resource from the cache, %.1f ms a resource through %d drbdadm calls' % (
+            self.COUNT, cached / self.COUNT * 1e6, forked * 1000, len(self._log('drbdadm')) / 10)
+
+    def test_config_index(self):
+        index = drbd.get_config_index()
+        config = index.get_by_minor(42)
+        self.assertEqual('res-42', config.name)
+        self.assertEqual('/dev/vg/res-42', config.local_host.disk)
+        self.assertIs(config, index.get_by_disk('/dev/vg/res-42'))
+        self.assertEqual(os.path.join(self.config_dir, 'res-42.res'),
+                         drbd.DrbdResource.get_config_path_from_name('res-42'))
+
+        # parsed again only when changed
+        os.remove(os.path.join(self.config_dir, 'res-1.res'))
+        with open(os.path.join(self.config_dir, 'res-2.res'), 'w') as fd:
+            fd.write(CONFIG % {'name': 'res-2', 'minor': 600, 'port': 20600})
+        index.invalidate()
+        self.assertIsNone(index.get('res-1'))
+        self.assertEqual('res-2', index.get_by_minor(600).name)
+        self.assertIsNone(index.get_by_minor(2))
+        self.assertIs(config, index.get_by_minor(42))
+        self.assertEqual([], self._log('drbdadm'))
+
+    def test_follow_stream(self):
+        self._ready()
+        r1, r3 = drbd.DrbdResource('res-1', up=False), drbd.DrbdResource('res-3', up=False)
+        self.assertEqual('Secondary', r1.get_role())
+        self._write('changes', [
+            'change resource name:res-1 role:Primary',
+            'change connection name:res-3 peer-node-id:1 conn-name:host-2 connection:Connecting',
+            'destroy peer-device name:res-3 peer-node-id:1 conn-name:host-2 volume:0',
+            'change device name:res-3 volume:0 minor:3 disk:Outdated',
+            'create resource name:res-2 role:Secondary suspended:no',
+            'create device name:res-2 volume:0 minor:2 disk:Inconsistent client:no',
+            'destroy resource name:res-5',
+        ], 'a')
+        self._wait(lambda: self.cache.get('res-5') is None)
+        self.assertEqual('Primary', r1.get_role())
+        self.assertEqual('Connecting', r3.get_cstate())
+        self.assertEqual('DUnknown', r3.get_remote_dstate())
+        self.assertEqual('Outdated', r3.get_dstate())
+        self.assertTrue(drbd.DrbdResource('res-2', up=False).minor_allocated())
+        self.assertFalse(drbd.DrbdResource('res-5', up=False).minor_allocated())
+
+        # a broken stream is restarted from a new snapshot, which has what
+        # changed meanwhile
+        self._write('events2', events2('res-1', 1, role='Secondary'))
+        self._write('changes', [])
+        self.cache.process.kill()
+        self._wait(lambda: len([l for l in self._log('drbdsetup') if l == 'events2 all']) == 2)
+        self._ready()
+        self.assertEqual('Secondary', r1.get_role())
+        self.assertFalse(r3.minor_allocated())
+
+    def test_refresh_after_change(self):
+        self._ready()
+        r = drbd.DrbdResource('res-7', up=False)
+        self.assertEqual('Secondary', r.get_role())
+        # the stream is late, the change made here is read at once
+        lines = events2('res-7', 7, role='Primary')
+        self._write('events2', lines)
+        r.promote()
+        self.assertEqual('Primary', r.get_role())
+        self.assertEqual(['primary res-7'], self._log('drbdadm'))
+        self.assertEqual(['events2 all', 'events2 --now res-7'], self._log('drbdsetup'))
+
+
+if __name__ == '__main__':
+    unittest.main()
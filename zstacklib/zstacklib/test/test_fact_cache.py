@@ -0,0 +1,99 @@
+'''
+
+test the boot scoped fact cache
+'''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from zstacklib.utils import fact_cache
+
+
+class TestFactCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.boot_id = os.path.join(self.tmp, 'boot_id')
+        self.binary = os.path.join(self.tmp, 'qemu-img')
+        self._write(self.boot_id, 'boot-1')
+        self._write(self.binary, '#!/bin/sh')
+        self.probes = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    @staticmethod
+    def _write(path, content):
+        with open(path, 'w') as fd:
+            fd.write(content)
+
+    def _probe(self):
+        self.probes += 1
+        return {'qemuImgVersion': '2.12.0', 'probe': self.probes}
+
+    def test_probe_once_per_boot(self):
+        cache = fact_cache.FactCache(self._probe, [self.binary], self.boot_id)
+        for _ in range(10):
+            self.assertEqual('2.12.0', cache.get()['qemuImgVersion'])
+        self.assertEqual(1, self.probes)
+        self.assertEqual(9, cache.hits)
+
+        self._write(self.boot_id, 'boot-2')
+        self.assertEqual(2, cache.get()['probe'])
+        self.assertEqual(2, self.probes)
+
+    def test_binary_upgrade_invalidates(self):
+        cache = fact_cache.FactCache(self._probe, [self.binary], self.boot_id)
+        cache.get()
+        st = os.stat(self.binary)
+        os.utime(self.binary, (st.st_atime, st.st_mtime + 10))
+        cache.get()
+        self.assertEqual(2, self.probes)
+
+        os.remove(self.binary)
+        cache.get()
+        cache.get()
+        self.assertEqual(3, self.probes)
+
+    def test_watched_contents(self):
+        online = os.path.join(self.tmp, 'online')
+        self._write(online, '0-3\n')
+        cache = fact_cache.FactCache(self._probe, [], self.boot_id, watched_contents=[online])
+        cache.get()
+        cache.get()
+        self.assertEqual(1, self.probes)
+
+        # a hotplugged cpu changes the value but not the mtime of the sysfs file
+        st = os.stat(online)
+        self._write(online, '0-7\n')
+        os.utime(online, (st.st_atime, st.st_mtime))
+        cache.get()
+        self.assertEqual(2, self.probes)
+
+    def test_returned_value_is_a_copy(self):
+        cache = fact_cache.FactCache(self._probe, [], self.boot_id)
+        cache.get()['qemuImgVersion'] = 'changed'
+        self.assertEqual('2.12.0', cache.get()['qemuImgVersion'])
+
+    def test_read_proc_files(self):
+        meminfo = os.path.join(self.tmp, 'meminfo')
+        self._write(meminfo, 'MemTotal:       16314664 kB\nMemFree:         1023212 kB\nHugePages_Total:       0\n')
+        info = fact_cache.read_meminfo(meminfo)
+        self.assertEqual(16314664 * 1024, info['MemTotal'])
+        self.assertEqual(0, info['HugePages_Total'])
+
+        cpuinfo = os.path.join(self.tmp, 'cpuinfo')
+        cpu = 'processor\t: %d\nmodel name\t: Intel(R) Xeon(R) CPU E5-2680 v4 @ 2.40GHz\ncpu MHz\t\t: 1200.000\n' \
+              'physical id\t: %d\nflags\t\t: fpu vmx ept\n\n'
+        self._write(cpuinfo, ''.join(cpu % (i, i / 2) for i in range(4)))
+        processors, sockets, flags, model, mhz = fact_cache.read_cpuinfo(cpuinfo)
+        self.assertEqual(4, processors)
+        self.assertEqual(2, sockets)
+        self.assertIn('ept', flags)
+        self.assertTrue(model.endswith('2.40GHz'))
+        self.assertEqual('1200.000', mhz)
+
+
+if __name__ == "__main__":
+    unittest.main()
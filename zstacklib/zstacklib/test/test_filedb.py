@@ -0,0 +1,106 @@
+'''
+
+journaled FileDB: recovery from torn tails, compaction and write latency
+'''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from zstacklib.utils import filedb
+
+
+class TestJournaledFileDB(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _open(self, **kwargs):
+        return filedb.JournaledFileDB(self.path, is_abs_path=True, **kwargs)
+
+    def test_reopen(self):
+        db = self._open()
+        db.set('a', 1)
+        db.set('b', {'x': [1, 2]})
+        db.set('a', 'one')
+        db.rem('b')
+        self.assertRaises(KeyError, db.rem, 'b')
+        db.close()
+
+        db = self._open()
+        self.assertEqual({'a': 'one'}, db.get_all())
+        self.assertIsNone(db.get('b'))
+        db.close()
+
+    def test_torn_tail(self):
+        db = self._open()
+        for i in range(10):
+            db.set('k%d' % i, 'v%d' % i)
+        db.close()
+        journal = self.path + filedb.JournaledFileDB.JOURNAL_SUFFIX
+        with open(journal, 'rb') as fd:
+            data = fd.read()
+        last = len(filedb.JournaledFileDB._encode('s', 'k9', 'v9'))
+
+        # a crash in the middle of any byte of the last record
+        for cut in range(1, last):
+            with open(journal, 'wb') as fd:
+                fd.write(data[:len(data) - cut])
+            db = self._open()
+            self.assertEqual(9, len(db.get_all()))
+            self.assertIsNone(db.get('k9'))
+            db.set('k9', 'again')
+            db.close()
+            self.assertEqual('again', self._open().get('k9'))
+
+        # garbage written over the tail
+        with open(journal, 'wb') as fd:
+            fd.write(data[:-3] + 'xyz')
+        db = self._open()
+        self.assertEqual(9, len(db.get_all()))
+        self.assertEqual(len(data) - last, os.path.getsize(journal))
+        db.close()
+
+    def test_import_pickledb(self):
+        with open(self.path, 'w') as fd:
+            fd.write('{"token": "info", "n": 3}')
+        db = self._open()
+        self.assertEqual({'token': 'info', 'n': 3}, db.get_all())
+        db.close()
+
+    def test_compaction(self):
+        db = self._open(compact_min_size=4096)
+        for i in range(20000):
+            db.set('k%d' % (i % 100), i)
+        db.close()
+        self.assertGreater(db.compactions, 0)
+        self.assertLess(db.size, 4096 * 3)
+
+        db = self._open()
+        self.assertEqual(dict(('k%d' % i, 19900 + i) for i in range(100)), db.get_all())
+        db.close()
+
+    def test_write_latency(self):
+        db = self._open()
+        samples = {}
+        keys = 0
+        for size in [1000, 10000, 100000, 1000000]:
+            while keys < size:
+                db.set('key-%d' % keys, 'value-%d' % keys)
+                keys += 1
+            start = time.time()
+            for i in range(1000):
+                db.set('key-%d' % i, 'new-%d' % i)
+            samples[size] = (time.time() - start) / 1000
+        db.close()
+
+        print '\n' + ', '.join('%d keys: %.1f us' % (k, samples[k] * 1e6) for k in sorted(samples))
+        self.assertLess(samples[1000000], samples[1000] * 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+'''
+
+http load test harness: fakes, percentiles and a run against a local
+HttpServer
+'''
+import threading
+import time
+import unittest
+
+import cherrypy
+import simplejson
+
+from zstacklib.utils import bash
+from zstacklib.utils import http
+from zstacklib.utils import http_loadtest
+from zstacklib.utils import shell
+
+
+class TestHarness(unittest.TestCase):
+    def test_percentiles(self):
+        p = http_loadtest.percentiles(range(1, 101))
+        self.assertEqual((50, 90, 99, 100, 100), (p['p50'], p['p90'], p['p99'], p['max'], p['count']))
+        self.assertEqual(7, http_loadtest.percentiles([7])['p99'])
+        self.assertIsNone(http_loadtest.percentiles([]))
+
+    def test_fake_shell(self):
+        fake = http_loadtest.FakeShell([('virsh list', 'vm1\n'), ('false', '', 1)], default_stdout='default')
+        with fake:
+            self.assertEqual('vm1\n', shell.call('virsh list --all'))
+            self.assertRaises(shell.ShellError, shell.call, 'false')
+            self.assertEqual((0, 'vm1\n'), bash.bash_ro('virsh list'))
+            self.assertEqual(1, bash.bash_r('false'))
+            self.assertEqual('default', bash.bash_o('ls /nowhere'))
+        self.assertEqual(5, fake.calls)
+        self.assertEqual(set(['ls /nowhere']), fake.unmatched)
+        self.assertEqual('real\n', shell.call('echo real'))
+
+    def test_fake_libvirt(self):
+        libvirt = http_loadtest.FakeLibvirt()
+        self.assertEqual(libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_RUNNING)
+        self.assertNotEqual(libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_SHUTOFF)
+        conn = libvirt.open('qemu:///system')
+        self.assertEqual([], conn.listAllDomains())
+        try:
+            conn.lookupByName('vm')
+            self.fail('no vm is running')
+        except libvirt.libvirtError as e:
+            self.assertEqual(libvirt.VIR_ERR_NO_DOMAIN, e.get_error_code())
+
+    def test_callback_server(self):
+        server = http_loadtest.CallbackServer().start()
+        try:
+            for i in range(3):
+                threading.Thread(target=http.json_post, args=(server.url, '{}', {http.TASK_UUID: str(i)})).start()
+            self.assertEqual(3, server.wait(3, 10))
+        finally:
+            server.stop()
+
+
+class FakeAgent(object):
+    SYNC_PATH = '/fake/echo'
+    ASYNC_PATH = '/fake/check'
+
+    def __init__(self):
+        self.http_server = http.HttpServer()
+        self.http_server.register_sync_uri(self.SYNC_PATH, self.echo)
+        self.http_server.register_async_uri(self.ASYNC_PATH, self.check)
+
+    def echo(self, req):
+        return ''
+
+    def check(self, req):
+        cmd = simplejson.loads(req[http.REQUEST_BODY])
+        return simplejson.dumps({'success': True, 'out': shell.call('check %s' % cmd['name'])})
+
+
+@unittest.skipUnless(hasattr(cherrypy.engine, 'timeout_monitor'), 'the CherryPy agents are built with')
+class TestLoadTest(unittest.TestCase):
+    def test_run(self):
+        mix = [{'uri': FakeAgent.SYNC_PATH, 'async': False},
+               {'uri': FakeAgent.ASYNC_PATH, 'body': {'name': 'disk'}, 'weight': 3}]
+        with http_loadtest.FakeShell([('check', 'ok', 0, 0.01)]) as fake:
+            test = http_loadtest.LoadTest(FakeAgent().http_server, mix, rate=200, count=400).start()
+            try:
+                report = test.run()
+            finally:
+                test.stop()
+
+        print '\n' + http_loadtest.format_report(report)
+        self.assertEqual(0, report['errors'])
+        self.assertEqual(0, report['missing_callbacks'])
+        self.assertEqual(100, report['latency'][FakeAgent.SYNC_PATH]['count'])
+        self.assertEqual(300, report['latency'][FakeAgent.ASYNC_PATH]['count'])
+        self.assertEqual(300, report['callback_delay']['count'])
+        self.assertEqual(300, fake.calls)
+        self.assertGreater(report['threads']['max'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,331 @@
+'''
+
+single pass import of qcow2 and raw streams into a file backed fake rbd,
+with qcow2 fixtures of several layouts built here, and the bytes written
+to the cluster against importing to a temporary image and converting it
+'''
+import json
+import os
+import random
+import shutil
+import stat
+import StringIO
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+import zlib
+
+from zstacklib.utils import image_import
+from zstacklib.utils import shell
+
+FAKE_RBD = '''#!%(python)s
+import os, sys, struct
+root = os.environ['FAKE_RBD_DIR']
+args = [a for a in sys.argv[1:] if a != '--no-progress']
+op, path = args[0], os.path.join(root, args[-1].replace('/', '_'))
+written = 0
+
+def write(fd, offset, data):
+    global written
+    for i in range(0, len(data), 4096):
+        block = data[i:i + 4096]
+        if block.strip('\\0'):
+            fd.seek(offset + i)
+            fd.write(block)
+            written += len(block)
+
+if op == 'create':
+    if os.path.exists(path):
+        sys.stderr.write('image exists\\n')
+        sys.exit(17)
+    with open(path, 'wb') as fd:
+        fd.truncate(int(args[args.index('--size') + 1]) * 1024 * 1024)
+elif op == 'rm':
+    os.remove(path)
+elif op == 'info':
+    sys.exit(0 if os.path.exists(path) else 2)
+elif op == 'import':
+    if os.path.exists(path):
+        sys.exit(17)
+    with open(path, 'wb') as fd:
+        pos = 0
+        while True:
+            data = sys.stdin.read(1024 * 1024)
+            if not data:
+                break
+            write(fd, pos, data)
+            pos += len(data)
+        fd.truncate(pos)
+elif op == 'import-diff':
+    assert sys.stdin.read(12) == 'rbd diff v1\\n'
+    with open(path, 'r+b') as fd:
+        while True:
+            tag = sys.stdin.read(1)
+            if tag == 's':
+                fd.truncate(struct.unpack('<Q', sys.stdin.read(8))[0])
+            elif tag == 'w':
+                offset, length = struct.unpack('<QQ', sys.stdin.read(16))
+                write(fd, offset, sys.stdin.read(length))
+            elif tag == 'e':
+                break
+            else:
+                sys.stderr.write('bad record %%r\\n' %% tag)
+                sys.exit(22)
+with open(os.path.join(root, 'log'), 'a') as fd:
+    fd.write('%%s %%d\\n' %% (op, written))
+'''
+
+
+def build_qcow2(path, size, clusters, cluster_bits=12, compressed=(), zero=(), layout='qemu', backing_file=None):
+    '''
+    `clusters` are the data of guest clusters by index, those in
+    `compressed` are stored compressed and those in `zero` are zero flagged.
+    The layout is the order of the metadata and data in the file
+    '''
+    cs = 1 << cluster_bits
+    l2_entries = cs / 8
+    l1_size = (size + cs * l2_entries - 1) / (cs * l2_entries)
+    l2s = sorted(set(g / l2_entries for g in list(clusters) + list(zero)))
+    blobs = {}
+    for g in compressed:
+        c = zlib.compressobj(6, zlib.DEFLATED, -12)
+        blobs[g] = c.compress(clusters[g]) + c.flush()
+
+    data_items = [('data', g) for g in sorted(clusters) if g not in compressed]
+    comp_items = [('comp', g) for g in sorted(compressed)]
+    l2_items = [('l2', i) for i in l2s]
+    l1_item = [('l1', None)]
+    if layout == 'qemu':
+        # an L2 table comes before the data it maps, compressed data is packed at the end
+        order = list(l1_item)
+        for i in l2s:
+            order.append(('l2', i))
+            order.extend(item for item in data_items if item[1] / l2_entries == i)
+        order.extend(comp_items)
+    elif layout == 'data_first':
+        order = data_items + comp_items + l2_items + l1_item
+    else:
+        order = l2_items + l1_item + comp_items + data_items
+
+    # cluster 0 is the header, 1 the refcount table, 2 a refcount block
+    end = 3 * cs
+    offsets = {}
+    for kind, key in order:
+        if kind == 'comp':
+            offsets[(kind, key)] = end
+            end += len(blobs[key])
+            continue
+        end = (end + cs - 1) / cs * cs
+        offsets[(kind, key)] = end
+        end += cs if kind != 'l1' else max(cs, (l1_size * 8 + cs - 1) / cs * cs)
+
+    img = bytearray(end)
+    backing = backing_file or ''
+    header = struct.pack('>4sIQIIQIIQQIIQQQQII', 'QFI\xfb', 3, 112 if backing else 0, len(backing), cluster_bits,
+                         size, 0, l1_size, offsets[('l1', None)], cs, 1, 0, 0, 0, 0, 0, 4, 104)
+    img[0:len(header)] = header
+    img[112:112 + len(backing)] = backing
+
+    l1 = [0] * l1_size
+    for i in l2s:
+        l1[i] = offsets[('l2', i)] | (1 << 63)
+    l1_offset = offsets[('l1', None)]
+    img[l1_offset:l1_offset + l1_size * 8] = struct.pack('>%dQ' % l1_size, *l1)
+
+    x = 62 - (cluster_bits - 8)
+    for i in l2s:
+        l2 = [0] * l2_entries
+        for j in range(l2_entries):
+            g = i * l2_entries + j
+            if g in zero:
+                l2[j] = 1
+            elif g in compressed:
+                off = offsets[('comp', g)]
+                more = (off + len(blobs[g]) - 1) / 512 - off / 512
+                l2[j] = (1 << 62) | (more << x) | off
+            elif g in clusters:
+                l2[j] = offsets[('data', g)] | (1 << 63)
+        off = offsets[('l2', i)]
+        img[off:off + cs] = struct.pack('>%dQ' % l2_entries, *l2)
+
+    for kind, g in order:
+        off = offsets[(kind, g)]
+        if kind == 'data':
+            img[off:off + cs] = clusters[g]
+        elif kind == 'comp':
+            img[off:off + len(blobs[g])] = blobs[g]
+
+    with open(path, 'wb') as fd:
+        fd.write(img)
+
+    raw = bytearray(size)
+    for g, data in clusters.items():
+        if g not in zero:
+            raw[g * cs:(g + 1) * cs] = data[:size - g * cs]
+    return str(raw)
+
+
+class TestImageImport(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pool = os.path.join(self.dir, 'pool')
+        os.mkdir(self.pool)
+        path = os.path.join(self.dir, 'rbd')
+        with open(path, 'w') as fd:
+            fd.write(FAKE_RBD % {'python': sys.executable})
+        os.chmod(path, stat.S_IRWXU)
+
+        self.saved_env = dict(os.environ)
+        os.environ['PATH'] = '%s:%s' % (self.dir, os.environ['PATH'])
+        os.environ['FAKE_RBD_DIR'] = self.pool
+
+        rand = random.Random(7)
+        self.cs = 4096
+        self.size = 64 * 1024 * 1024 - 1000
+        self.clusters = {}
+        self.compressed = set()
+        self.zero = set()
+        for g in range((self.size + self.cs - 1) / self.cs):
+            r = rand.random()
+            if r < 0.25:
+                self.clusters[g] = ''.join(chr(rand.randint(0, 255)) for _ in range(64)) * (self.cs / 64)
+            elif r < 0.3:
+                self.clusters[g] = ('zstack %d ' % g) * 256
+                self.compressed.add(g)
+            elif r < 0.32:
+                # allocated, but zeros
+                self.clusters[g] = '\0' * self.cs
+            elif r < 0.33:
+                self.clusters[g] = 'x' * self.cs
+                self.zero.add(g)
+        for g in self.clusters:
+            self.clusters[g] = self.clusters[g][:self.cs].ljust(self.cs, '\0')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+        shutil.rmtree(self.dir)
+
+    def _qcow2(self, layout='qemu', **kwargs):
+        path = os.path.join(self.dir, 'image-%s.qcow2' % layout)
+        raw = build_qcow2(path, self.size, self.clusters, compressed=self.compressed, zero=self.zero,
+                          layout=layout, **kwargs)
+        return path, raw
+
+    def _import(self, path, image='image', chunk=65536, **kwargs):
+        target = image_import.RbdTarget('pool/%s' % image)
+        importer = image_import.ImageImporter(target, spill_dir=self.dir, **kwargs)
+        with open(path) as fd:
+            while True:
+                data = fd.read(chunk)
+                if not data:
+                    break
+                importer.write(data)
+        importer.close()
+        return importer, target
+
+    def _image(self, image='image'):
+        with open(os.path.join(self.pool, 'pool_%s' % image)) as fd:
+            return fd.read()
+
+    def _allocated(self, raw):
+        return sum(len(raw[i:i + self.cs]) for i in range(0, len(raw), self.cs) if raw[i:i + self.cs].strip('\0'))
+
+    def test_qcow2_layouts(self):
+        for layout in ('qemu', 'data_first', 'metadata_first'):
+            path, raw = self._qcow2(layout)
+            # reads of any size
+            importer, target = self._import(path, layout, chunk=[65536, 1000, 1 << 20][len(layout) % 3])
+            self.assertEqual('qcow2', importer.format)
+            self.assertEqual(self.size, importer.size)
+            self.assertEqual(raw, self._image(layout), layout)
+            self.assertEqual(self._allocated(raw), target.bytes_written, layout)
+
+    def test_bytes_written_against_two_pass(self):
+        path, raw = self._qcow2()
+        _, target = self._import(path)
+
+        # the two pass import writes the stream to a temporary image, then
+        # converts it into the image, writing what is written here
+        tmp = image_import.RbdTarget('pool/tmp-image')
+        tmp.start()
+        with open(path) as fd:
+            tmp.write(0, fd.read())
+        tmp.finish(os.path.getsize(path))
+        with open(os.path.join(self.pool, 'log')) as fd:
+            log = [l.split() for l in fd]
+        tmp_written = int(log[-1][1])
+        single_written = int([l for l in log if l[0] == 'import-diff'][0][1])
+
+        two_pass = tmp_written + single_written
+        print '\n%d MB qcow2 stream of %d MB image: two pass writes %d MB and reads back %d MB, single pass writes %d MB' % (
+            os.path.getsize(path) >> 20, self.size >> 20, two_pass >> 20, os.path.getsize(path) >> 20,
+            single_written >> 20)
+        self.assertEqual(self._allocated(raw), single_written)
+        self.assertLess(single_written, two_pass)
+
+    def test_backing_file(self):
+        path, _ = self._qcow2(backing_file='base.qcow2')
+        self.assertRaises(image_import.ImageImportError, self._import, path)
+        self.assertFalse(os.path.exists(os.path.join(self.pool, 'pool_image')))
+
+    def test_truncated_qcow2(self):
+        path, _ = self._qcow2()
+        with open(path, 'r+b') as fd:
+            fd.truncate(os.path.getsize(path) / 2)
+        self.assertRaises(image_import.ImageImportError, self._import, path)
+
+    def test_spill_is_capped(self):
+        # all data of the image is kept before its tables, some 18 MB
+        path, _ = self._qcow2('data_first')
+        self.assertRaises(image_import.ImageImportError, self._import, path, max_spill=2 * 1024 * 1024)
+        # of the qemu layout only clusters mapped by nothing, some 0.7 MB
+        path, raw = self._qcow2('qemu')
+        self._import(path, 'qemu', max_spill=2 * 1024 * 1024)
+        self.assertEqual(raw, self._image('qemu'))
+
+    def test_existing_image_is_not_taken(self):
+        for name, content in (('qcow2', open(self._qcow2()[0]).read()), ('raw', 'raw' * 10000)):
+            with open(os.path.join(self.pool, 'pool_%s' % name), 'w') as fd:
+                fd.write('kept')
+            target = image_import.RbdTarget('pool/%s' % name)
+            importer = image_import.ImageImporter(target)
+            self.assertRaises((image_import.ImageImportError, shell.ShellError), importer.import_from,
+                              StringIO.StringIO(content))
+            self.assertFalse(target.created, name)
+            self.assertEqual('kept', self._image(name))
+
+        target = image_import.RbdTarget('pool/new')
+        image_import.ImageImporter(target).import_from(StringIO.StringIO('raw' * 10000))
+        self.assertTrue(target.created)
+
+    def test_raw_and_iso(self):
+        raw = ''.join(self.clusters.get(g, '\0' * self.cs) for g in range(1000))
+        iso = bytearray(raw)
+        iso[0x8001:0x8006] = 'CD001'
+        for name, content, fmt in (('raw', raw, 'raw'), ('iso', str(iso), 'iso'), ('tiny', 'tiny', 'raw')):
+            path = os.path.join(self.dir, name)
+            with open(path, 'w') as fd:
+                fd.write(content)
+            importer, _ = self._import(path, name)
+            self.assertEqual(fmt, importer.format)
+            self.assertEqual(len(content), importer.size)
+            self.assertEqual(content, self._image(name))
+
+    def test_import_cmd(self):
+        path, raw = self._qcow2()
+        out = os.path.join(self.dir, 'out.raw')
+        cmd = '%s < %s' % (image_import.get_import_cmd('file:%s' % out), path)
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+        ret = json.loads(p.communicate()[0])
+        self.assertEqual(0, p.returncode)
+        self.assertEqual('qcow2', ret['format'])
+        self.assertEqual(self.size, ret['size'])
+        with open(out) as fd:
+            self.assertEqual(raw, fd.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
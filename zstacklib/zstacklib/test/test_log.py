@@ -0,0 +1,102 @@
+'''
+
+lazily formatted log payloads: masking, capping and the cost of logging a
+50 KB domain xml and request body
+'''
+import logging
+import os
+import time
+import unittest
+
+import simplejson
+
+from zstacklib.utils import log
+
+
+def domain_xml(size=50 * 1024):
+    disk = "<disk type='file' device='disk'><driver name='qemu' type='qcow2' cache='none'/>" \
+           "<source file='/zstack_ps/rootVolumes/acct-36c27e8ff05c4780bf6d2fa65700f22e/vol-%d.qcow2'/>" \
+           "<target dev='vd%d' bus='virtio'/></disk>"
+    disks = []
+    while sum(len(d) for d in disks) < size:
+        disks.append(disk % (len(disks), len(disks)))
+    return "<domain type='kvm'><name>vm</name><devices>%s</devices></domain>" % ''.join(disks)
+
+
+class StartVmCmd(object):
+    @log.sensitive_fields("consolePassword", "addons.password")
+    def __init__(self):
+        self.vmName = 'vm'
+        self.consolePassword = 'secret'
+        self.addons = {'password': 'secret', 'channel': 'x'}
+        self.dataVolumes = [{'installPath': '/zstack_ps/vol-%d.qcow2' % i, 'password': 'kept'} for i in range(400)]
+
+
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self.stream = open(os.devnull, 'w')
+        self.logger = logging.getLogger('test_log')
+        self.logger.propagate = False
+        handler = logging.StreamHandler(self.stream)
+        handler.setFormatter(logging.Formatter(log.LogConfig.LOG_FORMAT))
+        self.logger.addHandler(handler)
+
+    def tearDown(self):
+        self.logger.handlers = []
+        self.stream.close()
+
+    def test_mask_as_before(self):
+        cmd = StartVmCmd()
+        body = simplejson.dumps(cmd.__dict__)
+        self.assertEqual(simplejson.loads(log.mask_sensitive_field(cmd, body)),
+                         simplejson.loads(log.mask_json(body, log.get_sensitive_paths(cmd))))
+        self.assertEqual(body, str(log.masked(None, body, limit=0)))
+
+        paths = log.get_sensitive_paths(cmd)
+        for body in ['{"SENSITIVE_FIELDS": [], "consolePassword": ""}',
+                     '{"consolePassword": {"a": [1, "}"]}, "SENSITIVE_FIELDS": {"x": 1}, "b": "\\"consolePassword\\""}',
+                     '{"addons": [{"password": 1}], "consolePassword": 0}']:
+            self.assertEqual(simplejson.loads(log.mask_sensitive_field(cmd, body)),
+                             simplejson.loads(log.mask_json(body, paths)), body)
+
+    def test_cap(self):
+        text = 'x' * 100
+        self.assertEqual('x' * 10 + '...(90 more bytes)', str(log.payload(text, 10)))
+        self.assertEqual(text, str(log.payload(text)))
+        self.assertEqual('None', str(log.payload(None)))
+        body = simplejson.dumps(StartVmCmd().__dict__)
+        self.assertTrue(str(log.masked(StartVmCmd(), body, 100)).endswith('more bytes)'))
+
+    def _cost(self, fn, n=200):
+        start = time.time()
+        for _ in xrange(n):
+            fn()
+        return (time.time() - start) / n * 1e6
+
+    def test_benchmark(self):
+        xml = domain_xml()
+        cmd = StartVmCmd()
+        body = simplejson.dumps(cmd.__dict__)
+        logger = self.logger
+
+        cases = [
+            ('domain xml', lambda: logger.debug("find xm xml: %s" % xml),
+             lambda: logger.debug("find xm xml: %s", log.payload(xml))),
+            ('masked body', lambda: logger.debug('body: %s' % log.mask_sensitive_field(cmd, body)),
+             lambda: logger.debug('body: %s', log.masked(cmd, body))),
+        ]
+        print
+        for level in (logging.INFO, logging.DEBUG):
+            logger.setLevel(level)
+            for name, current, lazy in cases:
+                current_cost = self._cost(current)
+                lazy_cost = self._cost(lazy)
+                print '%s of %d KB at %s: current %.1f us, lazy %.1f us' % (
+                    name, len(xml if name == 'domain xml' else body) / 1024, logging.getLevelName(level),
+                    current_cost, lazy_cost)
+                if level == logging.INFO or name == 'masked body':
+                    self.assertLess(lazy_cost, current_cost)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,26 @@
+import threading
 import time
 import unittest
 
 from plugin import task_plugin1
 from plugin import task_plugin2
+from zstacklib.utils import jsonobject
+from zstacklib.utils import plugin
+from zstacklib.utils import report
+from zstacklib.utils import thread
+
+
+class StalledTaskDaemon(plugin.TaskDaemon):
+    def __init__(self, timeout=0, report_progress=True):
+        cmd = jsonobject.loads('{"threadContext":{"api":"stalledApiId"}}')
+        super(StalledTaskDaemon, self).__init__(cmd, 'stalled task', timeout=timeout, report_progress=report_progress)
+        self.cancelled = threading.Event()
+
+    def _get_percent(self):
+        return 50
+
+    def _cancel(self):
+        self.cancelled.set()
 
 
 class TestTaskManager(unittest.TestCase):
@@ -25,6 +43,24 @@ class TestTaskManager(unittest.TestCase):
         time.sleep(1)
         self.assertEqual(1, plugin1.progress_count)
 
+    def test_timeout_with_stalled_reports(self):
+        # reports to a management node which does not answer
+        stalled = threading.Event()
+        progress_report = report.Report.progress_report
+        report.Report.progress_report = lambda self, percent, flag='report': stalled.wait()
+        reporters = [StalledTaskDaemon() for _ in range(thread.TIMER_WHEEL_WORKERS + 4)]
+        daemon = StalledTaskDaemon(timeout=1, report_progress=False)
+        try:
+            for d in reporters:
+                d.start()
+            daemon.start()
+            self.assertTrue(daemon.cancelled.wait(3))
+        finally:
+            stalled.set()
+            report.Report.progress_report = progress_report
+            for d in reporters + [daemon]:
+                d.close()
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
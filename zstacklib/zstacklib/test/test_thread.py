@@ -7,6 +7,8 @@ import time
 import threading
 from ..utils.thread import ThreadFacade
 from ..utils.thread import AsyncThread
+from ..utils.thread import ThreadPool
+from ..utils.thread import wait_futures
 
 
 class TestThreadFacade(unittest.TestCase):
@@ -33,6 +35,32 @@ class TestThreadFacade(unittest.TestCase):
         self.assertEqual('_do_async', self.async_thread_name)
         self.assertEqual("ok", self.async_ok)
         self.assertEqual("world", self.async_value)
+    def test_thread_pool(self):
+        pool = ThreadPool(4, 'test')
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def _work(i):
+            with lock:
+                running.append(i)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(i)
+            if i == 7:
+                raise Exception('failure on %d' % i)
+            return i * 2
+
+        futures = [pool.submit(_work, i) for i in range(32)]
+        done, not_done = wait_futures(futures, timeout=10)
+        pool.shutdown()
+
+        self.assertEqual(32, len(done))
+        self.assertEqual(0, len(not_done))
+        self.assertTrue(max(peak) <= 4)
+        self.assertEqual(62, futures[31].result())
+        self.assertTrue(futures[7].exception() is not None)
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
@@ -0,0 +1,181 @@
+'''
+
+timer wheel with a fake clock: ordering, cancellation and threads
+'''
+import random
+import threading
+import time
+import unittest
+
+from zstacklib.utils import thread
+
+TIMERS = 100000
+
+
+class FakeClock(object):
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestTimerWheel(unittest.TestCase):
+    def _run(self, wheel, clock, until, step=0.37):
+        while clock.now < until:
+            clock.now += random.uniform(0, step)
+            wheel.advance()
+
+    def _schedule(self, wheel, clock, fired, max_delay):
+        handles = []
+        for i in xrange(TIMERS):
+            delay = random.uniform(0, max_delay)
+
+            def fn(i=i, deadline=clock.now + delay):
+                fired.append((deadline, clock.now, i))
+
+            handles.append(wheel.schedule(delay, fn))
+        return handles
+
+    def _check_order(self, fired, tick, step):
+        deadlines = [d for d, _, _ in fired]
+        self.assertEqual(sorted(deadlines), deadlines)
+        for deadline, at, _ in fired:
+            self.assertGreaterEqual(at, deadline)
+            self.assertLess(at - deadline, tick + step)
+
+    def test_ordering(self):
+        random.seed(1)
+        clock = FakeClock()
+        wheel = thread.TimerWheel(tick=0.1, clock=clock)
+        fired = []
+        self._schedule(wheel, clock, fired, 3 * 24 * 3600)
+        self.assertEqual(TIMERS, wheel.pending)
+
+        self._run(wheel, clock, clock.now + 3 * 24 * 3600 + 1, step=60)
+        self.assertEqual(TIMERS, len(fired))
+        self.assertEqual(0, wheel.pending)
+        self._check_order(fired, 0.1, 60)
+
+    def test_beyond_top_level(self):
+        random.seed(2)
+        clock = FakeClock()
+        # 4096 ticks of 0.1s on the wheels, delays of up to 20 minutes
+        wheel = thread.TimerWheel(tick=0.1, wheel_bits=4, levels=3, clock=clock)
+        fired = []
+        self._schedule(wheel, clock, fired, 1200)
+        self._run(wheel, clock, clock.now + 1201, step=0.5)
+        self.assertEqual(TIMERS, len(fired))
+        self._check_order(fired, 0.1, 0.5)
+
+    def test_cancel(self):
+        random.seed(3)
+        clock = FakeClock()
+        wheel = thread.TimerWheel(clock=clock)
+        fired = []
+        handles = self._schedule(wheel, clock, fired, 600)
+        cancelled = set(random.sample(xrange(TIMERS), TIMERS / 2))
+        for i in cancelled:
+            handles[i].cancel()
+            handles[i].cancel()
+        self.assertEqual(TIMERS - len(cancelled), wheel.pending)
+
+        self._run(wheel, clock, clock.now + 300)
+        for i in xrange(TIMERS):
+            handles[i].cancel()
+        self._run(wheel, clock, clock.now + 301)
+        self.assertEqual(0, wheel.pending)
+        self.assertFalse(cancelled & set(i for _, _, i in fired))
+
+    def test_thread_count_constant(self):
+        random.seed(4)
+        clock = FakeClock()
+        pool = thread.ThreadPool(4, 'test-timer')
+        wheel = thread.TimerWheel(clock=clock, executor=pool)
+        fired = []
+        lock = threading.Lock()
+        threads = set()
+
+        def fn():
+            with lock:
+                fired.append(1)
+                threads.add(threading.current_thread().name)
+
+        before = threading.active_count()
+        for _ in xrange(TIMERS):
+            wheel.schedule(random.uniform(0, 60), fn)
+
+        counts = set()
+        while clock.now < 1000061:
+            clock.now += 0.5
+            wheel.advance()
+            counts.add(threading.active_count())
+        while len(fired) < TIMERS:
+            time.sleep(0.01)
+
+        self.assertLessEqual(max(counts), before + 4)
+        self.assertLessEqual(len(threads), 4)
+        pool.shutdown()
+
+    def test_periodic_timer(self):
+        wheel = thread.TimerWheel(tick=0.005, executor=thread.ThreadPool(2, 'test-periodic')).start()
+        ticks = []
+        counts = []
+
+        def tick():
+            ticks.append(time.time())
+            counts.append(threading.active_count())
+            return len(ticks) < 10
+
+        t = thread.PeriodicTimer(0.02, tick, wheel=wheel).start()
+        deadline = time.time() + 5
+        while len(ticks) < 10 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+
+        self.assertEqual(10, len(ticks))
+        self.assertEqual(1, len(set(counts[1:])))
+        self.assertEqual(0, wheel.pending)
+
+        ticks[:] = []
+        t = thread.PeriodicTimer(0.02, tick, wheel=wheel).start()
+        t.cancel()
+        time.sleep(0.1)
+        self.assertEqual([], ticks)
+        wheel.stop()
+
+    def test_hung_blocking_timers_do_not_starve_others(self):
+        shared = thread.TimerWheel(tick=0.005, executor=thread.ThreadPool(2, 'test-shared')).start()
+        blocking = thread.TimerWheel(tick=0.005, executor=thread.ThreadPerTaskExecutor('test-blocking')).start()
+        hang = threading.Event()
+        hung = []
+        ticks = []
+
+        def probe():
+            # stands for a heartbeat write to a dead nfs server
+            hung.append(1)
+            hang.wait()
+            return True
+
+        probes = [thread.PeriodicTimer(0.01, probe, wheel=blocking).start() for _ in range(8)]
+        deadline = time.time() + 5
+        while len(hung) < 8 and time.time() < deadline:
+            time.sleep(0.01)
+
+        t = thread.PeriodicTimer(0.01, lambda: ticks.append(1) or len(ticks) < 10, wheel=shared).start()
+        deadline = time.time() + 5
+        while len(ticks) < 10 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(10, len(ticks))
+        # a hung probe is not run again until it returns
+        self.assertEqual(8, len(hung))
+
+        hang.set()
+        for p in probes + [t]:
+            p.cancel()
+        shared.stop()
+        blocking.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+'''
+
+test copying a folder with streaming checksum verification
+'''
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from zstacklib.utils import verified_copy
+
+
+def _md5_of(path):
+    with open(path, 'rb') as fd:
+        return hashlib.md5(fd.read()).hexdigest()
+
+
+class TestVerifiedCopy(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+        os.makedirs(os.path.join(self.src, 'snapshots'))
+        os.makedirs(os.path.join(self.src, 'skip'))
+
+        self.files = {
+            'root.qcow2': os.urandom(3 * 1024 * 1024 + 17),
+            'snapshots/s1.qcow2': os.urandom(1024 * 1024),
+            'snapshots/s2.qcow2': '',
+            'skip/ignored': 'not copied',
+        }
+        for name, content in self.files.items():
+            with open(os.path.join(self.src, name), 'wb') as fd:
+                fd.write(content)
+        os.symlink('root.qcow2', os.path.join(self.src, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_copy(self):
+        reports = []
+        manifest_path = os.path.join(self.tmp, 'manifest')
+        copier = verified_copy.VerifiedCopier(self.src, self.dst, excludes=['/skip'], parallel=3,
+                                              chunk_size=64 * 1024, manifest_path=manifest_path,
+                                              progress=lambda c, t: reports.append((c, t)))
+        total = copier.plan()
+        self.assertEqual(4 * 1024 * 1024 + 17, total)
+
+        manifest = copier.copy()
+        for name in ['root.qcow2', 'snapshots/s1.qcow2', 'snapshots/s2.qcow2']:
+            self.assertEqual(_md5_of(os.path.join(self.src, name)), _md5_of(os.path.join(self.dst, name)))
+            self.assertEqual(_md5_of(os.path.join(self.src, name)), manifest.get(name)[1])
+
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'skip')))
+        self.assertEqual('root.qcow2', os.readlink(os.path.join(self.dst, 'link')))
+        self.assertEqual((total, total), reports[-1])
+        with open(manifest_path) as fd:
+            self.assertEqual(3, len(fd.readlines()))
+
+    def test_sparse_file(self):
+        sparse = os.path.join(self.src, 'sparse.raw')
+        with open(sparse, 'wb') as fd:
+            fd.write('head')
+            fd.seek(8 * 1024 * 1024)
+            fd.write('tail')
+            fd.truncate(16 * 1024 * 1024)
+
+        verified_copy.VerifiedCopier(self.src, self.dst, chunk_size=1024 * 1024).copy()
+        copied = os.path.join(self.dst, 'sparse.raw')
+        self.assertEqual(_md5_of(sparse), _md5_of(copied))
+        self.assertEqual(16 * 1024 * 1024, os.path.getsize(copied))
+        self.assertTrue(os.stat(copied).st_blocks * 512 < 4 * 1024 * 1024)
+
+    def test_corruption_detected(self):
+        state = {'chunks': 0}
+
+        def flip_one_byte(chunk):
+            state['chunks'] += 1
+            if state['chunks'] == 3:
+                return chr(ord(chunk[0]) ^ 0xff) + chunk[1:]
+            return chunk
+
+        copier = verified_copy.VerifiedCopier(self.src, self.dst, excludes=['skip'], parallel=1,
+                                              chunk_size=64 * 1024, transfer=flip_one_byte)
+        with self.assertRaises(verified_copy.ChecksumMismatchError) as ctx:
+            copier.copy()
+
+        # files are started largest first, the third chunk belongs to root.qcow2
+        self.assertEqual(['root.qcow2'], ctx.exception.mismatches)
+
+    def test_keeps_mode_and_owner(self):
+        src = os.path.join(self.src, 'snapshots/s1.qcow2')
+        os.chmod(src, 0o640)
+        os.chmod(os.path.join(self.src, 'snapshots'), 0o750)
+        verified_copy.VerifiedCopier(self.src, self.dst).copy()
+
+        for name in ('snapshots/s1.qcow2', 'snapshots'):
+            s = os.stat(os.path.join(self.src, name))
+            d = os.stat(os.path.join(self.dst, name))
+            self.assertEqual(stat.S_IMODE(s.st_mode), stat.S_IMODE(d.st_mode))
+            self.assertEqual((s.st_uid, s.st_gid), (d.st_uid, d.st_gid))
+            self.assertEqual(int(s.st_mtime), int(d.st_mtime))
+
+    def test_lost_write_detected(self):
+        # a write lost on the way to the disk is only seen when reading back
+        write = verified_copy._SparseWriter.write
+
+        def lose_second_chunk(writer, chunk):
+            if writer.size == 64 * 1024:
+                writer.size += len(chunk)
+                writer.fd.seek(len(chunk), os.SEEK_CUR)
+            else:
+                write(writer, chunk)
+
+        verified_copy._SparseWriter.write = lose_second_chunk
+        try:
+            copier = verified_copy.VerifiedCopier(self.src, self.dst, excludes=['skip'], chunk_size=64 * 1024)
+            with self.assertRaises(verified_copy.ChecksumMismatchError) as ctx:
+                copier.copy()
+        finally:
+            verified_copy._SparseWriter.write = write
+        self.assertEqual(['root.qcow2', 'snapshots/s1.qcow2'], sorted(ctx.exception.mismatches))
+
+    def test_cancel(self):
+        copier = None
+
+        def cancel_on_first_chunk(chunk):
+            copier.cancel()
+            return chunk
+
+        copier = verified_copy.VerifiedCopier(self.src, self.dst, parallel=2, chunk_size=64 * 1024,
+                                              transfer=cancel_on_first_chunk)
+        self.assertRaises(verified_copy.CopyCancelledError, copier.copy)
+        self.assertLess(copier.copied_size, 4 * 64 * 1024)
+
+    def test_truncation_detected(self):
+        copier = verified_copy.VerifiedCopier(self.src, self.dst, parallel=2, chunk_size=64 * 1024,
+                                              transfer=lambda chunk: chunk[:-1])
+        with self.assertRaises(verified_copy.ChecksumMismatchError) as ctx:
+            copier.copy()
+        self.assertEqual(3, len(ctx.exception.mismatches))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+'''
+
+compiled xml templates render what etree.tostring() writes
+'''
+import unittest
+import xml.etree.ElementTree as etree
+
+from zstacklib.utils import xml_template
+
+VALUES = ['plain', '', 'a & b', '<tag attr="x">', "it's\nmulti\nline", u'主机', '5 > 3 < 4', '@@', '&amp;']
+
+
+def build(name, desc, sections=None):
+    root = etree.Element('domain', {'type': 'kvm'})
+    etree.SubElement(root, 'name').text = name
+    devices = etree.SubElement(root, 'devices')
+    disk = etree.SubElement(devices, 'disk', {'type': 'file'})
+    etree.SubElement(disk, 'source', {'file': '/images/%s.qcow2' % name, 'desc': desc})
+    if sections is None:
+        nic = etree.SubElement(devices, 'interface', {'type': 'bridge'})
+        etree.SubElement(nic, 'mac', {'address': desc})
+    else:
+        xml_template.add_section(devices, 'nics')
+    etree.SubElement(root, 'description').text = desc
+    return root
+
+
+def make_nics(parent, desc):
+    nic = etree.SubElement(parent, 'interface', {'type': 'bridge'})
+    etree.SubElement(nic, 'mac', {'address': desc})
+
+
+class TestXmlTemplate(unittest.TestCase):
+    def test_escape_as_etree(self):
+        for v in filter(None, VALUES):
+            root = etree.Element('e', {'a': v})
+            root.text = v
+            self.assertEqual('<e a="%s">%s</e>' % (xml_template.escape_attrib(v), xml_template.escape_cdata(v)),
+                             etree.tostring(root))
+
+    def test_render_as_etree(self):
+        template = xml_template.Template(etree.tostring(build(xml_template.slot('name'), xml_template.slot('desc'),
+                                                              sections=True)))
+        self.assertEqual(set(['name', 'desc']), template.slots)
+        self.assertEqual(['nics'], template.sections)
+
+        for name in ['vm1', 'a&b']:
+            for desc in VALUES:
+                if not desc:
+                    # an empty text leaves the element empty, another shape
+                    continue
+                nics = etree.Element('devices')
+                make_nics(nics, desc)
+                rendered = template.render({'name': name, 'desc': desc},
+                                           {'nics': xml_template.serialize_children(nics)})
+                self.assertEqual(etree.tostring(build(name, desc)), rendered)
+
+    def test_cache(self):
+        cache = xml_template.TemplateCache(max_entries=2)
+        compiled = []
+
+        def compile_fn(key):
+            def fn():
+                compiled.append(key)
+                return '<a>%s</a>' % xml_template.slot('v')
+            return fn
+
+        for key in ['x', 'y', 'x', 'y']:
+            cache.get(key, compile_fn(key))
+        self.assertEqual(['x', 'y'], compiled)
+        self.assertEqual(2, cache.hits)
+        cache.get('z', compile_fn('z'))
+        self.assertEqual(1, len(cache.templates))
+        self.assertEqual('<a>1 &lt; 2</a>', cache.get('z', None).render({'v': '1 < 2'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,8 @@
 import os
 import platform
+import subprocess
+import threading
+import time
 
 from zstacklib.utils import linux
 from zstacklib.utils import bash
@@ -37,6 +40,273 @@ class DrbdNetState(object):
     Unconfigured = "Unconfigured"
 
 
+DRBD_CONFIG_DIR = "/etc/drbd.d"
+DrbdDiskStateUnknown = "DUnknown"
+
+
+class DrbdConfigIndex(object):
+    """
+    the resources of the config files by name, local minor and local disk.
+    The files are parsed once, and again only when the directory changes
+    or invalidate() is called after a file is written
+    """
+
+    def __init__(self, config_dir=DRBD_CONFIG_DIR):
+        self.config_dir = config_dir
+        self.lock = threading.Lock()
+        self.dir_mtime = None
+        self.files = {}  # type: dict[str, tuple[float, DrbdConfigStruct]]
+        self.by_name = {}
+        self.by_minor = {}
+        self.by_disk = {}
+
+    def invalidate(self):
+        with self.lock:
+            self.dir_mtime = None
+
+    @staticmethod
+    def _parse(path):
+        with open(path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("resource ") and line.endswith(" {"):
+                    config = DrbdConfigStruct(line.split(" ")[1])
+                    break
+            else:
+                return None
+        config.path = path
+        config.read_config()
+        return config
+
+    def _refresh(self):
+        try:
+            dir_mtime = os.stat(self.config_dir).st_mtime
+        except OSError:
+            dir_mtime = None
+        if dir_mtime is not None and dir_mtime == self.dir_mtime:
+            return
+
+        files = {}
+        for f in os.listdir(self.config_dir) if dir_mtime is not None else []:
+            if not f.endswith(".res"):
+                continue
+            path = os.path.join(self.config_dir, f)
+            try:
+                mtime = os.stat(path).st_mtime
+                parsed = self.files.get(path)
+                if parsed is None or parsed[0] != mtime:
+                    parsed = (mtime, self._parse(path))
+            except Exception as e:
+                logger.warn("can not parse drbd config %s: %s" % (path, e))
+                continue
+            if parsed[1] is not None:
+                files[path] = parsed
+
+        self.files = files
+        self.by_name = {}
+        self.by_minor = {}
+        self.by_disk = {}
+        for _, config in files.values():
+            self.by_name[config.name] = config
+            if config.local_host.minor is not None:
+                self.by_minor[str(config.local_host.minor)] = config
+            if config.local_host.disk is not None:
+                self.by_disk[config.local_host.disk] = config
+        self.dir_mtime = dir_mtime
+
+    def get(self, name):
+        with self.lock:
+            self._refresh()
+            return self.by_name.get(name)
+
+    def get_by_minor(self, minor):
+        with self.lock:
+            self._refresh()
+            return self.by_minor.get(str(minor))
+
+    def get_by_disk(self, disk):
+        with self.lock:
+            self._refresh()
+            return self.by_disk.get(disk)
+
+
+class DrbdResourceState(object):
+    def __init__(self, name):
+        self.name = name
+        self.role = None
+        self.minor = None
+        self.disk_state = None
+        self.cstate = DrbdNetState.StandAlone
+        self.remote_role = DrbdNetState.Unknown
+        self.remote_disk_state = DrbdDiskStateUnknown
+
+
+class DrbdStateCache(object):
+    """
+    the state of the resources that are up, as `drbdsetup events2` reports
+    it. load() takes a snapshot, start() follows the event stream in a
+    thread and restarts it when it breaks. Reads take no process.
+
+    Only volume 0 of a resource is kept, as the resources here have one.
+    """
+
+    RESTART_INTERVAL = 5
+
+    def __init__(self, drbdsetup="drbdsetup"):
+        self.drbdsetup = drbdsetup
+        self.lock = threading.Lock()
+        self.resources = {}  # type: dict[str, DrbdResourceState]
+        # the initial state is being read into it
+        self.initial = None
+        self.ready = False
+        self.running = False
+        self.process = None
+
+    @staticmethod
+    def _apply(resources, line):
+        fields = line.split()
+        if len(fields) < 3:
+            return
+        event, obj = fields[0], fields[1]
+        props = dict(f.split(":", 1) for f in fields[2:] if ":" in f)
+        name = props.get("name")
+        if name is None or obj not in ("resource", "device", "connection", "peer-device"):
+            return
+        if props.get("volume", "0") != "0":
+            return
+
+        if obj == "resource" and event == "destroy":
+            resources.pop(name, None)
+            return
+        state = resources.get(name)
+        if state is None:
+            if event == "destroy":
+                return
+            state = resources[name] = DrbdResourceState(name)
+
+        if obj == "resource":
+            state.role = props.get("role", state.role)
+        elif obj == "device":
+            if event == "destroy":
+                state.minor = state.disk_state = None
+            else:
+                state.minor = props.get("minor", state.minor)
+                state.disk_state = props.get("disk", state.disk_state)
+        elif obj == "connection":
+            if event == "destroy":
+                state.cstate = DrbdNetState.StandAlone
+                state.remote_role = DrbdNetState.Unknown
+                state.remote_disk_state = DrbdDiskStateUnknown
+            else:
+                state.cstate = props.get("connection", state.cstate)
+                state.remote_role = props.get("role", state.remote_role)
+        elif obj == "peer-device":
+            if event == "destroy":
+                state.remote_disk_state = DrbdDiskStateUnknown
+            else:
+                state.remote_disk_state = props.get("peer-disk", state.remote_disk_state)
+
+    def feed(self, line):
+        """
+        apply a line of events2 output. The lines before `exists -` are the
+        initial state, which replaces the cached one when complete
+        """
+        with self.lock:
+            if line.startswith("exists "):
+                if self.initial is None:
+                    self.initial = {}
+                if line.split()[1] == "-":
+                    self.resources, self.initial = self.initial, None
+                    self.ready = True
+                else:
+                    self._apply(self.initial, line)
+            else:
+                self._apply(self.resources, line)
+
+    def load(self):
+        for line in bash.bash_errorout("%s events2 --now all" % self.drbdsetup).splitlines():
+            self.feed(line)
+
+    def refresh(self, name):
+        """
+        read the state of one resource now, after it is changed here
+        """
+        r, o, e = bash.bash_roe("%s events2 --now %s" % (self.drbdsetup, name))
+        if r != 0:
+            # a resource just taken down may be unknown, the stream tells
+            logger.debug("can not read the state of drbd resource %s: %s" % (name, e))
+            return
+        resources = {}
+        for line in o.splitlines():
+            self._apply(resources, line)
+        with self.lock:
+            self.resources.pop(name, None)
+            if name in resources:
+                self.resources[name] = resources[name]
+
+    def get(self, name):
+        """
+        :rtype: DrbdResourceState
+        """
+        return self.resources.get(name)
+
+    def _follow(self):
+        while self.running:
+            try:
+                self.process = subprocess.Popen([self.drbdsetup, "events2", "all"], stdout=subprocess.PIPE,
+                                                close_fds=True)
+                for line in iter(self.process.stdout.readline, ""):
+                    self.feed(line)
+                self.process.wait()
+                if self.running:
+                    logger.warn("drbdsetup events2 exited with %s, restart it" % self.process.returncode)
+            except Exception as e:
+                logger.warn("follow drbdsetup events2 failed: %s" % e)
+            with self.lock:
+                self.ready = False
+                self.initial = None
+            if self.running:
+                time.sleep(self.RESTART_INTERVAL)
+
+    def start(self):
+        self.running = True
+        t = threading.Thread(target=self._follow, name="drbd-events2")
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.running = False
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+
+
+_config_index = DrbdConfigIndex()
+_state_cache = DrbdStateCache()
+_state_cache_lock = threading.Lock()
+
+
+def get_config_index():
+    return _config_index
+
+
+def get_state_cache():
+    """
+    the state cache, started at the first call. None until it has the
+    state of all resources, the callers query drbdadm meanwhile
+    """
+    if not _state_cache.running:
+        with _state_cache_lock:
+            if not _state_cache.running:
+                _state_cache.start()
+    return _state_cache if _state_cache.ready else None
+
+
+def _state_changed(name):
+    cache = get_state_cache()
+    if cache is not None:
+        cache.refresh(name)
+
+
 class DrbdResource(object):
     def __init__(self, name, up=True):
         super(DrbdResource, self).__init__()
@@ -89,6 +359,9 @@ class DrbdResource(object):
     @staticmethod
     @bash.in_bash
     def get_config_path_from_name(name):
+        config = get_config_index().get(name)
+        if config is not None:
+            return config.path
         if bash.bash_r("drbdadm dump %s" % name) == 0:
             return bash.bash_o("drbdadm dump %s | grep 'defined at' | awk '{print $4}'" % name).split(":")[0]
         if bash.bash_r("ls /etc/drbd.d/%s.res" % name) == 0:
@@ -107,15 +380,24 @@ class DrbdResource(object):
         else:
             return config_path.split("/")[-1].split(".")[0]
 
+    def _cached_state(self):
+        """
+        the cached state, None if there is no cache or the resource is not up
+        """
+        cache = get_state_cache()
+        return cache.get(self.name) if cache is not None else None
+
     @bash.in_bash
     def up(self):
         if not self.minor_allocated() or self.get_cstate() == DrbdNetState.Unconfigured:
             bash.bash_errorout("drbdadm up %s" % self.name)
+            _state_changed(self.name)
 
     @bash.in_bash
     @linux.retry(5, 2)
     def down(self):
         r, o, e = bash.bash_roe("drbdadm down %s" % self.name)
+        _state_changed(self.name)
         if r == 0:
             return
         if "conflicting use of device-minor" in o+e:
@@ -134,6 +416,7 @@ class DrbdResource(object):
         def do_promote():
             f = " --force" if force else ""
             r, o, e = bash.bash_roe("drbdadm primary %s %s" % (self.name, f))
+            _state_changed(self.name)
             if self.get_role() != DrbdRole.Primary:
                 raise RetryException("promote failed, return: %s, %s, %s. resource %s still not in role %s" % (
                     r, o, e, self.name, DrbdRole.Primary))
@@ -142,6 +425,7 @@ class DrbdResource(object):
             do_promote()
         else:
             bash.bash_errorout("drbdadm primary %s --force" % self.name)
+            _state_changed(self.name)
 
     @bash.in_bash
     def demote(self):
@@ -149,19 +433,30 @@ class DrbdResource(object):
         @linux.retry(times=30, sleep_time=2)
         def do_demote():
             bash.bash_errorout("drbdadm secondary %s" % self.name)
+            _state_changed(self.name)
 
         do_demote()
 
     @bash.in_bash
     def get_cstate(self):
+        cache = get_state_cache()
+        if cache is not None:
+            state = cache.get(self.name)
+            return state.cstate if state is not None else DrbdNetState.Unconfigured
         return bash.bash_o("drbdadm cstate %s" % self.name).strip()
 
     @bash.in_bash
     def get_dstate(self):
+        state = self._cached_state()
+        if state is not None and state.disk_state is not None:
+            return state.disk_state
         return bash.bash_o("drbdadm dstate %s | cut -d '/' -f1" % self.name).strip()
 
     @bash.in_bash
     def get_remote_dstate(self):
+        state = self._cached_state()
+        if state is not None:
+            return state.remote_disk_state
         return bash.bash_o("drbdadm dstate %s | cut -d '/' -f2" % self.name).strip()
 
     def is_connected(self):
@@ -169,10 +464,16 @@ class DrbdResource(object):
 
     @bash.in_bash
     def get_role(self):
+        state = self._cached_state()
+        if state is not None and state.role is not None:
+            return state.role
         return bash.bash_o("drbdadm role %s | awk -F '/' '{print $1}'" % self.name).strip()
 
     @bash.in_bash
     def get_remote_role(self):
+        state = self._cached_state()
+        if state is not None:
+            return state.remote_role
         return bash.bash_o("drbdadm role %s | awk -F '/' '{print $2}'" % self.name).strip()
 
     def get_dev_path(self):
@@ -183,9 +484,14 @@ class DrbdResource(object):
     @linux.retry(times=90, sleep_time=3)
     def clear_bits(self):
         bash.bash_errorout("drbdadm new-current-uuid --clear-bitmap %s" % self.name)
+        _state_changed(self.name)
 
     @bash.in_bash
     def minor_allocated(self):
+        cache = get_state_cache()
+        if cache is not None:
+            state = cache.get(self.name)
+            return state is not None and state.minor is not None
         r, o, e = bash.bash_roe("drbdadm role %s" % self.name)
         if e is not None and "Device minor not allocated" in o+e:
             logger.debug("Device %s minor not allocated!" % self.name)
@@ -240,6 +546,7 @@ class DrbdResource(object):
         self.down()
         bash.bash_r("echo yes | drbdadm wipe-md %s" % self.name)
         bash.bash_r("rm /etc/drbd.d/%s.res" % self.name)
+        get_config_index().invalidate()
 
     @bash.in_bash
     def resize(self):
@@ -376,6 +683,7 @@ resource {{ name }} {
             f.write(config.render(self.make_ctx()).strip())
             f.flush()
             os.fsync(f.fileno())
+        get_config_index().invalidate()
 
     def make_ctx(self):
         ctx = {}
@@ -0,0 +1,147 @@
+'''
+
+cache for facts which only change on reboot or on package upgrade
+'''
+
+import copy
+import os
+import threading
+
+from zstacklib.utils import log
+from zstacklib.utils import sizeunit
+
+logger = log.get_logger(__name__)
+
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+MEMINFO_PATH = '/proc/meminfo'
+CPUINFO_PATH = '/proc/cpuinfo'
+
+
+def read_boot_id(path=BOOT_ID_PATH):
+    try:
+        with open(path) as fd:
+            return fd.read().strip()
+    except IOError:
+        return None
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def read_small_file(path):
+    try:
+        with open(path) as fd:
+            return fd.read()
+    except IOError:
+        return None
+
+
+def read_meminfo(path=MEMINFO_PATH):
+    '''
+    return /proc/meminfo as a dict of bytes, without forking grep
+    '''
+    info = {}
+    with open(path) as fd:
+        for line in fd:
+            name, sep, value = line.partition(':')
+            if not sep:
+                continue
+
+            fields = value.split()
+            if not fields:
+                continue
+
+            try:
+                size = long(fields[0])
+            except ValueError:
+                continue
+
+            if len(fields) > 1 and fields[1].lower() == 'kb':
+                size = sizeunit.KiloByte.toByte(size)
+            info[name.strip()] = size
+    return info
+
+
+def read_cpuinfo(path=CPUINFO_PATH):
+    '''
+    return (processors, sockets, flags, first_model_name, first_cpu_mhz)
+    parsed from a single read of /proc/cpuinfo
+    '''
+    processors = 0
+    physical_ids = set()
+    flags = set()
+    model_name = None
+    cpu_mhz = None
+
+    with open(path) as fd:
+        for line in fd:
+            name, sep, value = line.partition(':')
+            if not sep:
+                continue
+
+            name = name.strip().lower()
+            value = value.strip()
+            if name == 'processor':
+                processors += 1
+            elif name == 'physical id':
+                physical_ids.add(value)
+            elif name in ('flags', 'features'):
+                flags.update(value.split())
+            elif name == 'model name' and model_name is None:
+                model_name = value
+            elif name == 'cpu mhz' and cpu_mhz is None:
+                cpu_mhz = value
+
+    return processors, len(physical_ids), flags, model_name, cpu_mhz
+
+
+class FactCache(object):
+    '''
+    memorize the result of an expensive probe. The cached value is dropped
+    when the boot id or the mtime of any watched file changes, so facts are
+    computed once per boot and again after the watched binaries are upgraded.
+    `watched_paths` may be a callable, for files named by another file.
+    `watched_contents` are small files compared by content instead, like
+    sysfs attributes whose mtime does not change with their value.
+    '''
+
+    def __init__(self, probe, watched_paths=None, boot_id_path=BOOT_ID_PATH, watched_contents=None):
+        self.probe = probe
+        self.watched_paths = watched_paths if callable(watched_paths) else list(watched_paths or [])
+        self.watched_contents = list(watched_contents or [])
+        self.boot_id_path = boot_id_path
+        self._lock = threading.Lock()
+        self._key = None
+        self._value = None
+        self.hits = 0
+        self.misses = 0
+
+    def _current_key(self):
+        key = [read_boot_id(self.boot_id_path) if self.boot_id_path else None]
+        paths = self.watched_paths() if callable(self.watched_paths) else self.watched_paths
+        key.extend(get_mtime(p) for p in paths)
+        key.extend(read_small_file(p) for p in self.watched_contents)
+        return tuple(key)
+
+    def get(self):
+        key = self._current_key()
+        with self._lock:
+            if self._key != key:
+                logger.debug('fact cache miss for %s, key: %s' % (getattr(self.probe, '__name__', self.probe), key))
+                self._value = self.probe()
+                self._key = key
+                self.misses += 1
+            else:
+                self.hits += 1
+
+            # callers are free to modify the returned value
+            return copy.deepcopy(self._value)
+
+    def invalidate(self):
+        with self._lock:
+            self._key = None
+            self._value = None
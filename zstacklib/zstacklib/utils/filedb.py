@@ -4,6 +4,14 @@
 '''
 import pickledb
 import os
+import simplejson
+import struct
+import threading
+import zlib
+
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
 
 ZSTACK_FILEDB_DIR="/var/lib/zstack/pickledb/"
 
@@ -37,3 +45,175 @@ class FileDB(object):
 
     def close(self):
         self.file_db.close()
+
+
+class JournaledFileDB(object):
+    '''
+    FileDB appending every set and rem to a journal of checksummed records
+    instead of rewriting the whole file. The data are kept in memory, read
+    back from the journal on open; a torn record at the tail, left by a crash,
+    is dropped. Once the journal grows to `compact_ratio` times the size of
+    the live records, it is rewritten in the background.
+
+    A pickledb file of the same name is imported on first open.
+    '''
+
+    JOURNAL_SUFFIX = '.journal'
+    # length and crc32 of the payload
+    HEADER = struct.Struct('>II')
+
+    def __init__(self, file_name, is_abs_path=False, compact_ratio=2, compact_min_size=64 * 1024, sync=False):
+        if not is_abs_path:
+            file_path = os.path.join(ZSTACK_FILEDB_DIR, file_name)
+        else:
+            file_path = file_name
+        file_dir = os.path.dirname(file_path)
+        if not os.path.exists(file_dir):
+            os.makedirs(file_dir, 0755)
+
+        self.path = file_path + self.JOURNAL_SUFFIX
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self.sync = sync
+        self.db = {}
+        self.record_sizes = {}
+        self.live_size = 0
+        self.size = 0
+        self.compactions = 0
+        self.lock = threading.RLock()
+        self.compactor = None
+
+        if not os.path.exists(self.path) and os.path.exists(file_path):
+            self._import_pickledb(file_path)
+        self._load()
+        self.fd = open(self.path, 'ab')
+
+    @staticmethod
+    def _encode(op, key, value=None):
+        payload = simplejson.dumps([op, key, value] if op == 's' else [op, key])
+        return JournaledFileDB.HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    def _import_pickledb(self, file_path):
+        try:
+            with open(file_path) as fd:
+                data = simplejson.load(fd)
+        except ValueError:
+            logger.warn('pickledb file %s is broken, not imported' % file_path)
+            return
+        self._rewrite(data)
+
+    def _apply(self, op, key, value, record_size):
+        self.live_size -= self.record_sizes.pop(key, 0)
+        if op == 's':
+            self.db[key] = value
+            self.record_sizes[key] = record_size
+            self.live_size += record_size
+        else:
+            self.db.pop(key, None)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb') as fd:
+            data = fd.read()
+
+        pos = 0
+        while pos + self.HEADER.size <= len(data):
+            length, crc = self.HEADER.unpack_from(data, pos)
+            end = pos + self.HEADER.size + length
+            payload = data[pos + self.HEADER.size:end]
+            if end > len(data) or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            record = simplejson.loads(payload)
+            self._apply(record[0], record[1], record[2] if len(record) > 2 else None, end - pos)
+            pos = end
+
+        if pos != len(data):
+            logger.warn('drop %d bytes of torn records at the tail of %s' % (len(data) - pos, self.path))
+            with open(self.path, 'r+b') as fd:
+                fd.truncate(pos)
+        self.size = pos
+
+    def _append(self, op, key, value=None):
+        record = self._encode(op, key, value)
+        with self.lock:
+            self.fd.write(record)
+            self.fd.flush()
+            if self.sync:
+                os.fsync(self.fd.fileno())
+            self.size += len(record)
+            self._apply(op, key, value, len(record))
+            self._compact_if_needed()
+
+    def _compact_if_needed(self):
+        if self.compactor or self.size < self.compact_min_size or self.size < self.live_size * self.compact_ratio:
+            return
+        self.compactor = threading.Thread(target=self.compact, name='filedb-compact')
+        self.compactor.daemon = True
+        self.compactor.start()
+
+    def _rewrite(self, data, tail=''):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as fd:
+            for k, v in data.iteritems():
+                fd.write(self._encode('s', k, v))
+            fd.write(tail)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(tmp, self.path)
+
+    def compact(self):
+        '''
+        rewrite the journal with the live records, the records appended
+        meanwhile are carried over
+        '''
+        try:
+            with self.lock:
+                snapshot = dict(self.db)
+                offset = self.size
+
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as fd:
+                for k, v in snapshot.iteritems():
+                    fd.write(self._encode('s', k, v))
+
+            with self.lock:
+                with open(self.path, 'rb') as old:
+                    old.seek(offset)
+                    tail = old.read(self.size - offset)
+                with open(tmp, 'ab') as fd:
+                    fd.write(tail)
+                    fd.flush()
+                    os.fsync(fd.fileno())
+                os.rename(tmp, self.path)
+                self.fd.close()
+                self.fd = open(self.path, 'ab')
+                self.size = os.path.getsize(self.path)
+                self.compactions += 1
+        except Exception as e:
+            logger.warn('failed to compact %s: %s' % (self.path, e))
+        finally:
+            self.compactor = None
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def set(self, key, value):
+        self._append('s', key, value)
+
+    def rem(self, key):
+        if key not in self.db:
+            # pickledb raises on a missing key, and so does FileDB
+            raise KeyError(key)
+        self._append('r', key)
+
+    def get_all(self):
+        return self.db
+
+    def close(self):
+        compactor = self.compactor
+        if compactor:
+            compactor.join()
+        with self.lock:
+            self.fd.close()
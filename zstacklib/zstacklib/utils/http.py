@@ -82,10 +82,10 @@ class SyncUriHandler(object):
     @cherrypy.expose
     def index(self):
         req = Request.from_cherrypy_request(cherrypy.request)
-        logger.debug('sync http call: %s' % req.body)
+        logger.debug('sync http call: %s', log.masked(self.uri_obj.cmd, req.body))
         rsp = self._do_index(req)
         self._check_response(rsp)
-        logger.debug("sync http reply to %s: \"%s\"" % (cherrypy.url(), rsp))
+        logger.debug("sync http reply to %s: \"%s\"", cherrypy.url(), log.payload(rsp))
         return rsp
 
 class RawUriHandler(object):
@@ -127,7 +127,7 @@ class AsyncUirHandler(SyncUriHandler):
 
         try:
             json_post(callback_uri, content, headers)
-            logger.debug("async http reply[task uuid: %s] to %s: %s" % (task_uuid, callback_uri, content))
+            logger.debug("async http reply[task uuid: %s] to %s: %s", task_uuid, callback_uri, log.payload(content))
         finally:
             self.HANDLER_COUNTER.dec()
         
@@ -158,8 +158,7 @@ class AsyncUirHandler(SyncUriHandler):
         task_uuid = cherrypy.request.headers[TASK_UUID]
         req = Request.from_cherrypy_request(cherrypy.request)
 
-        filter_body = log.mask_sensitive_field(self.uri_obj.cmd, req.body)
-        logger.debug('async http call[task uuid: %s], body: %s' % (task_uuid, filter_body))
+        logger.debug('async http call[task uuid: %s], body: %s', task_uuid, log.masked(self.uri_obj.cmd, req.body))
         self._run_index(task_uuid, req)
 
 def tool_disable_multipart_preprocessing():
@@ -183,6 +182,7 @@ class HttpServer(object):
         self.server = None
         self.server_conf = None
         self.logfile_path = log.get_logfile_path()
+        self.host = '0.0.0.0'
         self.port = port
         self.mapper = None
     
@@ -245,7 +245,7 @@ class HttpServer(object):
 
         cherrypy.engine.autoreload.unsubscribe()
         site_config = {}
-        site_config['server.socket_host'] = '0.0.0.0'
+        site_config['server.socket_host'] = self.host
         site_config['server.socket_port'] = self.port
         site_config['server.thread_pool'] = int(os.getenv('POOLSIZE', '10'))
 
@@ -0,0 +1,512 @@
+'''
+
+load test of the HttpServer of an agent, fully on localhost.
+
+The agent runs in this process with its shell commands answered by a
+FakeShell, libvirt replaced by a FakeLibvirt module where the agent needs
+it, and async replies posted to a local CallbackServer. A recorded command
+mix is replayed at a fixed rate and the report gives latency percentiles by
+uri, the delay of callbacks after the ack, and the thread counts of the
+agent:
+
+    POOLSIZE=20 python -m zstacklib.utils.http_loadtest --agent kvmagent \
+        --mix host_mix.json --rate 200 --count 5000
+
+A mix is a json list of {"uri": ..., "body": {...}, "async": true,
+"weight": 1}, replayed in order, each command `weight` times a round.
+'''
+import BaseHTTPServer
+import SocketServer
+import argparse
+import httplib
+import importlib
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import types
+import uuid
+
+import simplejson
+
+from zstacklib.utils import http
+from zstacklib.utils import shell
+from zstacklib.utils import thread
+
+HARNESS_THREAD_PREFIX = 'loadtest'
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    '''
+    nearest-rank percentiles and the max of `samples`, None if there are none
+    '''
+    if not samples:
+        return None
+    s = sorted(samples)
+    ret = dict(('p%d' % p, s[max(0, int(round(p / 100.0 * len(s))) - 1)]) for p in points)
+    ret['max'] = s[-1]
+    ret['count'] = len(s)
+    return ret
+
+
+class FakeProcess(object):
+    '''
+    what shell.get_process() returns while a FakeShell is installed. The
+    command is the argument of ShellCmd, or the stdin of bash for bash_roe()
+    '''
+
+    def __init__(self, fake_shell, cmd):
+        self.fake_shell = fake_shell
+        self.cmd = cmd
+        self.pid = None
+        self.returncode = None
+
+    def communicate(self, input=None):
+        cmd = input if input is not None and self.cmd == '/bin/bash' else self.cmd
+        self.returncode, stdout, stderr = self.fake_shell.run(cmd)
+        return stdout, stderr
+
+    def wait(self):
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        pass
+
+    terminate = kill
+
+
+class FakeShell(object):
+    '''
+    answers shell commands by the first rule whose pattern is found in them,
+    with (stdout, return code) after `delay` seconds, instead of forking
+    '''
+
+    def __init__(self, rules=(), default_stdout='', default_return_code=0, default_delay=0):
+        self.rules = []
+        self.default = ('', default_stdout, default_return_code, default_delay)
+        self.calls = 0
+        self.unmatched = set()
+        self.lock = threading.Lock()
+        self.saved = None
+        for r in rules:
+            self.add(*r)
+
+    def add(self, pattern, stdout='', return_code=0, delay=0):
+        self.rules.append((re.compile(pattern), stdout, return_code, delay))
+
+    def run(self, cmd):
+        with self.lock:
+            self.calls += 1
+
+        for pattern, stdout, return_code, delay in self.rules:
+            if pattern.search(cmd):
+                break
+        else:
+            _, stdout, return_code, delay = self.default
+            with self.lock:
+                self.unmatched.add(cmd)
+
+        if delay:
+            time.sleep(delay)
+        return return_code, stdout, '' if return_code == 0 else 'fake shell: %s failed' % cmd
+
+    def install(self):
+        self.saved = shell.get_process
+        shell.get_process = lambda cmd, *args, **kwargs: FakeProcess(self, cmd)
+        return self
+
+    def uninstall(self):
+        if self.saved:
+            shell.get_process = self.saved
+            self.saved = None
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.uninstall()
+
+
+class FakeLibvirtError(Exception):
+    def __init__(self, msg, error_code=0):
+        super(FakeLibvirtError, self).__init__(msg)
+        self.error_code = error_code
+
+    def get_error_code(self):
+        return self.error_code
+
+    def get_error_message(self):
+        return str(self)
+
+
+class FakeLibvirtConnection(object):
+    '''
+    a libvirt connection of a host running no vm
+    '''
+
+    def __init__(self, module):
+        self.module = module
+
+    def lookupByName(self, name):
+        raise FakeLibvirtError('Domain not found: %s' % name, self.module.VIR_ERR_NO_DOMAIN)
+
+    lookupByUUIDString = lookupByName
+
+    def listAllDomains(self, flags=0):
+        return []
+
+    def listDomainsID(self):
+        return []
+
+    def getLibVersion(self):
+        return 4009000
+
+    def getVersion(self):
+        return 4002000
+
+    def isAlive(self):
+        return True
+
+    def __getattr__(self, name):
+        # registering events, keepalive, close and the like
+        return lambda *args, **kwargs: 0
+
+
+class FakeLibvirt(types.ModuleType):
+    '''
+    a module standing for libvirt, constants have stable distinct values and
+    connections are FakeLibvirtConnection
+    '''
+
+    def __init__(self, name='libvirt'):
+        super(FakeLibvirt, self).__init__(name)
+        self.libvirtError = FakeLibvirtError
+        self._constants = {}
+
+    def __getattr__(self, name):
+        if name.startswith('VIR_'):
+            return self._constants.setdefault(name, len(self._constants) + 1)
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name in ('open', 'openReadOnly', 'openAuth'):
+            return lambda *args, **kwargs: FakeLibvirtConnection(self)
+        if name == 'virEventRunDefaultImpl':
+            return lambda: time.sleep(1)
+        return lambda *args, **kwargs: 0
+
+
+def install_fake_modules(modules):
+    '''
+    put fake modules in place of the real ones, before the agent imports them
+    '''
+    for name, module in modules.items():
+        sys.modules[name] = module
+
+
+class _CallbackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        self.server.on_callback(self.headers.getheader(http.TASK_UUID), body, self.headers.getheader(http.ERROR_CODE))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CallbackServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    the callback endpoint async replies are posted to, on a local port
+    '''
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _CallbackHandler)
+        self.url = 'http://127.0.0.1:%d/callback' % self.server_address[1]
+        self.arrivals = {}
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.all_arrived = threading.Condition(self.lock)
+        self.expected = 0
+
+    def process_request(self, request, client_address):
+        t = threading.Thread(target=self.process_request_thread, args=(request, client_address),
+                             name='%s-callback' % HARNESS_THREAD_PREFIX)
+        t.daemon = True
+        t.start()
+
+    def on_callback(self, task_uuid, body, error):
+        with self.lock:
+            self.arrivals[task_uuid] = time.time()
+            if error:
+                self.errors += 1
+            if len(self.arrivals) >= self.expected:
+                self.all_arrived.notify_all()
+
+    def wait(self, expected, timeout):
+        deadline = time.time() + timeout
+        with self.lock:
+            self.expected = expected
+            while len(self.arrivals) < expected and time.time() < deadline:
+                self.all_arrived.wait(deadline - time.time())
+            return len(self.arrivals)
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, name='%s-callback-server' % HARNESS_THREAD_PREFIX)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def load_mix(path):
+    with open(path) as fd:
+        return simplejson.load(fd)
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class LoadTest(object):
+    '''
+    replays `mix` against `http_server` at `rate` commands per second.
+    Latencies count from the time a command was due to be sent, so a server
+    falling behind is not hidden by the client waiting for it
+    '''
+
+    def __init__(self, http_server, mix, rate=100, count=1000, concurrency=64, timeout=120):
+        self.http_server = http_server
+        self.commands = []
+        for c in mix:
+            self.commands.extend([c] * int(c.get('weight', 1)))
+        self.rate = rate
+        self.count = count
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.callback_server = None
+        self.base_url = None
+
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.acks = {}
+        self.async_sent = {}
+        self.errors = 0
+        self.thread_samples = []
+
+    def start(self):
+        self.callback_server = CallbackServer().start()
+        self.http_server.host = '127.0.0.1'
+        self.http_server.port = _free_port()
+        self.base_url = 'http://127.0.0.1:%d' % self.http_server.port
+        self.http_server.start_in_thread()
+
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.http_server.port), 1).close()
+                return self
+            except socket.error:
+                time.sleep(0.1)
+        raise Exception('agent http server is not up on port %d' % self.http_server.port)
+
+    def stop(self):
+        self.http_server.stop()
+        self.callback_server.stop()
+
+    def _record(self, table, key, value):
+        with self.lock:
+            table.setdefault(key, []).append(value)
+
+    def _send(self, cmd, due):
+        uri = cmd['uri']
+        is_async = cmd.get('async', True)
+        body = simplejson.dumps(cmd.get('body', {}))
+        headers = {'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+        task_uuid = None
+        if is_async:
+            task_uuid = uuid.uuid4().hex
+            headers[http.TASK_UUID] = task_uuid
+            headers[http.CALLBACK_URI] = self.callback_server.url
+
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', self.http_server.port, timeout=self.timeout)
+            conn.request('POST', uri, body, headers)
+            rsp = conn.getresponse()
+            rsp.read()
+            conn.close()
+            if rsp.status != 200:
+                raise Exception('http status %d' % rsp.status)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            return
+
+        now = time.time()
+        if is_async:
+            with self.lock:
+                self.async_sent[task_uuid] = (uri, due, now)
+            self._record(self.acks, uri, now - due)
+        else:
+            self._record(self.latencies, uri, now - due)
+
+    def _sample_threads(self, stop):
+        while not stop.is_set():
+            agent_threads = [t for t in threading.enumerate() if not t.name.startswith(HARNESS_THREAD_PREFIX)]
+            self.thread_samples.append(len(agent_threads))
+            stop.wait(0.1)
+
+    def run(self):
+        pool = thread.ThreadPool(self.concurrency, '%s-client' % HARNESS_THREAD_PREFIX)
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample_threads, args=(stop,), name='%s-sampler' % HARNESS_THREAD_PREFIX)
+        sampler.daemon = True
+        sampler.start()
+
+        start = time.time()
+        futures = []
+        for i in xrange(self.count):
+            due = start + float(i) / self.rate
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(self._send, self.commands[i % len(self.commands)], due))
+        thread.wait_futures(futures, self.timeout)
+        sent = time.time() - start
+
+        with self.lock:
+            async_sent = dict(self.async_sent)
+        arrived = self.callback_server.wait(len(async_sent), self.timeout)
+        duration = time.time() - start
+        stop.set()
+        sampler.join()
+        pool.shutdown(wait=False)
+
+        callback_delays = []
+        for task_uuid, (uri, due, acked) in async_sent.items():
+            at = self.callback_server.arrivals.get(task_uuid)
+            if at is None:
+                continue
+            self._record(self.latencies, uri, at - due)
+            callback_delays.append(at - acked)
+
+        return {
+            'requests': self.count,
+            'rate': self.rate,
+            'send_duration': sent,
+            'duration': duration,
+            'errors': self.errors,
+            'callback_errors': self.callback_server.errors,
+            'missing_callbacks': len(async_sent) - arrived,
+            'latency': dict((uri, percentiles(v)) for uri, v in self.latencies.items()),
+            'ack_latency': dict((uri, percentiles(v)) for uri, v in self.acks.items()),
+            'callback_delay': percentiles(callback_delays),
+            'threads': {
+                'min': min(self.thread_samples) if self.thread_samples else 0,
+                'max': max(self.thread_samples) if self.thread_samples else 0,
+                'avg': sum(self.thread_samples) / float(len(self.thread_samples)) if self.thread_samples else 0,
+            },
+            'poolsize': int(os.getenv('POOLSIZE', '10')),
+        }
+
+
+def format_report(report):
+    def ms(p):
+        if not p:
+            return '-'
+        return 'p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms (%d)' % (
+            p['p50'] * 1000, p['p90'] * 1000, p['p99'] * 1000, p['max'] * 1000, p['count'])
+
+    lines = ['%d requests at %d/s with POOLSIZE=%d, sent in %.1fs, done in %.1fs' % (
+        report['requests'], report['rate'], report['poolsize'], report['send_duration'], report['duration']),
+             'errors: %d, callback errors: %d, missing callbacks: %d' % (
+        report['errors'], report['callback_errors'], report['missing_callbacks']),
+             'agent threads: min %(min)d, max %(max)d, avg %(avg).1f' % report['threads'],
+             'callback delay after ack: %s' % ms(report['callback_delay'])]
+    for uri in sorted(report['latency']):
+        lines.append('%s: %s' % (uri, ms(report['latency'][uri])))
+        if uri in report['ack_latency']:
+            lines.append('%s ack: %s' % (uri, ms(report['ack_latency'][uri])))
+    return '\n'.join(lines)
+
+
+def _kvmagent():
+    install_fake_modules({'libvirt': FakeLibvirt()})
+    from kvmagent import kvmagent
+    service = kvmagent.new_rest_service()
+    service.plugin_rgty.configure_plugins({})
+    service.plugin_rgty.start_plugins()
+    return service.http_server
+
+
+def _cephbackupstorage():
+    from cephbackupstorage import cephagent
+    return cephagent.CephAgent().http_server
+
+
+def _sftpbackupstorage():
+    from sftpbackupstorage import sftpbackupstorage
+    return sftpbackupstorage.SftpBackupStorageAgent().http_server
+
+
+AGENTS = {
+    'kvmagent': _kvmagent,
+    'cephbackupstorage': _cephbackupstorage,
+    'sftpbackupstorage': _sftpbackupstorage,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load test of an agent http server on localhost')
+    parser.add_argument('--agent', help='one of %s' % ', '.join(sorted(AGENTS)))
+    parser.add_argument('--server', help='module:callable returning the HttpServer of another agent')
+    parser.add_argument('--mix', required=True, help='json file of the recorded commands to replay')
+    parser.add_argument('--shell-rules', help='json file of [pattern, stdout, return code, delay] answering shell commands')
+    parser.add_argument('--rate', type=float, default=100, help='commands per second')
+    parser.add_argument('--count', type=int, default=1000, help='commands to send')
+    parser.add_argument('--concurrency', type=int, default=64, help='client connections at most')
+    parser.add_argument('--timeout', type=int, default=120)
+    args = parser.parse_args()
+
+    if args.server:
+        module, fn = args.server.split(':')
+        factory = getattr(importlib.import_module(module), fn)
+    elif args.agent in AGENTS:
+        factory = AGENTS[args.agent]
+    else:
+        parser.error('--agent or --server is required')
+
+    rules = []
+    if args.shell_rules:
+        with open(args.shell_rules) as fd:
+            rules = simplejson.load(fd)
+
+    fake_shell = FakeShell(rules)
+    with fake_shell:
+        test = LoadTest(factory(), load_mix(args.mix), args.rate, args.count, args.concurrency, args.timeout).start()
+        try:
+            print format_report(test.run())
+        finally:
+            test.stop()
+
+    if fake_shell.unmatched:
+        print 'shell commands without a rule, answered with empty output:'
+        for cmd in sorted(fake_shell.unmatched)[:20]:
+            print '    %s' % cmd
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,524 @@
+'''
+
+single pass import of an image stream into a block device image.
+
+The format is sniffed from the first bytes of the stream. A raw or iso
+stream is written as it comes. A qcow2 stream is converted to raw on the
+fly: a data cluster is written to its guest offset as soon as the L2 table
+mapping it has been read, so only allocated clusters are written, with
+sparse writes. Clusters streamed before their mapping is known, which
+images written by qemu-img seldom have, are kept in a local spill file
+until the mapping arrives, up to MAX_SPILL_SIZE.
+'''
+import json
+import struct
+import subprocess
+import sys
+import tempfile
+import zlib
+
+from zstacklib.utils import log
+from zstacklib.utils import shell
+
+logger = log.get_logger(__name__)
+
+# enough to find the iso signature
+SNIFF_LENGTH = 0x9007
+QCOW2_MAGIC = 'QFI\xfb'
+READ_CHUNK_SIZE = 1024 * 1024
+# sparse writes of adjacent clusters are merged up to the rbd object size
+MAX_WRITE_SIZE = 4 * 1024 * 1024
+# a qcow2 image with its tables after its data, like one with the L1 table
+# at the end, would otherwise be kept in the spill file as a whole
+MAX_SPILL_SIZE = 1024 * 1024 * 1024
+
+# of the qcow2 incompatible features only the dirty bit is taken, corrupt
+# images, external data files, zstd compression and extended L2 entries are not
+QCOW2_INCOMPAT_DIRTY = 1 << 0
+QCOW2_OFFSET_MASK = 0x00fffffffffffe00
+QCOW2_COMPRESSED = 1 << 62
+QCOW2_ZERO = 1
+
+
+class ImageImportError(Exception):
+    ''' the stream can not be imported '''
+
+
+def get_image_format(qhdr):
+    if qhdr[:4] == QCOW2_MAGIC:
+        if qhdr[16:20] == '\x00\x00\x00\00':
+            return "qcow2"
+        else:
+            return "derivedQcow2"
+
+    if qhdr[0x8001:0x8006] == 'CD001':
+        return 'iso'
+
+    if qhdr[0x8801:0x8806] == 'CD001':
+        return 'iso'
+
+    if qhdr[0x9001:0x9006] == 'CD001':
+        return 'iso'
+    return "raw"
+
+
+def _is_zero(data):
+    return not data.strip('\0')
+
+
+class FileTarget(object):
+    '''
+    a local file, left sparse where nothing is written
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.bytes_written = 0
+
+    def start(self, size=None):
+        self.fd = open(self.path, 'wb')
+        if size is not None:
+            self.fd.truncate(size)
+
+    def write(self, offset, data):
+        if _is_zero(data):
+            return
+        self.fd.seek(offset)
+        self.fd.write(data)
+        self.bytes_written += len(data)
+
+    def finish(self, size):
+        self.fd.truncate(size)
+        self.fd.close()
+
+    def abort(self):
+        if self.fd:
+            self.fd.close()
+
+
+class RbdTarget(object):
+    '''
+    a new rbd image of `path` (pool/image). A stream of unknown size goes
+    through `rbd import`, which skips zero blocks itself. Sparse writes of
+    an image of known size go as records of `rbd import-diff` to an image
+    created empty. `created` tells whether the image is made by this target,
+    only then it is to be removed when the import fails
+    '''
+    DIFF_HEADER = 'rbd diff v1\n'
+
+    def __init__(self, path):
+        self.path = path
+        self.process = None
+        self.sparse = False
+        self.created = False
+        self.bytes_written = 0
+        self.pos = 0
+        # a run of adjacent sparse writes
+        self.run_offset = 0
+        self.run = []
+        self.run_size = 0
+
+    def start(self, size=None):
+        if size is None:
+            # rbd import refuses an existing image too, but its failure does
+            # not tell whether it has made the image before failing
+            if shell.run('rbd info %s > /dev/null 2>&1' % self.path) == 0:
+                raise ImageImportError('rbd image %s already exists' % self.path)
+            args = ['rbd', 'import', '--no-progress', '--image-format', '2', '-', self.path]
+        else:
+            shell.check_run('rbd create --image-format 2 --size %d %s' % (max(1, (size + 1048575) / 1048576), self.path))
+            args = ['rbd', 'import-diff', '--no-progress', '-', self.path]
+            self.sparse = True
+        self.created = True
+
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        if self.sparse:
+            # the image is created in MB, the size record sets it exactly
+            self.process.stdin.write(self.DIFF_HEADER + 's' + struct.pack('<Q', size))
+
+    def _flush_run(self):
+        if not self.run_size:
+            return
+        self.process.stdin.write('w' + struct.pack('<QQ', self.run_offset, self.run_size))
+        for data in self.run:
+            self.process.stdin.write(data)
+        self.bytes_written += self.run_size
+        self.run = []
+        self.run_size = 0
+
+    def write(self, offset, data):
+        if not self.sparse:
+            if offset != self.pos:
+                raise ImageImportError('rbd import takes a sequential stream, got offset %d at %d' % (offset, self.pos))
+            self.process.stdin.write(data)
+            self.pos += len(data)
+            self.bytes_written += len(data)
+            return
+
+        if _is_zero(data):
+            return
+        if self.run_size and (offset != self.run_offset + self.run_size or self.run_size + len(data) > MAX_WRITE_SIZE):
+            self._flush_run()
+        if not self.run_size:
+            self.run_offset = offset
+        self.run.append(data)
+        self.run_size += len(data)
+
+    def finish(self, size):
+        if self.sparse:
+            self._flush_run()
+            self.process.stdin.write('e')
+        self.process.stdin.close()
+        err = self.process.stderr.read()
+        if self.process.wait() != 0:
+            raise ImageImportError('failed to import %s: %s' % (self.path, err))
+
+    def abort(self):
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+class RawImage(object):
+    def __init__(self, target):
+        self.target = target
+        self.target.start()
+        self.size = 0
+
+    def write(self, data):
+        self.target.write(self.size, data)
+        self.size += len(data)
+
+    def close(self):
+        self.target.finish(self.size)
+
+
+class _CompressedCluster(object):
+    def __init__(self, guest, start, end, clusters):
+        self.guest = guest
+        self.start = start
+        self.end = end
+        # host cluster index -> its bytes, for the clusters the data spans
+        self.pieces = {}
+        self.missing = set(clusters)
+
+
+class Qcow2Image(object):
+    '''
+    converts a qcow2 stream, fed in order by write(), to raw writes of its
+    allocated clusters. Internal snapshots are not converted, the same as
+    `qemu-img convert` does
+    '''
+
+    def __init__(self, target, spill_dir=None, max_spill=MAX_SPILL_SIZE):
+        self.target = target
+        self.spill_dir = spill_dir
+        self.max_spill = max_spill
+        self.spill = None
+        # host clusters in the spill file
+        self.spilled = set()
+        self.pending = []
+        self.pending_size = 0
+        self.cluster = 0
+        self.cluster_size = None
+        self.size = 0
+
+        self.l1_clusters = None
+        self.l1_data = []
+        # host cluster -> index in L1 of the L2 table there
+        self.l2_clusters = {}
+        # host cluster -> guest offsets of the data there
+        self.data_clusters = {}
+        # host cluster -> compressed clusters with data there
+        self.compressed_clusters = {}
+
+    def _parse_header(self, header):
+        if len(header) < 72:
+            raise ImageImportError('qcow2 header is truncated')
+
+        version, backing_file_offset, _, cluster_bits, size, crypt_method, l1_size, l1_table_offset = \
+            struct.unpack('>IQIIQIIQ', header[4:48])
+        if version not in (2, 3):
+            raise ImageImportError('unsupported qcow2 version %d' % version)
+        if backing_file_offset:
+            raise ImageImportError('qcow2 image has backing file')
+        if crypt_method:
+            raise ImageImportError('qcow2 image is encrypted')
+        if cluster_bits < 9 or cluster_bits > 21:
+            raise ImageImportError('invalid qcow2 cluster bits %d' % cluster_bits)
+        if version == 3:
+            incompatible_features, = struct.unpack('>Q', header[72:80])
+            if incompatible_features & ~QCOW2_INCOMPAT_DIRTY:
+                raise ImageImportError('unsupported qcow2 incompatible features 0x%x' % incompatible_features)
+
+        self.cluster_bits = cluster_bits
+        self.cluster_size = 1 << cluster_bits
+        self.size = size
+        self.l2_entries = self.cluster_size / 8
+        self.l1_size = l1_size
+        self.l1_table_offset = l1_table_offset
+        if l1_size:
+            first = l1_table_offset / self.cluster_size
+            self.l1_clusters = (first, (l1_table_offset + l1_size * 8 - 1) / self.cluster_size)
+        self.target.start(size)
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.cluster_size is None:
+            if self.pending_size < 24:
+                return
+            head = ''.join(self.pending)
+            self.pending = [head]
+            cluster_bits, = struct.unpack('>I', head[20:24])
+            if cluster_bits < 9 or cluster_bits > 21:
+                raise ImageImportError('invalid qcow2 cluster bits %d' % cluster_bits)
+            if self.pending_size < 1 << cluster_bits:
+                return
+            self._parse_header(head)
+
+        if self.pending_size < self.cluster_size:
+            return
+        buf = ''.join(self.pending)
+        pos = 0
+        while len(buf) - pos >= self.cluster_size:
+            self._cluster(self.cluster, buf[pos:pos + self.cluster_size])
+            self.cluster += 1
+            pos += self.cluster_size
+        self.pending = [buf[pos:]]
+        self.pending_size = len(buf) - pos
+
+    def _cluster(self, c, data):
+        known = False
+        if self.l1_clusters and self.l1_clusters[0] <= c <= self.l1_clusters[1]:
+            known = True
+            self.l1_data.append(data)
+            if c == self.l1_clusters[1]:
+                self._parse_l1(''.join(self.l1_data))
+        if c in self.l2_clusters:
+            known = True
+            self._parse_l2(self.l2_clusters.pop(c), data)
+        if c in self.data_clusters:
+            known = True
+            for guest in self.data_clusters.pop(c):
+                self._write_guest(guest, data)
+        if c in self.compressed_clusters:
+            known = True
+            for cc in self.compressed_clusters.pop(c):
+                self._add_piece(cc, c, data)
+        if not known and c != 0:
+            self._spill(c, data)
+
+    def _spill(self, c, data):
+        if (len(self.spilled) + 1) * self.cluster_size > self.max_spill:
+            raise ImageImportError('qcow2 image has more than %d bytes of data before the tables mapping it, '
+                                   'convert it by qemu-img first' % self.max_spill)
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(dir=self.spill_dir)
+        self.spill.seek(c * self.cluster_size)
+        self.spill.write(data)
+        self.spilled.add(c)
+
+    def _spilled(self, c):
+        if c not in self.spilled:
+            return None
+        self.spill.seek(c * self.cluster_size)
+        return self.spill.read(self.cluster_size)
+
+    def _parse_l1(self, data):
+        data = data[self.l1_table_offset % self.cluster_size:][:self.l1_size * 8]
+        for i, entry in enumerate(struct.unpack('>%dQ' % (len(data) / 8), data)):
+            offset = entry & QCOW2_OFFSET_MASK
+            if not offset:
+                continue
+            c = offset / self.cluster_size
+            if c < self.cluster:
+                self._past_cluster(c, lambda d, i=i: self._parse_l2(i, d))
+            else:
+                self.l2_clusters[c] = i
+
+    def _past_cluster(self, c, fn):
+        data = self._spilled(c)
+        if data is None:
+            raise ImageImportError('qcow2 cluster at 0x%x is referenced twice or is metadata' % (c * self.cluster_size))
+        fn(data)
+
+    def _parse_l2(self, l1_index, data):
+        for i, entry in enumerate(struct.unpack('>%dQ' % self.l2_entries, data)):
+            if not entry:
+                continue
+            guest = (l1_index * self.l2_entries + i) * self.cluster_size
+            if guest >= self.size:
+                break
+
+            if entry & QCOW2_COMPRESSED:
+                self._add_compressed(guest, entry)
+                continue
+            if entry & QCOW2_ZERO:
+                # the target is new, zeros need no write
+                continue
+            offset = entry & QCOW2_OFFSET_MASK
+            if not offset:
+                continue
+            c = offset / self.cluster_size
+            if c < self.cluster:
+                self._past_cluster(c, lambda d, guest=guest: self._write_guest(guest, d))
+            else:
+                self.data_clusters.setdefault(c, []).append(guest)
+
+    def _add_compressed(self, guest, entry):
+        x = 62 - (self.cluster_bits - 8)
+        start = entry & ((1 << x) - 1)
+        sectors = ((entry >> x) & ((1 << (self.cluster_bits - 8)) - 1)) + 1
+        end = (start / 512 + sectors) * 512
+        clusters = range(start / self.cluster_size, (end - 1) / self.cluster_size + 1)
+        cc = _CompressedCluster(guest, start, end, clusters)
+        for c in clusters:
+            if c < self.cluster:
+                data = self._spilled(c)
+                if data is not None:
+                    self._add_piece(cc, c, data)
+                    continue
+            self.compressed_clusters.setdefault(c, []).append(cc)
+
+    def _add_piece(self, cc, c, data):
+        cc.pieces[c] = data
+        cc.missing.discard(c)
+        if not cc.missing:
+            self._write_compressed(cc)
+
+    def _write_compressed(self, cc):
+        first = min(cc.pieces)
+        data = ''.join(cc.pieces[c] for c in sorted(cc.pieces))
+        data = data[cc.start - first * self.cluster_size:cc.end - first * self.cluster_size]
+        try:
+            raw = zlib.decompressobj(-12).decompress(data, self.cluster_size)
+        except zlib.error as e:
+            raise ImageImportError('bad compressed qcow2 cluster at 0x%x: %s' % (cc.start, e))
+        self._write_guest(cc.guest, raw.ljust(self.cluster_size, '\0'))
+
+    def _write_guest(self, guest, data):
+        self.target.write(guest, data[:self.size - guest])
+
+    def close(self):
+        if self.cluster_size is None:
+            raise ImageImportError('qcow2 stream is truncated')
+        if self.pending_size:
+            self._cluster(self.cluster, ''.join(self.pending))
+            self.cluster += 1
+
+        # compressed data at the end of the file is not padded to a cluster
+        tail = {}
+        for ccs in self.compressed_clusters.values():
+            tail.update((id(cc), cc) for cc in ccs)
+        self.compressed_clusters = {}
+        for cc in tail.values():
+            if not cc.pieces:
+                raise ImageImportError('qcow2 stream ends at 0x%x before all its clusters' % (self.cluster * self.cluster_size))
+            self._write_compressed(cc)
+
+        if self.l1_clusters and self.cluster <= self.l1_clusters[1] or self.l2_clusters or self.data_clusters:
+            raise ImageImportError('qcow2 stream ends at 0x%x before all its clusters' % (self.cluster * self.cluster_size))
+        self.abort()
+        self.target.finish(self.size)
+
+    def abort(self):
+        if self.spill:
+            self.spill.close()
+            self.spill = None
+
+
+class ImageImporter(object):
+    '''
+    a file-like sink of an image stream, written to `target`. `format` is
+    the sniffed format of the stream and `size` the size of the image,
+    once the stream is closed
+    '''
+
+    def __init__(self, target, spill_dir=None, max_spill=MAX_SPILL_SIZE):
+        self.target = target
+        self.spill_dir = spill_dir
+        self.max_spill = max_spill
+        self.format = None
+        self.size = None
+        self.stream_size = 0
+        self.head = []
+        self.image = None
+
+    def _start(self):
+        head = ''.join(self.head)
+        self.head = None
+        self.format = get_image_format(head)
+        if self.format == 'derivedQcow2':
+            raise ImageImportError('qcow2 image has backing file')
+
+        if self.format == 'qcow2':
+            self.image = Qcow2Image(self.target, self.spill_dir, self.max_spill)
+        else:
+            self.image = RawImage(self.target)
+        self.image.write(head)
+
+    def write(self, data):
+        self.stream_size += len(data)
+        if self.image is not None:
+            self.image.write(data)
+            return
+
+        self.head.append(data)
+        if self.stream_size >= SNIFF_LENGTH:
+            self._start()
+
+    def close(self):
+        if self.image is None:
+            self._start()
+        self.image.close()
+        self.size = self.image.size
+
+    def abort(self):
+        if isinstance(self.image, Qcow2Image):
+            self.image.abort()
+        self.target.abort()
+
+    def import_from(self, fd):
+        try:
+            while True:
+                data = fd.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                self.write(data)
+            self.close()
+        except:
+            self.abort()
+            raise
+
+
+def get_import_cmd(target):
+    '''
+    the command importing its stdin to `target`, rbd:pool/image or
+    file:path. It prints a json object of the image format and size
+    '''
+    return '%s -m zstacklib.utils.image_import %s' % (sys.executable, target)
+
+
+def main():
+    if len(sys.argv) != 2 or ':' not in sys.argv[1]:
+        sys.stderr.write('usage: %s rbd:pool/image|file:path < image\n' % sys.argv[0])
+        return 2
+
+    kind, path = sys.argv[1].split(':', 1)
+    target = RbdTarget(path) if kind == 'rbd' else FileTarget(path)
+    importer = ImageImporter(target)
+    try:
+        importer.import_from(sys.stdin)
+    except (ImageImportError, IOError, OSError, shell.ShellError) as e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+
+    print json.dumps({'format': importer.format, 'size': importer.size, 'streamSize': importer.stream_size,
+                      'bytesWritten': target.bytes_written})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
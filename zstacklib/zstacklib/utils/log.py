@@ -6,6 +6,7 @@ import logging
 import sys
 import os.path
 import gzip
+import re
 import shutil
 
 import simplejson
@@ -204,3 +205,134 @@ def mask_sensitive_field(cmd, cmd_str):
             del obj[SENSITIVE_FIELD_NAME]
 
     return simplejson.dumps(obj)
+
+
+# the most bytes of a payload written in one record
+MAX_PAYLOAD_SIZE = 64 * 1024
+MASKED_VALUE = '"*****"'
+
+class Lazy(object):
+    '''
+    a log argument computed by fn(*args) when the record is emitted, so
+    nothing is built for a filtered out level:
+
+        logger.debug('vm xml: %s', log.payload(xml))
+    '''
+    __slots__ = ('fn', 'args')
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        ret = self.fn(*self.args)
+        if isinstance(ret, unicode):
+            return ret.encode('utf-8')
+        return str(ret)
+
+def cap_payload(text, limit=MAX_PAYLOAD_SIZE):
+    if text is None:
+        return 'None'
+    if limit and len(text) > limit:
+        return '%s...(%d more bytes)' % (text[:limit], len(text) - limit)
+    return text
+
+def payload(text, limit=MAX_PAYLOAD_SIZE):
+    return Lazy(cap_payload, text, limit)
+
+def masked(cmd, body, limit=MAX_PAYLOAD_SIZE):
+    '''
+    the json `body` of `cmd` with its sensitive fields masked, rendered when
+    the record is emitted
+    '''
+    return Lazy(mask_json, body, get_sensitive_paths(cmd), limit)
+
+_SENSITIVE_PATH_KEY = re.compile(r"\['(.*?)'\]")
+
+def get_sensitive_paths(cmd):
+    if not cmd or not hasattr(cmd, SENSITIVE_FIELD_NAME):
+        return None
+    return set(tuple(_SENSITIVE_PATH_KEY.findall(p)) for p in getattr(cmd, SENSITIVE_FIELD_NAME))
+
+# a key with its colon, or the end of the object
+_JSON_KEY = re.compile(r'("[^"\\]*(?:\\.[^"\\]*)*")\s*:|\}')
+_JSON_WHITESPACE = re.compile(r'\s*')
+_JSON_COMMA = re.compile(r'\s*,')
+_JSON_DECODER = simplejson.JSONDecoder()
+
+def _json_key(token):
+    if '\\' not in token:
+        return token[1:-1]
+    return simplejson.loads(token)
+
+def mask_json(text, paths, limit=MAX_PAYLOAD_SIZE):
+    '''
+    mask the values at `paths` of the json `text` and drop its top level
+    SENSITIVE_FIELDS, like mask_sensitive_field() does, in one pass which
+    stops at `limit`. Only the objects on the way to a sensitive path are
+    walked, the other values are skipped by the C scanner of simplejson, and
+    the text is kept as it is apart from the masked values
+    '''
+    if text is None or not paths:
+        return cap_payload(text, limit)
+    leaves = set('"%s"' % p[-1] for p in paths)
+    if '"%s"' % SENSITIVE_FIELD_NAME not in text and not any(l in text for l in leaves):
+        return cap_payload(text, limit)
+
+    pos = _JSON_WHITESPACE.match(text).end()
+    if not text.startswith('{', pos):
+        return cap_payload(text, limit)
+
+    prefixes = set(p[:i] for p in paths for i in xrange(1, len(p)))
+    # (start, end, replacement) of the text
+    edits = []
+    # paths of the objects being walked
+    objects = [()]
+    pos += 1
+    end = len(text)
+    try:
+        while objects:
+            if limit and pos > limit:
+                end = limit
+                break
+
+            m = _JSON_KEY.search(text, pos)
+            if not m:
+                break
+            if not m.group(1):
+                objects.pop()
+                pos = m.end()
+                continue
+
+            path = objects[-1] + (_json_key(m.group(1)),)
+            value_start = _JSON_WHITESPACE.match(text, m.end()).end()
+            if path in prefixes and text.startswith('{', value_start):
+                objects.append(path)
+                pos = value_start + 1
+                continue
+
+            value, pos = _JSON_DECODER.raw_decode(text, value_start)
+            if path == (SENSITIVE_FIELD_NAME,):
+                # drop the pair with one of the commas around it
+                before = text[:m.start()].rstrip()
+                if before.endswith(','):
+                    edits.append((len(before) - 1, pos, ''))
+                else:
+                    comma = _JSON_COMMA.match(text, pos)
+                    edits.append((m.start(), comma.end() if comma else pos, ''))
+            elif path in paths and value:
+                edits.append((value_start, pos, MASKED_VALUE))
+    except ValueError:
+        return '(%d bytes of invalid json with sensitive fields, not logged)' % len(text)
+
+    out = []
+    pos = 0
+    for start, stop, replacement in edits:
+        out.append(text[pos:start])
+        out.append(replacement)
+        pos = stop
+    end = max(end, pos)
+    out.append(text[pos:end])
+    if end < len(text):
+        out.append('...(%d more bytes)' % (len(text) - end))
+    return ''.join(out)
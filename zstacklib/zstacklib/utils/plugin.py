@@ -17,7 +17,7 @@ import ConfigParser
 
 import time
 
-from zstacklib.utils import jsonobject, http
+from zstacklib.utils import jsonobject, http, thread
 from zstacklib.utils.report import get_api_id, AutoReporter
 
 PLUGIN_CONFIG_SECTION_NAME = 'plugins'
@@ -70,7 +70,7 @@ class TaskDaemon(object):
         self.task_name = task_name
         self.timeout = timeout
         self.progress_reporter = AutoReporter.from_spec(task_spec, task_name, self._get_percent) if report_progress else None
-        self.cancel_thread = threading.Timer(timeout, self._timeout_cancel) if timeout > 0 else None
+        self.cancel_timer = None
         self.closed = False
 
     def __enter__(self):
@@ -87,8 +87,8 @@ class TaskDaemon(object):
         if self.api_id:
             TaskManager.add_task(self.api_id, self)
 
-        if self.cancel_thread:
-            self.cancel_thread.start()
+        if self.timeout > 0:
+            self.cancel_timer = thread.get_timer_wheel().schedule(self.timeout, self._timeout_cancel)
 
         if self.progress_reporter:
             self.progress_reporter.start()
@@ -103,8 +103,8 @@ class TaskDaemon(object):
         if self.progress_reporter:
             self.progress_reporter.close()
 
-        if self.cancel_thread:
-            self.cancel_thread.cancel()
+        if self.cancel_timer:
+            self.cancel_timer.cancel()
 
         self.closed = True
 
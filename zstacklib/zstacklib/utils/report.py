@@ -104,23 +104,30 @@ class AutoReporter(object):
         self.progress_getter = progress_getter
         self.over = False
         self.timeout = timeout
+        self.timer = None
 
     @staticmethod
     def from_spec(spec, progress_type, progress_getter):
         report = Report.from_spec(spec, progress_type)
         return AutoReporter(report, progress_getter)
 
-    @thread.AsyncThread
     def start(self):
-        def report(_):
-            if self.over:
-                return True
+        deadline = time.time() + self.timeout
+
+        def report():
+            if self.over or time.time() > deadline:
+                return False
 
             percent = self.progress_getter()
             if percent and str(percent).isdigit():
                 self.report.progress_report(str(percent), "report")
+            return True
 
-        linux.wait_callback_success(report, callback_data=None, timeout=self.timeout)
+        # progress getters like libvirt's jobStats() and the report may block
+        # for long, they must not hold the workers cancel timers run on
+        self.timer = thread.timer(1, report, wheel=thread.get_blocking_timer_wheel()).start(delay=0)
 
     def close(self):
         self.over = True
+        if self.timer:
+            self.timer.cancel()
@@ -3,7 +3,11 @@
 @author: frank
 '''
 
+import Queue
+import math
+import os
 import threading
+import time
 import inspect
 import pprint
 import traceback
@@ -38,11 +42,19 @@ class ThreadFacade(object):
         return t
 
 class PeriodicTimer(object):
-    def __init__(self, interval, callback, args=[], kwargs={}, stop_on_exception=True):
+    '''
+    calls `callback` every `interval` seconds for as long as it returns a
+    true value. Ticks are scheduled on the process timer wheel and run in its
+    executor, no thread is created per tick
+    '''
+    def __init__(self, interval, callback, args=[], kwargs={}, stop_on_exception=True, wheel=None):
         self.interval = interval
         self.args = args
         self.kwargs = kwargs
         self.stop_on_exception = stop_on_exception
+        self.wheel = wheel
+        self.handle = None
+        self.cancelled = False
 
         @functools.wraps(callback)
         def wrapper(*args, **kwargs):
@@ -53,24 +65,31 @@ class PeriodicTimer(object):
                 content = traceback.format_exc()
                 err = '%s\n%s\nargs:%s' % (str(e), content, pprint.pformat([args, kwargs]))
                 logger.warn(err)
-                logger.warn('this timer thread will be terminated immediately due to the exception')
-                
-            if result:
-                self.thread = threading.Timer(self.interval, self.callback, self.args, self.kwargs)
-                self.thread.start()
+                logger.warn('this timer will be terminated immediately due to the exception')
+
+            if result and not self.cancelled:
+                self._schedule(self.interval)
 
         self.callback = wrapper
 
-    @AsyncThread
-    def start(self):
-        self.thread = threading.Timer(self.interval, self.callback, self.args, self.kwargs)
-        self.thread.start()
+    def _schedule(self, delay):
+        wheel = self.wheel or get_timer_wheel()
+        self.handle = wheel.schedule(delay, self.callback, self.args, self.kwargs)
+
+    def start(self, delay=None):
+        '''
+        the first tick is after `delay` seconds, `interval` by default
+        '''
+        self._schedule(self.interval if delay is None else delay)
+        return self
 
     def cancel(self):
-        self.thread.cancel()
-        
-def timer(interval, function, args=[], kwargs={}, stop_on_exception=True):
-    return PeriodicTimer(interval, function, args, kwargs, stop_on_exception)
+        self.cancelled = True
+        if self.handle:
+            self.handle.cancel()
+
+def timer(interval, function, args=[], kwargs={}, stop_on_exception=True, wheel=None):
+    return PeriodicTimer(interval, function, args, kwargs, stop_on_exception, wheel)
 
 class AtomicInteger(object):
     def __init__(self, value=0):
@@ -90,3 +109,372 @@ class AtomicInteger(object):
     def get(self):
         with self._lock:
             return self._value
+
+class Future(object):
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for cb in callbacks:
+            cb(self)
+
+    def add_done_callback(self, cb):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(cb)
+                return
+        cb(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError('future is not done in %s seconds' % timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError('future is not done in %s seconds' % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+class TimeoutError(Exception):
+    pass
+
+def wait_futures(futures, timeout=None):
+    '''
+    wait until all futures are done, return (done, not_done)
+    '''
+    deadline = None if timeout is None else time.time() + timeout
+    for f in futures:
+        if deadline is None:
+            f.wait()
+        else:
+            f.wait(max(0, deadline - time.time()))
+
+    done = [f for f in futures if f.done()]
+    not_done = [f for f in futures if not f.done()]
+    return done, not_done
+
+class ThreadPool(object):
+    '''
+    a fixed number of worker threads consuming a task queue. submit() blocks
+    once max_queue tasks are waiting, so producers can not run ahead unbounded.
+    '''
+
+    def __init__(self, max_workers, name='pool', max_queue=0):
+        self.max_workers = max_workers
+        self.name = name
+        self._queue = Queue.Queue(max_queue)
+        self._workers = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def _spawn_worker_if_needed(self):
+        with self._lock:
+            if len(self._workers) >= self.max_workers:
+                return
+
+            t = threading.Thread(target=self._work, name='%s-%d' % (self.name, len(self._workers)))
+            t.daemon = True
+            self._workers.append(t)
+            t.start()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+
+            future, fn, args, kwargs = task
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                logger.warn('%s\n%s' % (str(e), traceback.format_exc()))
+                future.set_exception(e)
+
+    def submit(self, fn, *args, **kwargs):
+        if self._shutdown:
+            raise Exception('thread pool[%s] has been shutdown' % self.name)
+
+        future = Future()
+        self._spawn_worker_if_needed()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def map(self, fn, iterable, timeout=None):
+        futures = [self.submit(fn, i) for i in iterable]
+        return [f.result(timeout) for f in futures]
+
+    def shutdown(self, wait=True):
+        self._shutdown = True
+        with self._lock:
+            workers = list(self._workers)
+        for _ in workers:
+            self._queue.put(None)
+        if wait:
+            for t in workers:
+                t.join()
+
+
+class ThreadPerTaskExecutor(object):
+    '''
+    run every task in a thread of its own, for tasks which may block for
+    good, like i/o on a hung nfs mount, and must not hold a pool worker
+    '''
+
+    def __init__(self, name='task'):
+        self.name = name
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                logger.warn('%s\n%s' % (str(e), traceback.format_exc()))
+                future.set_exception(e)
+
+        t = threading.Thread(target=run, name=self.name)
+        t.daemon = True
+        t.start()
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class TimerHandle(object):
+    __slots__ = ('deadline', 'expire_tick', 'seq', 'fn', 'args', 'kwargs', 'cancelled', 'wheel', 'bucket', 'level')
+
+    def __init__(self, wheel, deadline, expire_tick, seq, fn, args, kwargs):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.expire_tick = expire_tick
+        self.seq = seq
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.bucket = None
+        self.level = None
+
+    def cancel(self):
+        self.wheel._cancel(self)
+
+class TimerWheel(object):
+    '''
+    a hierarchical timer wheel driven by one thread. Level 0 has a slot per
+    `tick` seconds, every upper level a slot per turn of the level below;
+    timers move down a level when their slot comes up, so scheduling and
+    cancelling are O(1) whatever the number of timers. Due timers are run in
+    `executor`, or inline by advance() when there is none.
+    '''
+
+    def __init__(self, tick=0.01, wheel_bits=8, levels=4, clock=time.time, executor=None):
+        self.tick = tick
+        self.bits = wheel_bits
+        self.size = 1 << wheel_bits
+        self.mask = self.size - 1
+        self.levels = levels
+        self.clock = clock
+        self.executor = executor
+        self.wheels = [[set() for _ in xrange(self.size)] for _ in xrange(levels)]
+        # timers on each level, to skip the turns of empty levels
+        self.counts = [0] * levels
+        self.current_tick = int(clock() / tick)
+        self.pending = 0
+        self._seq = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._wake_tick = None
+        self._thread = None
+        self._stopped = False
+        self._pid = os.getpid()
+
+    def _add(self, h):
+        diff = h.expire_tick - self.current_tick
+        expire_tick = h.expire_tick
+        for level in xrange(self.levels):
+            if diff < 1 << (self.bits * (level + 1)):
+                break
+        else:
+            # beyond the top level, parked at its far end and placed again
+            # when it comes down
+            expire_tick = self.current_tick + (1 << (self.bits * self.levels)) - 1
+
+        h.bucket = self.wheels[level][(expire_tick >> (self.bits * level)) & self.mask]
+        h.bucket.add(h)
+        h.level = level
+        self.counts[level] += 1
+
+    def schedule(self, delay, fn, args=(), kwargs=None):
+        '''
+        call fn(*args, **kwargs) after `delay` seconds, return a handle to
+        cancel() it
+        '''
+        deadline = self.clock() + delay
+        with self._cond:
+            self._seq += 1
+            expire_tick = max(self.current_tick + 1, int(math.ceil(deadline / self.tick)))
+            h = TimerHandle(self, deadline, expire_tick, self._seq, fn, args, kwargs or {})
+            self._add(h)
+            self.pending += 1
+            if self._thread and (self._wake_tick is None or expire_tick < self._wake_tick):
+                self._cond.notify()
+        return h
+
+    def _cancel(self, h):
+        with self._cond:
+            h.cancelled = True
+            if h.bucket is not None:
+                h.bucket.discard(h)
+                h.bucket = None
+                self.counts[h.level] -= 1
+                self.pending -= 1
+
+    def _expire(self, now):
+        due = []
+        target = int(now / self.tick)
+        if self.pending == 0:
+            self.current_tick = max(self.current_tick, target)
+            return due
+
+        while self.current_tick < target:
+            # nothing happens before the lowest level holding timers turns
+            for level in xrange(self.levels):
+                if self.counts[level]:
+                    break
+            if level > 0:
+                span = 1 << (self.bits * level)
+                self.current_tick = min(target, (self.current_tick | (span - 1)) + 1) - 1
+
+            self.current_tick += 1
+            t = self.current_tick
+            for level in xrange(1, self.levels):
+                if t & ((1 << (self.bits * level)) - 1):
+                    break
+                idx = (t >> (self.bits * level)) & self.mask
+                bucket = self.wheels[level][idx]
+                if bucket:
+                    self.wheels[level][idx] = set()
+                    self.counts[level] -= len(bucket)
+                    for h in bucket:
+                        self._add(h)
+
+            bucket = self.wheels[0][t & self.mask]
+            if bucket:
+                self.wheels[0][t & self.mask] = set()
+                for h in bucket:
+                    h.bucket = None
+                self.counts[0] -= len(bucket)
+                self.pending -= len(bucket)
+                due.extend(sorted(bucket, key=lambda h: (h.deadline, h.seq)))
+        return due
+
+    def advance(self, now=None):
+        '''
+        run the timers due by `now`, in the order of their deadlines
+        '''
+        with self._cond:
+            due = self._expire(self.clock() if now is None else now)
+
+        for h in due:
+            if h.cancelled:
+                continue
+            if self.executor:
+                self.executor.submit(h.fn, *h.args, **h.kwargs)
+                continue
+            try:
+                h.fn(*h.args, **h.kwargs)
+            except Exception as e:
+                logger.warn('%s\n%s' % (str(e), traceback.format_exc()))
+        return len(due)
+
+    def _next_wake_tick(self):
+        if self.pending == 0:
+            return None
+
+        # the next due slot of level 0, or the end of its turn, when the
+        # upper levels are to be cascaded
+        for i in xrange(1, self.size + 1):
+            t = self.current_tick + i
+            if self.wheels[0][t & self.mask] or t & self.mask == 0:
+                return t
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                self._wake_tick = self._next_wake_tick()
+                timeout = None if self._wake_tick is None else self._wake_tick * self.tick - self.clock()
+                if timeout is None or timeout > 0:
+                    self._cond.wait(timeout)
+                self._wake_tick = None
+            self.advance()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='timer-wheel')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+TIMER_WHEEL_WORKERS = 16
+_timer_wheel = None
+_timer_wheel_lock = threading.Lock()
+
+def get_timer_wheel():
+    '''
+    the timer wheel of this process, its thread does not survive fork() so a
+    forked child gets its own
+    '''
+    global _timer_wheel
+    with _timer_wheel_lock:
+        if _timer_wheel is None or _timer_wheel._pid != os.getpid():
+            _timer_wheel = TimerWheel(executor=ThreadPool(TIMER_WHEEL_WORKERS, 'timer')).start()
+        return _timer_wheel
+
+_blocking_timer_wheel = None
+
+def get_blocking_timer_wheel():
+    '''
+    the timer wheel of this process for timers that may block without end,
+    such as probes of network filesystems. Each due timer runs in a thread
+    of its own, a hung probe can not starve the workers of get_timer_wheel()
+    '''
+    global _blocking_timer_wheel
+    with _timer_wheel_lock:
+        if _blocking_timer_wheel is None or _blocking_timer_wheel._pid != os.getpid():
+            _blocking_timer_wheel = TimerWheel(tick=0.1, executor=ThreadPerTaskExecutor('blocking-timer')).start()
+        return _blocking_timer_wheel
@@ -0,0 +1,268 @@
+'''
+
+copy a directory tree reading the source once: the source stream is hashed
+while it is read into a manifest, and every destination file is read back
+and checked against it as soon as it is complete. Owner, group, mode and
+times are kept as `rsync -a` kept them.
+'''
+
+import errno
+import hashlib
+import os
+import shutil
+import stat
+import threading
+
+from zstacklib.utils import log
+from zstacklib.utils import thread
+
+logger = log.get_logger(__name__)
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_PARALLEL = 4
+# report progress at most once per this many bytes
+PROGRESS_GRANULARITY = 64 * 1024 * 1024
+
+
+class ChecksumMismatchError(Exception):
+    def __init__(self, mismatches):
+        super(ChecksumMismatchError, self).__init__(
+            'checksum mismatch on %d file(s): %s' % (len(mismatches), ', '.join(sorted(mismatches))))
+        self.mismatches = mismatches
+
+
+class CopyCancelledError(Exception):
+    '''the copy is cancelled'''
+
+
+def _is_excluded(rel_path, excludes):
+    for e in excludes:
+        if rel_path == e or rel_path.startswith(e + '/'):
+            return True
+    return False
+
+
+def _normalize_excludes(excludes):
+    # exclude paths must be relative to the source folder
+    return [e.strip('/') for e in excludes or [] if e.strip('/')]
+
+
+class Manifest(object):
+    '''
+    per-file checksums of the source side, saved in `md5sum -c` format
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if self.path:
+            open(self.path, 'w').close()
+
+    def record(self, rel_path, size, md5):
+        with self._lock:
+            self.entries[rel_path] = (size, md5)
+            if self.path:
+                with open(self.path, 'a') as fd:
+                    fd.write('%s  %s\n' % (md5, rel_path))
+
+    def get(self, rel_path):
+        with self._lock:
+            return self.entries.get(rel_path)
+
+
+class _SparseWriter(object):
+    '''
+    destination side of a single file, skip the all-zero chunks so sparse
+    volumes stay sparse
+    '''
+
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.fd = open(path, 'wb')
+        self.size = 0
+        self.zero = '\0' * chunk_size
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if len(chunk) <= len(self.zero) and chunk == self.zero[:len(chunk)]:
+            self.fd.seek(len(chunk), os.SEEK_CUR)
+        else:
+            self.fd.write(chunk)
+
+    def close(self):
+        self.fd.truncate(self.size)
+        self.fd.close()
+
+
+def _read_back(path, chunk_size):
+    size = 0
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fd:
+        while True:
+            chunk = fd.read(chunk_size)
+            if not chunk:
+                return size, md5.hexdigest()
+            size += len(chunk)
+            md5.update(chunk)
+
+
+def _copy_owner(st, dst_path):
+    try:
+        os.lchown(dst_path, st.st_uid, st.st_gid)
+    except OSError as e:
+        # as rsync, only root keeps the owner
+        if e.errno != errno.EPERM:
+            raise
+
+
+class VerifiedCopier(object):
+    '''
+    copy src folder to dst folder with up to `parallel` files in flight.
+
+    `progress` is called with (copied_bytes, total_bytes). `transfer` is
+    applied to every chunk between the reader and the writer, it stands for
+    the transport and is where tests inject corruption. `cancel()` stops the
+    copy from another thread, copy() raises CopyCancelledError then.
+    '''
+
+    def __init__(self, src, dst, excludes=None, parallel=DEFAULT_PARALLEL, chunk_size=DEFAULT_CHUNK_SIZE,
+                 manifest_path=None, progress=None, transfer=None):
+        self.src = src.rstrip('/')
+        self.dst = dst.rstrip('/')
+        self.excludes = _normalize_excludes(excludes)
+        self.parallel = max(1, parallel)
+        self.chunk_size = chunk_size
+        self.manifest = Manifest(manifest_path)
+        self.progress = progress
+        self.transfer = transfer
+        self.total_size = 0
+        self.copied_size = 0
+        self._reported_size = 0
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._files = None
+        self._dirs = None
+        self._links = None
+
+    def plan(self):
+        '''
+        walk the source folder once, return the total bytes to copy
+        '''
+        self._files = []
+        self._dirs = []
+        self._links = []
+        self.total_size = 0
+
+        for root, dirs, files in os.walk(self.src):
+            rel_root = os.path.relpath(root, self.src)
+            rel_root = '' if rel_root == '.' else rel_root
+
+            for d in list(dirs):
+                rel = os.path.join(rel_root, d)
+                if _is_excluded(rel, self.excludes):
+                    dirs.remove(d)
+                elif os.path.islink(os.path.join(root, d)):
+                    self._links.append(rel)
+                else:
+                    self._dirs.append(rel)
+
+            for f in files:
+                rel = os.path.join(rel_root, f)
+                if _is_excluded(rel, self.excludes):
+                    continue
+
+                st = os.lstat(os.path.join(root, f))
+                if stat.S_ISLNK(st.st_mode):
+                    self._links.append(rel)
+                elif stat.S_ISREG(st.st_mode):
+                    self._files.append((rel, st.st_size))
+                    self.total_size += st.st_size
+
+        # start the largest files first so they do not end up as the tail
+        self._files.sort(key=lambda f: f[1], reverse=True)
+        return self.total_size
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _add_progress(self, n):
+        with self._lock:
+            self.copied_size += n
+            if self.progress is None:
+                return
+            if self.copied_size - self._reported_size < PROGRESS_GRANULARITY and self.copied_size != self.total_size:
+                return
+            self._reported_size = self.copied_size
+            copied = self.copied_size
+
+        self.progress(copied, self.total_size)
+
+    def _copy_file(self, rel_path):
+        src_path = os.path.join(self.src, rel_path)
+        dst_path = os.path.join(self.dst, rel_path)
+        src_md5 = hashlib.md5()
+        size = 0
+
+        writer = _SparseWriter(dst_path, self.chunk_size)
+        try:
+            with open(src_path, 'rb') as fd:
+                while True:
+                    if self._cancelled.is_set():
+                        raise CopyCancelledError('copy from %s to %s is cancelled' % (self.src, self.dst))
+
+                    chunk = fd.read(self.chunk_size)
+                    if not chunk:
+                        break
+
+                    src_md5.update(chunk)
+                    size += len(chunk)
+                    writer.write(self.transfer(chunk) if self.transfer else chunk)
+                    self._add_progress(len(chunk))
+        finally:
+            writer.close()
+
+        self.manifest.record(rel_path, size, src_md5.hexdigest())
+        _copy_owner(os.stat(src_path), dst_path)
+        shutil.copystat(src_path, dst_path)
+        return _read_back(dst_path, self.chunk_size) == self.manifest.get(rel_path)
+
+    def copy(self):
+        '''
+        raise ChecksumMismatchError after all files are copied if any
+        destination file does not read back as its source checksum
+        '''
+        if self._files is None:
+            self.plan()
+
+        if not os.path.isdir(self.dst):
+            os.makedirs(self.dst)
+        for d in self._dirs:
+            p = os.path.join(self.dst, d)
+            if not os.path.isdir(p):
+                os.makedirs(p)
+        for l in self._links:
+            p = os.path.join(self.dst, l)
+            if os.path.lexists(p):
+                os.remove(p)
+            os.symlink(os.readlink(os.path.join(self.src, l)), p)
+            _copy_owner(os.lstat(os.path.join(self.src, l)), p)
+
+        pool = thread.ThreadPool(self.parallel, 'verified-copy')
+        try:
+            futures = [(rel, pool.submit(self._copy_file, rel)) for rel, _ in self._files]
+            mismatches = [rel for rel, f in futures if not f.result()]
+        finally:
+            pool.shutdown()
+
+        # directory mtimes are changed by creating their children, so copy them at last
+        for d in reversed(self._dirs):
+            _copy_owner(os.stat(os.path.join(self.src, d)), os.path.join(self.dst, d))
+            shutil.copystat(os.path.join(self.src, d), os.path.join(self.dst, d))
+
+        if mismatches:
+            raise ChecksumMismatchError(mismatches)
+
+        logger.debug('copied %d files, %d bytes from %s to %s' %
+                     (len(self._files), self.total_size, self.src, self.dst))
+        return self.manifest
@@ -0,0 +1,137 @@
+'''
+
+compiled xml templates.
+
+A document is built once with ElementTree, with the values which differ
+from one use to the next replaced by slot() markers and the subtrees which
+have to be built each time replaced by add_section() placeholders. The
+serialized document is compiled into a Template, which renders the same
+bytes ElementTree would have written for the real values, without building
+or serializing the whole tree again.
+'''
+import re
+import threading
+import xml.etree.ElementTree as etree
+
+SLOT_MARK = '@@xml-slot-%s@@'
+SECTION_TAG = 'xml-section.%s'
+
+_PLACEHOLDER = re.compile(r'@@xml-slot-(\w+)@@|<xml-section\.(\w+) />')
+
+
+def slot(name):
+    return SLOT_MARK % name
+
+
+def add_section(parent, name):
+    etree.SubElement(parent, SECTION_TAG % name)
+
+
+# the same escaping ElementTree applies when serializing, so rendered values
+# are byte-equivalent to etree.tostring()
+def escape_attrib(text, encoding='us-ascii'):
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    if "\"" in text:
+        text = text.replace("\"", "&quot;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    return text.encode(encoding, "xmlcharrefreplace")
+
+
+def escape_cdata(text, encoding='us-ascii'):
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text.encode(encoding, "xmlcharrefreplace")
+
+
+def serialize_children(element):
+    '''
+    the serialized children of `element`, as they are written inside their
+    parent. Children must not use namespaces, their declarations go to the
+    document root
+    '''
+    return ''.join(etree.tostring(c) for c in element)
+
+
+class Template(object):
+    '''
+    a serialized document split into literal text, slots and sections
+    '''
+
+    def __init__(self, xml):
+        self.parts = []
+        self.slots = set()
+        # in document order, which is the order they are to be built in
+        self.sections = []
+
+        pos = 0
+        for m in _PLACEHOLDER.finditer(xml):
+            self.parts.append(xml[pos:m.start()])
+            if m.group(1):
+                name = m.group(1)
+                # inside a start tag the value is an attribute
+                in_tag = xml.rfind('<', 0, m.start()) > xml.rfind('>', 0, m.start())
+                self.parts.append((escape_attrib if in_tag else escape_cdata, name))
+                self.slots.add(name)
+            else:
+                self.parts.append((None, m.group(2)))
+                self.sections.append(m.group(2))
+            pos = m.end()
+        self.parts.append(xml[pos:])
+
+    def render(self, values, sections=None):
+        '''
+        `values` are strings by slot name, `sections` are serialized
+        subtrees by section name, see serialize_children()
+        '''
+        ret = []
+        for p in self.parts:
+            if isinstance(p, tuple):
+                escape, name = p
+                ret.append(sections[name] if escape is None else escape(values[name]))
+            else:
+                ret.append(p)
+        return ''.join(ret)
+
+
+class TemplateCache(object):
+    '''
+    templates by the key of the document shape, compiled by `compile_fn` on
+    first use. The cache is dropped when it grows to `max_entries`, shapes
+    come from a small set in practice
+    '''
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.templates = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compile_fn):
+        with self.lock:
+            t = self.templates.get(key)
+            if t is not None:
+                self.hits += 1
+                return t
+
+        t = Template(compile_fn())
+        with self.lock:
+            self.misses += 1
+            if len(self.templates) >= self.max_entries:
+                self.templates.clear()
+            self.templates[key] = t
+        return t
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()